@@ -0,0 +1,219 @@
+"""
+Ingestão em streaming do banco de codificação
+- xlsx: openpyxl em modo somente leitura (linha a linha)
+- csv: leitura em blocos (pandas chunksize)
+- parquet: grupos de linhas, coluna por coluna (cada coluna fica pronta antes do fim do arquivo)
+- Cada coluna é gravada em um arquivo de spool em disco, com estatística de valores únicos,
+  de forma que a memória não cresce com o número de linhas do banco
+"""
+
+import json
+import math
+import os
+import shutil
+import tempfile
+from collections import Counter
+from typing import Any, Iterator, List, Optional
+
+import pandas as pd
+
+# Extensões aceitas para o banco
+SUPPORTED_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.parquet')
+
+CSV_CHUNK_ROWS = int(os.getenv('BANCO_CSV_CHUNK_ROWS', 50_000))
+
+
+def _coerce(value: Any) -> Any:
+    """Converte valores lidos para os mesmos tipos que o pandas produziria (vazio -> NaN)"""
+    if value is None:
+        return float('nan')
+    if isinstance(value, float) and math.isnan(value):
+        return value
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        return value
+    if hasattr(value, 'item'):  # escalares numpy/pyarrow
+        return _coerce(value.item())
+    return str(value)
+
+
+def _parse_csv_value(value: Any) -> Any:
+    """CSV chega como texto: vazio -> NaN, números -> int/float, demais valores ficam como texto"""
+    if not isinstance(value, str):
+        return value
+    stripped = value.strip()
+    if not stripped:
+        return float('nan')
+    try:
+        return int(stripped)
+    except ValueError:
+        try:
+            return float(stripped)
+        except ValueError:
+            return value
+
+
+def _header_names(raw_names: List[Any]) -> List[str]:
+    """Nomes de coluna como o pandas gera (vazios -> 'Unnamed: i', duplicados -> 'nome.1')"""
+    names = []
+    seen = Counter()
+    for i, raw in enumerate(raw_names):
+        name = f"Unnamed: {i}" if raw is None or str(raw).strip() == '' else str(raw)
+        if seen[name]:
+            candidate = f"{name}.{seen[name]}"
+            while candidate in seen:
+                seen[name] += 1
+                candidate = f"{name}.{seen[name]}"
+            seen[name] += 1
+            name = candidate
+        seen[name] += 1
+        names.append(name)
+    return names
+
+
+class ColumnSpool:
+    """Valores de uma coluna gravados em disco (JSON por linha) + contagem de valores únicos"""
+
+    def __init__(self, index: int, name: str, spool_dir: str):
+        self.index = index
+        self.name = name
+        self.path = os.path.join(spool_dir, f"col_{index:04d}.jsonl")
+        self.row_count = 0
+        # resposta (texto normalizado por strip) -> frequência; limitado ao número de valores únicos
+        self.value_counts: Counter = Counter()
+        self._file = open(self.path, 'w', encoding='utf-8')
+
+    def append(self, value: Any):
+        value = _coerce(value)
+        is_nan = isinstance(value, float) and math.isnan(value)
+        self._file.write(json.dumps(None if is_nan else value, ensure_ascii=False))
+        self._file.write('\n')
+        self.row_count += 1
+        if not is_nan:
+            self.value_counts[str(value).strip()] += 1
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    @property
+    def unique_count(self) -> int:
+        return len(self.value_counts)
+
+    def iter_values(self) -> Iterator[Any]:
+        """Relê a coluna do disco (None volta como NaN, como no DataFrame)"""
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                value = json.loads(line)
+                yield float('nan') if value is None else value
+
+    def values(self) -> List[Any]:
+        return list(self.iter_values())
+
+    def cleanup(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class BancoReader:
+    """Leitor em streaming do banco: produz uma ColumnSpool por coluna assim que ela fica completa"""
+
+    def __init__(self, path: str, spool_dir: Optional[str] = None):
+        self.path = path
+        self.extension = os.path.splitext(path)[1].lower()
+        if self.extension not in SUPPORTED_EXTENSIONS:
+            raise Exception(f"Formato de banco não suportado: {self.extension}. Use {', '.join(SUPPORTED_EXTENSIONS)}")
+        # Diretório dedicado a este leitor (removido inteiro no cleanup)
+        self.spool_dir = spool_dir or tempfile.mkdtemp(prefix='ipo_banco_')
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self._columns: Optional[List[str]] = None
+
+    @property
+    def columns(self) -> List[str]:
+        """Nomes das colunas (lê apenas o cabeçalho)"""
+        if self._columns is None:
+            if self.extension == '.xlsx':
+                from openpyxl import load_workbook
+                wb = load_workbook(self.path, read_only=True, data_only=True)
+                try:
+                    header = next(wb.worksheets[0].iter_rows(max_row=1, values_only=True), ())
+                finally:
+                    wb.close()
+                self._columns = _header_names(list(header))
+            elif self.extension == '.csv':
+                self._columns = [str(c) for c in pd.read_csv(self.path, nrows=0).columns]
+            elif self.extension == '.parquet':
+                self._columns = list(self._parquet_file().schema_arrow.names)
+            else:
+                self._columns = [str(c) for c in pd.read_excel(self.path, nrows=0).columns]
+        return self._columns
+
+    def _parquet_file(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("Leitura de Parquet requer o pacote 'pyarrow' (pip install pyarrow)")
+        return pq.ParquetFile(self.path)
+
+    def iter_columns(self) -> Iterator[ColumnSpool]:
+        """Percorre o arquivo uma vez, gerando cada coluna já gravada em disco"""
+        if self.extension == '.parquet':
+            yield from self._iter_parquet()
+            return
+
+        spools = [ColumnSpool(i, name, self.spool_dir) for i, name in enumerate(self.columns)]
+        for row in self._iter_rows():
+            for spool, value in zip(spools, row):
+                spool.append(value)
+            # linhas mais curtas que o cabeçalho: completa com vazio
+            for spool in spools[len(row):]:
+                spool.append(None)
+        for spool in spools:
+            spool.close()
+            yield spool
+
+    def _iter_rows(self) -> Iterator[tuple]:
+        if self.extension == '.xlsx':
+            from openpyxl import load_workbook
+            wb = load_workbook(self.path, read_only=True, data_only=True)
+            try:
+                # Linhas vazias (ex.: só formatação) entram apenas se houver dados depois delas:
+                # o pandas descarta as vazias do fim da planilha
+                blank_rows = 0
+                for row in wb.worksheets[0].iter_rows(min_row=2, values_only=True):
+                    if all(value is None for value in row):
+                        blank_rows += 1
+                        continue
+                    for _ in range(blank_rows):
+                        yield ()
+                    blank_rows = 0
+                    yield row
+            finally:
+                wb.close()
+        elif self.extension == '.csv':
+            for chunk in pd.read_csv(self.path, dtype=str, chunksize=CSV_CHUNK_ROWS, keep_default_na=True):
+                for row in chunk.itertuples(index=False, name=None):
+                    yield tuple(_parse_csv_value(v) for v in row)
+        else:
+            # .xls não tem leitor em streaming: carrega via pandas
+            yield from pd.read_excel(self.path).itertuples(index=False, name=None)
+
+    def _iter_parquet(self) -> Iterator[ColumnSpool]:
+        pf = self._parquet_file()
+        for i, name in enumerate(self.columns):
+            spool = ColumnSpool(i, name, self.spool_dir)
+            for rg in range(pf.num_row_groups):
+                for value in pf.read_row_group(rg, columns=[name]).column(0).to_pylist():
+                    spool.append(value)
+            spool.close()
+            yield spool
+
+    def cleanup(self):
+        """Remove os arquivos de spool"""
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
@@ -0,0 +1,145 @@
+"""
+Tabela global de respostas únicas de um lote
+- Pré-passada sobre as colunas abertas do banco (contagens já calculadas no spool de cada coluna):
+  cada texto é normalizado uma única vez para o lote inteiro
+- Variantes de uma mesma resposta ("Saúde", "saude", "SAÚDE.") viram um único item enviado ao
+  LLM: a forma mais frequente no lote. As demais são mapeadas pelo match normalizado
+- Triagem das não-respostas ("Não sei", "NS/NR", ...) feita uma vez, com os códigos reservados de
+  config/nonresponse.json: esses textos não são enviados ao LLM em nenhuma coluna
+- Respostas com sentido próprio que dependem da pergunta ("Nada", "Nenhum") não são triadas,
+  apenas deduplicadas
+"""
+
+import json
+import os
+from collections import Counter, defaultdict
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple
+
+
+def load_nonresponse_rules() -> List[Dict]:
+    """Regras de não-resposta: [{'codigo': int, 'titulo': str, 'respostas': [str, ...]}, ...]"""
+    try:
+        base_dir = os.path.dirname(os.path.abspath(__file__))
+        config_path = os.path.join(base_dir, 'config', 'nonresponse.json')
+        if os.path.exists(config_path):
+            with open(config_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Erro ao carregar regras de não-resposta: {e}. Triagem desativada.")
+    return []
+
+
+def _is_number(text: str) -> bool:
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+class GlobalResponseTable:
+    """Respostas únicas de todas as colunas abertas de um lote (somente leitura após montada)"""
+
+    def __init__(self, normalize: Callable[[str], str], rules: Optional[List[Dict]] = None):
+        self._normalize = normalize
+        self._norm_memo: Dict[str, str] = {}
+        # forma normalizada -> frequência de cada variante no lote
+        self._variants: Dict[str, Counter] = defaultdict(Counter)
+        # forma normalizada -> colunas em que aparece
+        self._columns: Dict[str, set] = defaultdict(set)
+        # Total de respostas em texto do lote (base do custo por 1000 respostas)
+        self.total_responses = 0
+        # forma normalizada -> (código reservado, título) e código -> formas normalizadas da regra
+        self._triage: Dict[str, Tuple[int, str]] = {}
+        self._rule_forms: Dict[int, set] = defaultdict(set)
+        for rule in (load_nonresponse_rules() if rules is None else rules):
+            code, label = int(rule['codigo']), str(rule['titulo'])
+            forms = {self.normalize(label)} | {self.normalize(r) for r in rule.get('respostas', [])}
+            forms.discard('')
+            self._rule_forms[code] |= forms
+            for form in forms:
+                self._triage.setdefault(form, (code, label))
+
+    def normalize(self, text: str) -> str:
+        """normalize_text com memória compartilhada pelas colunas do lote"""
+        norm = self._norm_memo.get(text)
+        if norm is None:
+            norm = self._normalize(text)
+            self._norm_memo[text] = norm
+        return norm
+
+    def add_column(self, col_idx: int, value_counts: Mapping[str, int]):
+        """Registra os textos de uma coluna (valores numéricos, ex.: códigos, são ignorados)"""
+        for text, count in value_counts.items():
+            if not text or _is_number(text):
+                continue
+            norm = self.normalize(text)
+            if not norm:
+                continue
+            self._variants[norm][text] += count
+            self.total_responses += count
+            self._columns[norm].add(col_idx)
+
+    def representative(self, text: str) -> str:
+        """Variante mais frequente no lote com a mesma forma normalizada (empate: ordem alfabética)"""
+        variants = self._variants.get(self.normalize(text))
+        if not variants:
+            return text
+        return min(variants.items(), key=lambda item: (-item[1], item[0]))[0]
+
+    def representatives(self, texts: Iterable[str]) -> Dict[str, str]:
+        """{texto: representante} dos textos de uma coluna cujo representante é outra variante.
+        Depende do lote inteiro: entra na chave do checkpoint da questão"""
+        mapping = {}
+        for text in texts:
+            text = str(text).strip()
+            if not text or _is_number(text):
+                continue
+            representative = self.representative(text)
+            if representative != text:
+                mapping[text] = representative
+        return mapping
+
+    def _triage_for_codebook(self, existing_codes: Dict[str, int]) -> Dict[str, Tuple[int, str]]:
+        """Triagem válida para o codebook de uma questão: a descrição do F17 prevalece quando
+        corresponde à regra; se o código reservado já é usado no F17 para outra coisa, a regra
+        não se aplica (as respostas seguem para o LLM)"""
+        f17_by_code = {code: desc for desc, code in existing_codes.items()}
+        f17_by_norm = {self.normalize(desc): (code, desc) for desc, code in existing_codes.items()}
+        triage = {}
+        for code, forms in self._rule_forms.items():
+            f17_match = next((f17_by_norm[form] for form in sorted(forms) if form in f17_by_norm), None)
+            if f17_match is None and code in f17_by_code:
+                continue
+            for form in forms:
+                if self._triage[form][0] != code:
+                    continue
+                triage[form] = f17_match or self._triage[form]
+        return triage
+
+    def split(self, items: List[str], existing_codes: Dict[str, int]) -> Tuple[List[str], Dict[str, Tuple[int, str]]]:
+        """Separa os itens únicos de uma questão em (itens para o LLM, {item: (código, título)}).
+        Itens para o LLM saem deduplicados pela forma normalizada, na ordem de entrada"""
+        triage = self._triage_for_codebook(existing_codes)
+        llm_items = []
+        seen = set()
+        triaged = {}
+        for item in items:
+            norm = self.normalize(item)
+            if norm in triage:
+                triaged[item] = triage[norm]
+                continue
+            if norm in seen:
+                continue
+            seen.add(norm)
+            llm_items.append(self.representative(item))
+        return llm_items, triaged
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'unique_texts': sum(len(v) for v in self._variants.values()),
+            'unique_normalized': len(self._variants),
+            'shared': sum(1 for cols in self._columns.values() if len(cols) > 1),
+            'triaged': sum(1 for norm in self._variants if norm in self._triage),
+            'responses': self.total_responses,
+        }
@@ -0,0 +1,407 @@
+"""
+Saída consolidada do processamento em lote
+- Um único banco codificado, com um par de colunas (Código/Resposta) por questão
+- Um único F17 atualizado, com uma aba por questão
+- Relatórios de agrupamento e resumos estatísticos anexados a dois arquivos compartilhados
+- Workbooks gravados com o writer write-only do openpyxl (memória constante). Como o xlsx
+  é escrito linha a linha, as colunas do banco ficam em spool no disco até o fechamento
+- ZIP do lote montado incrementalmente: cada artefato é gravado direto numa entrada do
+  arquivo assim que a questão termina; o ZipFile fica aberto até o fim do lote
+- Resultados parciais: questões já concluídas podem ser lidas/empacotadas enquanto o lote roda,
+  a partir das cópias parciais ou do spool em disco (funciona em qualquer processo/worker)
+"""
+
+import io
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from itertools import zip_longest
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from openpyxl import Workbook
+
+# 'per_question' = quatro arquivos por questão (padrão); 'consolidated' = um arquivo de cada tipo
+# por lote, opcional pelo formulário ou por BATCH_OUTPUT_MODE
+OUTPUT_MODES = ('per_question', 'consolidated')
+DEFAULT_OUTPUT_MODE = os.getenv('BATCH_OUTPUT_MODE', 'per_question')
+
+# Nível de compressão do ZIP do lote (0 = sem compressão, 1-9 = deflate)
+ZIP_COMPRESSLEVEL = int(os.getenv('BATCH_ZIP_COMPRESSLEVEL', 6))
+# Formatos que já são comprimidos (xlsx é um zip): armazenados sem recomprimir
+_STORED_EXTENSIONS = ('.xlsx', '.zip', '.parquet')
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# Caracteres não permitidos em nomes de aba do Excel
+_INVALID_SHEET_CHARS = re.compile(r'[\[\]:*?/\\]')
+_MAX_SHEET_TITLE = 31
+
+
+def sheet_title(name: Any, used: Set[str]) -> str:
+    """Nome de aba válido (sem caracteres proibidos, até 31 caracteres) e único no workbook"""
+    base = _INVALID_SHEET_CHARS.sub('_', str(name).strip()).strip("'") or 'Questão'
+    title = base[:_MAX_SHEET_TITLE]
+    suffix = 2
+    while title.lower() in used:
+        tag = f"~{suffix}"
+        title = base[:_MAX_SHEET_TITLE - len(tag)] + tag
+        suffix += 1
+    used.add(title.lower())
+    return title
+
+
+def _cell_value(value: Any) -> Any:
+    """NaN vira célula vazia (mesmo comportamento do DataFrame.to_excel)"""
+    if value is None:
+        return None
+    if hasattr(value, 'item'):  # escalares numpy
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Destino não posicionável para o zipfile: acumula os bytes até serem consumidos"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip_stream(entries: Iterable[Tuple[str, bytes]], compresslevel: Optional[int] = None) -> Iterator[bytes]:
+    """Gera um ZIP em blocos a partir de (nome, conteúdo), sem arquivo temporário"""
+    level = ZIP_COMPRESSLEVEL if compresslevel is None else compresslevel
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w') as zf:
+        for arcname, data in entries:
+            if level <= 0 or arcname.lower().endswith(_STORED_EXTENSIONS):
+                zf.writestr(arcname, data, compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.writestr(arcname, data, compress_type=zipfile.ZIP_DEFLATED, compresslevel=min(level, 9))
+            chunk = buffer.drain()
+            if chunk:
+                yield chunk
+    # Diretório central
+    yield buffer.drain()
+
+
+def question_file_prefix(idx: int, name: Any) -> str:
+    """Prefixo dos arquivos de uma questão no lote (posição da coluna + nome seguro)"""
+    safe_name = str(name).strip().replace('/', '_').replace('?', '').replace(':', '')[:30]
+    return f"{idx:03d}_{safe_name}"
+
+
+def question_filenames(idx: int, name: Any) -> List[str]:
+    """Nomes dos arquivos parciais de uma questão do modo consolidado"""
+    prefix = question_file_prefix(idx, name)
+    return [f"{prefix}_banco_codificado.xlsx", f"{prefix}_f17_atualizado.xlsx",
+            f"{prefix}_relatorio_agrupamentos.txt", f"{prefix}_resumo_estatistico.txt"]
+
+
+def render_spooled_question(output_dir: str, idx: int, name: Any) -> Optional[List[Tuple[str, bytes]]]:
+    """Arquivos de uma questão concluída do modo consolidado, gerados a partir do spool em disco.
+    None se a questão não estiver no spool (não concluída ou lote já fechado)"""
+    spool_dir = ConsolidatedBatchWriter.spool_dir_for(output_dir)
+    banco_name, f17_name, relatorio_name, resumo_name = question_filenames(idx, name)
+    try:
+        with open(os.path.join(spool_dir, f"{idx:04d}.meta.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        banco_wb = Workbook(write_only=True)
+        ws = banco_wb.create_sheet(title='Banco codificado')
+        ws.append(['Código', 'Resposta'])
+        with open(os.path.join(spool_dir, f"{idx:04d}.jsonl"), 'r', encoding='utf-8') as f:
+            for line in f:
+                ws.append(json.loads(line))
+    except (OSError, ValueError):
+        return None
+    banco_buffer = io.BytesIO()
+    banco_wb.save(banco_buffer)
+
+    f17_wb = Workbook(write_only=True)
+    ws = f17_wb.create_sheet(title=sheet_title(name, set()))
+    ws.append(['Código', 'Descrição'])
+    for row in meta['f17_rows']:
+        ws.append(row)
+    f17_buffer = io.BytesIO()
+    f17_wb.save(f17_buffer)
+
+    return [
+        (banco_name, banco_buffer.getvalue()),
+        (f17_name, f17_buffer.getvalue()),
+        (relatorio_name, meta['detailed_report'].encode('utf-8')),
+        (resumo_name, meta['summary'].encode('utf-8')),
+    ]
+
+
+def read_zip_entries(path: str, names: List[str], attempts: int = 5) -> Optional[List[Tuple[str, bytes]]]:
+    """Lê entradas do ZIP final de um lote (tenta novamente enquanto o arquivo está sendo fechado)"""
+    for attempt in range(attempts):
+        try:
+            with zipfile.ZipFile(path, 'r') as zf:
+                return [(name, zf.read(name)) for name in names]
+        except (zipfile.BadZipFile, KeyError, OSError, EOFError):
+            time.sleep(0.2 * (attempt + 1))
+    return None
+
+
+def read_partial_entries(partial_dir: str, names: List[str]) -> Optional[List[Tuple[str, bytes]]]:
+    """Lê as cópias das entradas gravadas por StreamingZipArchive(partial_dir=...) durante o lote.
+    None se alguma não existir (lote já fechado)"""
+    entries = []
+    try:
+        for name in names:
+            with open(os.path.join(partial_dir, name), 'rb') as f:
+                entries.append((name, f.read()))
+    except OSError:
+        return None
+    return entries
+
+
+class StreamingZipArchive:
+    """ZIP do lote montado entrada a entrada, com um único ZipFile aberto até close().
+
+    O diretório central só é gravado no fechamento. Com 'partial_dir', cada entrada incluída
+    por add_bytes também é gravada nesse diretório, para downloads parciais feitos por outros
+    processos enquanto o lote roda (ver read_partial_entries); o diretório é removido no close().
+    """
+
+    def __init__(self, path: str, compresslevel: Optional[int] = None, partial_dir: Optional[str] = None):
+        self.path = path
+        self.compresslevel = ZIP_COMPRESSLEVEL if compresslevel is None else compresslevel
+        self.partial_dir = partial_dir
+        self._lock = threading.Lock()
+        self.entries: List[str] = []
+        if partial_dir:
+            os.makedirs(partial_dir, exist_ok=True)
+        self._zip = zipfile.ZipFile(self.path, 'w')
+
+    def _compression(self, arcname: str):
+        if self.compresslevel <= 0 or arcname.lower().endswith(_STORED_EXTENSIONS):
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, min(self.compresslevel, 9)
+
+    @contextmanager
+    def open_entry(self, arcname: str) -> Iterator[BinaryIO]:
+        """Abre uma nova entrada para escrita em streaming (uma entrada por vez)"""
+        compression, level = self._compression(arcname)
+        with self._lock:
+            if self._zip is None:
+                raise Exception(f"ZIP do lote já fechado: {self.path}")
+            # compressão da entrada: ZipFile.open(nome, 'w') usa a configuração atual do arquivo
+            self._zip.compression = compression
+            self._zip.compresslevel = level
+            # force_zip64: tamanho da entrada não é conhecido de antemão
+            with self._zip.open(arcname, 'w', force_zip64=True) as entry:
+                yield entry
+            self.entries.append(arcname)
+
+    def add_bytes(self, arcname: str, data: bytes):
+        with self.open_entry(arcname) as entry:
+            entry.write(data)
+        if self.partial_dir:
+            partial_path = os.path.join(self.partial_dir, arcname)
+            with open(partial_path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(partial_path + '.tmp', partial_path)
+
+    def add_file(self, src_path: str, arcname: str, remove: bool = True):
+        """Copia um arquivo para o ZIP em blocos (e o remove do disco, por padrão)"""
+        with open(src_path, 'rb') as src, self.open_entry(arcname) as entry:
+            shutil.copyfileobj(src, entry, _COPY_CHUNK_SIZE)
+        if remove:
+            os.remove(src_path)
+
+    def close(self):
+        """Grava o diretório central (uma única vez) e remove as cópias parciais"""
+        with self._lock:
+            if self._zip is None:
+                return
+            self._zip.close()
+            self._zip = None
+        if self.partial_dir:
+            shutil.rmtree(self.partial_dir, ignore_errors=True)
+
+    @staticmethod
+    def partial_dir_for(output_dir: str) -> str:
+        return os.path.join(output_dir, '_arquivos')
+
+
+class ConsolidatedBatchWriter:
+    """Acumula os resultados das questões de um lote em arquivos consolidados.
+
+    Seguro para uso a partir do pool de colunas: cada questão é registrada com seu índice
+    e os arquivos finais seguem sempre a ordem das colunas do banco.
+    """
+
+    def __init__(self, output_dir: str, question_names: List[Any], base_name: str = 'lote'):
+        self.output_dir = output_dir
+        self.question_names = [str(name).strip() for name in question_names]
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.banco_path = os.path.join(output_dir, f"{base_name}_banco_codificado.xlsx")
+        self.f17_path = os.path.join(output_dir, f"{base_name}_f17_atualizado.xlsx")
+        self.relatorio_path = os.path.join(output_dir, f"{base_name}_relatorio_agrupamentos.txt")
+        self.resumo_path = os.path.join(output_dir, f"{base_name}_resumo_estatistico.txt")
+
+        self._lock = threading.Lock()
+        self._closed = False
+
+        # F17: abas criadas já na ordem das colunas; as linhas entram quando a questão termina
+        self._f17_wb = Workbook(write_only=True)
+        self._f17_sheets = {}
+        used_titles: Set[str] = set()
+        for idx, name in enumerate(self.question_names):
+            ws = self._f17_wb.create_sheet(title=sheet_title(name, used_titles))
+            ws.append(['Código', 'Descrição'])
+            self._f17_sheets[idx] = ws
+
+        # Banco: colunas (código, resposta) de cada questão em spool até o fechamento
+        self._spool_dir = self.spool_dir_for(output_dir)
+        os.makedirs(self._spool_dir, exist_ok=True)
+        self._banco_spools: Dict[int, str] = {}
+
+        # Relatórios: gravados na ordem das colunas assim que as anteriores terminam
+        self._relatorio_file = open(self.relatorio_path, 'w', encoding='utf-8')
+        self._resumo_file = open(self.resumo_path, 'w', encoding='utf-8')
+        self._pending_reports: Dict[int, Optional[tuple]] = {}
+        self._next_report = 0
+
+    def add_question(self, idx: int, result: Dict[str, Any], f17_rows: List[Dict[str, Any]], summary: str):
+        """Registra o resultado da questão 'idx' (linhas do F17 e resumo já calculados)"""
+        spool_path = os.path.join(self._spool_dir, f"{idx:04d}.jsonl")
+        with open(spool_path, 'w', encoding='utf-8') as f:
+            for code, response in zip(result['code_column'], result['response_column']):
+                f.write(json.dumps([_cell_value(code), _cell_value(response)], ensure_ascii=False, default=str))
+                f.write('\n')
+        # F17 e relatórios da questão ao lado do spool: permitem gerar o download parcial
+        # em qualquer processo (ver render_spooled_question)
+        meta = {'f17_rows': [[_cell_value(row['Código']), row['Descrição']] for row in f17_rows],
+                'detailed_report': result['detailed_report'], 'summary': summary}
+        with open(os.path.join(self._spool_dir, f"{idx:04d}.meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, default=str)
+
+        with self._lock:
+            ws = self._f17_sheets[idx]
+            for row in f17_rows:
+                ws.append([_cell_value(row['Código']), row['Descrição']])
+            self._banco_spools[idx] = spool_path
+            self._pending_reports[idx] = (result['detailed_report'], summary)
+            self._flush_reports()
+
+    @staticmethod
+    def spool_dir_for(output_dir: str) -> str:
+        return os.path.join(output_dir, '_colunas')
+
+    def question_filenames(self, idx: int) -> List[str]:
+        """Nomes dos arquivos parciais de uma questão (ver render_spooled_question)"""
+        return question_filenames(idx, self.question_names[idx])
+
+    def skip_question(self, idx: int):
+        """Marca a questão como sem resultado (erro), liberando os relatórios seguintes"""
+        with self._lock:
+            self._pending_reports[idx] = None
+            self._flush_reports()
+
+    def _flush_reports(self):
+        while self._next_report in self._pending_reports:
+            entry = self._pending_reports.pop(self._next_report)
+            if entry is not None:
+                detailed_report, summary = entry
+                self._relatorio_file.write(detailed_report.rstrip('\n') + '\n\n')
+                self._resumo_file.write(summary.rstrip('\n') + '\n\n')
+            self._next_report += 1
+
+    def close(self, archive: Optional[StreamingZipArchive] = None) -> Dict[str, str]:
+        """Grava os workbooks, fecha os relatórios e remove o spool. Retorna os arquivos criados.
+        Com 'archive', os arquivos são gravados direto no ZIP (retorna os nomes das entradas)"""
+        with self._lock:
+            if self._closed:
+                return self.files(archive)
+            self._closed = True
+
+            # Questões que nunca foram registradas não bloqueiam os relatórios
+            for idx in range(self._next_report, len(self.question_names)):
+                self._pending_reports.setdefault(idx, None)
+            self._flush_reports()
+            self._relatorio_file.close()
+            self._resumo_file.close()
+
+            self._save_workbook(self._f17_wb, self.f17_path, archive)
+            self._save_workbook(self._build_banco(), self.banco_path, archive)
+            shutil.rmtree(self._spool_dir, ignore_errors=True)
+            if archive is not None:
+                archive.add_file(self.relatorio_path, os.path.basename(self.relatorio_path))
+                archive.add_file(self.resumo_path, os.path.basename(self.resumo_path))
+        return self.files(archive)
+
+    def discard(self):
+        """Lote interrompido por erro: fecha os arquivos abertos sem gravar os workbooks e remove o spool"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._relatorio_file.close()
+            self._resumo_file.close()
+            for ws in self._f17_sheets.values():
+                ws.close()
+            shutil.rmtree(self._spool_dir, ignore_errors=True)
+
+    @staticmethod
+    def _save_workbook(wb: Workbook, path: str, archive: Optional[StreamingZipArchive]):
+        if archive is None:
+            wb.save(path)
+            return
+        with archive.open_entry(os.path.basename(path)) as entry:
+            wb.save(entry)
+
+    def _build_banco(self) -> Workbook:
+        order = sorted(self._banco_spools)
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet(title='Banco codificado')
+        header = []
+        for idx in order:
+            name = self.question_names[idx]
+            header.extend([f"{name} - Código", f"{name} - Resposta"])
+        ws.append(header)
+
+        handles = [open(self._banco_spools[idx], 'r', encoding='utf-8') for idx in order]
+        try:
+            # Uma linha de cada spool por vez: memória constante no número de linhas
+            for lines in zip_longest(*handles):
+                row = []
+                for line in lines:
+                    row.extend(json.loads(line) if line is not None else [None, None])
+                ws.append(row)
+        finally:
+            for handle in handles:
+                handle.close()
+        return wb
+
+    def files(self, archive: Optional[StreamingZipArchive] = None) -> Dict[str, str]:
+        paths = {
+            'banco': self.banco_path,
+            'f17': self.f17_path,
+            'relatorio': self.relatorio_path,
+            'resumo': self.resumo_path,
+        }
+        if archive is not None:
+            return {key: os.path.basename(path) for key, path in paths.items()}
+        return paths
@@ -0,0 +1,294 @@
+"""
+Execução diferida de lotes pela API de batch do provedor (ondas noturnas)
+- Modo 'deferred' do processamento em lote: as chamadas ao LLM do job (agrupamento, pacotes,
+  padronização) não vão para a API interativa; são gravadas em um arquivo JSONL no formato de
+  batch (/v1/chat/completions), enviadas e acompanhadas até a conclusão
+- Ondas: uma passada de coleta roda o pipeline das questões com uma sessão ativa; cada chamada
+  sem resultado é registrada (DeferredCall) em vez de executada. As respostas do batch entram na
+  sessão e a próxima passada avança (retries e padronização dependem do agrupamento) até não
+  haver chamadas novas ou atingir BATCH_MAX_WAVES
+- Depois das ondas o pós-processamento normal roda com a sessão em modo de reprodução: as
+  chamadas recebem as respostas do batch; o que faltar segue pela API interativa
+- Arquivos, ids dos batches e respostas ficam em RESULTS_FOLDER/batches/<tarefa>: um job
+  retomado volta a acompanhar o batch já enviado em vez de reenviá-lo
+- Serviços: OpenAIBatchService (API de batch) ou LocalBatchService (BATCH_SERVICE=local), que
+  reproduz o arquivo contra um endpoint compatível (OPENAI_BASE_URL) para testes offline
+"""
+
+import contextvars
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+EXECUTION_MODES = ('interactive', 'deferred')
+DEFAULT_EXECUTION_MODE = os.getenv('DEFAULT_EXECUTION_MODE', 'interactive')
+
+# 'openai' (API de batch do provedor) ou 'local' (reprodução contra OPENAI_BASE_URL)
+BATCH_SERVICE = os.getenv('BATCH_SERVICE', 'openai')
+BATCH_POLL_SECONDS = float(os.getenv('BATCH_POLL_SECONDS', 60))
+BATCH_MAX_WAVES = int(os.getenv('BATCH_MAX_WAVES', 4))
+BATCH_COMPLETION_WINDOW = os.getenv('BATCH_COMPLETION_WINDOW', '24h')
+BATCH_FOLDER = os.getenv('BATCH_FOLDER', os.path.join(
+    os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_results')), 'batches'))
+BATCH_ENDPOINT = '/v1/chat/completions'
+
+_FINAL_STATES = ('completed', 'failed', 'expired', 'cancelled')
+
+_active_session: contextvars.ContextVar = contextvars.ContextVar('batch_session', default=None)
+
+
+class DeferredCall(Exception):
+    """Chamada ao LLM registrada para o próximo batch (passada de coleta)"""
+
+
+def request_body(model: str, messages: List[Dict[str, Any]], **kwargs) -> Dict[str, Any]:
+    """Corpo da requisição de chat, igual ao enviado pela chamada interativa"""
+    return dict(model=model, messages=messages, temperature=0, **kwargs)
+
+
+def custom_id(body: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:32]
+
+
+def current_session() -> Optional['BatchSession']:
+    return _active_session.get()
+
+
+class BatchSession:
+    """Requisições e respostas de batch de uma tarefa (seguro entre threads)"""
+
+    def __init__(self, task_id: str, folder: str = None):
+        self.task_id = task_id
+        self.folder = folder or os.path.join(BATCH_FOLDER, task_id)
+        os.makedirs(self.folder, exist_ok=True)
+        self._lock = threading.Lock()
+        self.collecting = False
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self._manifest_path = os.path.join(self.folder, 'manifest.json')
+        self.manifest: Dict[str, Any] = {'batches': {}}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        # Respostas de batches anteriores da mesma tarefa (retomada)
+        for entry in self.manifest['batches'].values():
+            if entry.get('output_path') and os.path.exists(entry['output_path']):
+                with open(entry['output_path'], 'r', encoding='utf-8') as f:
+                    self.load_output(f.read())
+
+    @property
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    @property
+    def result_count(self) -> int:
+        with self._lock:
+            return len(self._results)
+
+    @contextmanager
+    def active(self, collecting: bool = False):
+        """Ativa a sessão no contexto atual; collecting=True registra as chamadas sem resposta"""
+        self.collecting = collecting
+        token = _active_session.set(self)
+        try:
+            yield self
+        finally:
+            _active_session.reset(token)
+            self.collecting = False
+
+    def lookup(self, body: Dict[str, Any]) -> Optional[Any]:
+        """Resposta do batch para a requisição (ChatCompletion). Na coleta, requisição sem resposta
+        é registrada e levanta DeferredCall; fora dela, retorna None (chamada interativa)"""
+        key = custom_id(body)
+        with self._lock:
+            result = self._results.get(key)
+            if result is None and self.collecting:
+                self._pending.setdefault(key, body)
+        if result is not None:
+            from openai.types.chat import ChatCompletion
+            return ChatCompletion.model_validate(result)
+        if self.collecting:
+            raise DeferredCall(f"Chamada adiada para o batch ({key})")
+        return None
+
+    def write_batch_file(self, wave: int) -> str:
+        """Grava as requisições pendentes no formato JSONL de batch e as descarta da sessão"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        path = os.path.join(self.folder, f"onda_{wave:02d}.jsonl")
+        with open(path, 'w', encoding='utf-8') as f:
+            for key, body in pending.items():
+                f.write(json.dumps({'custom_id': key, 'method': 'POST', 'url': BATCH_ENDPOINT, 'body': body},
+                                   ensure_ascii=False) + '\n')
+        return path
+
+    def load_output(self, text: str) -> int:
+        """Respostas do arquivo de saída do batch; linhas com erro ficam sem resposta"""
+        loaded = 0
+        with self._lock:
+            for line in text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                response = record.get('response') or {}
+                if record.get('error') or response.get('status_code') != 200 or not response.get('body'):
+                    continue
+                self._results[record['custom_id']] = response['body']
+                loaded += 1
+        return loaded
+
+    def _save_manifest(self):
+        with open(self._manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+
+    def submit_and_wait(self, service, path: str, cancel_event: threading.Event = None,
+                        on_status: Callable[[str], None] = None) -> bool:
+        """Envia o arquivo (ou retoma o batch já enviado com o mesmo conteúdo) e espera o
+        resultado. Retorna False se cancelado ou se o batch terminou sem arquivo de saída"""
+        with open(path, 'rb') as f:
+            content_hash = hashlib.sha256(f.read()).hexdigest()
+        entry = self.manifest['batches'].get(content_hash)
+        if entry is None:
+            entry = {'file': path, 'batch_id': service.submit(path), 'submitted_at': time.time()}
+            self.manifest['batches'][content_hash] = entry
+            self._save_manifest()
+            print(f"[DEBUG] Tarefa {self.task_id}: batch {entry['batch_id']} enviado ({path})", flush=True)
+        else:
+            print(f"[DEBUG] Tarefa {self.task_id}: acompanhando batch já enviado {entry['batch_id']}", flush=True)
+        while True:
+            state, output = service.status(entry['batch_id'])
+            if state in _FINAL_STATES:
+                break
+            if on_status is not None:
+                on_status(f"Aguardando batch {entry['batch_id']} ({state})...")
+            if cancel_event is not None and cancel_event.wait(BATCH_POLL_SECONDS):
+                service.cancel(entry['batch_id'])
+                return False
+            if cancel_event is None:
+                time.sleep(BATCH_POLL_SECONDS)
+        entry['state'] = state
+        if output is None:
+            self._save_manifest()
+            print(f"[DEBUG] Tarefa {self.task_id}: batch {entry['batch_id']} terminou sem resultado ({state})", flush=True)
+            return False
+        entry['output_path'] = os.path.join(self.folder, f"{os.path.splitext(os.path.basename(path))[0]}_saida.jsonl")
+        with open(entry['output_path'], 'w', encoding='utf-8') as f:
+            f.write(output)
+        self._save_manifest()
+        loaded = self.load_output(output)
+        print(f"[DEBUG] Tarefa {self.task_id}: batch {entry['batch_id']} concluído ({loaded} respostas)", flush=True)
+        return True
+
+
+def run_waves(session: BatchSession, collect: Callable[[], None], service,
+              cancel_event: threading.Event = None, on_status: Callable[[str], None] = None) -> int:
+    """Passadas de coleta + batches até não haver chamadas novas. Retorna o número de ondas enviadas"""
+    for wave in range(1, BATCH_MAX_WAVES + 1):
+        with session.active(collecting=True):
+            collect()
+        if session.pending_count == 0 or (cancel_event is not None and cancel_event.is_set()):
+            return wave - 1
+        count = session.pending_count
+        path = session.write_batch_file(wave)
+        if on_status is not None:
+            on_status(f"Onda {wave}: {count} chamadas enviadas ao batch")
+        if not session.submit_and_wait(service, path, cancel_event, on_status):
+            return wave
+    return BATCH_MAX_WAVES
+
+
+class OpenAIBatchService:
+    """API de batch do provedor (arquivo JSONL -> batch -> arquivo de saída)"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def submit(self, path: str) -> str:
+        with open(path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(input_file_id=input_file.id, endpoint=BATCH_ENDPOINT,
+                                           completion_window=BATCH_COMPLETION_WINDOW)
+        return batch.id
+
+    def status(self, batch_id: str):
+        """(estado, texto do arquivo de saída quando concluído)"""
+        batch = self.client.batches.retrieve(batch_id)
+        if batch.status != 'completed' or not batch.output_file_id:
+            return batch.status, None
+        return batch.status, self.client.files.content(batch.output_file_id).text
+
+    def cancel(self, batch_id: str):
+        try:
+            self.client.batches.cancel(batch_id)
+        except Exception as e:
+            print(f"[DEBUG] Erro ao cancelar batch {batch_id}: {e}", flush=True)
+
+
+class LocalBatchService:
+    """Substituto local: reproduz o arquivo de batch, uma requisição por vez, contra um endpoint
+    compatível (ex.: servidor de teste em OPENAI_BASE_URL) e gera o arquivo de saída no mesmo
+    formato da API de batch"""
+
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._batches: Dict[str, Dict[str, Any]] = {}
+
+    def submit(self, path: str) -> str:
+        batch_id = f"batch_local_{uuid.uuid4().hex[:12]}"
+        with self._lock:
+            self._batches[batch_id] = {'state': 'in_progress', 'output': None, 'cancel': False}
+        threading.Thread(target=self._replay, args=(batch_id, path), daemon=True).start()
+        return batch_id
+
+    def _replay(self, batch_id: str, path: str):
+        lines = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if self._batches[batch_id]['cancel']:
+                    break
+                request = json.loads(line)
+                try:
+                    body = self.client.chat.completions.create(**request['body']).model_dump()
+                    response, error = {'status_code': 200, 'body': body}, None
+                except Exception as e:
+                    response, error = None, {'message': str(e)}
+                lines.append(json.dumps({'id': f"req_{uuid.uuid4().hex[:12]}", 'custom_id': request['custom_id'],
+                                         'response': response, 'error': error}, ensure_ascii=False))
+        with self._lock:
+            batch = self._batches[batch_id]
+            batch['state'] = 'cancelled' if batch['cancel'] else 'completed'
+            batch['output'] = None if batch['cancel'] else "\n".join(lines) + "\n"
+
+    def status(self, batch_id: str):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            # Batch local de outro processo (perdido com ele): termina sem resultado
+            return 'expired', None
+        return batch['state'], batch['output']
+
+    def cancel(self, batch_id: str):
+        with self._lock:
+            if batch_id in self._batches:
+                self._batches[batch_id]['cancel'] = True
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service(client_factory: Callable[[], Any]):
+    """Serviço de batch do processo (BATCH_SERVICE); client_factory cria o cliente OpenAI"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = LocalBatchService(client_factory()) if BATCH_SERVICE == 'local' else OpenAIBatchService(client_factory())
+    return _service
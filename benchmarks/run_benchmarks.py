@@ -0,0 +1,280 @@
+"""
+Benchmarks das etapas locais (CPU) da codificação, com baselines e relatório de comparação
+- Casos:
+  canonicalize: correção + forma canônica de cada valor único da coluna
+  group_responses_intelligent: agrupador local sobre a coluna inteira com o F17 da questão
+  merge_similar_groups: união dos grupos devolvidos pelo agrupamento (chamada feita após os blocos)
+  reverse_mapping: mapeamento reverso (local_stages.match_many) com metade dos valores únicos fora
+    do dicionário, exercitando os caminhos de substring e fuzzy
+  pipeline: process_single_question_with_chatgpt de ponta a ponta, offline (todas as rotas locais)
+- Tamanhos: 1k/10k/100k/1M linhas (--sizes), dados de synthetic_survey.py (mesma semente = mesmos dados)
+- Cada caso roda --repeat vezes com instâncias novas (sem memo/caches quentes) e vale o menor tempo;
+  tamanhos >= 100k rodam uma vez. Caso cuja projeção linear a partir do tamanho anterior passa de
+  --max-case-seconds é pulado (e marcado como tal no relatório)
+- baselines.json: tempos de referência por caso e tamanho (--save-baseline atualiza os casos rodados);
+  o relatório marca regressão quando o tempo passa a baseline em mais que --tolerance
+- Tempos dependem da máquina: compare baselines gravadas na mesma máquina (meta do arquivo)
+- Uso: python benchmarks/run_benchmarks.py --sizes 1k,10k [--save-baseline] [--fail-on-regression]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+BASELINES_PATH = os.path.join(BENCH_DIR, 'baselines.json')
+
+# Estado isolado e sem rede: pastas/caches temporários e todas as tarefas roteadas para o fallback local
+_WORKDIR = tempfile.mkdtemp(prefix='ipo_bench_')
+_LOCAL_ROUTES = os.path.join(_WORKDIR, 'model_routing.json')
+with open(_LOCAL_ROUTES, 'w', encoding='utf-8') as _f:
+    json.dump({'routes': [{'task': 'grouping', 'model': 'local'}, {'task': 'standardize', 'model': 'local'}]}, _f)
+os.environ.update(RESULTS_FOLDER=_WORKDIR, CACHE_DB_PATH=os.path.join(_WORKDIR, 'cache.db'),
+                  MODEL_ROUTING_CONFIG=_LOCAL_ROUTES, LLM_MODE='live')
+sys.path.insert(0, ROOT)
+
+import local_stages  # noqa: E402
+from final_ipo_agent_improved import FinalIPOAgentImproved  # noqa: E402
+from improved_coding_system import ImprovedIPOCodingSystem  # noqa: E402
+from synthetic_survey import generate_answers, generate_codebook  # noqa: E402
+
+SIZES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1m': 1_000_000}
+CASES = ['canonicalize', 'group_responses_intelligent', 'merge_similar_groups', 'reverse_mapping', 'pipeline']
+# Tempos abaixo disto são ruído de medição: não contam como regressão
+NOISE_FLOOR_SECONDS = 0.05
+# A partir deste tamanho cada caso roda uma única vez
+SINGLE_RUN_ROWS = 100_000
+
+
+@contextlib.contextmanager
+def quiet():
+    """Descarta os prints [DEBUG] do pipeline durante a medição (o custo de formatá-los continua contando)"""
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+class Dataset:
+    """Coluna sintética + F17 de um tamanho, e as entradas derivadas de cada caso (calculadas uma vez)"""
+
+    def __init__(self, rows: int, seed: int):
+        self.rows = rows
+        self.answers = generate_answers(rows, seed)
+        self.codebook = generate_codebook(seed)
+        self.unique = list(dict.fromkeys(self.answers))
+        self._grouped: Optional[Tuple[Dict[str, int], Dict[str, List[str]]]] = None
+
+    def grouped(self) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+        """(codes, groups) do agrupador local: entrada do merge e do mapeamento reverso"""
+        if self._grouped is None:
+            with quiet():
+                self._grouped = ImprovedIPOCodingSystem().group_responses_intelligent(self.answers, self.codebook)
+        return self._grouped
+
+    def response_to_code(self, coding_system: ImprovedIPOCodingSystem) -> Dict[str, Tuple[int, Any]]:
+        """Dicionário do mapeamento reverso montado como no pipeline, só com a metade inicial dos valores
+        únicos (a outra metade cai nos matches parcial/fuzzy)"""
+        codes, groups = self.grouped()
+        known = set(self.unique[:len(self.unique) // 2])
+        response_to_code = {}
+        for title, responses in groups.items():
+            code = codes.get(title)
+            if not code:
+                continue
+            response_to_code[title] = (code, title)
+            response_to_code[coding_system.normalize_text(title)] = (code, title)
+            for response in responses:
+                if str(response) in known:
+                    response_to_code[str(response).strip()] = (code, response)
+                    response_to_code[coding_system.normalize_text(str(response))] = (code, response)
+        return response_to_code
+
+
+def case_setup(case: str, data: Dataset) -> Callable[[], Dict[str, Any]]:
+    """Prepara o caso (fora da medição) e devolve a função medida, que retorna detalhes de conferência"""
+    if case == 'canonicalize':
+        coding_system = ImprovedIPOCodingSystem()
+
+        def run():
+            with coding_system.codebook_vocabulary(data.codebook):
+                forms = {coding_system.canonicalize(text) for text in data.unique}
+            return {'unique': len(data.unique), 'canonical_forms': len(forms)}
+        return run
+    if case == 'group_responses_intelligent':
+        coding_system = ImprovedIPOCodingSystem()
+
+        def run():
+            codes, groups = coding_system.group_responses_intelligent(data.answers, data.codebook)
+            return {'groups': len(groups), 'codes': len(codes)}
+        return run
+    if case == 'merge_similar_groups':
+        coding_system = ImprovedIPOCodingSystem()
+        groups = {title: list(responses) for title, responses in data.grouped()[1].items()}
+
+        def run():
+            return {'groups_in': len(groups), 'groups_out': len(coding_system.merge_similar_groups(groups, threshold=85))}
+        return run
+    if case == 'reverse_mapping':
+        coding_system = ImprovedIPOCodingSystem()
+        response_to_code = data.response_to_code(coding_system)
+
+        def run():
+            matched = local_stages.match_many(coding_system, data.unique, response_to_code, data.codebook)
+            return {'values': len(matched), 'unmatched': sum(1 for code in matched.values() if code is None)}
+        return run
+    if case == 'pipeline':
+        agent = FinalIPOAgentImproved()
+
+        def run():
+            result = agent.process_single_question_with_chatgpt(data.answers, data.codebook, 'P1')
+            return {'codes': len(result['final_codes']), 'errors': sum(1 for c in result['code_column'] if c == 'ERROR'),
+                    'method': result['processing_method']}
+        return run
+    raise ValueError(f"Caso desconhecido: {case}")
+
+
+def measure(case: str, data: Dataset, repeat: int) -> Tuple[float, Dict[str, Any]]:
+    """Menor tempo entre 'repeat' execuções (cada uma com setup novo)"""
+    best, details = None, {}
+    for _ in range(repeat):
+        with quiet():
+            run = case_setup(case, data)
+            started = time.perf_counter()
+            details = run()
+            elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, details
+
+
+def load_baselines(path: str = BASELINES_PATH) -> Dict[str, Any]:
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'meta': {}, 'results': {}}
+
+
+def machine_info() -> Dict[str, Any]:
+    return {'machine': platform.platform(), 'processor': platform.machine(), 'cpus': os.cpu_count(),
+            'python': platform.python_version(), 'local_pool_workers': local_stages.POOL_WORKERS}
+
+
+def run_suite(sizes: List[str], cases: List[str], repeat: int, seed: int, max_case_seconds: float) -> Dict[str, Dict[str, Any]]:
+    """{caso: {tamanho: {'seconds', 'details'} ou {'skipped': motivo}}}"""
+    results: Dict[str, Dict[str, Any]] = {case: {} for case in cases}
+    previous: Dict[str, Tuple[int, float]] = {}
+    for size in sizes:
+        rows = SIZES[size]
+        started = time.perf_counter()
+        data = Dataset(rows, seed)
+        print(f"[DEBUG] {size}: {rows} linhas, {len(data.unique)} valores únicos "
+              f"(gerados em {time.perf_counter() - started:.1f}s)", flush=True)
+        for case in cases:
+            if case in previous:
+                prev_rows, prev_seconds = previous[case]
+                projected = prev_seconds * rows / prev_rows
+                if projected > max_case_seconds:
+                    results[case][size] = {'skipped': f"projeção de {projected:.0f}s > {max_case_seconds:.0f}s"}
+                    print(f"[DEBUG]   {case}: pulado ({results[case][size]['skipped']})", flush=True)
+                    continue
+            seconds, details = measure(case, data, 1 if rows >= SINGLE_RUN_ROWS else repeat)
+            results[case][size] = {'seconds': round(seconds, 4), 'details': details}
+            previous[case] = (rows, seconds)
+            print(f"[DEBUG]   {case}: {seconds:.3f}s {details}", flush=True)
+    return results
+
+
+def compare(results: Dict[str, Dict[str, Any]], baselines: Dict[str, Any], tolerance: float) -> List[Dict[str, Any]]:
+    """Linhas do relatório: caso, tamanho, tempo, baseline, razão e status"""
+    rows = []
+    for case, by_size in results.items():
+        for size, result in by_size.items():
+            baseline = baselines.get('results', {}).get(case, {}).get(size)
+            row = {'case': case, 'size': size, 'seconds': result.get('seconds'), 'baseline': baseline,
+                   'ratio': None, 'status': 'novo'}
+            if 'skipped' in result:
+                row['status'] = 'pulado'
+            elif baseline:
+                row['ratio'] = round(result['seconds'] / baseline, 2)
+                if row['ratio'] > tolerance and result['seconds'] - baseline > NOISE_FLOOR_SECONDS:
+                    row['status'] = 'REGRESSÃO'
+                elif row['ratio'] < 1 / tolerance and baseline - result['seconds'] > NOISE_FLOOR_SECONDS:
+                    row['status'] = 'melhora'
+                else:
+                    row['status'] = 'ok'
+            rows.append(row)
+    return rows
+
+
+def print_report(rows: List[Dict[str, Any]], baselines: Dict[str, Any]):
+    meta = baselines.get('meta') or {}
+    if meta:
+        print(f"\nBaseline de {meta.get('created_at')} ({meta.get('machine')}, {meta.get('cpus')} CPUs, "
+              f"Python {meta.get('python')})")
+        if meta.get('machine') != machine_info()['machine'] or meta.get('cpus') != machine_info()['cpus']:
+            print("Atenção: baseline gravada em outra máquina; as razões servem só como indicação")
+    print(f"\n{'caso':<28} {'tamanho':>7} {'tempo (s)':>10} {'baseline':>10} {'razão':>7}  status")
+    for row in rows:
+        seconds = f"{row['seconds']:.3f}" if row['seconds'] is not None else '-'
+        baseline = f"{row['baseline']:.3f}" if row['baseline'] else '-'
+        ratio = f"{row['ratio']:.2f}" if row['ratio'] is not None else '-'
+        print(f"{row['case']:<28} {row['size']:>7} {seconds:>10} {baseline:>10} {ratio:>7}  {row['status']}")
+
+
+def save_baselines(results: Dict[str, Dict[str, Any]], baselines: Dict[str, Any], repeat: int, seed: int,
+                   path: str = BASELINES_PATH):
+    """Atualiza as baselines com os casos medidos nesta execução (os demais são mantidos)"""
+    for case, by_size in results.items():
+        for size, result in by_size.items():
+            if 'seconds' in result:
+                baselines.setdefault('results', {}).setdefault(case, {})[size] = result['seconds']
+    baselines['meta'] = dict(machine_info(), created_at=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                             repeat=repeat, seed=seed)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baselines, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    print(f"\nBaselines gravadas em {path}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmarks das etapas locais da codificação')
+    parser.add_argument('--sizes', default='1k,10k,100k,1m', help=f"tamanhos ({', '.join(SIZES)})")
+    parser.add_argument('--cases', default=','.join(CASES), help=f"casos ({', '.join(CASES)})")
+    parser.add_argument('--repeat', type=int, default=3, help='execuções por caso (vale o menor tempo)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--max-case-seconds', type=float, default=900,
+                        help='pula o caso quando a projeção a partir do tamanho anterior passa disto')
+    parser.add_argument('--tolerance', type=float, default=1.3, help='razão tempo/baseline acima da qual é regressão')
+    parser.add_argument('--baselines', default=BASELINES_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='grava os tempos medidos como nova baseline')
+    parser.add_argument('--fail-on-regression', action='store_true', help='código de saída 1 se houver regressão')
+    parser.add_argument('--json', default=None, help='grava resultados e comparação neste arquivo')
+    args = parser.parse_args(argv)
+
+    sizes = [s.strip().lower() for s in args.sizes.split(',') if s.strip()]
+    cases = [c.strip() for c in args.cases.split(',') if c.strip()]
+    unknown = [s for s in sizes if s not in SIZES] + [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error(f"Tamanhos/casos desconhecidos: {', '.join(unknown)}")
+
+    baselines = load_baselines(args.baselines)
+    results = run_suite(sizes, cases, args.repeat, args.seed, args.max_case_seconds)
+    rows = compare(results, baselines, args.tolerance)
+    print_report(rows, baselines)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'meta': machine_info(), 'results': results, 'comparison': rows}, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        save_baselines(results, baselines, args.repeat, args.seed, args.baselines)
+    regressions = [row for row in rows if row['status'] == 'REGRESSÃO']
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
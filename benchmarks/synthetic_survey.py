@@ -0,0 +1,241 @@
+"""
+Gerador de pesquisas sintéticas em pt-BR (benchmarks e teste de carga)
+- Respostas abertas realistas: temas com variações de redação, prefixos coloquiais ('falta de',
+  'acho que'), respostas compostas ('saúde e segurança') e não-respostas ('não sei', 'nada')
+- Frequência com distribuição de Zipf: poucas respostas concentram a maior parte da coluna e há
+  uma cauda longa de respostas raras (como nos bancos reais)
+- Ruído de digitação: acentos omitidos, letras trocadas/duplicadas/omitidas, tecla vizinha e
+  caixa alta, o que multiplica os valores únicos conforme o banco cresce
+- F17 (codebook) correspondente por questão: parte dos temas já codificada (os demais viram
+  códigos novos) e os códigos reservados de não-resposta
+- Determinístico pela semente (mesma semente -> mesmo banco)
+- Uso: python benchmarks/synthetic_survey.py --rows 10000 --open-questions 3 --out /tmp/pesquisa
+"""
+
+import argparse
+import io
+import os
+import random
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+# Temas: (descrição no F17, variações de resposta)
+THEMES = [
+    ('Saúde', ['saúde', 'mais médicos', 'posto de saúde', 'hospital', 'remédio no posto', 'atendimento na saúde',
+               'fila no hospital', 'upa']),
+    ('Segurança', ['segurança', 'mais policiamento', 'polícia na rua', 'violência', 'assaltos no bairro',
+                   'segurança pública', 'tráfico']),
+    ('Educação', ['educação', 'escola', 'creche', 'professores', 'vaga na creche', 'escola em tempo integral',
+                  'ensino de qualidade']),
+    ('Transporte', ['ônibus', 'transporte público', 'mais ônibus', 'passagem cara', 'metrô', 'linha de ônibus']),
+    ('Emprego', ['emprego', 'desemprego', 'trabalho', 'geração de empregos', 'oportunidade de trabalho']),
+    ('Asfalto', ['asfalto', 'buraco na rua', 'pavimentação', 'calçamento', 'rua esburacada', 'tapa buraco']),
+    ('Saneamento', ['saneamento', 'esgoto', 'água encanada', 'esgoto a céu aberto', 'falta de água']),
+    ('Iluminação', ['iluminação', 'iluminação pública', 'poste apagado', 'luz na rua']),
+    ('Lazer', ['lazer', 'praça', 'área de lazer', 'quadra de esportes', 'parque']),
+    ('Habitação', ['moradia', 'habitação', 'casa própria', 'aluguel caro', 'minha casa minha vida']),
+    ('Limpeza urbana', ['limpeza', 'coleta de lixo', 'lixo na rua', 'entulho', 'varrição']),
+    ('Corrupção', ['corrupção', 'políticos honestos', 'fim da corrupção', 'roubalheira']),
+    ('Trânsito', ['trânsito', 'engarrafamento', 'semáforo', 'faixa de pedestre']),
+    ('Drogas', ['drogas', 'usuários de drogas', 'cracolândia', 'tráfico de drogas']),
+    ('Enchentes', ['enchente', 'alagamento', 'drenagem', 'bueiro entupido']),
+    ('Custo de vida', ['custo de vida', 'inflação', 'preço dos alimentos', 'gasolina cara', 'luz cara']),
+    ('Meio ambiente', ['meio ambiente', 'poluição', 'arborização', 'queimadas']),
+    ('Assistência social', ['assistência social', 'cesta básica', 'bolsa família', 'moradores de rua']),
+    ('Cultura', ['cultura', 'teatro', 'biblioteca', 'eventos culturais']),
+    ('Esporte', ['esporte', 'escolinha de futebol', 'academia ao ar livre']),
+    ('Gestão pública', ['prefeito', 'gestão da prefeitura', 'falta de planejamento', 'descaso']),
+    ('Idosos', ['idosos', 'atendimento ao idoso', 'centro de convivência']),
+    ('Internet', ['internet', 'wi-fi público', 'sinal de celular']),
+    ('Animais', ['animais abandonados', 'castração', 'cachorro na rua']),
+]
+NON_RESPONSES = ['não sei', 'nada', 'ns', 'nenhum', 'tudo', 'não respondeu', 'nao sei dizer', 'sem opinião']
+PREFIXES = ['', '', '', '', 'mais ', 'melhorar a ', 'falta de ', 'precisa de ', 'acho que ', 'a ', 'o problema é ']
+RESERVED_CODES = {'Não sabe/Não respondeu': 99, 'Nenhum': 88}
+
+# Teclas vizinhas no teclado ABNT (troca por engano)
+_NEIGHBORS = {
+    'a': 'sq', 'b': 'vn', 'c': 'xv', 'd': 'sf', 'e': 'wr', 'f': 'dg', 'g': 'fh', 'h': 'gj', 'i': 'uo', 'j': 'hk',
+    'k': 'jl', 'l': 'k', 'm': 'n', 'n': 'bm', 'o': 'ip', 'p': 'o', 'q': 'wa', 'r': 'et', 's': 'ad', 't': 'ry',
+    'u': 'yi', 'v': 'cb', 'w': 'qe', 'x': 'zc', 'y': 'tu', 'z': 'x',
+}
+_NO_ACCENTS = str.maketrans('áâãàéêíóôõúüçÁÂÃÀÉÊÍÓÔÕÚÜÇ', 'aaaaeeiooouucAAAAEEIOOOUUC')
+
+
+def zipf_weights(n: int, exponent: float = 1.1) -> List[float]:
+    """Pesos de Zipf para n itens em ordem de popularidade"""
+    return [1 / (rank + 1) ** exponent for rank in range(n)]
+
+
+def drop_accents(text: str) -> str:
+    return text.translate(_NO_ACCENTS)
+
+
+def strip_prefix(answer: str) -> str:
+    """Resposta sem o prefixo coloquial (segunda parte de uma resposta composta)"""
+    for prefix in sorted((p for p in PREFIXES if p), key=len, reverse=True):
+        if answer.startswith(prefix):
+            return answer[len(prefix):]
+    return answer
+
+
+def add_typo(text: str, rng: random.Random) -> str:
+    """Um erro de digitação: acento omitido, troca, duplicação, omissão, tecla vizinha ou caixa alta"""
+    if len(text) < 4:
+        return text.upper() if rng.random() < 0.5 else text
+    kind = rng.random()
+    i = rng.randrange(1, len(text) - 2)
+    if kind < 0.35:
+        return drop_accents(text)
+    if kind < 0.5:
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    if kind < 0.62:
+        return text[:i] + text[i] + text[i:]
+    if kind < 0.72:
+        return text[:i] + text[i + 1:]
+    if kind < 0.85:
+        neighbors = _NEIGHBORS.get(text[i].lower())
+        return text[:i] + rng.choice(neighbors) + text[i + 1:] if neighbors else text
+    if kind < 0.93:
+        return text.upper()
+    return text.capitalize()
+
+
+def answer_vocabulary(themes: List[Tuple[str, List[str]]] = None) -> List[str]:
+    """Respostas 'limpas' possíveis, da mais comum para a mais rara (a ordem define o ranking de Zipf)"""
+    themes = themes or THEMES
+    vocabulary = []
+    # Variação principal de cada tema primeiro; prefixos e variações secundárias formam a cauda
+    for prefix in dict.fromkeys(PREFIXES):
+        for depth in range(max(len(v) for _, v in themes)):
+            for _, variants in themes:
+                if depth < len(variants):
+                    vocabulary.append(prefix + variants[depth])
+    return vocabulary
+
+
+class AnswerGenerator:
+    """Sorteia respostas abertas com frequência de Zipf, respostas compostas, não-respostas e erros"""
+
+    def __init__(self, seed: int = 42, typo_rate: float = 0.3, non_response_rate: float = 0.06,
+                 compound_rate: float = 0.08, exponent: float = 1.1, themes: List[Tuple[str, List[str]]] = None):
+        self.rng = random.Random(seed)
+        self.typo_rate = typo_rate
+        self.non_response_rate = non_response_rate
+        self.compound_rate = compound_rate
+        # Cada questão tem sua própria popularidade de temas (a ordem é embaralhada pela semente)
+        themes = list(themes or THEMES)
+        self.rng.shuffle(themes)
+        self.vocabulary = answer_vocabulary(themes)
+        weights = zipf_weights(len(self.vocabulary), exponent)
+        total = 0.0
+        self.cum_weights = []
+        for weight in weights:
+            total += weight
+            self.cum_weights.append(total)
+
+    def answers(self, rows: int) -> List[str]:
+        rng = self.rng
+        base = rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=rows)
+        answers = []
+        for answer in base:
+            roll = rng.random()
+            if roll < self.non_response_rate:
+                answer = rng.choice(NON_RESPONSES)
+            elif roll < self.non_response_rate + self.compound_rate:
+                other = rng.choices(self.vocabulary, cum_weights=self.cum_weights)[0]
+                answer = f"{answer} e {strip_prefix(other)}"
+            if rng.random() < self.typo_rate:
+                answer = add_typo(answer, rng)
+                # Parte das respostas com erro tem mais de um
+                if rng.random() < 0.25:
+                    answer = add_typo(answer, rng)
+            answers.append(answer)
+        return answers
+
+
+def generate_answers(rows: int, seed: int = 42, **kwargs) -> List[str]:
+    """Coluna de respostas abertas com 'rows' linhas"""
+    return AnswerGenerator(seed, **kwargs).answers(rows)
+
+
+def generate_codebook(seed: int = 42, coverage: float = 0.5,
+                      themes: List[Tuple[str, List[str]]] = None) -> Dict[str, int]:
+    """F17 da questão ({descrição: código}): fração 'coverage' dos temas com códigos a partir de 1,
+    mais os códigos reservados de não-resposta"""
+    themes = themes or THEMES
+    rng = random.Random(seed)
+    known = rng.sample([description for description, _ in themes], k=max(1, int(len(themes) * coverage)))
+    codebook = {description: code for code, description in enumerate(known, start=1)}
+    codebook.update(RESERVED_CODES)
+    return codebook
+
+
+def generate_survey(rows: int, open_questions: int = 3, closed_questions: int = 1, semi_open_questions: int = 0,
+                    seed: int = 42, typo_rate: float = 0.3) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame]]:
+    """Banco (P1..Pn: abertas, semiabertas e fechadas) e F17 (uma aba por questão, colunas Código/Descrição)"""
+    banco: Dict[str, list] = {}
+    f17: Dict[str, pd.DataFrame] = {}
+    number = 0
+    for q in range(open_questions + semi_open_questions):
+        number += 1
+        name = f"P{number}"
+        question_seed = seed * 1000 + number
+        answers = generate_answers(rows, question_seed, typo_rate=typo_rate)
+        codebook = generate_codebook(question_seed)
+        if q >= open_questions:
+            # Semiaberta: a maior parte já vem codificada pelo campo, o resto em texto
+            rng = random.Random(question_seed)
+            codes = list(codebook.values())
+            answers = [rng.choice(codes) if rng.random() < 0.7 else answer for answer in answers]
+        banco[name] = answers
+        f17[name] = pd.DataFrame({'Código': list(codebook.values()), 'Descrição': list(codebook.keys())})
+    scale = {'Ótimo': 1, 'Bom': 2, 'Regular': 3, 'Ruim': 4, 'Péssimo': 5}
+    for _ in range(closed_questions):
+        number += 1
+        name = f"P{number}"
+        rng = random.Random(seed * 1000 + number)
+        banco[name] = rng.choices(list(scale.values()), weights=[10, 30, 30, 20, 10], k=rows)
+        f17[name] = pd.DataFrame({'Código': list(scale.values()), 'Descrição': list(scale.keys())})
+    return pd.DataFrame(banco), f17
+
+
+def survey_files(rows: int, open_questions: int = 3, seed: int = 42, **kwargs) -> Tuple[bytes, bytes]:
+    """Banco e F17 em xlsx (bytes), prontos para upload"""
+    banco, f17 = generate_survey(rows, open_questions, seed=seed, **kwargs)
+    banco_buffer = io.BytesIO()
+    banco.to_excel(banco_buffer, index=False)
+    f17_buffer = io.BytesIO()
+    with pd.ExcelWriter(f17_buffer) as writer:
+        for name, sheet in f17.items():
+            sheet.to_excel(writer, sheet_name=name, index=False)
+    return banco_buffer.getvalue(), f17_buffer.getvalue()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Gera banco e F17 sintéticos em pt-BR')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--open-questions', type=int, default=3)
+    parser.add_argument('--semi-open-questions', type=int, default=1)
+    parser.add_argument('--closed-questions', type=int, default=1)
+    parser.add_argument('--typo-rate', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default='pesquisa_sintetica', help='prefixo dos arquivos gerados')
+    args = parser.parse_args(argv)
+    banco, f17 = generate_survey(args.rows, args.open_questions, args.closed_questions, args.semi_open_questions,
+                                 args.seed, args.typo_rate)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    banco_path = f"{args.out}_banco.xlsx"
+    f17_path = f"{args.out}_f17.xlsx"
+    banco.to_excel(banco_path, index=False)
+    with pd.ExcelWriter(f17_path) as writer:
+        for name, sheet in f17.items():
+            sheet.to_excel(writer, sheet_name=name, index=False)
+    for name in banco.columns:
+        print(f"{name}: {banco[name].astype(str).nunique()} valores únicos em {len(banco)} linhas")
+    print(f"Gerados: {banco_path}, {f17_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""
+Checkpoints e cache de resultados do processamento em lote
+- Cada questão concluída tem o resultado completo gravado em disco assim que termina
+  (checkpoint para retomar um lote interrompido e cache para reenvios do mesmo conteúdo)
+- Chave da questão = hash de: nome e valores normalizados da coluna do banco, códigos da aba
+  do F17 e versão do pipeline/prompts. Mudou qualquer um, a questão é reprocessada
+- Arquivos de saída já gerados de uma questão (modo por questão) também ficam guardados:
+  um resultado reaproveitado não regera as planilhas
+- Envio idêntico (mesmo hash dos arquivos de banco e F17, mesmo formato de saída) reaproveita o
+  ZIP inteiro de um lote anterior, sem abrir as planilhas
+- Gravação atômica (arquivo temporário + rename): um worker que morre no meio não deixa
+  entrada corrompida
+"""
+
+import gzip
+import hashlib
+import json
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# Entradas sem uso há mais que isso são removidas (prune)
+CHECKPOINT_TTL_DAYS = float(os.getenv('CHECKPOINT_TTL_DAYS', 7))
+
+# Tamanho dos blocos lidos ao calcular o hash dos arquivos enviados
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _normalize_value(value: Any) -> Any:
+    """Valor da coluna em forma canônica para o hash (ausentes unificados, tipos numpy -> Python)"""
+    if value is None:
+        return None
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        try:
+            value = value.item()
+        except (ValueError, TypeError):
+            pass
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if value.__class__.__name__ in ('NAType', 'NaTType'):
+        return None
+    return value
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CheckpointStore:
+    """Resultados de questões (<hash>.pkl.gz), suas saídas (<hash>.outputs.pkl.gz) e pacotes de
+    envios completos (upload_<hash>.zip + .json) dentro de 'root'"""
+
+    def __init__(self, root: str, version: str = ''):
+        self.root = root
+        # Versão do pipeline/prompts: entra em todas as chaves
+        self.version = version
+        os.makedirs(root, exist_ok=True)
+
+    def key_for(self, question_name: str, question_data: List[Any], existing_codes: Dict[str, Any],
+                representatives: Optional[Dict[str, str]] = None) -> str:
+        """Hash do conteúdo da questão (coluna do banco + aba do F17 + versão). No lote, inclui os
+        representantes das variantes da coluna (ver GlobalResponseTable.representatives), que
+        dependem das demais colunas do banco"""
+        payload = json.dumps(
+            [self.version, str(question_name), [_normalize_value(v) for v in question_data],
+             sorted(((str(k), _normalize_value(v)) for k, v in existing_codes.items()), key=str),
+             sorted((representatives or {}).items())],
+            default=str, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _read(self, name: str) -> Optional[Any]:
+        path = self._path(name)
+        try:
+            with gzip.open(path, 'rb') as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Entrada ilegível: a questão é reprocessada
+            print(f"[DEBUG] Checkpoint {name} ignorado: {e}", flush=True)
+            return None
+        # Uso renova o prazo de expiração
+        os.utime(path)
+        return value
+
+    def _write(self, name: str, value: Any, compresslevel: int = 6):
+        """Grava atomicamente; falhas não interrompem o processamento"""
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=compresslevel) as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(name))
+        except Exception as e:
+            print(f"[DEBUG] Falha ao gravar checkpoint {name}: {e}", flush=True)
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._read(f"{key}.pkl.gz")
+
+    def save(self, key: str, result: Dict[str, Any]):
+        self._write(f"{key}.pkl.gz", result)
+
+    def load_outputs(self, key: str) -> Optional[Dict[str, Tuple[str, bytes]]]:
+        """Arquivos já gerados da questão (formato de render_improved_outputs)"""
+        return self._read(f"{key}.outputs.pkl.gz")
+
+    def save_outputs(self, key: str, outputs: Dict[str, Tuple[str, bytes]]):
+        # Planilhas já são ZIP: compressão mínima
+        self._write(f"{key}.outputs.pkl.gz", outputs, compresslevel=1)
+
+    def upload_key(self, banco_path: str, f17_path: str, output_mode: str) -> str:
+        """Hash de um envio (conteúdo dos dois arquivos + formato de saída + versão), sem parsing"""
+        payload = json.dumps([self.version, file_digest(banco_path), file_digest(f17_path), output_mode])
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def load_upload(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """(caminho do ZIP, manifesto) de um envio idêntico já processado, ou None"""
+        zip_path = self._path(f"upload_{key}.zip")
+        manifest_path = self._path(f"upload_{key}.json")
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if not os.path.exists(zip_path):
+                return None
+            os.utime(zip_path)
+            os.utime(manifest_path)
+        except (OSError, ValueError):
+            return None
+        return zip_path, manifest
+
+    def save_upload(self, key: str, result_zip: str, manifest: Dict[str, Any]):
+        """Guarda o ZIP final de um envio (link físico quando possível) e o manifesto das questões"""
+        try:
+            tmp_path = self._path(f"upload_{key}.{os.getpid()}.part")
+            try:
+                os.link(result_zip, tmp_path)
+            except OSError:
+                shutil.copyfile(result_zip, tmp_path)
+            os.replace(tmp_path, self._path(f"upload_{key}.zip"))
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path(f"upload_{key}.json"))
+        except Exception as e:
+            print(f"[DEBUG] Falha ao guardar resultado do envio {key[:12]}: {e}", flush=True)
+
+    def prune(self, max_age_seconds: float = CHECKPOINT_TTL_DAYS * 86400) -> int:
+        """Remove entradas (e temporários órfãos) sem uso há mais de max_age_seconds"""
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for entry in os.scandir(self.root):
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                continue
+        return removed
@@ -0,0 +1,106 @@
+"""
+Carregamento do F17 (codebook) em uma única passada
+- Abre o workbook uma vez, em modo somente leitura (streaming) do openpyxl
+- Extrai código/descrição de cada aba de forma vetorizada
+- Resolve coluna do banco -> aba do F17 por índice normalizado pré-computado
+"""
+
+import re
+import unicodedata
+from typing import Dict, List, Optional
+
+import pandas as pd
+from openpyxl import load_workbook
+
+
+def normalize_sheet_name(name) -> str:
+    """Normaliza nome de aba/coluna: sem acentos, minúsculo, espaços simples."""
+    s = unicodedata.normalize('NFKD', str(name).strip().lower())
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+    return re.sub(r'\s+', ' ', s)
+
+
+def extract_codes(codes_raw: List, descs_raw: List) -> Dict[str, int]:
+    """Converte as colunas 0 (código) e 1 (descrição) de uma aba em {descrição: código}"""
+    if not codes_raw:
+        return {}
+    codes = pd.to_numeric(pd.Series(codes_raw, dtype=object), errors='coerce')
+    descs = pd.Series(descs_raw, dtype=object)
+    valid = codes.notna() & descs.notna()
+    codes = codes[valid].astype(int)
+    descs = descs[valid].astype(str)
+    # dict() mantém a última ocorrência de descrições repetidas, como na leitura linha a linha
+    return dict(zip(descs.tolist(), codes.tolist()))
+
+
+class F17Workbook:
+    """Codebooks de todas as abas do F17, carregados uma única vez"""
+
+    def __init__(self, codebooks: Dict[str, Dict[str, int]]):
+        self.codebooks = codebooks
+        self.sheet_names = list(codebooks.keys())
+        # Índices pré-computados para resolução coluna -> aba
+        self._exact_index: Dict[str, str] = {}
+        self._normalized_index: Dict[str, str] = {}
+        self._normalized_names = []
+        for sheet in self.sheet_names:
+            self._exact_index.setdefault(str(sheet).strip(), sheet)
+            norm = normalize_sheet_name(sheet)
+            self._normalized_index.setdefault(norm, sheet)
+            self._normalized_names.append((sheet, norm))
+        self._resolved: Dict[str, Optional[str]] = {}
+
+    @classmethod
+    def load(cls, path: str) -> 'F17Workbook':
+        """Lê todas as abas do F17 em uma passada (xlsx em streaming; xls via pandas)"""
+        try:
+            wb = load_workbook(path, read_only=True, data_only=True)
+        except Exception:
+            # Formatos que o openpyxl não lê (ex.: .xls): pandas lê todas as abas de uma vez
+            sheets = pd.read_excel(path, sheet_name=None)
+            return cls({
+                name: extract_codes(df.iloc[:, 0].tolist(), df.iloc[:, 1].tolist()) if len(df.columns) >= 2 else {}
+                for name, df in sheets.items()
+            })
+
+        codebooks = {}
+        try:
+            for ws in wb.worksheets:
+                codes_raw = []
+                descs_raw = []
+                # Primeira linha é o cabeçalho (mesmo comportamento do pd.read_excel)
+                for row in ws.iter_rows(min_row=2, max_col=2, values_only=True):
+                    if len(row) < 2:
+                        continue
+                    codes_raw.append(row[0])
+                    descs_raw.append(row[1])
+                codebooks[ws.title] = extract_codes(codes_raw, descs_raw)
+        finally:
+            wb.close()
+        return cls(codebooks)
+
+    def resolve_sheet(self, column_name) -> Optional[str]:
+        """Aba correspondente à coluna: exata, normalizada, ou por inclusão (nesta ordem)"""
+        col_safe = str(column_name).strip()
+        if col_safe in self._resolved:
+            return self._resolved[col_safe]
+
+        sheet = self._exact_index.get(col_safe)
+        if sheet is None:
+            col_norm = normalize_sheet_name(col_safe)
+            sheet = self._normalized_index.get(col_norm)
+            if sheet is None:
+                for candidate, norm in self._normalized_names:
+                    if col_norm in norm or norm in col_norm:
+                        sheet = candidate
+                        break
+
+        self._resolved[col_safe] = sheet
+        return sheet
+
+    def codes_for(self, column_name) -> Dict[str, int]:
+        """Codebook {descrição: código} da aba correspondente à coluna (vazio se não houver)"""
+        sheet = self.resolve_sheet(column_name)
+        if sheet is None:
+            return {}
+        return dict(self.codebooks.get(sheet, {}))
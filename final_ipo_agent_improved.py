@@ -5,12 +5,26 @@ Agente IPO Final Melhorado
 - Relatório detalhado como modelo fornecido
 """
 
+import io
 import pandas as pd
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import Dict, List, Any, Tuple
 
-from improved_coding_system import ImprovedIPOCodingSystem
+from batch_dedup import GlobalResponseTable
+from improved_coding_system import OPENAI_MODEL, ImprovedIPOCodingSystem, prompt_version
+import local_stages
+import model_routing
+import shard_sizer
+import token_accounting
+
+# Versão da lógica que gera o resultado de uma questão: incremente ao alterar o pipeline
+# (junto com prompt_version(), invalida o cache de resultados)
+PIPELINE_VERSION = '3'
+
+# Blocos de uma mesma questão enviados ao LLM ao mesmo tempo
+SHARD_PARALLELISM = int(os.getenv('SHARD_PARALLELISM', 4))
 
 class FinalIPOAgentImproved:
     """Agente IPO final com sistema melhorado"""
@@ -18,6 +32,10 @@ class FinalIPOAgentImproved:
     def __init__(self):
         self.coding_system = ImprovedIPOCodingSystem()
     
+    def result_version(self) -> str:
+        """Versão dos resultados produzidos (pipeline + prompts/configuração + modelos roteados)"""
+        return f"{PIPELINE_VERSION}:{prompt_version()}:{model_routing.routing_version(OPENAI_MODEL)}"
+    
     def analyze_question_type(self, data: list) -> str:
         """
         Analisa o tipo de questão conforme regras do IPO:
@@ -50,7 +68,101 @@ class FinalIPOAgentImproved:
         else:
             return "aberta"
 
-    def process_single_question_with_chatgpt(self, question_data: list, existing_codes: dict, question_name: str) -> dict:
+    def f17_prompt_lines(self, existing_codes: dict) -> List[str]:
+        """Linhas 'código | descrição' do F17 enviadas no prompt de agrupamento"""
+        return [f"{code} | {desc}" for desc, code in existing_codes.items()]
+
+    def grouping_request(self, name: str, value_counts: dict, existing_codes: dict,
+                         response_table: GlobalResponseTable = None) -> Dict[str, Any]:
+        """Entrada da chamada de agrupamento da questão, calculada a partir das contagens de valores
+        (sem reler a coluna): os mesmos itens que process_single_question_with_chatgpt envia ao LLM.
+        Usada para empacotar questões pequenas (ver request_packing.py)"""
+        unique_items = []
+        for item in value_counts:
+            try:
+                float(item)
+            except ValueError:
+                if str(item).strip():
+                    unique_items.append(str(item).strip())
+        unique_items = sorted(set(unique_items))
+        if response_table is not None:
+            unique_items = response_table.split(unique_items, existing_codes)[0]
+        return {'name': name, 'responses': unique_items, 'f17': self.f17_prompt_lines(existing_codes)}
+
+    def _group_question_items(self, items: List[str], f17_list: List[str], existing_codes: dict,
+                              route: model_routing.Route) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+        """Agrupa os itens da questão pela rota escolhida: LLM em blocos ou agrupador local"""
+        if route.is_local:
+            return self.coding_system.group_responses_intelligent(items, existing_codes)
+        return self._group_in_shards(items, f17_list, existing_codes, route)
+
+    def _group_in_shards(self, items: List[str], f17_list: List[str], existing_codes: dict,
+                         route: model_routing.Route) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+        """group_with_chatgpt em blocos dimensionados pelo shard_sizer (em paralelo), com a perda
+        observada em cada bloco registrada para o modelo da rota. Retorna (codes, groups) combinados"""
+        sizer = shard_sizer.get_sizer()
+        prefix_tokens = token_accounting.estimate_tokens(self.coding_system._grouping_messages([], None)[0]['content'])
+        shards = sizer.plan(items, route.model, f17_list, prefix_tokens)
+        normalized_f17 = {self.coding_system.normalize_text(k) for k in existing_codes}
+
+        def group_shard(shard):
+            with token_accounting.metering() as usage:
+                codes, groups = self.coding_system.group_with_chatgpt(shard, f17=f17_list, route=route)
+            if usage.calls:
+                # Só respostas reais da API ensinam o sizer (cache local repetiria a mesma observação)
+                covered = set()
+                for respostas in groups.values():
+                    for r in respostas:
+                        covered.add(str(r).strip())
+                        covered.add(self.coding_system.normalize_text(str(r)))
+                missing = 0
+                for item in shard:
+                    item_str = str(item).strip()
+                    item_norm = self.coding_system.normalize_text(item_str)
+                    if item_str not in covered and item_norm not in covered and item_str not in existing_codes and item_norm not in normalized_f17:
+                        missing += 1
+                sizer.observe(route.model, len(shard), missing, shard_sizer.output_tokens(shard))
+            return codes, groups
+
+        if len(shards) == 1:
+            return group_shard(shards[0])
+        # in_context: os blocos herdam medidores e prioridade do llm_gate (questão interativa segue interativa)
+        with ThreadPoolExecutor(max_workers=min(len(shards), SHARD_PARALLELISM)) as executor:
+            results = list(executor.map(token_accounting.in_context(group_shard), shards))
+
+        # Combina os blocos: mesmo título une as respostas; código novo repetido entre blocos é renumerado
+        codes_ret, groups_ret = dict(results[0][0]), {k: list(v) for k, v in results[0][1].items()}
+        f17_values = set(existing_codes.values())
+        used_codes = set(codes_ret.values()) | f17_values
+        for codes, groups in results[1:]:
+            for titulo, respostas in groups.items():
+                if titulo in groups_ret:
+                    groups_ret[titulo].extend(r for r in respostas if r not in groups_ret[titulo])
+                    continue
+                code = codes.get(titulo)
+                if code is None or (code in used_codes and code not in f17_values):
+                    code = max(used_codes | {9}) + 1
+                codes_ret[titulo] = code
+                groups_ret[titulo] = list(respostas)
+                used_codes.add(code)
+        # Títulos equivalentes criados em blocos diferentes viram um só grupo
+        groups_ret = self.coding_system.merge_similar_groups(groups_ret, threshold=85)
+        codes_ret = {titulo: codes_ret[titulo] for titulo in groups_ret}
+        return codes_ret, groups_ret
+
+    def process_single_question_with_chatgpt(self, question_data: list, existing_codes: dict, question_name: str,
+                                             response_table: GlobalResponseTable = None) -> dict:
+        """Codifica uma questão. Com response_table (processamento em lote), variantes da mesma resposta
+        vão uma única vez ao LLM e não-respostas triadas recebem o código reservado sem chamada ao LLM.
+        O resultado traz o uso de tokens da questão em 'usage'"""
+        # Termos do F17 entram no índice ortográfico (só para esta questão) antes de qualquer correção
+        with token_accounting.metering() as usage, self.coding_system.codebook_vocabulary(existing_codes):
+            result = self._code_question(question_data, existing_codes, question_name, response_table)
+        result['usage'] = usage.summary(responses=len(question_data))
+        return result
+
+    def _code_question(self, question_data: list, existing_codes: dict, question_name: str,
+                       response_table: GlobalResponseTable = None) -> dict:
         print(f"[DEBUG] Entrou em process_single_question_with_chatgpt para: {question_name}", flush=True)
         
         # 1. Análise do Tipo de Questão (Lógica IPO)
@@ -71,6 +183,7 @@ class FinalIPOAgentImproved:
                 'code_column': question_data, # Retorna os próprios dados como códigos
                 'response_column': question_data,
                 'processing_method': 'ignorado_fechada',
+                'question_type': q_type,
                 'statistics': {'total_codes': 0, 'new_codes_count': 0, 'groups_with_multiple': 0, 'largest_group_size': 0}
             }
 
@@ -102,16 +215,32 @@ class FinalIPOAgentImproved:
         
         print(f"[DEBUG] Dados para processar na IA: {len(items_to_process)} itens totais -> {len(unique_items)} itens ÚNICOS", flush=True)
 
+        # Tabela global do lote: variantes deduplicadas pela forma normalizada e não-respostas
+        # triadas (códigos reservados) ficam fora da chamada ao LLM
+        llm_items = unique_items
+        triaged = {}
+        if response_table is not None:
+            llm_items, triaged = response_table.split(unique_items, existing_codes)
+            print(f"[DEBUG] Tabela global do lote: {len(unique_items)} itens únicos -> {len(llm_items)} para a IA, "
+                  f"{len(triaged)} não-respostas triadas", flush=True)
+
         print(f"[DEBUG] Dados recebidos: question_data={len(question_data)} itens, existing_codes={len(existing_codes)}", flush=True)
         # Converte códigos existentes para lista de strings para o prompt
-        f17_list = [f"{code} | {desc}" for desc, code in existing_codes.items()]
-        processing_method = "chatgpt"
+        f17_list = self.f17_prompt_lines(existing_codes)
+        # Modelo por tamanho da questão ou fallback local (orçamento / circuit breaker): a rota
+        # fica registrada em processing_method
+        route = self.coding_system.route('grouping', len(llm_items)) if llm_items else None
+        processing_method = route.label() if route else "triagem_lote"
+        codes_ret, groups_ret = {}, {}
         
         # Usa APENAS ChatGPT - sem fallback local
         try:
             # group_with_chatgpt retorna (codes_dict, groups_dict) ou ({}, {}) em caso de erro
             # Passamos apenas os itens ÚNICOS para criar o Codebook
-            codes_ret, groups_ret = self.coding_system.group_with_chatgpt(unique_items, f17=f17_list)
+            # Lista dividida em blocos que cabem no orçamento de saída do modelo (shard_sizer),
+            # para que o retry abaixo seja exceção
+            if llm_items:
+                codes_ret, groups_ret = self._group_question_items(llm_items, f17_list, existing_codes, route)
             
             # --- LÓGICA DE RETRY PARA ITENS NÃO MAPEADOS ---
             # Verifica quais itens únicos NÃO foram cobertos por nenhum grupo retornado nem pelo F17
@@ -130,7 +259,7 @@ class FinalIPOAgentImproved:
             normalized_f17 = {self.coding_system.normalize_text(k): v for k, v in existing_codes.items()}
             
             items_missing = []
-            for item in unique_items:
+            for item in llm_items:
                 item_str = str(item).strip()
                 item_norm = self.coding_system.normalize_text(item_str)
                 
@@ -162,8 +291,8 @@ class FinalIPOAgentImproved:
                     retry_prompt_suffix = "\n\nIMPORTANT: You MUST provide a code for EACH of these remaining items. Do not skip any."
                     
                     # Usa uma chamada dedicada para o retry se possível, ou a mesma função
-                    # Aqui usamos a mesma função mas passando apenas os faltantes
-                    codes_retry, groups_retry = self.coding_system.group_with_chatgpt(items_missing, f17=f17_list)
+                    # Aqui usamos o mesmo caminho em blocos, já com o orçamento ajustado pela perda observada
+                    codes_retry, groups_retry = self._group_question_items(items_missing, f17_list, existing_codes, route)
                     
                     if codes_retry and groups_retry:
                         print(f"[DEBUG] ✅ Retry bem sucedido! Recuperados {len(codes_retry)} novos códigos.", flush=True)
@@ -253,7 +382,7 @@ class FinalIPOAgentImproved:
             # Não adiciona mais contexto para evitar duplicação
             raise e_gpt
 
-        if not codes_ret or not groups_ret:
+        if llm_items and (not codes_ret or not groups_ret):
             error_msg = "ChatGPT retornou resultado vazio ou inválido. Verifique sua chave de API e tente novamente."
             print(f"[DEBUG] {error_msg}", flush=True)
             raise Exception(error_msg)
@@ -336,6 +465,13 @@ class FinalIPOAgentImproved:
                  adjusted_codes[desc] = code
                  adjusted_groups[desc] = []
 
+        # Não-respostas triadas pela tabela do lote (código reservado ou o do F17 correspondente)
+        for item, (code, titulo) in triaged.items():
+            if titulo not in adjusted_codes:
+                adjusted_codes[titulo] = code
+                adjusted_groups[titulo] = []
+            adjusted_groups[titulo].append(item)
+
         codes = adjusted_codes
         groups = adjusted_groups
         detailed_report = self.coding_system.create_detailed_report(codes, groups, question_name, processing_method)
@@ -426,86 +562,46 @@ class FinalIPOAgentImproved:
         # REFAZENDO O LOOP PRINCIPAL PARA SUPORTAR OS TIPOS
         code_column = []
         response_column = []
+        processed_indices = set(indices_to_process)
+        reserved_response_codes = [55, 66, 77, 88, 98, 99]
+
+        # Mapeamento reverso calculado uma vez por valor único (em paralelo para colunas grandes)
+        values_to_match = []
+        for i, resp in enumerate(question_data):
+            if q_type == "semi-aberta" and i not in processed_indices:
+                continue
+            if isinstance(resp, (int, float)) and int(resp) in reserved_response_codes:
+                continue
+            values_to_match.append(str(resp).strip())
+        matched_codes = local_stages.match_many(
+            self.coding_system, list(dict.fromkeys(values_to_match)), response_to_code, existing_codes
+        )
         
         for i, resp in enumerate(question_data):
             # Se for semi-aberta e este índice NÃO foi processado (era número), mantém original
-            if q_type == "semi-aberta" and i not in indices_to_process:
+            if q_type == "semi-aberta" and i not in processed_indices:
                 code_column.append(resp) # Mantém o número original
                 response_column.append(resp)
                 continue
-                
-            found = False
             
             # Se for código numérico explícito (NS/NR) em questão aberta, mantém
             if isinstance(resp, (int, float)):
                 resp_num = int(resp)
-                if resp_num in [55, 66, 77, 88, 98, 99]:
+                if resp_num in reserved_response_codes:
                     code_column.append(resp_num)
                     response_column.append(resp)
-                    found = True
+                    continue
             
-            if not found:
-                # Normaliza resposta original para busca
-                resp_str = str(resp).strip()
-                resp_norm = self.coding_system.normalize_text(resp_str)
-                
-                # Tenta match exato (sem normalização primeiro)
-                if resp_str in response_to_code:
-                    code, resp_original = response_to_code[resp_str]
-                    code_column.append(code)
-                    response_column.append(resp)
-                    found = True
-                # Tenta match exato normalizado
-                elif resp_norm in response_to_code:
-                    code, resp_original = response_to_code[resp_norm]
-                    code_column.append(code)
-                    response_column.append(resp)
-                    found = True
-                else:
-                    # Tenta match parcial/fuzzy
-                    best_match = None
-                    best_score = 0
-                    for resp_norm_key, (code, resp_original) in response_to_code.items():
-                        # Match exato após normalização
-                        if resp_norm == resp_norm_key:
-                            best_match = (code, resp)
-                            best_score = 100
-                            break
-                        # Match parcial (substring)
-                        if resp_norm in resp_norm_key or resp_norm_key in resp_norm:
-                            score = min(len(resp_norm), len(resp_norm_key)) / max(len(resp_norm), len(resp_norm_key), 1)
-                            if score > best_score:
-                                best_score = score
-                                best_match = (code, resp)
-                    
-                    if best_match and best_score >= 0.8:  # Threshold de 80%
-                        code, resp_original = best_match
-                        code_column.append(code)
-                        response_column.append(resp)
-                        found = True
-                    else:
-                        # Tenta fuzzy matching como último recurso
-                        from fuzzywuzzy import fuzz
-                        for resp_norm_key, (code, resp_original) in response_to_code.items():
-                            score = fuzz.ratio(resp_norm, resp_norm_key)
-                            if score > best_score:
-                                best_score = score
-                                best_match = (code, resp)
-                        
-                        if best_match and best_score >= 85:  # Threshold de 85% para fuzzy
-                            code, resp_original = best_match
-                            code_column.append(code)
-                            response_column.append(resp)
-                            found = True
-            
-            if not found:
+            # Match exato, normalizado, parcial (substring) ou fuzzy - ver local_stages.ResponseMatcher
+            found_code = matched_codes.get(str(resp).strip())
+            if found_code is not None:
+                code_column.append(found_code)
+                response_column.append(resp)
+            else:
                 # Não encontrou match - marca como ERROR
                 resp_debug = str(resp).strip()
                 resp_norm_debug = self.coding_system.normalize_text(resp_debug)
                 print(f"[DEBUG] Resposta não mapeada: '{resp_debug}' (normalizada: '{resp_norm_debug}')", flush=True)
-                if len(response_to_code) > 0:
-                     # Debug limitado
-                     pass
                 code_column.append('ERROR')
                 response_column.append(resp)
         new_codes = {desc: code for desc, code in codes.items() if desc not in existing_codes}
@@ -562,24 +658,50 @@ class FinalIPOAgentImproved:
     def save_improved_outputs(self, result: Dict[str, Any], output_dir: str = ".") -> Dict[str, str]:
         """Salva arquivos de saída melhorados"""
         
+        files_created = {}
+        for key, (filename, content) in self.render_improved_outputs(result).items():
+            path = os.path.join(output_dir, filename)
+            with open(path, 'wb') as f:
+                f.write(content)
+            files_created[key] = path
+        
+        return files_created
+    
+    def render_improved_outputs(self, result: Dict[str, Any]) -> Dict[str, Tuple[str, bytes]]:
+        """Gera os arquivos de saída em memória: chave -> (nome do arquivo, conteúdo)"""
+        
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         safe_name = result['question_name'].replace('/', '_').replace('?', '').replace(':', '')[:30]
         base_name = f"{safe_name}_{timestamp}"
         
-        files_created = {}
+        outputs = {}
         
         # 1. Banco codificado
-        banco_path = os.path.join(output_dir, f"{base_name}_banco_codificado.xlsx")
         banco_df = pd.DataFrame({
             'Código': result['code_column'],
             'Resposta': result['response_column']
         })
-        banco_df.to_excel(banco_path, index=False)
-        files_created['banco'] = banco_path
+        buffer = io.BytesIO()
+        banco_df.to_excel(buffer, index=False)
+        outputs['banco'] = (f"{base_name}_banco_codificado.xlsx", buffer.getvalue())
         
         # 2. F17 atualizado
-        f17_path = os.path.join(output_dir, f"{base_name}_f17_atualizado.xlsx")
+        f17_df = pd.DataFrame(self.build_final_f17(result))
+        buffer = io.BytesIO()
+        f17_df.to_excel(buffer, index=False)
+        outputs['f17'] = (f"{base_name}_f17_atualizado.xlsx", buffer.getvalue())
+        
+        # 3. Relatório detalhado de agrupamentos
+        outputs['relatorio'] = (f"{base_name}_relatorio_agrupamentos.txt", result['detailed_report'].encode('utf-8'))
         
+        # 4. Resumo estatístico
+        resumo_content = self.create_statistical_summary(result)
+        outputs['resumo'] = (f"{base_name}_resumo_estatistico.txt", resumo_content.encode('utf-8'))
+        
+        return outputs
+    
+    def build_final_f17(self, result: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Linhas do F17 atualizado ({'Código', 'Descrição'}), ordenadas por código"""
         # Padroniza descrições antes de salvar
         # Separa o que é do F17 original (confiável) do que é novo (precisa de revisão)
         original_f17_descs = set(result['existing_codes'].keys())
@@ -598,30 +720,13 @@ class FinalIPOAgentImproved:
                     if hasattr(self.coding_system, 'standardize_with_chatgpt') and getattr(self.coding_system, 'chatgpt_available', False):
                          final_desc = self.coding_system.standardize_with_chatgpt(clean_desc)
                     else:
-                         final_desc = self.coding_system.correct_text(clean_desc)
+                         with self.coding_system.codebook_vocabulary(result['existing_codes']):
+                             final_desc = self.coding_system.correct_text(clean_desc)
                 except Exception:
                     final_desc = desc # Mantém original em caso de erro
             
             final_f17_list.append({'Código': code, 'Descrição': final_desc})
-
-        f17_df = pd.DataFrame(final_f17_list)
-        f17_df.to_excel(f17_path, index=False)
-        files_created['f17'] = f17_path
-        
-        # 3. Relatório detalhado de agrupamentos
-        relatorio_path = os.path.join(output_dir, f"{base_name}_relatorio_agrupamentos.txt")
-        with open(relatorio_path, 'w', encoding='utf-8') as f:
-            f.write(result['detailed_report'])
-        files_created['relatorio'] = relatorio_path
-        
-        # 4. Resumo estatístico
-        resumo_path = os.path.join(output_dir, f"{base_name}_resumo_estatistico.txt")
-        resumo_content = self.create_statistical_summary(result)
-        with open(resumo_path, 'w', encoding='utf-8') as f:
-            f.write(resumo_content)
-        files_created['resumo'] = resumo_path
-        
-        return files_created
+        return final_f17_list
     
     def create_statistical_summary(self, result: Dict[str, Any]) -> str:
         """Cria resumo estatístico do processamento"""
@@ -635,12 +740,16 @@ class FinalIPOAgentImproved:
         # Método de processamento
         processing_method = result.get('processing_method', 'desconhecido')
         method_display = {
-            'chatgpt': '🤖 ChatGPT (OpenAI GPT-4o)',
+            'chatgpt': '🤖 ChatGPT (OpenAI)',
             'fallback_local': '🔧 Agrupador Local (Fallback)',
+            'triagem_lote': '📋 Somente não-respostas (triagem do lote)',
             'desconhecido': '❓ Método Desconhecido'
         }
         lines.append("MÉTODO DE PROCESSAMENTO:")
-        lines.append(f"- {method_display.get(processing_method, f'❓ {processing_method}')}")
+        # Rota registrada após ':' (modelo ou motivo do fallback local; ver model_routing.py)
+        method, _, route_detail = processing_method.partition(':')
+        method_label = method_display.get(method, f'❓ {processing_method}')
+        lines.append(f"- {method_label} [{route_detail}]" if route_detail else f"- {method_label}")
         lines.append("")
         
         # Calcula frequências REAIS baseadas na coluna de códigos final
@@ -669,6 +778,17 @@ class FinalIPOAgentImproved:
         lines.append(f"- Maior grupo: {largest_group_size} respostas")
         lines.append("")
         
+        # Uso do LLM na questão (chamadas empacotadas com outras questões contam só no total do lote)
+        usage = result.get('usage')
+        if usage:
+            lines.append("USO DO LLM:")
+            lines.append(f"- Chamadas: {usage['calls']} (respostas do cache local: {usage['cache_hits']})")
+            lines.append(f"- Tokens de prompt: {usage['prompt_tokens']} (em cache no provedor: {usage['cached_tokens']}, "
+                         f"estimados: {usage['estimated_prompt_tokens']})")
+            lines.append(f"- Tokens de resposta: {usage['completion_tokens']}")
+            lines.append(f"- Custo estimado: US$ {usage['cost_usd']:.4f}")
+            lines.append("")
+        
         # Códigos existentes utilizados
         existing_used = []
         for desc, code in result['existing_codes'].items():
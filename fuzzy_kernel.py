@@ -0,0 +1,130 @@
+"""
+Kernel de pontuação fuzzy em lote
+- Recebe listas de consultas e escolhas e devolve matriz de scores ou top-k com corte
+- Usa rapidfuzz (C++, libera o GIL, multi-core) quando instalado
+- Sem rapidfuzz, usa fuzzywuzzy e divide matrizes grandes entre processos (pool spawn do
+  módulo, criado no primeiro uso e reaproveitado; chamado a partir de threads)
+- Scores idênticos aos do fuzzywuzzy (inteiros 0-100, mesmo pré-processamento)
+"""
+
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from fuzzywuzzy import fuzz, utils as fw_utils
+
+import job_queue
+
+try:
+    from rapidfuzz import fuzz as rf_fuzz, process as rf_process
+    HAS_RAPIDFUZZ = True
+except ImportError:
+    HAS_RAPIDFUZZ = False
+
+# Scorers suportados (nomes iguais às funções do fuzzywuzzy)
+SCORERS = {
+    'ratio': fuzz.ratio,
+    'token_set_ratio': fuzz.token_set_ratio,
+}
+
+# Abaixo deste número de pares a execução é serial (overhead de processos não compensa)
+PARALLEL_MIN_PAIRS = int(os.getenv('FUZZY_PARALLEL_MIN_PAIRS', 200_000))
+
+
+def default_workers() -> int:
+    """Número de workers (FUZZY_WORKERS ou número de CPUs)"""
+    try:
+        return max(1, int(os.getenv('FUZZY_WORKERS', os.cpu_count() or 1)))
+    except ValueError:
+        return os.cpu_count() or 1
+
+
+# Pools de processos por número de workers (spawn: o worker não herda threads/locks do processo)
+_pools: Dict[int, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    with _pools_lock:
+        pool = _pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=job_queue.WorkerContext())
+            _pools[workers] = pool
+        return pool
+
+
+def _prepare(strings: Sequence[str], scorer: str) -> List[str]:
+    """Aplica o mesmo pré-processamento que o fuzzywuzzy faz internamente"""
+    prepared = ['' if s is None else str(s) for s in strings]
+    if scorer == 'token_set_ratio':
+        prepared = [fw_utils.full_process(s, force_ascii=True) for s in prepared]
+    return prepared
+
+
+def _score_rows(queries: List[str], choices: List[str], scorer: str) -> np.ndarray:
+    """Pontua um bloco de consultas com o fuzzywuzzy (executado em processo worker)"""
+    func = SCORERS[scorer]
+    scores = np.zeros((len(queries), len(choices)), dtype=np.int32)
+    for i, q in enumerate(queries):
+        for j, c in enumerate(choices):
+            scores[i, j] = func(q, c)
+    return scores
+
+
+def score_matrix(queries: Sequence[str], choices: Sequence[str], scorer: str = 'token_set_ratio',
+                 workers: Optional[int] = None) -> np.ndarray:
+    """Matriz (len(queries) x len(choices)) de scores inteiros 0-100"""
+    if scorer not in SCORERS:
+        raise ValueError(f"Scorer desconhecido: {scorer}")
+    if not queries or not choices:
+        return np.zeros((len(queries), len(choices)), dtype=np.int32)
+
+    workers = workers or default_workers()
+
+    if HAS_RAPIDFUZZ:
+        q = _prepare(queries, scorer)
+        c = _prepare(choices, scorer)
+        rf_scorer = rf_fuzz.token_set_ratio if scorer == 'token_set_ratio' else rf_fuzz.ratio
+        raw = rf_process.cdist(q, c, scorer=rf_scorer, processor=None,
+                               dtype=np.float32, workers=workers if len(q) * len(c) >= PARALLEL_MIN_PAIRS else 1)
+        # fuzzywuzzy arredonda para inteiro (int(round(x)))
+        return np.rint(raw).astype(np.int32)
+
+    queries = list(queries)
+    choices = list(choices)
+    if workers <= 1 or len(queries) < 2 or len(queries) * len(choices) < PARALLEL_MIN_PAIRS:
+        return _score_rows(queries, choices, scorer)
+
+    chunk = max(1, -(-len(queries) // (workers * 4)))
+    blocks = [queries[i:i + chunk] for i in range(0, len(queries), chunk)]
+    # map preserva a ordem dos blocos: resultado determinístico
+    parts = list(_get_pool(workers).map(_score_rows, blocks, [choices] * len(blocks), [scorer] * len(blocks)))
+    return np.vstack(parts)
+
+
+def extract_best(query: str, choices: Sequence[str], scorer: str = 'token_set_ratio',
+                 score_cutoff: int = 0) -> Optional[Tuple[int, int]]:
+    """Melhor escolha para uma consulta: (índice, score) ou None abaixo do corte.
+    Em empate, vence o primeiro índice (mesmo comportamento dos loops com '>')."""
+    if not choices:
+        return None
+    row = score_matrix([query], choices, scorer, workers=1)[0]
+    index = int(np.argmax(row))
+    score = int(row[index])
+    if score < score_cutoff:
+        return None
+    return index, score
+
+
+def top_k(queries: Sequence[str], choices: Sequence[str], k: int = 1, scorer: str = 'token_set_ratio',
+          score_cutoff: int = 0, workers: Optional[int] = None) -> List[List[Tuple[int, int]]]:
+    """Para cada consulta, as k melhores escolhas [(índice, score), ...] com score >= score_cutoff"""
+    scores = score_matrix(queries, choices, scorer, workers)
+    results = []
+    for row in scores:
+        # ordenação estável: empates mantêm a ordem original das escolhas
+        order = np.argsort(-row, kind='stable')[:k]
+        results.append([(int(j), int(row[j])) for j in order if row[j] >= score_cutoff])
+    return results
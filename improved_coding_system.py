@@ -6,16 +6,25 @@ Sistema de Codificação IPO Melhorado
 """
 
 import pandas as pd
+import numpy as np
 import re
 from typing import Dict, List, Tuple, Any
 from collections import defaultdict
 import os
 import json
+import hashlib
+import contextvars
+from contextlib import contextmanager
 from datetime import datetime
 from openai import OpenAI
 
-def get_openai_client(api_key):
-    return OpenAI(api_key=api_key)
+def get_openai_client(api_key, base_url=None):
+    # Sem novas tentativas no cliente: 429/timeout voltam para o controle adaptativo (llm_gate.call)
+    # base_url: endpoint compatível da rota (model_routing) ou OPENAI_BASE_URL (ex.: servidor local de teste)
+    # LLM_MODE=record/replay: cliente que grava ou reproduz as chamadas (llm_replay)
+    return llm_replay.wrap_client(lambda: OpenAI(
+        api_key=api_key, base_url=base_url or os.getenv('OPENAI_BASE_URL') or None, max_retries=0,
+        timeout=float(os.getenv('LLM_REQUEST_TIMEOUT', 120))))
 from dotenv import load_dotenv
 from fuzzywuzzy import fuzz
 import unicodedata
@@ -23,20 +32,127 @@ from dotenv import load_dotenv
 from fuzzywuzzy import fuzz
 import unicodedata
 from cache_manager import CacheManager
+import batch_submission
+import fuzzy_kernel
+import llm_gate
+import llm_replay
+import local_stages
+import model_routing
+import token_accounting
+from spell_index import SymSpellIndex
 load_dotenv()
 
+# Vocabulário do F17 da questão em andamento: (chaves do F17, camada do índice ortográfico)
+_codebook_overlay: contextvars.ContextVar = contextvars.ContextVar('codebook_overlay', default=None)
+
+def prompt_version() -> str:
+    """Versão dos prompts e da configuração: hash dos arquivos em prompts/ e config/.
+    Entra na chave do cache de resultados (editar um prompt invalida os resultados antigos)"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for folder in ('prompts', 'config'):
+        folder_path = os.path.join(base_dir, folder)
+        if not os.path.isdir(folder_path):
+            continue
+        for name in sorted(os.listdir(folder_path)):
+            file_path = os.path.join(folder_path, name)
+            if os.path.isfile(file_path):
+                digest.update(f"{folder}/{name}\0".encode('utf-8'))
+                with open(file_path, 'rb') as f:
+                    digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+# Modelo usado nas chamadas ao LLM
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o')
+
+# Regras fixas do agrupamento: ficam no fim do prompt de sistema (prefixo idêntico em todas as
+# chamadas); as partes variáveis (F17 e respostas) vão nas mensagens seguintes
+GROUPING_RULES = (
+    "CRITICAL REQUIREMENTS:"
+    " 1. You MUST process ALL unique responses given in the last user message."
+    " 2. Create a Codebook that covers EVERY single response."
+    " 3. Use existing F17 codes when a response matches exactly or closely. You MUST return these groups too."
+    " 4. If you create new codes, start at 10 or the next available number."
+    " 5. Return a JSON array (list) of objects with the exact fields:"
+    " [{\"codigo\": <integer>, \"titulo\": <string>, \"respostas\": [<string>, ...]}, ...]."
+    " 6. IMPORTANT: Even if a response matches an existing F17 code, you MUST include it in the output JSON with that code."
+    " 7. Do NOT skip any response. The goal is to map every input to a code."
+)
+
+PACKED_GROUPING_RULES = (
+    "PACKED REQUEST: the user message contains several independent survey questions, each starting with"
+    " '### QUESTÃO: <name>' and followed by its own F17 codebook and responses. Apply the requirements above"
+    " to EACH question separately: never reuse groups or codes across questions, and new codes follow each"
+    " question's own F17. Return one entry per question: {\"questao\": <question name exactly as given>,"
+    " \"groups\": [{\"codigo\": <integer>, \"titulo\": <string>, \"respostas\": [<string>, ...]}, ...]}."
+)
+
+# Schema de function-calling: lista de objetos {codigo,titulo,respostas}
+_GROUP_ITEMS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "object",
+        "properties": {
+            "codigo": {"type": "integer"},
+            "titulo": {"type": "string"},
+            "respostas": {"type": "array", "items": {"type": "string"}}
+        },
+        "required": ["codigo", "titulo", "respostas"]
+    }
+}
+
+GROUPS_FUNCTION = {
+    "name": "return_groups",
+    "description": "Retorna uma lista de grupos codificados seguindo o formato IPO",
+    "parameters": {
+        "type": "object",
+        "properties": {"groups": _GROUP_ITEMS_SCHEMA},
+        "required": ["groups"]
+    }
+}
+
+# Várias questões em uma chamada: resposta indexada pelo nome da questão
+PACKED_GROUPS_FUNCTION = {
+    "name": "return_question_groups",
+    "description": "Retorna os grupos codificados de cada questão, seguindo o formato IPO",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "questao": {"type": "string"},
+                        "groups": _GROUP_ITEMS_SCHEMA
+                    },
+                    "required": ["questao", "groups"]
+                }
+            }
+        },
+        "required": ["questions"]
+    }
+}
+
 class ImprovedIPOCodingSystem:
     """Sistema de codificação melhorado com relatório detalhado"""
+
+    # Limite de assinaturas de similaridade mantidas em memória
+    SIGNATURE_CACHE_SIZE = 100_000
     
-    def __init__(self):
-        self.corrections = self.load_corrections()
-        self.similarity_patterns = self.load_similarity_patterns()
+    def __init__(self, corrections: Dict[str, str] = None, similarity_patterns: Dict[str, List[str]] = None,
+                 spell_index: SymSpellIndex = None):
+        self.corrections = corrections if corrections is not None else self.load_corrections()
+        self.similarity_patterns = similarity_patterns if similarity_patterns is not None else self.load_similarity_patterns()
         # Flag indicando se a API do ChatGPT está disponível (True/False/None)
         # None = não testado ainda, True = disponível, False = indisponível
         # Flag indicando se a API do ChatGPT está disponível (True/False/None)
         # None = não testado ainda, True = disponível, False = indisponível
         self.chatgpt_available = None
-        self.cache = CacheManager()
+        # CACHE_DB_PATH: cache de respostas fora da raiz do projeto (ex.: teste de carga)
+        self.cache = CacheManager(llm_replay.cache_db_path() or os.getenv('CACHE_DB_PATH', 'cache.db'))
+        self.spell_index = spell_index if spell_index is not None else self.build_spell_index()
+        self._signature_cache = {}
     
     def load_corrections(self) -> Dict[str, str]:
         """Carrega correções ortográficas de arquivo JSON ou usa padrão"""
@@ -112,6 +228,29 @@ class ImprovedIPOCodingSystem:
             
         return default_patterns
     
+    def build_spell_index(self) -> SymSpellIndex:
+        """Monta o índice ortográfico com a lista pt-BR e o vocabulário da configuração"""
+        vocabulary = list(self.corrections.values())
+        for keywords in self.similarity_patterns.values():
+            vocabulary.extend(keywords)
+        return SymSpellIndex.load_default(extra_words=vocabulary)
+
+    @contextmanager
+    def codebook_vocabulary(self, existing_codes: Dict[str, int]):
+        """Ativa, no contexto atual, as descrições do F17 como camada do índice ortográfico
+        (termos do codebook têm prioridade). O índice compartilhado entre questões não é alterado"""
+        vocabulary = frozenset(str(desc) for desc in existing_codes)
+        current = _codebook_overlay.get()
+        if current is not None and current[0] == vocabulary:
+            # mesma questão (chamada aninhada): reaproveita a camada e seu cache
+            yield
+            return
+        token = _codebook_overlay.set((vocabulary, self.spell_index.overlay(vocabulary)))
+        try:
+            yield
+        finally:
+            _codebook_overlay.reset(token)
+
     def correct_text(self, text: str) -> str:
         """Corrige ortografia do texto"""
         if pd.isna(text) or not isinstance(text, str):
@@ -131,7 +270,13 @@ class ImprovedIPOCodingSystem:
                 corrected_word = word.replace(clean_word, self.corrections[clean_word])
                 corrected_words.append(corrected_word)
             else:
-                corrected_words.append(word)
+                # Erros de digitação (distância 1/2) via índice de deleção simétrica
+                active = _codebook_overlay.get()
+                suggestion = self.spell_index.lookup(clean_word, active[1] if active else None) if clean_word else None
+                if suggestion and suggestion != clean_word:
+                    corrected_words.append(word.replace(clean_word, suggestion))
+                else:
+                    corrected_words.append(word)
         
         corrected = ' '.join(corrected_words)
         
@@ -166,11 +311,10 @@ class ImprovedIPOCodingSystem:
         norm = self.normalize_text(corrected)
 
         # regras simples de sinônimos/normalização
+        # (erros de digitação como 'polisia', 'egotos' e 'onibis' já chegam corrigidos pelo índice ortográfico)
         syn_map = {
             'onibus': 'onibus',
-            'ônibus': 'onibus',
-            'onibis': 'onibus',
-            'asfaltmento': 'asfalto',
+            'asfaltamento': 'asfalto',
             'asfalto': 'asfalto',
             'pavimentacao': 'asfalto',
             'pavimentacao/asfalto': 'asfalto',
@@ -179,14 +323,13 @@ class ImprovedIPOCodingSystem:
             'muito medico': 'medico',
             'mais medicos': 'medico',
             'medicos no posto': 'medico',
-            'polisia': 'policia',
             'policia': 'policia',
             'policiamento nas ruas': 'policiamento',
             'policiamento melhor': 'policiamento',
             'seguranca nas ruas': 'seguranca',
             'seguranca publica': 'seguranca',
             'mais seguranca': 'seguranca',
-            'egotos': 'esgoto',
+            'esgotos': 'esgoto',
             'esgotos emtupidos': 'esgoto',
             'saneamento basico': 'saneamento',
         }
@@ -202,49 +345,128 @@ class ImprovedIPOCodingSystem:
 
         return norm
     
+    def similarity_signature(self, text: str) -> Tuple[int, frozenset]:
+        """Assinatura de similaridade (cacheada): bitset das categorias encontradas + conjunto de palavras"""
+        text_lower = text.lower()
+        signature = self._signature_cache.get(text_lower)
+        if signature is None:
+            bits = 0
+            for bit, keywords in enumerate(self.similarity_patterns.values()):
+                if any(keyword in text_lower for keyword in keywords):
+                    bits |= 1 << bit
+            signature = (bits, frozenset(text_lower.split()))
+            if len(self._signature_cache) >= self.SIGNATURE_CACHE_SIZE:
+                self._signature_cache.clear()
+            self._signature_cache[text_lower] = signature
+        return signature
+
     def calculate_similarity(self, text1: str, text2: str) -> float:
         """Calcula similaridade entre dois textos"""
         if not text1 or not text2:
             return 0.0
         
-        text1_lower = text1.lower()
-        text2_lower = text2.lower()
-        
         # Similaridade exata
-        if text1_lower == text2_lower:
+        if text1.lower() == text2.lower():
             return 1.0
         
-        # Similaridade por palavras-chave
-        similarity_score = 0.0
+        bits1, words1 = self.similarity_signature(text1)
+        bits2, words2 = self.similarity_signature(text2)
         
-        for category, keywords in self.similarity_patterns.items():
-            text1_matches = sum(1 for keyword in keywords if keyword in text1_lower)
-            text2_matches = sum(1 for keyword in keywords if keyword in text2_lower)
-            
-            if text1_matches > 0 and text2_matches > 0:
-                similarity_score += 0.8  # Alta similaridade por categoria
+        # Similaridade por palavras-chave: 0.8 por categoria em comum
+        similarity_score = bin(bits1 & bits2).count('1') * 0.8
         
         # Similaridade por palavras comuns
-        words1 = set(text1_lower.split())
-        words2 = set(text2_lower.split())
-        
         if words1 and words2:
             common_words = words1.intersection(words2)
             word_similarity = len(common_words) / max(len(words1), len(words2))
             similarity_score += word_similarity * 0.5
         
         return min(similarity_score, 1.0)
+
+    def similarity_matrix(self, texts1: List[str], texts2: List[str], chunk_size: int = 1024) -> np.ndarray:
+        """Calcula calculate_similarity para todos os pares (texts1 x texts2) como operação NumPy"""
+        result = np.zeros((len(texts1), len(texts2)), dtype=np.float64)
+        if not texts1 or not texts2:
+            return result
+
+        n_categories = len(self.similarity_patterns)
+
+        def encode(texts):
+            lowers = [str(t).lower() if t else '' for t in texts]
+            signatures = [self.similarity_signature(t) if t else (0, frozenset()) for t in lowers]
+            categories = np.zeros((len(texts), n_categories), dtype=np.float32)
+            for row, (bits, _) in enumerate(signatures):
+                for bit in range(n_categories):
+                    if bits >> bit & 1:
+                        categories[row, bit] = 1.0
+            return lowers, signatures, categories
+
+        lowers2, signatures2, categories2 = encode(texts2)
+        vocab = {}
+        for _, words in signatures2:
+            for w in words:
+                vocab.setdefault(w, len(vocab))
+        tokens2 = np.zeros((len(texts2), len(vocab)), dtype=np.float32)
+        for row, (_, words) in enumerate(signatures2):
+            for w in words:
+                tokens2[row, vocab[w]] = 1.0
+        sizes2 = np.array([len(words) for _, words in signatures2], dtype=np.float64)
+        valid2 = np.array([bool(t) for t in lowers2])
+        exact_index = {}
+        for col, t in enumerate(lowers2):
+            exact_index.setdefault(t, []).append(col)
+
+        for start in range(0, len(texts1), chunk_size):
+            lowers1, signatures1, categories1 = encode(texts1[start:start + chunk_size])
+            tokens1 = np.zeros((len(lowers1), len(vocab)), dtype=np.float32)
+            for row, (_, words) in enumerate(signatures1):
+                for w in words:
+                    col = vocab.get(w)
+                    if col is not None:
+                        tokens1[row, col] = 1.0
+            sizes1 = np.array([len(words) for _, words in signatures1], dtype=np.float64)
+
+            score = (categories1 @ categories2.T).astype(np.float64) * 0.8
+            common = (tokens1 @ tokens2.T).astype(np.float64)
+            denom = np.maximum.outer(sizes1, sizes2)
+            both = np.outer(sizes1 > 0, sizes2 > 0)
+            score += np.divide(common, denom, out=np.zeros_like(common), where=both) * 0.5
+            np.minimum(score, 1.0, out=score)
+
+            # textos vazios não têm similaridade; iguais (case-insensitive) valem 1.0
+            valid1 = np.array([bool(t) for t in lowers1])
+            score[~valid1, :] = 0.0
+            score[:, ~valid2] = 0.0
+            for row, t in enumerate(lowers1):
+                if t:
+                    for col in exact_index.get(t, []):
+                        score[row, col] = 1.0
+            result[start:start + len(lowers1)] = score
+        return result
+
+    def similarity_scores(self, text: str, texts: List[str]) -> np.ndarray:
+        """Similaridade de um texto contra uma lista (ex.: todas as descrições de códigos)"""
+        return self.similarity_matrix([text], texts)[0]
     
     def group_responses_intelligent(self, responses: List[str], existing_codes: Dict[str, int], 
                                   similarity_threshold: float = 0.6) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
         """Agrupa respostas de forma inteligente"""
-        # Normaliza e corrige respostas e existing_codes
+        with self.codebook_vocabulary(existing_codes):
+            return self._group_responses_intelligent(responses, existing_codes, similarity_threshold)
+
+    def _group_responses_intelligent(self, responses: List[str], existing_codes: Dict[str, int],
+                                     similarity_threshold: float) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+        # Normaliza e corrige respostas (valores únicos; em paralelo quando a coluna é grande)
+        unique_texts = list(dict.fromkeys(
+            str(r) for r in responses if not pd.isna(r) and str(r).strip()
+        ))
+        prepared = dict(zip(unique_texts, local_stages.canonicalize_many(self, unique_texts, existing_codes)))
         corrected_responses = []
         for response in responses:
             if pd.isna(response) or not str(response).strip():
                 corrected_responses.append(response)
             else:
-                corrected_responses.append(self.correct_text(str(response)))
+                corrected_responses.append(prepared[str(response)][0])
 
         # Normaliza existing_codes para comparação (mantém mapa para recuperar descrição original)
         norm_existing_map = {}  # norm_desc -> (original_desc, code)
@@ -262,6 +484,27 @@ class ImprovedIPOCodingSystem:
         used_codes = [c for c in existing_codes.values() if c not in reserved_codes]
         next_code = max(used_codes) + 1 if used_codes else 10
 
+        # Formas canônicas de cada resposta (calculadas uma única vez)
+        canonical_forms = {}
+        for original_response, corrected_response in zip(responses, corrected_responses):
+            if pd.isna(original_response) or original_response in canonical_forms:
+                continue
+            if isinstance(corrected_response, str) and str(original_response) in prepared:
+                canonical_forms[original_response] = prepared[str(original_response)][1]
+            else:
+                canonical_forms[original_response] = self.canonicalize(corrected_response) if corrected_response is not None else ''
+
+        # Scores fuzzy de todas as respostas contra o F17 em uma única chamada ao kernel
+        norm_desc_list = list(norm_existing_map.keys())
+        unique_norms = list(dict.fromkeys(canonical_forms.values()))
+        norm_row = {norm: row for row, norm in enumerate(unique_norms)}
+        f17_scores = fuzzy_kernel.score_matrix(unique_norms, norm_desc_list, 'token_set_ratio')
+
+        # Grupos novos (fora do F17), na ordem de criação, com suas formas canônicas
+        new_group_keys = []
+        new_group_norms = []
+        canonical_to_group = {}
+
         # Processa cada resposta, priorizando códigos do F17
         processed = set()
         for original_response, corrected_response in zip(responses, corrected_responses):
@@ -284,58 +527,48 @@ class ImprovedIPOCodingSystem:
                 pass
 
             # Normaliza e canonicaliza para comparação
-            corr_norm = self.canonicalize(corrected_response) if corrected_response is not None else ''
+            corr_norm = canonical_forms[original_response]
 
             # 1) Tenta match exato com existing_codes normalizado
-            matched = False
             if corr_norm in norm_existing_map:
                 desc, code = norm_existing_map[corr_norm]
                 groups[desc].append(original_response)
                 processed.add(original_response)
-                matched = True
                 continue
 
-            # 2) Tenta match fuzzy com existing_codes
-            best_desc = None
-            best_score = 0
-            for norm_desc, (orig_desc, code) in norm_existing_map.items():
-                score = fuzz.token_set_ratio(corr_norm, norm_desc)
-                if score > best_score:
-                    best_score = score
-                    best_desc = orig_desc
-            if best_score >= 85:
-                groups[best_desc].append(original_response)
-                processed.add(original_response)
-                continue
+            # 2) Tenta match fuzzy com existing_codes (primeiro melhor score)
+            if norm_desc_list:
+                scores = f17_scores[norm_row[corr_norm]]
+                best_index = int(np.argmax(scores))
+                if scores[best_index] >= 85:
+                    groups[norm_existing_map[norm_desc_list[best_index]][0]].append(original_response)
+                    processed.add(original_response)
+                    continue
 
             # 3) Procura grupo novo já criado (usa canonical forms + fuzzy)
-            best_match = None
-            best_score = 0
-            for group_key in list(groups.keys()):
-                # ignora grupos que são F17 existentes (já tratados acima)
-                if group_key in existing_codes:
-                    continue
-                key_norm = self.canonicalize(group_key)
-                # verificação direta de igualdade canônica
-                if key_norm and corr_norm and key_norm == corr_norm:
-                    best_match = group_key
-                    best_score = 100
-                    break
+            # verificação direta de igualdade canônica
+            best_match = canonical_to_group.get(corr_norm) if corr_norm else None
+            if best_match is None:
                 # fuzzy nas formas normalizadas
-                sim = fuzz.token_set_ratio(corr_norm, key_norm)
-                if sim > best_score:
-                    best_score = sim
-                    best_match = group_key
-            if best_score >= 82:
+                best = fuzzy_kernel.extract_best(corr_norm, new_group_norms, 'token_set_ratio', score_cutoff=82)
+                if best:
+                    best_match = new_group_keys[best[0]]
+            if best_match is not None:
                 groups[best_match].append(original_response)
                 processed.add(original_response)
                 continue
 
             # 4) Cria novo grupo com a forma corrigida padronizada
             # Cria novo grupo usando forma canônica porém apresentável (capitalizada)
-            canonical = self.canonicalize(corrected_response) if corrected_response is not None else ''
+            canonical = corr_norm
             display_key = self.correct_text(canonical) if canonical else self.correct_text(str(original_response))
             new_key = display_key
+            if new_key not in groups and new_key not in existing_codes:
+                key_norm = self.canonicalize(new_key)
+                new_group_keys.append(new_key)
+                new_group_norms.append(key_norm)
+                if key_norm:
+                    canonical_to_group.setdefault(key_norm, new_key)
             groups[new_key].append(original_response)
             processed.add(original_response)
 
@@ -374,14 +607,16 @@ class ImprovedIPOCodingSystem:
     def standardize_with_chatgpt(self, phrase: str) -> str:
         """Padroniza frase usando ChatGPT (OpenAI) seguindo regras IPO"""
         api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        if not api_key and not llm_replay.replaying():
             return phrase
-        client = get_openai_client(api_key=api_key)
+        route = self.route('standardize')
+        if route.is_local:
+            return self.correct_text(phrase)
         
         # Prompt mais específico conforme regras IPO
-        # Tenta carregar prompt do arquivo
+        # Regras fixas como prompt de sistema (prefixo estável); só o título varia, na mensagem do usuário
         default_prompt = (
-            f"Apply IPO rules to standardize this category title: '{phrase}'.\n"
+            "Apply IPO rules to standardize the category title given by the user.\n"
             "Rules:\n"
             "1. Correct spelling and grammar.\n"
             "2. Capitalize the first letter (Sentence case).\n"
@@ -390,28 +625,29 @@ class ImprovedIPOCodingSystem:
             "5. Return ONLY the standardized text."
         )
         
-        prompt = default_prompt
+        messages = [{"role": "system", "content": default_prompt}, {"role": "user", "content": phrase}]
         try:
             base_dir = os.path.dirname(os.path.abspath(__file__))
             prompt_path = os.path.join(base_dir, 'prompts', 'standardization_prompt.txt')
             if os.path.exists(prompt_path):
                 with open(prompt_path, 'r', encoding='utf-8') as f:
                     template = f.read()
-                    prompt = template.replace('{phrase}', phrase)
+                if '{phrase}' in template:
+                    # Modelo antigo com a frase embutida no texto
+                    messages = [{"role": "user", "content": template.replace('{phrase}', phrase)}]
+                else:
+                    messages = [{"role": "system", "content": template}, {"role": "user", "content": phrase}]
         except Exception as e:
             print(f"Erro ao carregar prompt de padronização: {e}. Usando padrão.")
         
         try:
             # Verifica cache antes de chamar
-            cached_response = self.cache.get(prompt, "standardize")
+            cached_response = self.cache.get(messages, "standardize", route.model)
             if cached_response:
+                token_accounting.record_cache_hit()
                 return cached_response
 
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0
-            )
+            response = self._chat_completion("standardize", messages, route)
             # Se chegou aqui, a API respondeu corretamente
             try:
                 content = response.choices[0].message.content.strip()
@@ -422,7 +658,7 @@ class ImprovedIPOCodingSystem:
                 content = str(response.choices[0].message.get('content', '')).strip()
             
             # Salva no cache
-            self.cache.set(content, prompt, "standardize")
+            self.cache.set(content, messages, "standardize", route.model, model=route.model)
             
             # marca disponibilidade
             try:
@@ -430,6 +666,9 @@ class ImprovedIPOCodingSystem:
             except Exception:
                 pass
             return content
+        except batch_submission.DeferredCall:
+            # Coleta do batch: o título volta sem padronização nesta passada
+            return phrase
         except Exception:
             # marca indisponibilidade para evitar tentativas repetidas
             try:
@@ -447,11 +686,17 @@ class ImprovedIPOCodingSystem:
         
         # Adiciona informação sobre o método usado
         if processing_method:
+            # processing_method registra a rota: 'chatgpt:<modelo>', 'fallback_local:<motivo>'
+            method, _, route_detail = processing_method.partition(':')
             method_info = {
-                'chatgpt': '🤖 Processado com ChatGPT (OpenAI GPT-4o)',
-                'fallback_local': '🔧 Processado com Agrupador Local (Fallback)'
+                'chatgpt': '🤖 Processado com ChatGPT (OpenAI)',
+                'fallback_local': '🔧 Processado com Agrupador Local (Fallback)',
+                'triagem_lote': '📋 Somente não-respostas (triagem do lote, sem chamada à IA)'
             }
-            report_lines.append(f"Método de Processamento: {method_info.get(processing_method, processing_method)}")
+            method_label = method_info.get(method, processing_method)
+            if route_detail:
+                method_label += f" [{route_detail}]"
+            report_lines.append(f"Método de Processamento: {method_label}")
             report_lines.append("")
         
         # Ordena códigos, reservados por último
@@ -466,7 +711,7 @@ class ImprovedIPOCodingSystem:
             # Só tenta padronizar via ChatGPT se soubermos que a API está disponível.
             # Se não estiver disponível (ou ainda não testada), usa a padronização local.
             # Também verifica se o método de processamento foi 'chatgpt'
-            use_chatgpt = getattr(self, 'chatgpt_available', False) or (processing_method == 'chatgpt')
+            use_chatgpt = getattr(self, 'chatgpt_available', False) or (processing_method or '').startswith('chatgpt')
             
             if use_chatgpt:
                 standardized_desc = self.standardize_with_chatgpt(description)
@@ -502,6 +747,8 @@ class ImprovedIPOCodingSystem:
         
         code_column = []
         response_column = []
+        # respostas sem mapeamento direto: resolvidas depois, em lote, por similaridade
+        pending = {}
         
         for response in original_responses:
             if pd.isna(response):
@@ -521,29 +768,29 @@ class ImprovedIPOCodingSystem:
                     code_column.append(response_to_code[response])
                     response_column.append(response)
                 else:
-                    # Tenta encontrar por similaridade
-                    found_code = None
-                    for group_desc, code in codes.items():
-                        if self.calculate_similarity(str(response), group_desc) >= 0.8:
-                            found_code = code
-                            break
-                    if found_code:
-                        code_column.append(found_code)
-                        response_column.append(response)
-                    else:
-                        code_column.append("ERROR")
-                        response_column.append(response)
+                    pending.setdefault(str(response), []).append(len(code_column))
+                    code_column.append("ERROR")
+                    response_column.append(response)
+        
+        if pending:
+            # Tenta encontrar por similaridade: primeiro código (na ordem de 'codes') com score >= 0.8
+            code_descs = list(codes.keys())
+            code_values = list(codes.values())
+            pending_texts = list(pending.keys())
+            scores = self.similarity_matrix(pending_texts, code_descs)
+            hits = scores >= 0.8
+            for row, text in enumerate(pending_texts):
+                if not hits[row].any():
+                    continue
+                found_code = code_values[int(np.argmax(hits[row]))]
+                if found_code:
+                    for position in pending[text]:
+                        code_column[position] = found_code
         
         return code_column, response_column
 
-    def group_with_chatgpt(self, responses: list, f17: list = None, questionario: str = None) -> dict:
-        """Agrupa respostas usando o ChatGPT, seguindo o prompt IPO, retornando um dicionário {titulo: [respostas]}"""
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise Exception("OPENAI_API_KEY não encontrada no .env")
-        client = get_openai_client(api_key=api_key)
-        # Usa o prompt fornecido pelo usuário como system prompt para o ChatGPT
-        # Carrega prompt do sistema
+    def load_system_prompt(self) -> str:
+        """Prompt de sistema do agrupamento (prompts/system_prompt.txt ou padrão)"""
         default_system_prompt = """
 You are a survey coding specialist for the Institute of Opinion Research (IPO). Your objective is to receive data and code survey responses, following the IPO's rules exactly.
 
@@ -593,351 +840,351 @@ Working Format: Confirm question type before coding. Group equivalent meanings.
                     system_prompt = f.read()
         except Exception as e:
             print(f"Erro ao carregar prompt do sistema: {e}. Usando padrão.")
-        f17_block = ""
-        if f17:
-            f17_block = "F17 (codebook):\n" + "\n".join([str(x) for x in f17])
+        return system_prompt
+
+    def _grouping_messages(self, responses: list, f17: list = None) -> List[Dict[str, str]]:
+        """Mensagens de um agrupamento, do mais estável ao mais variável: prompt de sistema + regras
+        fixas (idênticos em todas as chamadas, aproveitam o cache de prefixo do provedor), F17 da
+        questão (repete no retry) e por último as respostas. Também são a chave do cache local"""
+        f17_block = "F17 (codebook):\n" + ("\n".join([str(x) for x in f17]) if f17 else "(vazio)")
         respostas_block = "\n".join([f"{i+1}. {str(x)}" for i, x in enumerate(responses)])
         total_respostas = len(responses)
-        # User content pede explicitamente que o modelo retorne uma lista de objetos com codigo/titulo/respostas
-        user_content = (
-            f"{f17_block}\n\n"
-            f"Total de respostas para processar: {total_respostas}\n"
-            f"Responses to be coded (do not reorder rows, process ALL {total_respostas} responses):\n{respostas_block}\n\n"
-            "CRITICAL REQUIREMENTS:"
-            " 1. You MUST process ALL unique responses listed above."
-            " 2. Create a Codebook that covers EVERY single response."
-            " 3. Use existing F17 codes when a response matches exactly or closely. You MUST return these groups too."
-            " 4. If you create new codes, start at 10 or the next available number."
-            " 5. Return a JSON array (list) of objects with the exact fields:"
-            " [{\"codigo\": <integer>, \"titulo\": <string>, \"respostas\": [<string>, ...]}, ...]."
-            " 6. IMPORTANT: Even if a response matches an existing F17 code, you MUST include it in the output JSON with that code."
-            " 7. Do NOT skip any response. The goal is to map every input to a code."
-        )
-        import sys
-        import sys
+        return [
+            {"role": "system", "content": f"{self.load_system_prompt()}\n\n{GROUPING_RULES}"},
+            {"role": "user", "content": f17_block},
+            {"role": "user", "content": (
+                f"Total de respostas para processar: {total_respostas}\n"
+                f"Responses to be coded (do not reorder rows, process ALL {total_respostas} responses):\n{respostas_block}"
+            )},
+        ]
+
+    def route(self, task: str, items: int = 0) -> model_routing.Route:
+        """Modelo (ou fallback local) da tarefa para uma entrada de 'items' itens (model_routing)"""
+        return model_routing.get_router(OPENAI_MODEL).route(task, items)
+
+    def _chat_completion(self, kind: str, messages: List[Dict[str, str]], route: model_routing.Route = None, **kwargs) -> Any:
+        """Ponto único de chamada ao LLM: modelo/endpoint da rota, vaga e controle adaptativo no
+        llm_gate (com novas tentativas em 429/timeout), circuit breaker do modelo e registro de tokens"""
+        route = route or model_routing.Route(kind, OPENAI_MODEL)
+        # Execução diferida (batch_submission): resposta do batch, ou a chamada é registrada para o
+        # próximo batch (DeferredCall). Rotas com endpoint próprio não passam pelo batch
+        session = batch_submission.current_session()
+        if session is not None and not route.base_url:
+            response = session.lookup(batch_submission.request_body(route.model, messages, **kwargs))
+            if response is not None:
+                token_accounting.record_call(kind, route.model, messages, response, batch=True)
+                return response
+        client = get_openai_client(api_key=os.getenv("OPENAI_API_KEY"), base_url=route.base_url)
+        if llm_replay.replaying():
+            # Respostas gravadas: sem vaga no llm_gate nem circuit breaker (velocidade total, determinístico)
+            response = client.chat.completions.create(model=route.model, messages=messages, temperature=0, **kwargs)
+            token_accounting.record_call(kind, route.model, messages, response)
+            return response
+        router = model_routing.get_router(OPENAI_MODEL)
         try:
-            # Verifica cache para o agrupamento principal
-            # Usa system_prompt e user_content como chave
-            cached_grouping = self.cache.get(system_prompt, user_content, "grouping")
-            
-            if cached_grouping:
-                print("[DEBUG] Usando resposta em CACHE para agrupamento!", flush=True)
-                # Simula estrutura de resposta para o restante do código processar
-                # Precisamos retornar o conteúdo como se fosse o 'content' extraído
-                content = cached_grouping
-                # Pula a chamada da API
-            else:
-                print("[DEBUG] Chamando ChatGPT (function-calling)...", flush=True)
-                # Define schema para function-calling: lista de objetos {codigo,titulo,respostas}
-                functions = [
-                    {
-                        "name": "return_groups",
-                        "description": "Retorna uma lista de grupos codificados seguindo o formato IPO",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "groups": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "object",
-                                        "properties": {
-                                            "codigo": {"type": "integer"},
-                                            "titulo": {"type": "string"},
-                                            "respostas": {"type": "array", "items": {"type": "string"}}
-                                        },
-                                        "required": ["codigo", "titulo", "respostas"]
-                                    }
-                                }
-                            },
-                            "required": ["groups"]
-                        }
-                    }
-                ]
-
-                # Tenta chamar com function-calling; alguns clientes legados podem rejeitar o parâmetro
+            response = llm_gate.call(lambda: client.chat.completions.create(
+                model=route.model, messages=messages, temperature=0, **kwargs))
+        except Exception as e:
+            # Só falhas transitórias contam para o circuit breaker (erro de requisição, chave ou
+            # cota chega ao chamador sem degradar o lote inteiro para o fallback local)
+            if model_routing.is_transient_failure(e):
+                router.record_failure(route.model)
+            raise
+        router.record_success(route.model)
+        token_accounting.record_call(kind, route.model, messages, response)
+        return response
+
+    def _request_function_call(self, messages: List[Dict[str, str]], function: dict, cache_tag: str,
+                               route: model_routing.Route = None) -> str:
+        """Chama o ChatGPT com function-calling e devolve o conteúdo bruto (argumentos da função).
+        Respostas válidas ficam no cache (chave: mensagens + cache_tag + modelo)"""
+        route = route or model_routing.Route(cache_tag, OPENAI_MODEL)
+        cached_content = self.cache.get(messages, cache_tag, route.model)
+        if cached_content:
+            print(f"[DEBUG] Usando resposta em CACHE ({cache_tag})!", flush=True)
+            token_accounting.record_cache_hit()
+            return cached_content
+
+        if not os.getenv("OPENAI_API_KEY") and not llm_replay.replaying():
+            raise Exception("OPENAI_API_KEY não encontrada no .env")
+        print(f"[DEBUG] Chamando ChatGPT (function-calling, {cache_tag})...", flush=True)
+        # Tenta chamar com function-calling; alguns clientes legados podem rejeitar o parâmetro
+        try:
+            # Nova API OpenAI usa 'tools' ao invés de 'functions'
+            try:
+                response = self._chat_completion(cache_tag, messages, route,
+                                                 tools=[{"type": "function", "function": function}],
+                                                 tool_choice="auto")
+            except (TypeError, AttributeError):
+                # Tenta com 'functions' (API antiga)
                 try:
-                    # Nova API OpenAI usa 'tools' ao invés de 'functions'
-                    try:
-                        response = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
-                            temperature=0,
-                            tools=[{
-                                "type": "function",
-                                "function": functions[0]
-                            }],
-                            tool_choice="auto"
-                        )
-                    except (TypeError, AttributeError):
-                        # Tenta com 'functions' (API antiga)
-                        try:
-                            response = client.chat.completions.create(
-                                model="gpt-4o",
-                                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
-                                temperature=0,
-                                functions=functions,
-                                function_call="auto"
-                            )
-                        except (TypeError, AttributeError):
-                            # Fallback para chamada normal sem function-calling
-                            print("[DEBUG] Function-calling não suportado, usando chamada normal", flush=True)
-                            response = client.chat.completions.create(
-                                model="gpt-4o",
-                                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": user_content}],
-                                temperature=0
-                            )
-                except Exception as api_error:
-                    error_str = str(api_error)
-                    # Trata erros específicos da API OpenAI
-                    if '429' in error_str or 'insufficient_quota' in error_str or 'quota' in error_str.lower():
-                        error_msg = "Quota da API OpenAI excedida. Verifique seus créditos e limite de uso em https://platform.openai.com/account/billing"
-                        print(f"[DEBUG] {error_msg}", flush=True)
-                        raise Exception(error_msg)
-                    elif '401' in error_str or 'invalid_api_key' in error_str or 'authentication' in error_str.lower():
-                        error_msg = "Chave de API OpenAI inválida ou expirada. Verifique sua chave em https://platform.openai.com/api-keys"
-                        print(f"[DEBUG] {error_msg}", flush=True)
-                        raise Exception(error_msg)
-                    elif 'rate_limit' in error_str.lower() or 'too_many_requests' in error_str.lower():
-                        error_msg = "Limite de requisições excedido. Aguarde alguns minutos e tente novamente."
-                        print(f"[DEBUG] {error_msg}", flush=True)
-                        raise Exception(error_msg)
-                    else:
-                        error_msg = f"Erro na chamada à API OpenAI: {error_str}"
-                        print(f"[DEBUG] {error_msg}", flush=True)
-                        raise Exception(error_msg)
-                    print("[DEBUG] ChatGPT respondeu!", flush=True)
-                    self.chatgpt_available = True # Marca como disponível após sucesso
-                import json
-                # nova resposta: acesso via response.choices[0].message.content ou via response.choices[0].message['content']
-                # adaptamos para ambos formatos
-                # Salva raw response para auditoria
+                    response = self._chat_completion(cache_tag, messages, route, functions=[function], function_call="auto")
+                except (TypeError, AttributeError):
+                    # Fallback para chamada normal sem function-calling
+                    print("[DEBUG] Function-calling não suportado, usando chamada normal", flush=True)
+                    response = self._chat_completion(cache_tag, messages, route)
+        except batch_submission.DeferredCall:
+            raise
+        except Exception as api_error:
+            error_str = str(api_error)
+            # Trata erros específicos da API OpenAI
+            # 429 de limite de taxa chega aqui só depois das novas tentativas do llm_gate
+            if llm_gate.overload_reason(api_error) == 'rate_limit' or 'too_many_requests' in error_str.lower():
+                error_msg = "Limite de requisições excedido. Aguarde alguns minutos e tente novamente."
+            elif '429' in error_str or 'insufficient_quota' in error_str or 'quota' in error_str.lower():
+                error_msg = "Quota da API OpenAI excedida. Verifique seus créditos e limite de uso em https://platform.openai.com/account/billing"
+            elif '401' in error_str or 'invalid_api_key' in error_str or 'authentication' in error_str.lower():
+                error_msg = "Chave de API OpenAI inválida ou expirada. Verifique sua chave em https://platform.openai.com/api-keys"
+            else:
+                error_msg = f"Erro na chamada à API OpenAI: {error_str}"
+            print(f"[DEBUG] {error_msg}", flush=True)
+            raise Exception(error_msg)
+        print("[DEBUG] ChatGPT respondeu!", flush=True)
+        self.chatgpt_available = True # Marca como disponível após sucesso
+
+        # Salva raw response para auditoria
+        try:
+            raw_path = os.path.join(os.getenv('RESULTS_FOLDER', '/tmp/ipo_results'), f"raw_chatgpt_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+            with open(raw_path, 'w', encoding='utf-8') as rf:
                 try:
-                    raw_path = os.path.join(os.getenv('RESULTS_FOLDER', '/tmp/ipo_results'), f"raw_chatgpt_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
-                    with open(raw_path, 'w', encoding='utf-8') as rf:
-                        try:
-                            # tenta serializar o objeto de resposta diretamente
-                            import json as _json
-                            _json.dump(response.__dict__ if hasattr(response, '__dict__') else str(response), rf, ensure_ascii=False, indent=2)
-                        except Exception:
-                            rf.write(str(response))
-                    print(f"[DEBUG] Raw ChatGPT salvo em: {raw_path}", flush=True)
+                    # tenta serializar o objeto de resposta diretamente
+                    json.dump(response.__dict__ if hasattr(response, '__dict__') else str(response), rf, ensure_ascii=False, indent=2)
                 except Exception:
-                    pass
+                    rf.write(str(response))
+            print(f"[DEBUG] Raw ChatGPT salvo em: {raw_path}", flush=True)
+        except Exception:
+            pass
 
-                # Extrai conteúdo: verifica tools (nova API) ou function_call (API antiga) ou content direto
-                content = None
-                try:
-                    msg = response.choices[0].message
-                    
-                    # Nova API: verifica 'tool_calls' primeiro
-                    if hasattr(msg, 'tool_calls') and msg.tool_calls:
-                        for tool_call in msg.tool_calls:
-                            if hasattr(tool_call, 'function') and hasattr(tool_call.function, 'arguments'):
-                                content = tool_call.function.arguments
-                                print("[DEBUG] Conteúdo extraído de tool_calls (nova API)", flush=True)
-                                break
-                    
-                    # Se não encontrou em tool_calls, tenta function_call (API antiga)
-                    if not content:
-                        if isinstance(msg, dict) and 'function_call' in msg and msg['function_call']:
-                            func = msg['function_call']
-                            content = func.get('arguments') or func.get('args') or ''
-                            if content:
-                                print("[DEBUG] Conteúdo extraído de function_call (dict)", flush=True)
-                        else:
-                            # objeto com atributos
-                            try:
-                                fc = getattr(msg, 'function_call', None)
-                                if fc:
-                                    content = fc.get('arguments') if isinstance(fc, dict) else getattr(fc, 'arguments', None)
-                                    if content:
-                                        print("[DEBUG] Conteúdo extraído de function_call (attr)", flush=True)
-                            except Exception:
-                                pass
-                    
-                    # Se ainda não encontrou, tenta content direto
-                    if not content:
-                        content = getattr(msg, 'content', None) or (msg.get('content') if isinstance(msg, dict) else None)
-                        if content:
-                            print("[DEBUG] Conteúdo extraído de message.content", flush=True)
-                            
-                except Exception as e_extract:
-                    print(f"[DEBUG] Erro ao extrair conteúdo: {e_extract}", flush=True)
-                    # fallback para estruturas antigas
+        # Extrai conteúdo: verifica tools (nova API) ou function_call (API antiga) ou content direto
+        content = None
+        try:
+            msg = response.choices[0].message
+            
+            # Nova API: verifica 'tool_calls' primeiro
+            if hasattr(msg, 'tool_calls') and msg.tool_calls:
+                for tool_call in msg.tool_calls:
+                    if hasattr(tool_call, 'function') and hasattr(tool_call.function, 'arguments'):
+                        content = tool_call.function.arguments
+                        print("[DEBUG] Conteúdo extraído de tool_calls (nova API)", flush=True)
+                        break
+            
+            # Se não encontrou em tool_calls, tenta function_call (API antiga)
+            if not content:
+                if isinstance(msg, dict) and 'function_call' in msg and msg['function_call']:
+                    func = msg['function_call']
+                    content = func.get('arguments') or func.get('args') or ''
+                    if content:
+                        print("[DEBUG] Conteúdo extraído de function_call (dict)", flush=True)
+                else:
+                    # objeto com atributos
                     try:
-                        content = response.choices[0].message.content
+                        fc = getattr(msg, 'function_call', None)
+                        if fc:
+                            content = fc.get('arguments') if isinstance(fc, dict) else getattr(fc, 'arguments', None)
+                            if content:
+                                print("[DEBUG] Conteúdo extraído de function_call (attr)", flush=True)
                     except Exception:
-                        try:
-                            content = response.choices[0].message['content'] if isinstance(response.choices[0].message, dict) else str(response)
-                        except Exception:
-                            content = str(response)
-                
-                # Salva no cache se tiver conteúdo válido
-                if content and isinstance(content, str) and content.strip():
-                    self.cache.set(content, system_prompt, user_content, "grouping")
+                        pass
             
-            if not content or (isinstance(content, str) and not content.strip()):
-                error_msg = "ChatGPT retornou resposta sem conteúdo válido. Verifique a resposta da API."
-                print(f"[DEBUG] {error_msg}", flush=True)
-                # print(f"[DEBUG] Tipo de resposta: {type(response)}", flush=True)
-                # print(f"[DEBUG] Estrutura da mensagem: {dir(response.choices[0].message) if response.choices else 'sem choices'}", flush=True)
-                raise Exception(error_msg)
+            # Se ainda não encontrou, tenta content direto
+            if not content:
+                content = getattr(msg, 'content', None) or (msg.get('content') if isinstance(msg, dict) else None)
+                if content:
+                    print("[DEBUG] Conteúdo extraído de message.content", flush=True)
+                    
+        except Exception as e_extract:
+            print(f"[DEBUG] Erro ao extrair conteúdo: {e_extract}", flush=True)
+            # fallback para estruturas antigas
+            try:
+                content = response.choices[0].message.content
+            except Exception:
+                try:
+                    content = response.choices[0].message['content'] if isinstance(response.choices[0].message, dict) else str(response)
+                except Exception:
+                    content = str(response)
+        
+        if not content or (isinstance(content, str) and not content.strip()):
+            error_msg = "ChatGPT retornou resposta sem conteúdo válido. Verifique a resposta da API."
+            print(f"[DEBUG] {error_msg}", flush=True)
+            raise Exception(error_msg)
 
-            print(f"[DEBUG] Conteúdo bruto retornado pelo ChatGPT:\n{content}", flush=True)
-            # Constrói mapa de existing_codes a partir do f17 para priorização (se fornecido)
-            existing_codes = {}
-            if f17:
-                for line in f17:
-                    try:
-                        parts = str(line).split('|', 1)
-                        if len(parts) == 2:
-                            code = int(parts[0].strip())
-                            desc = parts[1].strip()
-                            existing_codes[desc] = code
-                    except Exception:
-                        continue
+        # Salva no cache se tiver conteúdo válido
+        if isinstance(content, str):
+            self.cache.set(content, messages, cache_tag, route.model, model=route.model)
+        return content
 
-            # Tenta extrair JSON da resposta de forma tolerante
-            grupos = None
-            # busca o primeiro e último colchete/brace que pareçam envelopar um JSON
-            possible_jsons = []
-            # procura por { ... }
-            starts = [m.start() for m in re.finditer(r'\{', content)]
-            ends = [m.start() for m in re.finditer(r'\}', content)]
-            if starts and ends:
-                for s in starts:
-                    for e in reversed(ends):
-                        if e > s:
-                            candidate = content[s:e+1]
-                            possible_jsons.append(candidate)
-                            break
-            # também tenta arrays [...]
-            starts_b = [m.start() for m in re.finditer(r'\[', content)]
-            ends_b = [m.start() for m in re.finditer(r'\]', content)]
-            if starts_b and ends_b:
-                for s in starts_b:
-                    for e in reversed(ends_b):
-                        if e > s:
-                            candidate = content[s:e+1]
-                            possible_jsons.append(candidate)
-                            break
+    def _extract_json_payload(self, content: str) -> Any:
+        """Extrai o JSON da resposta de forma tolerante (texto em volta, cercas de código); None se falhar"""
+        # busca o primeiro e último colchete/brace que pareçam envelopar um JSON
+        possible_jsons = []
+        # procura por { ... }
+        starts = [m.start() for m in re.finditer(r'\{', content)]
+        ends = [m.start() for m in re.finditer(r'\}', content)]
+        if starts and ends:
+            for s in starts:
+                for e in reversed(ends):
+                    if e > s:
+                        candidate = content[s:e+1]
+                        possible_jsons.append(candidate)
+                        break
+        # também tenta arrays [...]
+        starts_b = [m.start() for m in re.finditer(r'\[', content)]
+        ends_b = [m.start() for m in re.finditer(r'\]', content)]
+        if starts_b and ends_b:
+            for s in starts_b:
+                for e in reversed(ends_b):
+                    if e > s:
+                        candidate = content[s:e+1]
+                        possible_jsons.append(candidate)
+                        break
+
+        for candidate in possible_jsons:
+            try:
+                return json.loads(candidate)
+            except Exception as e_json:
+                # ignora e tenta próximo
+                print(f"[DEBUG] json.loads falhou para candidato (len={len(candidate)}): {e_json}", flush=True)
+                continue
+        # última tentativa: tenta carregar todo o conteúdo bruto se ele for um JSON válido
+        try:
+            return json.loads(content)
+        except Exception as e_json:
+            print(f"[DEBUG] Não foi possível parsear JSON do conteúdo retornado pelo ChatGPT: {e_json}", flush=True)
+            return None
 
-            parsed = False
-            for candidate in possible_jsons:
+    def _f17_codes(self, f17: list = None) -> Dict[str, int]:
+        """Mapa descrição -> código a partir das linhas 'código | descrição' do F17"""
+        existing_codes = {}
+        for line in f17 or []:
+            try:
+                parts = str(line).split('|', 1)
+                if len(parts) == 2:
+                    code = int(parts[0].strip())
+                    desc = parts[1].strip()
+                    existing_codes[desc] = code
+            except Exception:
+                continue
+        return existing_codes
+
+    def _parse_groups_payload(self, grupos: Any, existing_codes: Dict[str, int], responses: list) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+        """Converte o JSON retornado em (codes, groups), priorizando os códigos do F17"""
+        # Agora esperamos que 'grupos' seja uma lista de objetos: [{codigo, titulo, respostas}, ...]
+        # OU um dicionário com a chave 'groups': {'groups': [{codigo, titulo, respostas}, ...]}
+        # OU um único objeto de grupo: {codigo, titulo, respostas} (caso raro, mas possível)
+        
+        if isinstance(grupos, dict):
+            if 'groups' in grupos:
+                # ChatGPT retornou {'groups': [...]} - extrai a lista
+                grupos = grupos['groups']
+                print("[DEBUG] Extraído 'groups' do dicionário retornado pelo ChatGPT", flush=True)
+            elif 'codigo' in grupos and 'titulo' in grupos and 'respostas' in grupos:
+                # ChatGPT retornou um único grupo sem lista
+                print("[DEBUG] ChatGPT retornou um único grupo não envelopado. Convertendo para lista.", flush=True)
+                grupos = [grupos]
+            else:
+                # Tenta encontrar lista em outras chaves
+                found_list = False
+                for key in ['data', 'result', 'items']:
+                    if key in grupos and isinstance(grupos[key], list):
+                        grupos = grupos[key]
+                        print(f"[DEBUG] Extraído lista da chave '{key}'", flush=True)
+                        found_list = True
+                        break
+                
+                if not found_list:
+                    # É um dicionário mas não tem estrutura conhecida
+                    error_msg = f"Formato inesperado do retorno do ChatGPT (esperava lista ou dict com 'groups'): {type(grupos)} -> {list(grupos.keys()) if grupos else 'vazio'}"
+                    print(f"[DEBUG] {error_msg}", flush=True)
+                    raise Exception(error_msg)
+
+        if not isinstance(grupos, list):
+            error_msg = f"Formato inesperado do retorno do ChatGPT (esperava lista): {type(grupos)} -> {grupos}"
+            print(f"[DEBUG] {error_msg}", flush=True)
+            raise Exception(error_msg)
+
+        codes = {}
+        groups_map = {}
+        for item in grupos:
+            if not isinstance(item, dict):
+                print(f"[DEBUG] Item ignorado (não é dict): {item}", flush=True)
+                continue
+            if 'codigo' in item and 'titulo' in item and 'respostas' in item:
                 try:
-                    grupos = json.loads(candidate)
-                    parsed = True
-                    break
-                except Exception as e_json:
-                    # ignora e tenta próximo
-                    print(f"[DEBUG] json.loads falhou para candidato (len={len(candidate)}): {e_json}", flush=True)
+                    codigo = int(item['codigo'])
+                except Exception:
+                    # pula itens com codigo inválido
+                    print(f"[DEBUG] Codigo inválido no item: {item}", flush=True)
                     continue
-            if not parsed:
-                # última tentativa: tenta carregar todo o conteúdo bruto se ele for um JSON válido
-                try:
-                    grupos = json.loads(content)
-                    parsed = True
-                except Exception as e_json:
-                    print(f"[DEBUG] Não foi possível parsear JSON do conteúdo retornado pelo ChatGPT: {e_json}", flush=True)
-                    grupos = None
-            # Agora esperamos que 'grupos' seja uma lista de objetos: [{codigo, titulo, respostas}, ...]
-            # OU um dicionário com a chave 'groups': {'groups': [{codigo, titulo, respostas}, ...]}
-            # OU um único objeto de grupo: {codigo, titulo, respostas} (caso raro, mas possível)
-            
-            if isinstance(grupos, dict):
-                if 'groups' in grupos:
-                    # ChatGPT retornou {'groups': [...]} - extrai a lista
-                    grupos = grupos['groups']
-                    print("[DEBUG] Extraído 'groups' do dicionário retornado pelo ChatGPT", flush=True)
-                elif 'codigo' in grupos and 'titulo' in grupos and 'respostas' in grupos:
-                    # ChatGPT retornou um único grupo sem lista
-                    print("[DEBUG] ChatGPT retornou um único grupo não envelopado. Convertendo para lista.", flush=True)
-                    grupos = [grupos]
-                else:
-                    # Tenta encontrar lista em outras chaves
-                    found_list = False
-                    for key in ['data', 'result', 'items']:
-                        if key in grupos and isinstance(grupos[key], list):
-                            grupos = grupos[key]
-                            print(f"[DEBUG] Extraído lista da chave '{key}'", flush=True)
-                            found_list = True
-                            break
-                    
-                    if not found_list:
-                        # É um dicionário mas não tem estrutura conhecida
-                        error_msg = f"Formato inesperado do retorno do ChatGPT (esperava lista ou dict com 'groups'): {type(grupos)} -> {list(grupos.keys()) if grupos else 'vazio'}"
-                        print(f"[DEBUG] {error_msg}", flush=True)
-                        raise Exception(error_msg)
-
-            if isinstance(grupos, list):
-                codes = {}
-                groups_map = {}
-                for item in grupos:
-                    if not isinstance(item, dict):
-                        print(f"[DEBUG] Item ignorado (não é dict): {item}", flush=True)
-                        continue
-                    if 'codigo' in item and 'titulo' in item and 'respostas' in item:
-                        try:
-                            codigo = int(item['codigo'])
-                        except Exception:
-                            # pula itens com codigo inválido
-                            print(f"[DEBUG] Codigo inválido no item: {item}", flush=True)
-                            continue
-                        titulo = self.correct_text(str(item['titulo']))
-                        respostas_list = [r for r in item.get('respostas', []) if isinstance(r, str) and r.strip()]
-                        codes[titulo] = codigo
-                        groups_map[titulo] = respostas_list
-                    else:
-                        print(f"[DEBUG] Item sem campos esperados: {item}", flush=True)
-                        continue
-                # normaliza e une títulos semelhantes
-                groups_map = self.merge_similar_groups(groups_map, threshold=85)
-                # garante que não haja códigos duplicados para títulos iguais: se houver conflito, prioriza códigos do F17
-                final_codes = {}
-                for titulo, respostas in groups_map.items():
-                    # se titulo corresponde a existing_codes, use o código existente
-                    title_norm = self.correct_text(titulo).strip().lower()
-                    used_code = None
-                    for desc, code in existing_codes.items():
-                        if self.correct_text(desc).strip().lower() == title_norm:
-                            used_code = code
-                            break
-                    if used_code is None:
-                        used_code = codes.get(titulo, None)
-                    if used_code is None:
-                        # atribui novo código sequencial
-                        max_existing = max([c for c in existing_codes.values()] + [9])
-                        used_code = max_existing + 1
-                    final_codes[titulo] = used_code
-                if final_codes and groups_map:
-                    # Verifica se todas as respostas foram processadas
-                    total_respostas_mapeadas = sum(len(resps) for resps in groups_map.values())
-                    total_respostas_originais = len(responses)
-                    
-                    print(f"[DEBUG] ✅ ChatGPT retornou {len(final_codes)} grupos válidos", flush=True)
-                    print(f"[DEBUG] Respostas mapeadas: {total_respostas_mapeadas} de {total_respostas_originais} originais", flush=True)
-                    
-                    if total_respostas_mapeadas < total_respostas_originais:
-                        faltando = total_respostas_originais - total_respostas_mapeadas
-                        print(f"[DEBUG] ⚠️ ATENÇÃO: {faltando} respostas não foram processadas pelo ChatGPT!", flush=True)
-                        print(f"[DEBUG] Respostas originais: {responses[:10]}...", flush=True)
-                        print(f"[DEBUG] Respostas mapeadas: {[r for resps in groups_map.values() for r in resps[:10]]}...", flush=True)
-                        # Não lança exceção, mas avisa - o sistema vai tentar mapear as faltantes depois
-                    
-                    return final_codes, groups_map
-                else:
-                    print(f"[DEBUG] ⚠️ ChatGPT retornou grupos vazios após processamento", flush=True)
-                    raise Exception("ChatGPT retornou grupos vazios após processamento. Verifique o formato da resposta.")
+                titulo = self.correct_text(str(item['titulo']))
+                respostas_list = [r for r in item.get('respostas', []) if isinstance(r, str) and r.strip()]
+                codes[titulo] = codigo
+                groups_map[titulo] = respostas_list
             else:
-                error_msg = f"Formato inesperado do retorno do ChatGPT (esperava lista): {type(grupos)} -> {grupos}"
-                print(f"[DEBUG] {error_msg}", flush=True)
+                print(f"[DEBUG] Item sem campos esperados: {item}", flush=True)
+                continue
+        # normaliza e une títulos semelhantes
+        groups_map = self.merge_similar_groups(groups_map, threshold=85)
+        # garante que não haja códigos duplicados para títulos iguais: se houver conflito, prioriza códigos do F17
+        final_codes = {}
+        for titulo, respostas in groups_map.items():
+            # se titulo corresponde a existing_codes, use o código existente
+            title_norm = self.correct_text(titulo).strip().lower()
+            used_code = None
+            for desc, code in existing_codes.items():
+                if self.correct_text(desc).strip().lower() == title_norm:
+                    used_code = code
+                    break
+            if used_code is None:
+                used_code = codes.get(titulo, None)
+            if used_code is None:
+                # atribui novo código sequencial
+                max_existing = max([c for c in existing_codes.values()] + [9])
+                used_code = max_existing + 1
+            final_codes[titulo] = used_code
+        if not final_codes or not groups_map:
+            print(f"[DEBUG] ⚠️ ChatGPT retornou grupos vazios após processamento", flush=True)
+            raise Exception("ChatGPT retornou grupos vazios após processamento. Verifique o formato da resposta.")
+
+        # Verifica se todas as respostas foram processadas
+        total_respostas_mapeadas = sum(len(resps) for resps in groups_map.values())
+        total_respostas_originais = len(responses)
+        
+        print(f"[DEBUG] ✅ ChatGPT retornou {len(final_codes)} grupos válidos", flush=True)
+        print(f"[DEBUG] Respostas mapeadas: {total_respostas_mapeadas} de {total_respostas_originais} originais", flush=True)
+        
+        if total_respostas_mapeadas < total_respostas_originais:
+            faltando = total_respostas_originais - total_respostas_mapeadas
+            print(f"[DEBUG] ⚠️ ATENÇÃO: {faltando} respostas não foram processadas pelo ChatGPT!", flush=True)
+            print(f"[DEBUG] Respostas originais: {responses[:10]}...", flush=True)
+            print(f"[DEBUG] Respostas mapeadas: {[r for resps in groups_map.values() for r in resps[:10]]}...", flush=True)
+            # Não lança exceção, mas avisa - o sistema vai tentar mapear as faltantes depois
+        
+        return final_codes, groups_map
+
+    def group_with_chatgpt(self, responses: list, f17: list = None, questionario: str = None,
+                           route: model_routing.Route = None) -> dict:
+        """Agrupa respostas usando o ChatGPT, seguindo o prompt IPO, retornando um dicionário {titulo: [respostas]}.
+        route: modelo escolhido para a questão inteira (padrão: rota de 'grouping' para o tamanho da lista)"""
+        if not os.getenv("OPENAI_API_KEY") and not llm_replay.replaying():
+            raise Exception("OPENAI_API_KEY não encontrada no .env")
+        # Prompt de sistema do usuário + regras fixas formam o prefixo estável das mensagens
+        messages = self._grouping_messages(responses, f17)
+        route = route or self.route('grouping', len(responses))
+        try:
+            content = self._request_function_call(messages, GROUPS_FUNCTION, "grouping", route)
+            print(f"[DEBUG] Conteúdo bruto retornado pelo ChatGPT:\n{content}", flush=True)
+            grupos = self._extract_json_payload(content)
+            try:
+                return self._parse_groups_payload(grupos, self._f17_codes(f17), responses)
+            except Exception:
                 print(f"[DEBUG] Conteúdo bruto recebido: {content[:500]}...", flush=True)
-                raise Exception(f"{error_msg}. Conteúdo recebido: {str(content)[:200]}")
+                raise
+        except batch_submission.DeferredCall:
+            # Coleta do batch: não é falha da API (chatgpt_available não muda)
+            raise
         except Exception as e:
             error_msg = f"Erro ao agrupar com ChatGPT: {str(e)}"
             print(f"[DEBUG] {error_msg}", flush=True)
-            if 'content' in locals():
-                print(f"[DEBUG] Conteúdo retornado pelo ChatGPT: {content[:500]}...", flush=True)
             try:
                 self.chatgpt_available = False
             except Exception:
@@ -945,6 +1192,69 @@ Working Format: Confirm question type before coding. Group equivalent meanings.
             # Re-lança a exceção ao invés de retornar vazio
             raise Exception(error_msg)
 
+    def group_many_with_chatgpt(self, questions: List[Dict[str, Any]],
+                                route: model_routing.Route = None) -> Dict[str, Tuple[Dict[str, int], Dict[str, List[str]]]]:
+        """Agrupa várias questões pequenas em uma única chamada (ver request_packing.py).
+        questions: [{'name', 'responses', 'f17'}, ...]. Retorna {nome: (codes, groups)} apenas das
+        questões que vieram na resposta; cada resultado também entra no cache com a mesma chave de
+        group_with_chatgpt, de forma que o pipeline da questão o reaproveita sem nova chamada"""
+        if not os.getenv("OPENAI_API_KEY") and not llm_replay.replaying():
+            raise Exception("OPENAI_API_KEY não encontrada no .env")
+        blocks = []
+        for question in questions:
+            f17_block = "\n".join(str(x) for x in question['f17']) if question['f17'] else "(vazio)"
+            respostas_block = "\n".join(f"{i+1}. {x}" for i, x in enumerate(question['responses']))
+            blocks.append(
+                f"### QUESTÃO: {question['name']}\n"
+                f"F17 (codebook):\n{f17_block}\n"
+                f"Responses to be coded ({len(question['responses'])}):\n{respostas_block}"
+            )
+        # Mesmo prefixo fixo do agrupamento individual; as questões vão na mensagem do usuário
+        messages = [
+            {"role": "system", "content": f"{self.load_system_prompt()}\n\n{GROUPING_RULES}\n\n{PACKED_GROUPING_RULES}"},
+            {"role": "user", "content": f"Questions in this request: {len(questions)}\n\n" + "\n\n".join(blocks)},
+        ]
+        # Rota da maior questão do pacote; com as faixas de config/model_routing.json cobrindo
+        # PACK_MAX_ITEMS, cada questão individual cai no mesmo modelo e encontra o resultado no cache
+        route = route or self.route('grouping', max(len(q['responses']) for q in questions))
+        if route.is_local:
+            return {}
+        try:
+            content = self._request_function_call(messages, PACKED_GROUPS_FUNCTION, "grouping_pack", route)
+            payload = self._extract_json_payload(content)
+            entries = payload.get('questions') if isinstance(payload, dict) else payload
+            if not isinstance(entries, list):
+                raise Exception(f"Formato inesperado do retorno do ChatGPT (esperava 'questions'): {str(content)[:200]}")
+        except batch_submission.DeferredCall:
+            raise
+        except Exception as e:
+            error_msg = f"Erro ao agrupar questões em lote com ChatGPT: {str(e)}"
+            print(f"[DEBUG] {error_msg}", flush=True)
+            raise Exception(error_msg)
+
+        by_name = {str(q['name']).strip(): q for q in questions}
+        results = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            question = by_name.get(str(entry.get('questao', '')).strip())
+            if question is None or question['name'] in results:
+                continue
+            try:
+                results[question['name']] = self._parse_groups_payload(
+                    entry.get('groups'), self._f17_codes(question['f17']), question['responses'])
+            except Exception as e:
+                print(f"[DEBUG] Questão '{question['name']}' do pacote descartada: {e}", flush=True)
+                continue
+            # Conteúdo no formato de uma resposta individual: group_with_chatgpt encontra no cache
+            self.cache.set(json.dumps({'groups': entry.get('groups')}, ensure_ascii=False),
+                           self._grouping_messages(question['responses'], question['f17']), "grouping", route.model,
+                           model=route.model)
+        missing = [q['name'] for q in questions if q['name'] not in results]
+        if missing:
+            print(f"[DEBUG] ⚠️ Pacote sem resultado para: {missing} (serão processadas individualmente)", flush=True)
+        return results
+
     def merge_similar_groups(self, grupos: dict, threshold: int = 85) -> dict:
         """Une grupos com títulos muito semelhantes usando fuzzy matching."""
         keys = list(grupos.keys())
@@ -953,6 +1263,9 @@ Working Format: Confirm question type before coding. Group equivalent meanings.
 
         # Pré-calc normalizado para chaves
         norm_map = {k: self.normalize_text(k) for k in keys}
+        norms = [norm_map[k] for k in keys]
+        # Matriz de similaridade entre todos os títulos em uma única chamada ao kernel
+        sim_matrix = fuzzy_kernel.score_matrix(norms, norms, 'token_set_ratio')
 
         for i, k1 in enumerate(keys):
             if k1 in used:
@@ -961,15 +1274,14 @@ Working Format: Confirm question type before coding. Group equivalent meanings.
             for j, k2 in enumerate(keys):
                 if i == j or k2 in used:
                     continue
-                n1 = norm_map.get(k1, '')
-                n2 = norm_map.get(k2, '')
+                n1 = norms[i]
+                n2 = norms[j]
                 # mescla se uma forma for substring da outra (ex: 'posto saude' vs 'posto de saude')
                 if n1 and n2 and (n1 in n2 or n2 in n1):
                     merged[k1].extend(grupos[k2])
                     used.add(k2)
                     continue
-                sim = fuzz.token_set_ratio(n1, n2)
-                if sim >= threshold:
+                if sim_matrix[i, j] >= threshold:
                     merged[k1].extend(grupos[k2])
                     used.add(k2)
             used.add(k1)
@@ -0,0 +1,223 @@
+"""
+Fila de jobs do processamento em lote
+- Jobs são tarefas PENDING do task_store: com SQLite a fila é compartilhada entre processos
+  e sobrevive a reinícios do servidor web
+- Pool fixo de processos worker (JOB_WORKERS) que reivindicam jobs atomicamente
+- Controle de admissão: no máximo MAX_ACTIVE_JOBS jobs pendentes/em andamento (acima disso
+  o /upload responde 429)
+- Cancelamento por job: pendente é cancelado na hora; em andamento para entre questões
+- Retomada: job interrompido (erro, queda do worker/servidor) ou cancelado volta à fila;
+  questões já concluídas vêm dos checkpoints (ver checkpoint_store.py)
+- Execução: embutido no servidor web (JOB_EMBEDDED_WORKERS=1, padrão) ou em processo
+  separado com 'python job_queue.py'
+"""
+
+import importlib
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from multiprocessing.context import SpawnContext, SpawnProcess
+from typing import Any, Callable, Dict, List, Optional
+
+from task_store import RESUMABLE_STATES, SQLiteTaskStore, TaskStore
+
+JOB_WORKERS = max(1, int(os.getenv('JOB_WORKERS', 2)))
+MAX_ACTIVE_JOBS = int(os.getenv('MAX_ACTIVE_JOBS', 20))
+JOB_POLL_SECONDS = float(os.getenv('JOB_POLL_SECONDS', 1.0))
+JOB_EMBEDDED_WORKERS = os.getenv('JOB_EMBEDDED_WORKERS', '1') == '1'
+# Segundos sugeridos no Retry-After quando a fila está cheia
+QUEUE_RETRY_AFTER = int(os.getenv('QUEUE_RETRY_AFTER', 30))
+
+# Tipo de job -> função 'modulo:funcao' chamada como funcao(task_id, **job_args)
+JOB_HANDLERS = {
+    'batch': 'web_interface_ipo:process_batch_task',
+}
+
+# Marca os processos worker (o servidor web não deve iniciar outro pool dentro deles)
+_WORKER_ENV = 'IPO_JOB_WORKER'
+
+_pool: List[Any] = []
+_pool_lock = threading.Lock()
+_pool_lock_file = None
+_marker_lock = threading.Lock()
+
+
+class QueueFullError(Exception):
+    """Fila de jobs cheia (controle de admissão)"""
+
+
+def in_worker() -> bool:
+    return os.getenv(_WORKER_ENV) == '1'
+
+
+@contextmanager
+def worker_environment():
+    """Marca como worker os processos iniciados dentro do bloco. A marca precisa valer já na
+    reimportação do __main__ feita pelo spawn (ex.: 'python web_interface_ipo.py')"""
+    with _marker_lock:
+        previous = os.environ.get(_WORKER_ENV)
+        os.environ[_WORKER_ENV] = '1'
+        try:
+            yield
+        finally:
+            if previous is None:
+                os.environ.pop(_WORKER_ENV, None)
+            else:
+                os.environ[_WORKER_ENV] = previous
+
+
+class _WorkerProcess(SpawnProcess):
+    """Processo spawn marcado como worker: a reimportação do __main__ não inicia o servidor/pool de jobs"""
+
+    def start(self):
+        with worker_environment():
+            super().start()
+
+
+class WorkerContext(SpawnContext):
+    """Contexto spawn dos processos auxiliares (workers da fila, pools de local_stages e fuzzy_kernel)"""
+    Process = _WorkerProcess
+
+
+def submit(store: TaskStore, task_id: str, kind: str, job_args: Dict[str, Any], **fields):
+    """Enfileira um job. Levanta QueueFullError se já houver MAX_ACTIVE_JOBS ativos"""
+    if kind not in JOB_HANDLERS:
+        raise Exception(f"Tipo de job desconhecido: {kind}")
+    if not store.try_enqueue(task_id, MAX_ACTIVE_JOBS, job_kind=kind, job_args=job_args, **fields):
+        raise QueueFullError(f"Fila de processamento cheia ({MAX_ACTIVE_JOBS} tarefas ativas). Tente novamente em instantes.")
+
+
+def resume(store: TaskStore, task_id: str, **fields):
+    """Devolve à fila um job encerrado com erro ou cancelado. Levanta QueueFullError se a fila
+    estiver cheia"""
+    task = store.get(task_id)
+    if task is None:
+        raise Exception("Tarefa não encontrada")
+    if not task.get('job_kind') or task.get('state') not in RESUMABLE_STATES:
+        raise Exception(f"Tarefa no estado {task.get('state')} não pode ser retomada")
+    if not store.try_requeue(task_id, MAX_ACTIVE_JOBS, **fields):
+        raise QueueFullError(f"Fila de processamento cheia ({MAX_ACTIVE_JOBS} tarefas ativas). Tente novamente em instantes.")
+
+
+def _resolve_handler(kind: str) -> Callable:
+    module_name, func_name = JOB_HANDLERS[kind].split(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def run_worker(store: TaskStore, worker_id: str, stop: Optional[threading.Event] = None):
+    """Laço do worker: reivindica e executa jobs até 'stop' ser sinalizado"""
+    print(f"[DEBUG] Worker {worker_id} aguardando jobs", flush=True)
+    while stop is None or not stop.is_set():
+        try:
+            job = store.claim_next(worker_id)
+        except Exception as e:
+            print(f"[DEBUG] Worker {worker_id}: erro ao ler a fila: {e}", flush=True)
+            job = None
+        if job is None:
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+
+        task_id = job['task_id']
+        print(f"[DEBUG] Worker {worker_id} iniciou job {task_id} ({job['job_kind']})", flush=True)
+        try:
+            _resolve_handler(job['job_kind'])(task_id, **(job.get('job_args') or {}))
+        except Exception as e:
+            print(f"Erro no job {task_id}: {e}")
+            store.update(task_id, state='ERROR', error=str(e))
+
+
+def _process_worker_id(pid: int) -> str:
+    return f"worker-{pid}"
+
+
+def _process_main(db_path: str):
+    os.environ[_WORKER_ENV] = '1'
+    run_worker(SQLiteTaskStore(db_path), _process_worker_id(os.getpid()))
+
+
+def _acquire_pool_lock(db_path: str) -> bool:
+    """Garante um único pool embutido por máquina (vários workers do gunicorn importam o web)"""
+    global _pool_lock_file
+    try:
+        import fcntl
+    except ImportError:
+        # Sem fcntl (Windows): um pool por processo web
+        return True
+    handle = open(db_path + '.pool.lock', 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        return False
+    _pool_lock_file = handle
+    return True
+
+
+def _spawn_process(db_path: str, slot: int):
+    # spawn: o worker não herda threads/locks do servidor web
+    process = WorkerContext().Process(target=_process_main, args=(db_path,), daemon=True, name=f"ipo-job-worker-{slot}")
+    process.start()
+    return process
+
+
+def _supervise(db_path: str):
+    """Repõe workers que morreram (ex.: falta de memória), mantendo o pool com tamanho fixo"""
+    store = SQLiteTaskStore(db_path)
+    while True:
+        time.sleep(5)
+        with _pool_lock:
+            for slot, process in enumerate(_pool):
+                if not process.is_alive():
+                    print(f"[DEBUG] Worker {process.name} terminou (código {process.exitcode}); reiniciando", flush=True)
+                    store.fail_worker_jobs(_process_worker_id(process.pid),
+                                           f"Worker do processamento terminou inesperadamente (código {process.exitcode})")
+                    _pool[slot] = _spawn_process(db_path, slot)
+
+
+def start_pool(store: TaskStore, workers: int = JOB_WORKERS) -> bool:
+    """Inicia o pool de workers: processos com SQLite, threads com o store em memória.
+    Retorna False se outro processo já mantém o pool"""
+    with _pool_lock:
+        if _pool:
+            return True
+        if isinstance(store, SQLiteTaskStore):
+            if not _acquire_pool_lock(store.db_path):
+                return False
+            for i in range(workers):
+                _pool.append(_spawn_process(store.db_path, i))
+            threading.Thread(target=_supervise, args=(store.db_path,), daemon=True,
+                             name='ipo-job-supervisor').start()
+        else:
+            stop = threading.Event()
+            for i in range(workers):
+                thread = threading.Thread(target=run_worker, args=(store, f"t{i}-{uuid.uuid4().hex[:6]}", stop),
+                                          daemon=True, name=f"ipo-job-worker-{i}")
+                thread.start()
+                _pool.append(thread)
+        print(f"[DEBUG] Pool de jobs iniciado com {workers} workers", flush=True)
+        return True
+
+
+def worker_pids() -> List[int]:
+    """PIDs dos processos worker vivos deste pool (vazio com workers em thread ou pool em outro processo)"""
+    with _pool_lock:
+        return [worker.pid for worker in _pool if getattr(worker, 'pid', None) and worker.is_alive()]
+
+
+if __name__ == '__main__':
+    # Pool standalone: 'python job_queue.py' (use JOB_EMBEDDED_WORKERS=0 no servidor web)
+    from dotenv import load_dotenv
+    load_dotenv()
+    import tempfile
+    from task_store import create_task_store
+    results_folder = os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_results'))
+    standalone_store = create_task_store(os.path.join(results_folder, 'tasks.db'))
+    if not isinstance(standalone_store, SQLiteTaskStore):
+        raise SystemExit("O pool standalone requer TASK_STORE=sqlite")
+    if start_pool(standalone_store):
+        while True:
+            time.sleep(3600)
+    else:
+        print("Outro processo já mantém o pool de jobs nesta máquina")
@@ -0,0 +1,344 @@
+"""
+Controle de concorrência das chamadas ao LLM
+- Limite global de chamadas simultâneas (LLM_MAX_CONCURRENCY), compartilhado entre o servidor
+  web e os workers da fila por uma tabela SQLite
+- Prioridade: enquanto houver chamada interativa (/questao_especifica) esperando, chamadas
+  de lote não ocupam vagas que forem liberadas
+- A prioridade é do contexto atual (ver priority()) e segue para as threads iniciadas com
+  token_accounting.in_context (blocos e colunas em paralelo); o padrão é lote
+- Limite adaptativo (AIMD): o número de vagas sobe aos poucos enquanto as chamadas dão certo com
+  latência estável e cai pela metade em 429 ou timeout; LLM_MAX_CONCURRENCY é o teto. O estado
+  fica na mesma tabela SQLite, compartilhado por todos os jobs
+- call() é o ponto de entrada: ocupa a vaga, informa o resultado ao controle e repete 429/timeout
+  com backoff (respeitando Retry-After) antes de devolver o erro
+"""
+
+import contextvars
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, Dict, Optional
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Teto de chamadas simultâneas; 0 = sem limite (gate e controle adaptativo desligados)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', 8))
+LLM_MIN_CONCURRENCY = max(1, int(os.getenv('LLM_MIN_CONCURRENCY', 1)))
+LLM_INITIAL_CONCURRENCY = int(os.getenv('LLM_INITIAL_CONCURRENCY', 4))
+# Vagas somadas a cada janela de chamadas bem-sucedidas (uma janela = limite atual de chamadas)
+AIMD_INCREASE = float(os.getenv('LLM_AIMD_INCREASE', 1.0))
+# Fator aplicado ao limite em 429/timeout
+AIMD_DECREASE = float(os.getenv('LLM_AIMD_DECREASE', 0.5))
+# Latência acima de (média × tolerância) segura o crescimento do limite
+LATENCY_TOLERANCE = float(os.getenv('LLM_LATENCY_TOLERANCE', 2.0))
+# Intervalo mínimo entre duas reduções (os 429 das chamadas já em voo contam como um só)
+DECREASE_COOLDOWN_SECONDS = float(os.getenv('LLM_DECREASE_COOLDOWN', 5))
+# Novas tentativas após 429/timeout antes de devolver o erro
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 5))
+BACKOFF_BASE_SECONDS = float(os.getenv('LLM_BACKOFF_BASE', 1.0))
+BACKOFF_MAX_SECONDS = 60
+LLM_GATE_DB = os.getenv('LLM_GATE_DB', os.path.join(
+    os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_results')), 'llm_gate.db'))
+# Vagas presas além disso (processo morto no meio da chamada) são liberadas
+SLOT_TIMEOUT_SECONDS = int(os.getenv('LLM_SLOT_TIMEOUT', 900))
+# Espera interativa sem renovação além disso é descartada (processo morto enquanto esperava)
+WAITER_TIMEOUT_SECONDS = 30
+# Intervalo entre verificações de vaga (com jitter); a espera de lote cresce até POLL_MAX_SECONDS
+POLL_SECONDS = float(os.getenv('LLM_GATE_POLL_SECONDS', 0.2))
+POLL_MAX_SECONDS = float(os.getenv('LLM_GATE_POLL_MAX_SECONDS', 1.0))
+# Peso da chamada mais recente na média móvel da latência
+_LATENCY_EWMA_WEIGHT = 0.2
+
+_priority: contextvars.ContextVar = contextvars.ContextVar('llm_priority', default=BULK)
+
+
+@contextmanager
+def priority(level: str):
+    """Define a prioridade das chamadas ao LLM feitas dentro do bloco (inclusive em threads via in_context)"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> str:
+    return _priority.get()
+
+
+class LLMGate:
+    """Semáforo com prioridade e limite adaptativo, compartilhado entre processos via SQLite"""
+
+    def __init__(self, db_path: str, capacity: int):
+        self.db_path = db_path
+        # Teto do limite adaptativo
+        self.capacity = capacity
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conns = threading.local()
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_slots (
+                slot_id TEXT PRIMARY KEY,
+                priority TEXT,
+                pid INTEGER,
+                acquired_at REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_waiters (
+                waiter_id TEXT PRIMARY KEY,
+                priority TEXT,
+                seen_at REAL
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_limit (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                concurrency REAL,
+                latency_ewma REAL,
+                decreased_at REAL,
+                updated_at REAL
+            )
+        ''')
+        conn.execute('INSERT OR IGNORE INTO llm_limit (id, concurrency, latency_ewma, decreased_at, updated_at) '
+                     'VALUES (1, ?, NULL, 0, ?)', (self._clamp(LLM_INITIAL_CONCURRENCY), time.time()))
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._conns, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._conns.conn = conn
+        return conn
+
+    def _clamp(self, concurrency: float) -> float:
+        return min(float(self.capacity), max(float(LLM_MIN_CONCURRENCY), concurrency))
+
+    def _limit_row(self, conn: sqlite3.Connection):
+        concurrency, latency_ewma, decreased_at = conn.execute(
+            'SELECT concurrency, latency_ewma, decreased_at FROM llm_limit WHERE id = 1').fetchone()
+        return self._clamp(concurrency), latency_ewma, decreased_at
+
+    def limit(self) -> int:
+        """Vagas liberadas agora pelo controle adaptativo"""
+        return int(self._limit_row(self._conn())[0])
+
+    def on_success(self, latency: float):
+        """Chamada respondida: soma AIMD_INCREASE por janela de sucessos se a latência está estável"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            concurrency, latency_ewma, _ = self._limit_row(conn)
+            previous = concurrency
+            if latency_ewma is None or latency <= latency_ewma * LATENCY_TOLERANCE:
+                concurrency = self._clamp(concurrency + AIMD_INCREASE / max(1.0, concurrency))
+            latency_ewma = latency if latency_ewma is None else (
+                (1 - _LATENCY_EWMA_WEIGHT) * latency_ewma + _LATENCY_EWMA_WEIGHT * latency)
+            conn.execute('UPDATE llm_limit SET concurrency = ?, latency_ewma = ?, updated_at = ? WHERE id = 1',
+                         (concurrency, latency_ewma, time.time()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if int(concurrency) > int(previous):
+            print(f"[DEBUG] Limite de chamadas ao LLM -> {int(concurrency)} (latência média {latency_ewma:.1f}s)", flush=True)
+
+    def on_overload(self, reason: str):
+        """429 ou timeout: multiplica o limite por AIMD_DECREASE (uma vez por intervalo de espera)"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            concurrency, latency_ewma, decreased_at = self._limit_row(conn)
+            cooldown = max(DECREASE_COOLDOWN_SECONDS, latency_ewma or 0)
+            reduced = now - (decreased_at or 0) >= cooldown
+            if reduced:
+                concurrency = self._clamp(concurrency * AIMD_DECREASE)
+                conn.execute('UPDATE llm_limit SET concurrency = ?, decreased_at = ?, updated_at = ? WHERE id = 1',
+                             (concurrency, now, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if reduced:
+            print(f"[DEBUG] {reason} na API: limite de chamadas ao LLM -> {int(concurrency)}", flush=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Estado atual do controle (limite, teto, vagas ocupadas, latência média)"""
+        conn = self._conn()
+        concurrency, latency_ewma, _ = self._limit_row(conn)
+        in_use = conn.execute('SELECT COUNT(*) FROM llm_slots').fetchone()[0]
+        return {'limit': int(concurrency), 'concurrency': round(concurrency, 3), 'ceiling': self.capacity,
+                'in_use': in_use, 'latency_ewma': latency_ewma}
+
+    def _looks_available(self, conn: sqlite3.Connection, level: str, now: float) -> bool:
+        """Verificação somente leitura (não bloqueia os outros processos): vale a pena tentar ocupar a vaga?"""
+        in_use = conn.execute('SELECT COUNT(*) FROM llm_slots WHERE acquired_at >= ?',
+                              (now - SLOT_TIMEOUT_SECONDS,)).fetchone()[0]
+        if in_use >= int(self._limit_row(conn)[0]):
+            return False
+        if level == INTERACTIVE:
+            return True
+        interactive_waiting = conn.execute('SELECT COUNT(*) FROM llm_waiters WHERE priority = ? AND seen_at >= ?',
+                                           (INTERACTIVE, now - WAITER_TIMEOUT_SECONDS)).fetchone()[0]
+        return interactive_waiting == 0
+
+    def acquire(self, level: Optional[str] = None) -> str:
+        """Espera uma vaga e a ocupa. Retorna o id da vaga (para release).
+        Enquanto espera, só consulta a tabela (leitura); a transação de escrita é aberta quando há
+        vaga aparente ou para renovar o registro de espera interativa"""
+        level = level or current_priority()
+        conn = self._conn()
+        slot_id = uuid.uuid4().hex
+        waiter_id = None
+        waiter_seen = 0.0
+        waited = False
+        poll = POLL_SECONDS
+        try:
+            while True:
+                now = time.time()
+                renew_waiter = waiter_id is not None and now - waiter_seen >= WAITER_TIMEOUT_SECONDS / 3
+                if waited and not renew_waiter and not self._looks_available(conn, level, now):
+                    # Sem vaga: espera com jitter (lote espaça as consultas até POLL_MAX_SECONDS)
+                    time.sleep(poll * random.uniform(0.5, 1.5))
+                    if level != INTERACTIVE:
+                        poll = min(POLL_MAX_SECONDS, poll * 1.5)
+                    continue
+                conn.execute('BEGIN IMMEDIATE')
+                try:
+                    conn.execute('DELETE FROM llm_slots WHERE acquired_at < ?', (now - SLOT_TIMEOUT_SECONDS,))
+                    conn.execute('DELETE FROM llm_waiters WHERE seen_at < ?', (now - WAITER_TIMEOUT_SECONDS,))
+                    in_use = conn.execute('SELECT COUNT(*) FROM llm_slots').fetchone()[0]
+                    interactive_waiting = conn.execute(
+                        'SELECT COUNT(*) FROM llm_waiters WHERE priority = ? AND waiter_id != ?',
+                        (INTERACTIVE, waiter_id or '')
+                    ).fetchone()[0]
+                    allowed = in_use < int(self._limit_row(conn)[0]) and (level == INTERACTIVE or interactive_waiting == 0)
+                    if allowed:
+                        conn.execute('INSERT INTO llm_slots (slot_id, priority, pid, acquired_at) VALUES (?, ?, ?, ?)',
+                                     (slot_id, level, os.getpid(), now))
+                    elif level == INTERACTIVE:
+                        # Registra (ou renova) a espera: chamadas de lote cedem a vez
+                        waiter_id = waiter_id or uuid.uuid4().hex
+                        conn.execute('INSERT OR REPLACE INTO llm_waiters (waiter_id, priority, seen_at) VALUES (?, ?, ?)',
+                                     (waiter_id, level, now))
+                        waiter_seen = now
+                    conn.execute('COMMIT')
+                except Exception:
+                    conn.execute('ROLLBACK')
+                    raise
+                if allowed:
+                    if waited:
+                        print(f"[DEBUG] Vaga de LLM obtida ({level}) após espera", flush=True)
+                    return slot_id
+                waited = True
+                time.sleep(poll * random.uniform(0.5, 1.5))
+        finally:
+            if waiter_id is not None:
+                conn.execute('DELETE FROM llm_waiters WHERE waiter_id = ?', (waiter_id,))
+
+    def release(self, slot_id: str):
+        self._conn().execute('DELETE FROM llm_slots WHERE slot_id = ?', (slot_id,))
+
+    @contextmanager
+    def slot(self, level: Optional[str] = None):
+        slot_id = self.acquire(level)
+        try:
+            yield
+        finally:
+            self.release(slot_id)
+
+
+_gate: Optional[LLMGate] = None
+_gate_lock = threading.Lock()
+
+
+def get_gate() -> Optional[LLMGate]:
+    """Gate global do processo (None se LLM_MAX_CONCURRENCY <= 0)"""
+    global _gate
+    if LLM_MAX_CONCURRENCY <= 0:
+        return None
+    with _gate_lock:
+        if _gate is None:
+            _gate = LLMGate(LLM_GATE_DB, LLM_MAX_CONCURRENCY)
+    return _gate
+
+
+def slot(level: Optional[str] = None):
+    """Contexto que ocupa uma vaga de chamada ao LLM durante o bloco"""
+    gate = get_gate()
+    return gate.slot(level) if gate is not None else nullcontext()
+
+
+def overload_reason(error: Exception) -> Optional[str]:
+    """'rate_limit' (429), 'timeout' ou None (erro que nova tentativa não resolve)"""
+    text = str(error).lower()
+    if 'insufficient_quota' in text:
+        # Créditos esgotados também voltam como 429, mas esperar não resolve
+        return None
+    name = type(error).__name__
+    if name == 'RateLimitError' or getattr(error, 'status_code', None) == 429 or 'rate_limit' in text:
+        return 'rate_limit'
+    if name == 'APITimeoutError' or isinstance(error, TimeoutError) or 'timed out' in text:
+        return 'timeout'
+    return None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Espera indicada pela API nos cabeçalhos da resposta (retry-after-ms / retry-after)"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def backoff_seconds(attempt: int, error: Optional[Exception] = None) -> float:
+    """Backoff exponencial com jitter; Retry-After da API prevalece quando maior"""
+    delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.0)
+    retry_after = _retry_after(error) if error is not None else None
+    return min(BACKOFF_MAX_SECONDS, max(delay, retry_after or 0))
+
+
+def call(func: Callable[[], Any], level: Optional[str] = None) -> Any:
+    """Executa func (uma chamada ao LLM) em uma vaga e informa o resultado ao controle adaptativo.
+    429/timeout: reduz o limite, espera fora da vaga e tenta de novo (até LLM_MAX_RETRIES)"""
+    gate = get_gate()
+    attempt = 0
+    while True:
+        error = None
+        with slot(level):
+            started = time.time()
+            try:
+                result = func()
+            except Exception as e:
+                error = e
+            latency = time.time() - started
+        if error is None:
+            if gate is not None:
+                gate.on_success(latency)
+            return result
+        reason = overload_reason(error)
+        if reason is None:
+            raise error
+        if gate is not None:
+            gate.on_overload(reason)
+        if attempt >= LLM_MAX_RETRIES:
+            raise error
+        delay = backoff_seconds(attempt, error)
+        attempt += 1
+        print(f"[DEBUG] {reason} na chamada ao LLM; nova tentativa {attempt}/{LLM_MAX_RETRIES} em {delay:.1f}s", flush=True)
+        time.sleep(delay)
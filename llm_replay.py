@@ -0,0 +1,169 @@
+"""
+Gravação e reprodução das chamadas ao LLM (LLM_MODE)
+- live (padrão): chamadas à API, sem gravação
+- record: cada par requisição/resposta da API vai para um log JSONL compactado (gzip), um
+  arquivo por processo em LLM_RECORD_DIR
+- replay: as respostas gravadas (LLM_REPLAY_PATH: arquivo ou pasta de logs) são servidas pela
+  mesma interface do cliente (client.chat.completions.create), sem rede, sem llm_gate e sem o
+  cache.db do projeto (cache isolado por processo); chamada não gravada é erro
+- Na gravação o cache.db também fica de fora: toda chamada vai à API e entra no log
+- A chave é o hash do corpo da requisição (modelo, mensagens, parâmetros): a mesma usada nos
+  arquivos de batch (batch_submission.py). Requisições repetidas com respostas diferentes são
+  servidas na ordem gravada (a última se repete)
+- Uso: iterar no pós-processamento (reconciliação com o F17, retry, mapeamento reverso) e rodar
+  benchmarks e regressões do pipeline completo offline
+"""
+
+import glob
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+from batch_submission import custom_id
+
+LIVE = 'live'
+RECORD = 'record'
+REPLAY = 'replay'
+
+LLM_MODE = os.getenv('LLM_MODE', LIVE)
+LLM_RECORD_DIR = os.getenv('LLM_RECORD_DIR', os.path.join(
+    os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_results')), 'llm_recordings'))
+LLM_REPLAY_PATH = os.getenv('LLM_REPLAY_PATH', LLM_RECORD_DIR)
+
+
+def replaying() -> bool:
+    return LLM_MODE == REPLAY
+
+
+def recording_files(path: str) -> List[str]:
+    """Logs de gravação de um arquivo ou pasta (ordem de nome = ordem de gravação)"""
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*.jsonl.gz')))
+    return [path] if os.path.exists(path) else []
+
+
+def load_recordings(path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """chave -> respostas gravadas (na ordem)"""
+    recordings: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for file_path in recording_files(path):
+        with gzip.open(file_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    recordings[entry['key']].append(entry['response'])
+    return recordings
+
+
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+
+class _Chat:
+    def __init__(self, create):
+        self.completions = _Completions(create)
+
+
+_record_path: Optional[str] = None
+_replay_cache_path: Optional[str] = None
+_replay_client: Optional['ReplayClient'] = None
+_state_lock = threading.Lock()
+
+
+def record_path() -> str:
+    """Log de gravação deste processo (workers diferentes não se intercalam)"""
+    global _record_path
+    with _state_lock:
+        if _record_path is None:
+            os.makedirs(LLM_RECORD_DIR, exist_ok=True)
+            _record_path = os.path.join(LLM_RECORD_DIR, f"llm_{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.jsonl.gz")
+            print(f"[DEBUG] LLM em modo record: gravando em {_record_path}", flush=True)
+    return _record_path
+
+
+class RecordingClient:
+    """Cliente que repassa as chamadas ao cliente real e grava cada par requisição/resposta"""
+
+    _lock = threading.Lock()
+
+    def __init__(self, client, path: str = None):
+        self.client = client
+        self.path = path or record_path()
+        self.chat = _Chat(self._create)
+
+    def _create(self, **body):
+        started = time.time()
+        response = self.client.chat.completions.create(**body)
+        entry = {
+            'key': custom_id(body),
+            'request': body,
+            'response': response.model_dump() if hasattr(response, 'model_dump') else response,
+            'latency': round(time.time() - started, 3),
+            'recorded_at': time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            # Cada gravação é um membro gzip completo (o arquivo é legível mesmo se o processo cair)
+            with gzip.open(self.path, 'at', encoding='utf-8') as f:
+                f.write(line)
+        return response
+
+
+class ReplayClient:
+    """Cliente que responde com as gravações (determinístico, sem rede)"""
+
+    def __init__(self, path: str = None):
+        self.path = path or LLM_REPLAY_PATH
+        self._recordings = load_recordings(self.path)
+        self._served: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self.chat = _Chat(self._create)
+
+    @property
+    def size(self) -> int:
+        return sum(len(responses) for responses in self._recordings.values())
+
+    def _create(self, **body):
+        key = custom_id(body)
+        with self._lock:
+            responses = self._recordings.get(key)
+            if not responses:
+                raise Exception(f"Chamada não gravada em {self.path} (chave {key}, modelo {body.get('model')})")
+            index = min(self._served[key], len(responses) - 1)
+            self._served[key] += 1
+        from openai.types.chat import ChatCompletion
+        return ChatCompletion.model_validate(responses[index])
+
+
+def wrap_client(client_factory):
+    """Cliente conforme LLM_MODE: o real (live), o real com gravação (record) ou o de reprodução
+    (replay, compartilhado pelo processo; o cliente real não é criado)"""
+    global _replay_client
+    if LLM_MODE == REPLAY:
+        with _state_lock:
+            if _replay_client is None:
+                _replay_client = ReplayClient()
+                print(f"[DEBUG] LLM em modo replay: {_replay_client.size} respostas gravadas ({_replay_client.path})", flush=True)
+        return _replay_client
+    if LLM_MODE == RECORD:
+        return RecordingClient(client_factory())
+    return client_factory()
+
+
+def cache_db_path() -> Optional[str]:
+    """Na gravação e no replay o cache de respostas fica isolado e vazio no início do processo
+    (o cache.db do projeto não esconde chamadas da gravação nem mascara as respostas gravadas)"""
+    global _replay_cache_path
+    if LLM_MODE not in (RECORD, REPLAY):
+        return None
+    with _state_lock:
+        if _replay_cache_path is None:
+            _replay_cache_path = os.path.join(tempfile.gettempdir(), f"llm_{LLM_MODE}_cache_{os.getpid()}.db")
+            if os.path.exists(_replay_cache_path):
+                os.remove(_replay_cache_path)
+    return _replay_cache_path
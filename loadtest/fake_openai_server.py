@@ -0,0 +1,310 @@
+"""
+Servidor local que imita o endpoint de chat completions da OpenAI (teste de carga)
+- POST /v1/chat/completions no formato da API: function-calling (tools ou functions) para o
+  agrupamento individual (return_groups) e por pacote (return_question_groups, blocos
+  '### QUESTÃO:'); sem função, devolve a frase padronizada (padronização de títulos)
+- Agrupamento determinístico: as respostas numeradas são agrupadas pela primeira palavra
+  significativa (sem acentos; grafias parecidas caem no mesmo grupo, como faria o modelo); o
+  grupo reaproveita o código do F17 cuja descrição contém essa palavra, senão recebe código novo
+  a partir de 10. Mesma entrada -> mesma saída
+- Latência configurável: base + variação aleatória (com semente) + tokens de saída / vazão
+- Falhas injetadas: 500 (--error-rate), 429 aleatório (--rate-limit-rate), 429 acima de N chamadas
+  simultâneas (--max-concurrency) ou de N chamadas por minuto (--rpm), sempre com Retry-After
+- GET /stats: contadores (chamadas, erros, 429, simultaneidade máxima, tokens)
+- Uso: python loadtest/fake_openai_server.py --port 8001 --latency-ms 300 --tokens-per-second 400
+  e no app OPENAI_BASE_URL=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake
+"""
+
+import argparse
+import difflib
+import json
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+# Palavras ignoradas na escolha da chave do grupo
+STOPWORDS = {
+    'a', 'o', 'as', 'os', 'e', 'de', 'da', 'do', 'das', 'dos', 'em', 'na', 'no', 'nas', 'nos', 'um', 'uma',
+    'para', 'pra', 'com', 'sem', 'por', 'que', 'mais', 'menos', 'muito', 'muita', 'falta', 'ter', 'tem', 'ser',
+    'melhorar', 'melhoria', 'melhor', 'acho', 'eu', 'bem', 'mal', 'so', 'nao', 'sim',
+}
+NEW_CODE_START = 10
+
+_QUESTION_HEADER = re.compile(r'^### QUESTÃO: (.*)$', re.M)
+_NUMBERED_ITEM = re.compile(r'^\d+\. (.*)$', re.M)
+_F17_LINE = re.compile(r'^\s*(\d+)\s*[-|:.)]?\s*(.*)$')
+
+
+def normalize(text: str) -> str:
+    s = unicodedata.normalize('NFKD', str(text).lower())
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+    return re.sub(r'[^a-z0-9 ]+', ' ', s)
+
+
+def group_key(response: str) -> str:
+    """Primeira palavra significativa da resposta (ou o texto inteiro normalizado)"""
+    words = normalize(response).split()
+    for word in words:
+        if word not in STOPWORDS and len(word) > 2:
+            return word
+    return words[0] if words else 'outros'
+
+
+def parse_f17(block: str) -> List[Tuple[Optional[int], str]]:
+    """Linhas do bloco 'F17 (codebook):' como (código ou None, descrição)"""
+    entries = []
+    for line in block.splitlines():
+        line = line.strip()
+        if not line or line == '(vazio)':
+            continue
+        match = _F17_LINE.match(line)
+        entries.append((int(match.group(1)), match.group(2)) if match else (None, line))
+    return entries
+
+
+def group_responses(responses: List[str], f17: List[Tuple[Optional[int], str]]) -> List[Dict[str, Any]]:
+    """Grupos no formato de return_groups: {'codigo', 'titulo', 'respostas'}"""
+    used = {code for code, _ in f17 if code is not None}
+    next_code = max([NEW_CODE_START - 1] + [code for code in used if code < 55 or code > 99]) + 1
+    groups: Dict[str, Dict[str, Any]] = {}
+    for response in responses:
+        key = group_key(response)
+        # Erro de digitação na palavra-chave ('hospiatl') vai para o grupo da grafia já vista
+        close = difflib.get_close_matches(key, list(groups), n=1, cutoff=0.8)
+        if close:
+            key = close[0]
+        group = groups.get(key)
+        if group is None:
+            code, title = None, key.capitalize()
+            for index, (f17_code, description) in enumerate(f17):
+                if key in normalize(description).split():
+                    code, title = (f17_code if f17_code is not None else index + 1), description
+                    break
+            if code is None:
+                code = next_code
+                next_code += 1
+            group = groups[key] = {'codigo': code, 'titulo': title, 'respostas': []}
+        group['respostas'].append(response)
+    return list(groups.values())
+
+
+def _section(text: str, start: str, end: Optional[str] = None) -> str:
+    _, _, rest = text.partition(start)
+    return rest.split(end, 1)[0] if end and end in rest else rest
+
+
+def grouping_arguments(messages: List[Dict[str, Any]], packed: bool) -> Dict[str, Any]:
+    """Argumentos da função de agrupamento a partir das mensagens enviadas pelo app"""
+    user_text = "\n".join(str(m.get('content') or '') for m in messages if m.get('role') == 'user')
+    if not packed:
+        f17 = parse_f17(_section(user_text, 'F17 (codebook):', 'Total de respostas'))
+        responses = _NUMBERED_ITEM.findall(_section(user_text, 'Responses to be coded'))
+        return {'groups': group_responses(responses, f17)}
+    questions = []
+    headers = list(_QUESTION_HEADER.finditer(user_text))
+    for i, header in enumerate(headers):
+        block = user_text[header.end():headers[i + 1].start() if i + 1 < len(headers) else len(user_text)]
+        f17 = parse_f17(_section(block, 'F17 (codebook):', 'Responses to be coded'))
+        responses = _NUMBERED_ITEM.findall(_section(block, 'Responses to be coded'))
+        questions.append({'questao': header.group(1).strip(), 'groups': group_responses(responses, f17)})
+    return {'questions': questions}
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeOpenAI:
+    """Estado do servidor: configuração, gerador aleatório, janela de requisições e contadores"""
+
+    def __init__(self, latency_ms: float = 300, jitter_ms: float = 100, tokens_per_second: float = 0,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, max_concurrency: int = 0, rpm: int = 0,
+                 retry_after: float = 1.0, seed: int = 42):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._recent = deque()
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'completed': 0, 'errors': 0, 'rate_limited': 0, 'max_in_flight': 0,
+                      'prompt_tokens': 0, 'completion_tokens': 0, 'models': {}}
+
+    def admit(self) -> Optional[Tuple[int, str]]:
+        """Decide a falha injetada da requisição: (status, motivo) ou None (atende)"""
+        with self._lock:
+            now = time.time()
+            self.stats['requests'] += 1
+            while self._recent and now - self._recent[0] > 60:
+                self._recent.popleft()
+            roll = self._random.random()
+            failure = None
+            if self.max_concurrency and self.in_flight >= self.max_concurrency:
+                failure = (429, f'Limite de {self.max_concurrency} chamadas simultâneas')
+            elif self.rpm and len(self._recent) >= self.rpm:
+                failure = (429, f'Limite de {self.rpm} chamadas por minuto')
+            elif roll < self.rate_limit_rate:
+                failure = (429, '429 injetado')
+            elif roll < self.rate_limit_rate + self.error_rate:
+                failure = (500, 'Erro injetado')
+            if failure is not None:
+                self.stats['rate_limited' if failure[0] == 429 else 'errors'] += 1
+                return failure
+            self._recent.append(now)
+            self.in_flight += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+            return None
+
+    def delay(self, completion_tokens: int) -> float:
+        with self._lock:
+            jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0
+        generation = completion_tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        return max(0.0, (self.latency_ms + jitter) / 1000) + generation
+
+    def complete(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Resposta no formato chat.completion (sem a espera)"""
+        messages = body.get('messages') or []
+        functions = [tool.get('function', {}) for tool in body.get('tools') or []] + list(body.get('functions') or [])
+        name = functions[0].get('name') if functions else None
+        if name:
+            arguments = json.dumps(grouping_arguments(messages, name == 'return_question_groups'), ensure_ascii=False)
+            output = arguments
+            if body.get('tools'):
+                message = {'role': 'assistant', 'content': None, 'tool_calls': [
+                    {'id': f'call_{uuid.uuid4().hex[:12]}', 'type': 'function',
+                     'function': {'name': name, 'arguments': arguments}}]}
+                finish_reason = 'tool_calls'
+            else:
+                message = {'role': 'assistant', 'content': None, 'function_call': {'name': name, 'arguments': arguments}}
+                finish_reason = 'function_call'
+        else:
+            phrase = str(messages[-1].get('content') or '').strip() if messages else ''
+            output = phrase[:1].upper() + phrase[1:].lower()
+            message = {'role': 'assistant', 'content': output}
+            finish_reason = 'stop'
+        prompt_tokens = estimate_tokens(json.dumps(messages, ensure_ascii=False))
+        completion_tokens = estimate_tokens(output)
+        with self._lock:
+            self.stats['prompt_tokens'] += prompt_tokens
+            self.stats['completion_tokens'] += completion_tokens
+            model = body.get('model') or ''
+            self.stats['models'][model] = self.stats['models'].get(model, 0) + 1
+        return {
+            'id': f'chatcmpl-{uuid.uuid4().hex[:24]}', 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model'),
+            'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def release(self, ok: bool):
+        with self._lock:
+            self.in_flight -= 1
+            if ok:
+                self.stats['completed'] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self.stats, in_flight=self.in_flight, models=dict(self.stats['models']))
+
+
+def make_handler(fake: FakeOpenAI):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/stats':
+                self._send(200, fake.snapshot())
+            elif self.path.rstrip('/').endswith('/models'):
+                self._send(200, {'object': 'list', 'data': [{'id': 'fake', 'object': 'model'}]})
+            else:
+                self._send(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                self._send(404, {'error': {'message': 'Not found', 'type': 'invalid_request_error'}})
+                return
+            failure = fake.admit()
+            if failure is not None:
+                status, reason = failure
+                if status == 429:
+                    self._send(429, {'error': {'message': f'Rate limit reached: {reason}', 'type': 'requests',
+                                               'code': 'rate_limit_exceeded'}},
+                               {'Retry-After': str(fake.retry_after)})
+                else:
+                    self._send(500, {'error': {'message': reason, 'type': 'server_error'}})
+                return
+            ok = False
+            try:
+                response = fake.complete(body)
+                time.sleep(fake.delay(response['usage']['completion_tokens']))
+                self._send(200, response)
+                ok = True
+            finally:
+                fake.release(ok)
+
+    return Handler
+
+
+def serve(fake: FakeOpenAI, host: str = '127.0.0.1', port: int = 8001) -> ThreadingHTTPServer:
+    """Inicia o servidor em thread própria (uso embutido em scripts). Porta 0 = livre"""
+    server = ThreadingHTTPServer((host, port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='fake-openai').start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor local que imita o chat completions da OpenAI')
+    parser.add_argument('--host', default=os.getenv('FAKE_OPENAI_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('FAKE_OPENAI_PORT', 8001)))
+    parser.add_argument('--latency-ms', type=float, default=300, help='latência base por chamada')
+    parser.add_argument('--jitter-ms', type=float, default=100, help='variação aleatória da latência (±)')
+    parser.add_argument('--tokens-per-second', type=float, default=0, help='vazão de saída (0 = instantânea)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fração de respostas 500')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fração de respostas 429')
+    parser.add_argument('--max-concurrency', type=int, default=0, help='429 acima de N chamadas simultâneas (0 = sem limite)')
+    parser.add_argument('--rpm', type=int, default=0, help='429 acima de N chamadas por minuto (0 = sem limite)')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='segundos no cabeçalho Retry-After dos 429')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    fake = FakeOpenAI(args.latency_ms, args.jitter_ms, args.tokens_per_second, args.error_rate, args.rate_limit_rate,
+                      args.max_concurrency, args.rpm, args.retry_after, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(fake))
+    server.daemon_threads = True
+    print(f"[DEBUG] Fake OpenAI em http://{args.host}:{args.port}/v1", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(fake.snapshot(), ensure_ascii=False, indent=2), flush=True)
+
+
+if __name__ == '__main__':
+    main()
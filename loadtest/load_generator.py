@@ -0,0 +1,302 @@
+"""
+Teste de carga do servidor web contra o servidor falso da OpenAI (loadtest/fake_openai_server.py)
+- Gera bancos/F17 realistas com benchmarks/synthetic_survey.py (respostas abertas em pt-BR,
+  erros de digitação, não-respostas, frequência de Zipf) e dispara, com N clientes simultâneos:
+  uploads em lote (/upload + acompanhamento por /task_status até o estado final) e questões
+  específicas (/questao_especifica)
+- Amostra /metrics durante o teste: profundidade da fila, jobs ativos, vagas do llm_gate e
+  memória (RSS) do servidor web e dos workers
+- Relatório: vazão, latência p50/p95/p99 por operação, rejeições 429 da fila, erros,
+  pico de fila/memória e os contadores do servidor falso (chamadas, 429 injetados)
+- --spawn sobe o servidor falso e o app (python web_interface_ipo.py) em subprocessos com
+  pastas temporárias; sem --spawn usa --url/--fake-url de servidores já em execução
+- Uso: python loadtest/load_generator.py --spawn --uploads 8 --questions 20 --concurrency 4
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from synthetic_survey import generate_answers, generate_codebook, survey_files  # noqa: E402
+
+FINAL_STATES = ('COMPLETED', 'ERROR', 'CANCELLED')
+
+
+def encode_multipart(fields: Dict[str, str], files: Dict[str, Tuple[str, bytes]]) -> Tuple[bytes, str]:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    for name, (filename, data) in files.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/octet-stream\r\n\r\n'.encode('utf-8') + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def http(method: str, url: str, data: bytes = None, content_type: str = None,
+         timeout: float = 600) -> Tuple[int, Dict[str, str], Any]:
+    """(status, cabeçalhos, corpo JSON ou texto); respostas de erro HTTP não levantam exceção"""
+    req = urllib.request.Request(url, data=data, method=method)
+    if content_type:
+        req.add_header('Content-Type', content_type)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            status, headers, body = resp.status, dict(resp.headers), resp.read()
+    except urllib.error.HTTPError as e:
+        status, headers, body = e.code, dict(e.headers), e.read()
+    try:
+        return status, headers, json.loads(body)
+    except ValueError:
+        return status, headers, body.decode('utf-8', 'replace')
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por posição mais próxima (None sem amostras)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered), max(1, math.ceil(pct / 100 * len(ordered)))) - 1]
+
+
+class LoadTest:
+    """Executa as operações, mede latências e amostra /metrics"""
+
+    def __init__(self, url: str, args):
+        self.url = url.rstrip('/')
+        self.args = args
+        self.results: Dict[str, List[Dict[str, Any]]] = {'upload': [], 'job': [], 'questao': []}
+        self.samples: List[Dict[str, Any]] = []
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _record(self, kind: str, seconds: float, ok: bool, detail: str = None):
+        with self._lock:
+            self.results[kind].append({'seconds': seconds, 'ok': ok, 'detail': detail})
+
+    def run_upload(self, index: int):
+        banco, f17 = survey_files(self.args.rows, self.args.open_questions, seed=self.args.seed + index)
+        fields = {'output_mode': self.args.output_mode, 'execution_mode': self.args.execution_mode}
+        files = {'banco_file': (f'banco_{index}.xlsx', banco), 'f17_file': (f'f17_{index}.xlsx', f17)}
+        submitted = time.time()
+        while True:
+            body, content_type = encode_multipart(fields, files)
+            started = time.time()
+            status, headers, payload = http('POST', f"{self.url}/upload", body, content_type)
+            if status == 429:
+                # Fila cheia: espera o Retry-After e reenvia (o tempo até a admissão conta no job)
+                with self._lock:
+                    self.rejected += 1
+                time.sleep(float(headers.get('Retry-After') or 5))
+                continue
+            break
+        ok = status == 200 and isinstance(payload, dict) and payload.get('success')
+        self._record('upload', time.time() - started, bool(ok), None if ok else str(payload)[:200])
+        if not ok:
+            return
+        task_id = payload['task_id']
+        deadline = time.time() + self.args.job_timeout
+        state, task = None, {}
+        while time.time() < deadline:
+            _, _, task = http('GET', f"{self.url}/task_status/{task_id}")
+            state = task.get('state') if isinstance(task, dict) else None
+            if state in FINAL_STATES:
+                break
+            time.sleep(self.args.poll_seconds)
+        self._record('job', time.time() - submitted, state == 'COMPLETED',
+                     None if state == 'COMPLETED' else f"{state}: {(task or {}).get('error')}")
+
+    def run_questao(self, index: int):
+        question_seed = self.args.seed * 1000 + index
+        answers = generate_answers(self.args.questao_rows, question_seed)
+        f17 = [f"{code}|{description}" for description, code in generate_codebook(question_seed).items()]
+        body = urllib.parse.urlencode({'question_name': f'Q{index}', 'question_data': '\n'.join(answers),
+                                       'f17_codes': '\n'.join(f17)}).encode('utf-8')
+        started = time.time()
+        status, _, payload = http('POST', f"{self.url}/questao_especifica", body, 'application/x-www-form-urlencoded')
+        ok = status == 200 and isinstance(payload, dict) and payload.get('success')
+        self._record('questao', time.time() - started, bool(ok), None if ok else str(payload)[:200])
+
+    def _sample_metrics(self):
+        while not self._stop.is_set():
+            try:
+                _, _, metrics = http('GET', f"{self.url}/metrics", timeout=10)
+                if isinstance(metrics, dict):
+                    metrics['at'] = time.time()
+                    self.samples.append(metrics)
+            except Exception as e:
+                print(f"[DEBUG] Falha ao ler /metrics: {e}", flush=True)
+            self._stop.wait(self.args.sample_seconds)
+
+    def run(self) -> Dict[str, Any]:
+        operations = ([(self.run_upload, i) for i in range(self.args.uploads)] +
+                      [(self.run_questao, i) for i in range(self.args.questions)])
+        random.Random(self.args.seed).shuffle(operations)
+        sampler = threading.Thread(target=self._sample_metrics, daemon=True, name='metrics-sampler')
+        sampler.start()
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            futures = [executor.submit(func, i) for func, i in operations]
+            for future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"[DEBUG] Operação falhou: {e}", flush=True)
+        elapsed = time.time() - started
+        self._stop.set()
+        sampler.join(timeout=15)
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        operations = {}
+        for kind, results in self.results.items():
+            if not results:
+                continue
+            seconds = [r['seconds'] for r in results if r['ok']]
+            operations[kind] = {
+                'count': len(results), 'ok': len(seconds), 'errors': len(results) - len(seconds),
+                'throughput_per_min': round(len(seconds) / elapsed * 60, 2) if elapsed else None,
+                'p50': percentile(seconds, 50), 'p95': percentile(seconds, 95), 'p99': percentile(seconds, 99),
+                'max': max(seconds) if seconds else None,
+                'sample_errors': [r['detail'] for r in results if not r['ok']][:3],
+            }
+
+        def peak(getter, best=max):
+            values = [v for v in (getter(s) for s in self.samples) if v is not None]
+            return best(values) if values else None
+
+        def total_rss(sample):
+            memory = sample.get('memory_mb') or {}
+            parts = [memory.get('web')] + list((memory.get('workers') or {}).values())
+            parts = [p for p in parts if p is not None]
+            return round(sum(parts), 1) if parts else None
+
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'operations': operations,
+            'queue_rejections_429': self.rejected,
+            'metrics': {
+                'samples': len(self.samples),
+                'peak_queue_depth': peak(lambda s: s.get('queue_depth')),
+                'peak_active_jobs': peak(lambda s: s.get('active_jobs')),
+                'peak_llm_in_use': peak(lambda s: (s.get('llm_gate') or {}).get('in_use')),
+                'min_llm_limit': peak(lambda s: (s.get('llm_gate') or {}).get('limit'), best=min),
+                'peak_web_rss_mb': peak(lambda s: (s.get('memory_mb') or {}).get('web')),
+                'peak_total_rss_mb': peak(total_rss),
+            },
+        }
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"\nDuração: {report['elapsed_seconds']}s | rejeições 429 da fila: {report['queue_rejections_429']}")
+    print(f"{'operação':<10} {'ok/total':>10} {'por min':>9} {'p50':>8} {'p95':>8} {'p99':>8} {'máx':>8}")
+    for kind, op in report['operations'].items():
+        cells = [f"{op[k]:.2f}" if op[k] is not None else '-' for k in ('p50', 'p95', 'p99', 'max')]
+        print(f"{kind:<10} {op['ok']:>5}/{op['count']:<4} {op['throughput_per_min'] or 0:>9} "
+              f"{cells[0]:>8} {cells[1]:>8} {cells[2]:>8} {cells[3]:>8}")
+        for detail in op['sample_errors']:
+            print(f"    erro: {detail}")
+    print("Métricas do servidor:", json.dumps(report['metrics'], ensure_ascii=False))
+    if report.get('fake_openai'):
+        print("Servidor falso da OpenAI:", json.dumps(report['fake_openai'], ensure_ascii=False))
+
+
+def _wait_until_up(url: str, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            http('GET', url, timeout=2)
+            return
+        except Exception:
+            time.sleep(0.3)
+    raise Exception(f"Servidor não respondeu em {url}")
+
+
+def spawn_servers(args) -> Tuple[List[subprocess.Popen], str, str]:
+    """Sobe o servidor falso da OpenAI e o app em subprocessos, com pastas e cache.db temporários
+    (o cache do projeto não esconde chamadas do teste)"""
+    workdir = tempfile.mkdtemp(prefix='ipo_loadtest_')
+    fake_cmd = [sys.executable, os.path.join(ROOT, 'loadtest', 'fake_openai_server.py'),
+                '--port', str(args.fake_port)] + args.fake_args
+    env = dict(os.environ,
+               OPENAI_BASE_URL=f"http://127.0.0.1:{args.fake_port}/v1", OPENAI_API_KEY='fake',
+               PORT=str(args.app_port), FLASK_ENV='production', LLM_MODE='live',
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'), RESULTS_FOLDER=os.path.join(workdir, 'results'),
+               CACHE_DB_PATH=os.path.join(workdir, 'cache.db'))
+    log = open(os.path.join(workdir, 'app.log'), 'w')
+    processes = [subprocess.Popen(fake_cmd, stdout=log, stderr=subprocess.STDOUT),
+                 subprocess.Popen([sys.executable, 'web_interface_ipo.py'], cwd=ROOT, env=env,
+                                  stdout=log, stderr=subprocess.STDOUT)]
+    url = f"http://127.0.0.1:{args.app_port}"
+    fake_url = f"http://127.0.0.1:{args.fake_port}"
+    _wait_until_up(f"{fake_url}/stats")
+    _wait_until_up(f"{url}/metrics")
+    print(f"[DEBUG] App em {url}, OpenAI falsa em {fake_url} (log e pastas em {workdir})", flush=True)
+    return processes, url, fake_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Teste de carga do servidor web do IPO')
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='app já em execução (sem --spawn)')
+    parser.add_argument('--fake-url', default=None, help='servidor falso da OpenAI (para ler /stats)')
+    parser.add_argument('--spawn', action='store_true', help='sobe o servidor falso e o app em subprocessos')
+    parser.add_argument('--app-port', type=int, default=5055)
+    parser.add_argument('--fake-port', type=int, default=8001)
+    parser.add_argument('--fake-args', default='', help="argumentos do servidor falso, ex.: '--latency-ms 500 --rate-limit-rate 0.05'")
+    parser.add_argument('--uploads', type=int, default=4, help='uploads em lote')
+    parser.add_argument('--questions', type=int, default=10, help='chamadas a /questao_especifica')
+    parser.add_argument('--concurrency', type=int, default=4, help='clientes simultâneos')
+    parser.add_argument('--rows', type=int, default=500, help='linhas de cada banco')
+    parser.add_argument('--open-questions', type=int, default=4, help='questões abertas de cada banco')
+    parser.add_argument('--questao-rows', type=int, default=40, help='respostas de cada questão específica')
+    parser.add_argument('--output-mode', default='consolidated')
+    parser.add_argument('--execution-mode', default='interactive')
+    parser.add_argument('--poll-seconds', type=float, default=1.0)
+    parser.add_argument('--sample-seconds', type=float, default=2.0)
+    parser.add_argument('--job-timeout', type=float, default=1800)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--json', default=None, help='grava o relatório neste arquivo')
+    args = parser.parse_args()
+    args.fake_args = args.fake_args.split()
+
+    processes = []
+    url, fake_url = args.url, args.fake_url
+    try:
+        if args.spawn:
+            processes, url, fake_url = spawn_servers(args)
+        report = LoadTest(url, args).run()
+        if fake_url:
+            report['fake_openai'] = http('GET', f"{fake_url.rstrip('/')}/stats")[2]
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
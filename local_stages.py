@@ -0,0 +1,183 @@
+"""
+Execução paralela das etapas locais de CPU (normalização, canonicalização, mapeamento reverso)
+- Conjuntos grandes de valores únicos são divididos em blocos
+- Um único pool de processos (spawn) por processo, criado no primeiro uso e reaproveitado
+  pelas chamadas seguintes; os workers são inicializados uma vez com a configuração
+  (correções, padrões) e o próprio índice ortográfico do processo principal, de modo que
+  o resultado em paralelo é idêntico ao serial
+- Os dados de cada chamada (codebook F17, mapa resposta -> código) seguem com os blocos
+- Os resultados são recombinados na ordem original (saída determinística)
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import fuzzy_kernel
+import job_queue
+
+# 0 = modo serial (padrão); N > 0 = número de processos worker
+POOL_WORKERS = int(os.getenv('LOCAL_POOL_WORKERS', 0))
+# Abaixo deste número de valores únicos não compensa abrir processos
+POOL_MIN_ITEMS = int(os.getenv('LOCAL_POOL_MIN_ITEMS', 5000))
+POOL_CHUNK_SIZE = int(os.getenv('LOCAL_POOL_CHUNK_SIZE', 2000))
+
+
+class ResponseMatcher:
+    """Matcher compilado do mapeamento reverso (resposta -> código)"""
+
+    def __init__(self, response_to_code: Dict[str, Tuple[int, Any]], normalize: Callable[[str], str]):
+        self.response_to_code = response_to_code
+        self.normalize = normalize
+        self.keys = list(response_to_code.keys())
+        self._memo: Dict[str, Optional[int]] = {}
+
+    def match(self, resp_str: str) -> Optional[int]:
+        """Código da resposta (exato, normalizado, substring >= 80% ou fuzzy >= 85), ou None"""
+        if resp_str in self._memo:
+            return self._memo[resp_str]
+
+        resp_norm = self.normalize(resp_str)
+        found_code = None
+
+        # Tenta match exato (sem normalização primeiro) e exato normalizado
+        if resp_str in self.response_to_code:
+            found_code = self.response_to_code[resp_str][0]
+        elif resp_norm in self.response_to_code:
+            found_code = self.response_to_code[resp_norm][0]
+        else:
+            # Tenta match parcial (substring)
+            best_code = None
+            best_score = 0
+            for resp_norm_key, (code, _) in self.response_to_code.items():
+                if resp_norm in resp_norm_key or resp_norm_key in resp_norm:
+                    score = min(len(resp_norm), len(resp_norm_key)) / max(len(resp_norm), len(resp_norm_key), 1)
+                    if score > best_score:
+                        best_score = score
+                        best_code = code
+
+            if best_code and best_score >= 0.8:  # Threshold de 80%
+                found_code = best_code
+            else:
+                # Fuzzy matching como último recurso (threshold de 85%)
+                best = fuzzy_kernel.extract_best(resp_norm, self.keys, 'ratio', score_cutoff=85)
+                if best:
+                    found_code = self.response_to_code[self.keys[best[0]]][0]
+
+        self._memo[resp_str] = found_code
+        return found_code
+
+
+def use_pool(item_count: int) -> bool:
+    """Indica se o modo multiprocessos deve ser usado para esta quantidade de itens"""
+    return POOL_WORKERS > 0 and item_count >= POOL_MIN_ITEMS
+
+
+def _chunks(items: List[Any]) -> List[List[Any]]:
+    # Blocos de no mínimo POOL_CHUNK_SIZE, e poucos por worker: os dados da chamada seguem com cada bloco
+    size = max(1, POOL_CHUNK_SIZE, -(-len(items) // (POOL_WORKERS * 4)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# --- Pool de processos (um por processo, criado no primeiro uso e mantido até o fim) ---
+_pools: Dict[str, ProcessPoolExecutor] = {}
+_pools_lock = threading.Lock()
+_call_ids = itertools.count()
+
+
+def _config_key(coding_system) -> str:
+    """Chave da configuração com que os workers são inicializados (correções, padrões e vocabulário)"""
+    payload = json.dumps([coding_system.corrections, coding_system.similarity_patterns,
+                          sorted(coding_system.spell_index.words.items())],
+                         sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _get_pool(coding_system) -> ProcessPoolExecutor:
+    # spawn: o worker não herda threads/locks do processo (o pool é usado a partir de threads)
+    key = _config_key(coding_system)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = ProcessPoolExecutor(
+                max_workers=POOL_WORKERS,
+                mp_context=job_queue.WorkerContext(),
+                initializer=_init_worker,
+                initargs=(coding_system.corrections, coding_system.similarity_patterns, coding_system.spell_index),
+            )
+            _pools[key] = pool
+        return pool
+
+
+# --- Estado dos processos worker (configuração fixa; dados de cada chamada chegam com os blocos) ---
+_worker_system = None
+# id da chamada -> matcher (poucas chamadas recentes: colunas em paralelo compartilham o pool)
+_worker_matchers: 'OrderedDict[int, ResponseMatcher]' = OrderedDict()
+WORKER_MATCHER_SLOTS = 4
+
+
+def _init_worker(corrections: Dict[str, str], similarity_patterns: Dict[str, List[str]], spell_index):
+    global _worker_system
+    from improved_coding_system import ImprovedIPOCodingSystem
+    # o índice vem do processo principal (não é reconstruído a partir dos arquivos do worker)
+    _worker_system = ImprovedIPOCodingSystem(corrections=corrections, similarity_patterns=similarity_patterns,
+                                             spell_index=spell_index)
+
+
+def _canonicalize_chunk(existing_codes: Dict[str, int], texts: List[Any]) -> List[Tuple[str, str]]:
+    results = []
+    with _worker_system.codebook_vocabulary(existing_codes):
+        for text in texts:
+            corrected = _worker_system.correct_text(str(text))
+            results.append((corrected, _worker_system.canonicalize(corrected)))
+    return results
+
+
+def _match_chunk(call_id: int, response_to_code: bytes, values: List[str]) -> List[Optional[int]]:
+    matcher = _worker_matchers.get(call_id)
+    if matcher is None:
+        # o mapa da chamada vai serializado uma única vez no processo principal
+        matcher = ResponseMatcher(pickle.loads(response_to_code), _worker_system.normalize_text)
+        _worker_matchers[call_id] = matcher
+        while len(_worker_matchers) > WORKER_MATCHER_SLOTS:
+            _worker_matchers.popitem(last=False)
+    return [matcher.match(v) for v in values]
+
+
+def canonicalize_many(coding_system, texts: List[Any], existing_codes: Dict[str, int]) -> List[Tuple[str, str]]:
+    """(texto corrigido, forma canônica) de cada texto, em paralelo quando a lista é grande"""
+    if not use_pool(len(texts)):
+        results = []
+        for text in texts:
+            corrected = coding_system.correct_text(str(text))
+            results.append((corrected, coding_system.canonicalize(corrected)))
+        return results
+
+    print(f"[DEBUG] Canonicalizando {len(texts)} valores em {POOL_WORKERS} processos", flush=True)
+    chunks = _chunks(list(texts))
+    # map preserva a ordem dos blocos
+    parts = _get_pool(coding_system).map(_canonicalize_chunk, [existing_codes] * len(chunks), chunks)
+    return [item for part in parts for item in part]
+
+
+def match_many(coding_system, values: List[str], response_to_code: Dict[str, Tuple[int, Any]],
+               existing_codes: Dict[str, int]) -> Dict[str, Optional[int]]:
+    """Mapeamento reverso de valores únicos -> código (None se não encontrado)"""
+    if not use_pool(len(values)):
+        matcher = ResponseMatcher(response_to_code, coding_system.normalize_text)
+        return {v: matcher.match(v) for v in values}
+
+    print(f"[DEBUG] Mapeamento reverso de {len(values)} valores em {POOL_WORKERS} processos", flush=True)
+    values = list(values)
+    chunks = _chunks(values)
+    payload = pickle.dumps(response_to_code, protocol=pickle.HIGHEST_PROTOCOL)
+    call_id = next(_call_ids)
+    parts = _get_pool(coding_system).map(_match_chunk, [call_id] * len(chunks), [payload] * len(chunks), chunks)
+    codes = [code for part in parts for code in part]
+    return dict(zip(values, codes))
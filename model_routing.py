@@ -0,0 +1,194 @@
+"""
+Roteamento de modelo por tarefa e tamanho da entrada
+- Tabela em config/model_routing.json: a primeira rota da tarefa cujo 'max_items' comporta a
+  entrada define o modelo (sem 'model' = OPENAI_MODEL) e, opcionalmente, outro endpoint
+  compatível ('base_url', ex.: servidor local) e os preços do modelo ('price', US$ por 1M de tokens,
+  usados no custo do job e no orçamento; sem 'price' = LLM_PRICE_*)
+- Padrão: modelo barato para padronização de títulos e questões pequenas; modelo forte para criar
+  o codebook das questões grandes
+- Fallback local (correct_text / agrupador local) quando o circuit breaker do modelo está aberto
+  (falhas transitórias seguidas da API: sobrecarga, 5xx, conexão) ou quando o job passou do orçamento (job_budget_usd / LLM_JOB_BUDGET_USD)
+- Estado do circuit breaker em SQLite (compartilhado entre o servidor web e os workers)
+- MODEL_ROUTING_CONFIG: outra tabela de rotas (ex.: benchmarks com todas as tarefas locais)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import llm_gate
+import llm_replay
+import token_accounting
+
+ROUTING_STATE_DB = os.getenv('ROUTING_STATE_DB', os.path.join(
+    os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_results')), 'model_routing.db'))
+
+MODEL_ROUTING_CONFIG = os.getenv('MODEL_ROUTING_CONFIG', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'config', 'model_routing.json'))
+
+LOCAL = 'local'
+
+
+def load_routing_config() -> Dict[str, Any]:
+    """Configuração de roteamento ({'routes': [...], 'circuit_breaker': {...}, 'job_budget_usd': float})"""
+    try:
+        if os.path.exists(MODEL_ROUTING_CONFIG):
+            with open(MODEL_ROUTING_CONFIG, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"Erro ao carregar roteamento de modelos: {e}. Usando OPENAI_MODEL em todas as tarefas.")
+    return {}
+
+
+def routing_version(default_model: str) -> str:
+    """Hash da tabela de rotas resolvida (modelo e endpoint de cada rota; sem 'model' = default_model).
+    Entra na versão dos resultados: trocar OPENAI_MODEL ou MODEL_ROUTING_CONFIG invalida os resultados antigos"""
+    resolved = [(route.get('task'), route.get('max_items'), route.get('model') or default_model, route.get('base_url'))
+                for route in load_routing_config().get('routes', [])]
+    payload = json.dumps({'default_model': default_model, 'routes': resolved}, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def is_transient_failure(error: Exception) -> bool:
+    """Falha que conta para o circuit breaker: sobrecarga (429/timeout), erro do servidor (5xx) ou
+    de conexão. Requisição inválida, chave errada, modelo inexistente, contexto longo demais e cota
+    esgotada não abrem o circuito (o fallback local esconderia o erro de configuração)"""
+    if llm_gate.overload_reason(error) is not None:
+        return True
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return int(status) >= 500
+    return type(error).__name__ == 'APIConnectionError' or isinstance(error, ConnectionError)
+
+
+def is_degraded(processing_method: Optional[str]) -> bool:
+    """Questão codificada pelo fallback local por orçamento ou circuit breaker (não por configuração)"""
+    method, _, reason = (processing_method or '').partition(':')
+    return method == 'fallback_local' and reason in ('orcamento', 'circuito_aberto')
+
+
+class Route:
+    """Destino de uma chamada: modelo (ou LOCAL) + endpoint + motivo do fallback"""
+
+    def __init__(self, task: str, model: str, base_url: Optional[str] = None, reason: Optional[str] = None):
+        self.task = task
+        self.model = model
+        self.base_url = base_url
+        self.reason = reason
+
+    @property
+    def is_local(self) -> bool:
+        return self.model == LOCAL
+
+    def label(self) -> str:
+        """Rota registrada em processing_method ('chatgpt:<modelo>' ou 'fallback_local:<motivo>')"""
+        return f"fallback_local:{self.reason}" if self.is_local else f"chatgpt:{self.model}"
+
+
+class ModelRouter:
+    """Escolha do modelo por tarefa/tamanho + circuit breaker por modelo"""
+
+    def __init__(self, db_path: str, config: Optional[Dict[str, Any]] = None, default_model: str = 'gpt-4o'):
+        config = load_routing_config() if config is None else config
+        self.routes: List[Dict[str, Any]] = config.get('routes', [])
+        self.default_model = default_model
+        for route in self.routes:
+            if route.get('price') and route.get('model') and route['model'] != LOCAL:
+                token_accounting.set_model_price(route['model'], route['price'])
+        breaker = config.get('circuit_breaker', {})
+        self.failure_threshold = int(breaker.get('failures', 5))
+        self.reset_seconds = float(breaker.get('reset_seconds', 120))
+        self.job_budget_usd = float(os.getenv('LLM_JOB_BUDGET_USD', config.get('job_budget_usd') or 0))
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conns = threading.local()
+        self._conn().execute('''
+            CREATE TABLE IF NOT EXISTS circuit_breaker (
+                model TEXT PRIMARY KEY,
+                failures INTEGER,
+                opened_at REAL
+            )
+        ''')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._conns, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._conns.conn = conn
+        return conn
+
+    def _configured(self, task: str, items: int) -> Route:
+        for route in self.routes:
+            if route.get('task') != task:
+                continue
+            max_items = route.get('max_items')
+            if max_items is not None and items > int(max_items):
+                continue
+            return Route(task, route.get('model') or self.default_model, route.get('base_url'))
+        return Route(task, self.default_model)
+
+    def route(self, task: str, items: int = 0) -> Route:
+        """Rota da chamada: tarefa ('grouping', 'standardize') e número de itens da entrada"""
+        route = self._configured(task, items)
+        if route.is_local:
+            route.reason = 'configurado'
+        elif self.job_budget_usd > 0 and token_accounting.job_cost_usd() >= self.job_budget_usd:
+            route = Route(task, LOCAL, reason='orcamento')
+        elif not llm_replay.replaying() and self.is_open(route.model):
+            route = Route(task, LOCAL, reason='circuito_aberto')
+        if route.is_local:
+            print(f"[DEBUG] Rota {task} ({items} itens): local ({route.reason})", flush=True)
+        return route
+
+    def is_open(self, model: str) -> bool:
+        """Circuito aberto: falhas seguidas atingiram o limite e o tempo de espera não passou"""
+        row = self._conn().execute('SELECT failures, opened_at FROM circuit_breaker WHERE model = ?', (model,)).fetchone()
+        if row is None or row[0] < self.failure_threshold:
+            return False
+        return time.time() - (row[1] or 0) < self.reset_seconds
+
+    def record_success(self, model: str):
+        self._conn().execute('INSERT OR REPLACE INTO circuit_breaker (model, failures, opened_at) VALUES (?, 0, NULL)',
+                             (model,))
+
+    def record_failure(self, model: str):
+        """Falha transitória da API (após as novas tentativas do llm_gate; ver is_transient_failure).
+        Ao atingir o limite o circuito abre; falha na chamada de teste após o tempo de espera o reabre"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT failures, opened_at FROM circuit_breaker WHERE model = ?', (model,)).fetchone()
+            failures = (row[0] if row else 0) + 1
+            opened_at = row[1] if row else None
+            opened = failures >= self.failure_threshold
+            if opened:
+                opened_at = time.time()
+            conn.execute('INSERT OR REPLACE INTO circuit_breaker (model, failures, opened_at) VALUES (?, ?, ?)',
+                         (model, failures, opened_at))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if opened:
+            print(f"[DEBUG] Circuito aberto para {model} ({failures} falhas seguidas); "
+                  f"fallback local por {self.reset_seconds:.0f}s", flush=True)
+
+
+_router: Optional[ModelRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router(default_model: str = 'gpt-4o') -> ModelRouter:
+    """Roteador global do processo"""
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = ModelRouter(ROUTING_STATE_DB, default_model=default_model)
+    return _router
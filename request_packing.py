@@ -0,0 +1,75 @@
+"""
+Empacotamento de questões pequenas em uma única chamada de agrupamento
+- Questões com poucas respostas únicas para o LLM (ex.: semi-abertas com 3–15 textos) pagam
+  o prompt de sistema e a latência de uma chamada inteira para pouco conteúdo
+- Essas questões são reunidas em pacotes (cada uma com seu bloco do F17) respeitando um
+  orçamento de tokens por chamada; a resposta vem indexada por questão
+- O resultado de cada questão é gravado no cache com a mesma chave da chamada individual:
+  o pipeline da questão roda sem mudanças e reaproveita o agrupamento
+- Questões que não vierem na resposta do pacote seguem pelo caminho individual
+"""
+
+import os
+from typing import Any, Dict, List, Tuple
+
+from batch_submission import DeferredCall
+from token_accounting import estimate_tokens
+
+# Questões com até este número de itens para o LLM entram nos pacotes (0 desativa)
+PACK_MAX_ITEMS = int(os.getenv('PACK_MAX_ITEMS', 15))
+# Orçamento estimado de tokens da mensagem do usuário de um pacote
+PACK_TOKEN_BUDGET = int(os.getenv('PACK_TOKEN_BUDGET', 2500))
+PACK_MAX_QUESTIONS = int(os.getenv('PACK_MAX_QUESTIONS', 8))
+
+# Tokens fixos por questão no pacote (cabeçalho e instruções)
+_QUESTION_OVERHEAD_TOKENS = 20
+
+
+def question_tokens(question: Dict[str, Any]) -> int:
+    """Tokens estimados de uma questão dentro do pacote (F17 + respostas)"""
+    body = "\n".join(str(x) for x in question['f17']) + "\n" + "\n".join(str(x) for x in question['responses'])
+    return estimate_tokens(body) + _QUESTION_OVERHEAD_TOKENS + 2 * len(question['responses'])
+
+
+def is_candidate(question: Dict[str, Any]) -> bool:
+    return 0 < len(question['responses']) <= PACK_MAX_ITEMS
+
+
+def plan_packs(questions: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Distribui as questões candidatas em pacotes (first-fit na ordem das colunas).
+    Pacotes de uma questão só não são retornados: essa questão segue pelo caminho individual"""
+    packs: List[List[Dict[str, Any]]] = []
+    budgets: List[int] = []
+    for question in questions:
+        if not is_candidate(question):
+            continue
+        tokens = question_tokens(question)
+        if tokens > PACK_TOKEN_BUDGET:
+            continue
+        for i, pack in enumerate(packs):
+            if len(pack) < PACK_MAX_QUESTIONS and budgets[i] + tokens <= PACK_TOKEN_BUDGET:
+                pack.append(question)
+                budgets[i] += tokens
+                break
+        else:
+            packs.append([question])
+            budgets.append(tokens)
+    return [pack for pack in packs if len(pack) > 1]
+
+
+def run_pack(coding_system, pack: List[Dict[str, Any]]) -> Dict[str, Tuple[Dict[str, int], Dict[str, List[str]]]]:
+    """Executa um pacote; falhas da chamada ao LLM não interrompem o lote (as questões seguem
+    individualmente). Erros de programação são propagados e aparecem como erro das questões do pacote"""
+    names = [q['name'] for q in pack]
+    print(f"[DEBUG] Pacote de {len(pack)} questões em uma chamada: {names}", flush=True)
+    try:
+        return coding_system.group_many_with_chatgpt(pack)
+    except DeferredCall:
+        # Coleta do modo diferido: o pacote vai no próximo batch
+        return {}
+    except (TypeError, AttributeError, KeyError):
+        # group_many_with_chatgpt já converte as falhas da chamada/resposta em Exception
+        raise
+    except Exception as e:
+        print(f"[DEBUG] Pacote {names} falhou ({e}); questões seguem individualmente", flush=True)
+        return {}
@@ -0,0 +1,149 @@
+"""
+Dimensionamento adaptativo dos blocos (shards) de respostas enviados ao agrupamento
+- O modelo deixa respostas de fora de 'respostas' quando a lista é longa demais; em vez de
+  descobrir isso depois (retry), a lista é dividida antes em blocos que cabem no orçamento
+- Estimativa de tokens de prompt (prefixo + F17 + respostas) e de saída (cada resposta volta
+  ecoada no JSON, mais títulos/códigos dos grupos) para a lista candidata
+- O orçamento de saída efetivo é aprendido por modelo a partir das taxas de perda observadas:
+  perdas acima da tolerância reduzem o orçamento para o que o modelo de fato devolveu; blocos
+  cheios sem perda o devolvem aos poucos ao teto configurado
+- Estatísticas por modelo em SQLite (compartilhadas entre o servidor web e os workers)
+"""
+
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from token_accounting import estimate_tokens
+
+# Teto de tokens de saída estimados por chamada de agrupamento
+SHARD_OUTPUT_TOKEN_BUDGET = int(os.getenv('SHARD_OUTPUT_TOKEN_BUDGET', 6000))
+# Piso do orçamento aprendido (evita blocos minúsculos após uma resposta ruim)
+SHARD_MIN_OUTPUT_TOKENS = int(os.getenv('SHARD_MIN_OUTPUT_TOKENS', 800))
+# Teto de tokens de prompt por chamada (janela de contexto com folga)
+SHARD_PROMPT_TOKEN_BUDGET = int(os.getenv('SHARD_PROMPT_TOKEN_BUDGET', 60000))
+# Taxa de perda tolerada antes de reduzir o orçamento
+SHARD_DROP_TOLERANCE = float(os.getenv('SHARD_DROP_TOLERANCE', 0.01))
+SHARD_STATS_DB = os.getenv('SHARD_STATS_DB', os.path.join(
+    os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_results')), 'shard_stats.db'))
+
+# Tokens de saída por resposta além do texto (aspas, vírgula) e por grupo (código, título, chaves)
+_ITEM_OUTPUT_OVERHEAD = 3
+_GROUP_OUTPUT_TOKENS = 18
+# Fração esperada de grupos por resposta única (títulos na saída)
+_GROUPS_PER_ITEM = 0.3
+# Tokens de prompt por resposta além do texto (numeração, quebra de linha)
+_ITEM_PROMPT_OVERHEAD = 3
+# Margem de segurança aplicada ao reduzir o orçamento após perdas
+_SHRINK_MARGIN = 0.9
+# Crescimento do orçamento após blocos cheios sem perda
+_GROWTH_FACTOR = 1.1
+# Peso da observação mais recente na média móvel da taxa de perda
+_DROP_EWMA_WEIGHT = 0.2
+
+
+def output_tokens(items: List[str]) -> int:
+    """Tokens de saída estimados para agrupar 'items' (JSON de grupos com as respostas ecoadas)"""
+    echoed = sum(estimate_tokens(str(item)) + _ITEM_OUTPUT_OVERHEAD for item in items)
+    return echoed + math.ceil(len(items) * _GROUPS_PER_ITEM) * _GROUP_OUTPUT_TOKENS + 20
+
+
+def prompt_tokens(items: List[str], f17: Optional[List[str]] = None, prefix_tokens: int = 0) -> int:
+    """Tokens de prompt estimados: prefixo fixo + bloco do F17 + respostas numeradas"""
+    f17_tokens = estimate_tokens("\n".join(str(x) for x in f17)) if f17 else 0
+    return prefix_tokens + f17_tokens + sum(estimate_tokens(str(item)) + _ITEM_PROMPT_OVERHEAD for item in items)
+
+
+class ShardSizer:
+    """Orçamento de saída aprendido por modelo + divisão das listas em blocos"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._conns = threading.local()
+        self._conn().execute('''
+            CREATE TABLE IF NOT EXISTS shard_stats (
+                model TEXT PRIMARY KEY,
+                output_budget REAL,
+                drop_rate REAL,
+                samples INTEGER,
+                updated_at REAL
+            )
+        ''')
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._conns, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._conns.conn = conn
+        return conn
+
+    def stats(self, model: str) -> Dict[str, float]:
+        row = self._conn().execute('SELECT output_budget, drop_rate, samples FROM shard_stats WHERE model = ?',
+                                   (model,)).fetchone()
+        if row is None:
+            return {'output_budget': SHARD_OUTPUT_TOKEN_BUDGET, 'drop_rate': 0.0, 'samples': 0}
+        return {'output_budget': min(row[0], SHARD_OUTPUT_TOKEN_BUDGET), 'drop_rate': row[1], 'samples': row[2]}
+
+    def plan(self, items: List[str], model: str, f17: Optional[List[str]] = None, prefix_tokens: int = 0) -> List[List[str]]:
+        """Divide 'items' (na ordem) em blocos de tamanho parecido que cabem nos orçamentos de saída
+        (aprendido) e de prompt. Lista que cabe inteira volta como um único bloco"""
+        if not items:
+            return []
+        budget = max(SHARD_MIN_OUTPUT_TOKENS, self.stats(model)['output_budget'])
+        prompt_room = max(1, SHARD_PROMPT_TOKEN_BUDGET - prompt_tokens([], f17, prefix_tokens))
+        by_output = output_tokens(items) / budget
+        by_prompt = prompt_tokens(items) / prompt_room
+        shard_count = min(len(items), max(1, math.ceil(max(by_output, by_prompt))))
+        if shard_count == 1:
+            return [list(items)]
+        size = math.ceil(len(items) / shard_count)
+        shards = [list(items[i:i + size]) for i in range(0, len(items), size)]
+        print(f"[DEBUG] {len(items)} respostas divididas em {len(shards)} blocos de até {size} "
+              f"(orçamento de saída {budget:.0f} tokens, {model})", flush=True)
+        return shards
+
+    def observe(self, model: str, sent: int, missing: int, estimated_output_tokens: int):
+        """Registra o resultado de uma chamada: 'missing' respostas de 'sent' não voltaram agrupadas"""
+        if sent <= 0:
+            return
+        rate = missing / sent
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = self.stats(model)
+            budget = current['output_budget']
+            if rate > SHARD_DROP_TOLERANCE:
+                # O modelo devolveu só parte do que foi pedido: o orçamento passa a ser isso, com margem
+                budget = max(SHARD_MIN_OUTPUT_TOKENS, min(budget, estimated_output_tokens * (1 - rate)) * _SHRINK_MARGIN)
+            elif estimated_output_tokens >= 0.8 * budget:
+                budget = min(SHARD_OUTPUT_TOKEN_BUDGET, budget * _GROWTH_FACTOR)
+            drop_rate = rate if current['samples'] == 0 else (
+                (1 - _DROP_EWMA_WEIGHT) * current['drop_rate'] + _DROP_EWMA_WEIGHT * rate)
+            conn.execute('INSERT OR REPLACE INTO shard_stats (model, output_budget, drop_rate, samples, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (model, budget, drop_rate, current['samples'] + 1, time.time()))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if rate > SHARD_DROP_TOLERANCE:
+            print(f"[DEBUG] {missing}/{sent} respostas perdidas ({model}); orçamento de saída -> {budget:.0f} tokens", flush=True)
+
+
+_sizer: Optional[ShardSizer] = None
+_sizer_lock = threading.Lock()
+
+
+def get_sizer() -> ShardSizer:
+    """Sizer global do processo"""
+    global _sizer
+    with _sizer_lock:
+        if _sizer is None:
+            _sizer = ShardSizer(SHARD_STATS_DB)
+    return _sizer
@@ -0,0 +1,214 @@
+"""
+Índice ortográfico por deleção simétrica (estilo SymSpell)
+- Pré-computa as deleções de cada palavra do vocabulário
+- Corrige erros de distância de edição 1/2 com poucas consultas a dicionário por token
+- Vocabulário: léxico pt-BR de domínio + termos do codebook (F17) + configuração
+  (opcionalmente uma lista de frequência real via SPELL_FREQUENCY_FILE)
+- O F17 de cada questão entra como camada (overlay) na consulta, sem alterar o índice compartilhado
+- Só corrige palavras fora do vocabulário; plurais de palavras conhecidas são mantidos
+- Sugestões de distância 2 exigem palavra longa, mesma inicial e frequência mínima
+"""
+
+import os
+import re
+import threading
+import unicodedata
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import Levenshtein
+
+# Lista de frequência real no formato 'palavra contagem' (ex.: corpus pt-BR de 50k palavras)
+SPELL_FREQUENCY_FILE = os.getenv('SPELL_FREQUENCY_FILE', '')
+# Contagem mínima do candidato para aceitar uma correção de distância 2
+SPELL_MIN_COUNT = int(os.getenv('SPELL_MIN_COUNT', 100))
+# Tamanho mínimo da palavra para tentar correções de distância 2
+SPELL_MIN_LENGTH_DISTANCE_2 = int(os.getenv('SPELL_MIN_LENGTH_DISTANCE_2', 8))
+
+# Terminações de plural -> singular (ex.: 'lixos' -> 'lixo', 'animais' -> 'animal')
+PLURAL_SUFFIXES = (('ões', 'ão'), ('ães', 'ão'), ('ais', 'al'), ('eis', 'el'), ('ns', 'm'), ('es', ''), ('s', ''))
+
+
+def strip_accents(word: str) -> str:
+    """Remove acentos de uma palavra (chave de busca do índice)."""
+    word = unicodedata.normalize('NFKD', word)
+    return ''.join(c for c in word if not unicodedata.combining(c))
+
+
+class SymSpellIndex:
+    """Índice de correção ortográfica baseado em deleções simétricas"""
+
+    # Frequência atribuída a termos vindos do codebook: têm prioridade sobre a lista geral
+    CODEBOOK_FREQUENCY = 1_000_000
+    # Palavras do léxico sem contagem: conhecidas, mas só alvo de correções de distância 1
+    LEXICON_FREQUENCY = 0
+
+    def __init__(self, max_edit_distance: int = 2, min_word_length: int = 5):
+        self.max_edit_distance = max_edit_distance
+        self.min_word_length = min_word_length
+        # palavra (com acento) -> frequência
+        self.words: Dict[str, int] = {}
+        # chave sem acento -> melhor forma acentuada
+        self.canonical: Dict[str, str] = {}
+        # deleção -> chaves sem acento que a geram
+        self.deletes: Dict[str, Set[str]] = {}
+        self._lookup_cache: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # enviado aos workers do pool local (local_stages): mesmo vocabulário, sem lock nem cache
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_lookup_cache'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load_default(cls, extra_words: Iterable[str] = ()) -> 'SymSpellIndex':
+        """Cria o índice a partir do léxico em config/ptbr_lexicon.txt (e de SPELL_FREQUENCY_FILE, se definido)"""
+        index = cls()
+        try:
+            base_dir = os.path.dirname(os.path.abspath(__file__))
+            lexicon_path = os.path.join(base_dir, 'config', 'ptbr_lexicon.txt')
+            if os.path.exists(lexicon_path):
+                index.load_frequency_file(lexicon_path)
+            if SPELL_FREQUENCY_FILE:
+                index.load_frequency_file(SPELL_FREQUENCY_FILE)
+        except Exception as e:
+            print(f"Erro ao carregar lista de frequência de palavras: {e}. Usando apenas vocabulário de configuração.")
+        index.add_texts(extra_words, frequency=cls.CODEBOOK_FREQUENCY)
+        return index
+
+    def load_frequency_file(self, path: str):
+        """Carrega arquivo no formato 'palavra [frequência]' (uma por linha; sem frequência = léxico)"""
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split()
+                try:
+                    count = int(parts[1]) if len(parts) > 1 else self.LEXICON_FREQUENCY
+                except ValueError:
+                    count = self.LEXICON_FREQUENCY
+                self.add_word(parts[0], count)
+
+    def add_texts(self, texts: Iterable[str], frequency: int = CODEBOOK_FREQUENCY):
+        """Adiciona todas as palavras de uma lista de textos (ex.: descrições do F17)"""
+        for text in texts:
+            if text is None:
+                continue
+            for word in re.findall(r'\w+', str(text).lower()):
+                if not word.isdigit():
+                    self.add_word(word, frequency)
+
+    def add_word(self, word: str, count: int = LEXICON_FREQUENCY):
+        """Adiciona (ou reforça) uma palavra no vocabulário e registra suas deleções"""
+        word = word.strip().lower()
+        if not word:
+            return
+        with self._lock:
+            previous = self.words.get(word)
+            if previous is not None and previous >= count:
+                # palavra já conhecida: correções já calculadas continuam válidas
+                return
+            self.words[word] = count
+            key = strip_accents(word)
+            best = self.canonical.get(key)
+            if best is None or self.words[word] > self.words.get(best, 0):
+                self.canonical[key] = word
+            if best is None:
+                for deleted in self._edits(key, self.max_edit_distance):
+                    self.deletes.setdefault(deleted, set()).add(key)
+            # novo vocabulário pode mudar correções já calculadas
+            self._lookup_cache.clear()
+
+    def overlay(self, texts: Iterable[str], frequency: int = CODEBOOK_FREQUENCY) -> 'SymSpellIndex':
+        """Camada de vocabulário extra (ex.: F17 de uma questão) para lookup(word, overlay=...).
+        O índice compartilhado não é alterado"""
+        layer = SymSpellIndex(self.max_edit_distance, self.min_word_length)
+        layer.add_texts(texts, frequency=frequency)
+        return layer
+
+    def _edits(self, word: str, distance: int) -> Set[str]:
+        """Gera todas as deleções de até 'distance' caracteres (inclui a própria palavra)"""
+        results = {word}
+        frontier = {word}
+        for _ in range(distance):
+            next_frontier = set()
+            for w in frontier:
+                if len(w) <= 1:
+                    continue
+                for i in range(len(w)):
+                    next_frontier.add(w[:i] + w[i + 1:])
+            results |= next_frontier
+            frontier = next_frontier
+        return results
+
+    def _allowed_distance(self, word: str) -> int:
+        # palavras curtas toleram apenas um erro para evitar trocas indevidas
+        return 1 if len(word) < SPELL_MIN_LENGTH_DISTANCE_2 else self.max_edit_distance
+
+    def _is_inflection(self, key: str) -> bool:
+        """Plural de uma palavra conhecida (ex.: 'lixos', 'pessoas') não é erro de digitação"""
+        for suffix, replacement in PLURAL_SUFFIXES:
+            if key.endswith(suffix) and len(key) - len(suffix) >= 3:
+                if key[:-len(suffix)] + replacement in self.canonical:
+                    return True
+        return False
+
+    def lookup(self, word: str, overlay: Optional['SymSpellIndex'] = None) -> Optional[str]:
+        """Retorna a forma corrigida da palavra, ou None se não houver correção segura.
+        Com overlay, o vocabulário da camada tem prioridade sobre o do índice (cache próprio da camada)"""
+        word = word.lower()
+        cache = self._lookup_cache if overlay is None else overlay._lookup_cache
+        if word in cache:
+            return cache[word]
+
+        layers = [self] if overlay is None else [overlay, self]
+        result = None
+        if any(word in layer.words for layer in layers):
+            result = word
+        elif len(word) >= self.min_word_length and not any(c.isdigit() for c in word):
+            key = strip_accents(word)
+            known = next((layer.canonical[key] for layer in layers if key in layer.canonical), None)
+            if known is not None:
+                # só faltou acento (ex.: 'educacao' -> 'educação')
+                result = known
+            elif not any(layer._is_inflection(key) for layer in layers):
+                result = self._best_candidate(key, layers)
+
+        cache[word] = result
+        return result
+
+    def _best_candidate(self, key: str, layers: List['SymSpellIndex']) -> Optional[str]:
+        max_distance = self._allowed_distance(key)
+        deletions = self._edits(key, max_distance)
+
+        best: Optional[Tuple[int, int, str]] = None
+        seen: Set[str] = set()
+        for layer in layers:
+            candidates: Set[str] = set()
+            for deleted in deletions:
+                candidates |= layer.deletes.get(deleted, set())
+            for candidate in candidates - seen:
+                # a primeira camada (overlay) decide a forma de uma chave presente nas duas
+                seen.add(candidate)
+                distance = Levenshtein.distance(key, candidate)
+                if distance > max_distance:
+                    continue
+                form = layer.canonical[candidate]
+                count = layer.words.get(form, 0)
+                if distance == 2 and (candidate[0] != key[0] or count < SPELL_MIN_COUNT):
+                    # distância 2 só para candidatos frequentes com a mesma inicial (evita 'pessoas' -> 'essas')
+                    continue
+                rank = (distance, -count, form)
+                if best is None or rank < best:
+                    best = rank
+        return best[2] if best else None
+
+    def correct_words(self, words: List[str], overlay: Optional['SymSpellIndex'] = None) -> List[str]:
+        """Corrige uma lista de palavras, mantendo as que não têm correção"""
+        return [self.lookup(w, overlay) or w for w in words]
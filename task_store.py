@@ -0,0 +1,645 @@
+"""
+Armazenamento das tarefas de processamento em lote
+- Interface TaskStore (classe abstrata): estado, progresso, resultado por questão e artefatos de cada tarefa
+- SQLiteTaskStore (padrão): arquivo SQLite em modo WAL, compartilhado entre processos
+  (vários workers do gunicorn) e preservado entre reinícios
+- InMemoryTaskStore: dicionário em memória (um único processo, sem persistência)
+- Cada atualização é gravada junto com o seu evento em uma única transação (BEGIN IMMEDIATE)
+- Também serve de fila de jobs (ver job_queue.py): tarefas PENDING com job_kind são
+  reivindicadas atomicamente pelos workers; admissão limitada e cancelamento por tarefa
+- Cada alteração gera um evento numerado ('state', 'progress' ou 'question'), lido pelo
+  stream SSE (/task_events) e pelo /task_status?since=N (só o que mudou)
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+# Tarefas em processamento sem atualização há mais que isso são consideradas interrompidas
+TASK_STALE_SECONDS = int(os.getenv('TASK_STALE_SECONDS', 300))
+
+# Campos com coluna própria na tabela de tarefas; os demais vão para 'extra' (JSON)
+TASK_COLUMNS = ('state', 'status', 'progress', 'error', 'result_file', 'output_mode', 'created_at',
+                'job_kind', 'job_args', 'worker_id', 'cancel_requested')
+
+# Estados em que a tarefa ocupa a fila
+ACTIVE_STATES = ('PENDING', 'PROCESSING')
+
+# Estados finais a partir dos quais um job pode ser retomado (ver job_queue.resume)
+RESUMABLE_STATES = ('ERROR', 'CANCELLED')
+
+# Campos zerados quando a tarefa volta à fila
+_REQUEUE_RESET = {'progress': 0, 'error': None, 'result_file': None, 'worker_id': None, 'cancel_requested': 0}
+
+# Campos internos: não vão para os eventos nem para as respostas da API
+PRIVATE_FIELDS = ('work_dir', 'job_args', 'worker_id')
+
+# Estados finais (o stream de eventos da tarefa termina)
+FINAL_STATES = ('COMPLETED', 'ERROR', 'CANCELLED')
+
+# Eventos mais antigos que isso são removidos (purge_events)
+TASK_EVENTS_TTL_SECONDS = int(os.getenv('TASK_EVENTS_TTL_SECONDS', 86400))
+
+
+def _event_for(fields: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """(tipo, dados) do evento de uma atualização de campos; None se não houver o que publicar"""
+    data = {k: v for k, v in fields.items() if k not in PRIVATE_FIELDS and k != 'updated_at'}
+    if not data:
+        return None
+    return ('state' if 'state' in data else 'progress'), data
+
+
+def _question_event(index: int, question: str, summary: Optional[str], files: Optional[List[str]]) -> Dict[str, Any]:
+    data = {'index': index, 'question': question}
+    if summary is not None:
+        data['summary'] = summary
+    if files is not None:
+        data['files'] = list(files)
+    return data
+
+
+def merge_events(events: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Junta uma sequência de eventos em um único conjunto de mudanças: campos alterados e
+    questões alteradas ('questions'). 'questions_reset' indica que as anteriores foram descartadas"""
+    changes: Dict[str, Any] = {}
+    questions: Dict[int, Dict[str, Any]] = {}
+    for event in events:
+        data = dict(event['data'])
+        if event['kind'] == 'question':
+            questions.setdefault(data['index'], {}).update(data)
+            continue
+        if data.pop('questions_reset', False):
+            questions = {}
+            changes['questions_reset'] = True
+        changes.update(data)
+    if questions:
+        changes['questions'] = [questions[idx] for idx in sorted(questions)]
+    return changes
+
+
+class TaskStore(ABC):
+    """Interface do armazenamento de tarefas"""
+
+    @abstractmethod
+    def create(self, task_id: str, **fields):
+        """Cria a tarefa com os campos informados"""
+
+    @abstractmethod
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """Tarefa no formato usado pelo /task_status (None se não existir)"""
+
+    @abstractmethod
+    def update(self, task_id: str, **fields):
+        """Atualiza apenas os campos informados"""
+
+    @abstractmethod
+    def set_question_result(self, task_id: str, index: int, question: str, summary: Optional[str] = None,
+                            files: Optional[List[str]] = None):
+        """Registra o resumo e/ou os arquivos de uma questão (campos None mantêm o valor atual)"""
+
+    def heartbeat(self, task_id: str):
+        """Sinaliza que a tarefa continua viva (ver recover_interrupted)"""
+        self.update(task_id)
+
+    @abstractmethod
+    def recover_interrupted(self, stale_seconds: int = TASK_STALE_SECONDS) -> List[str]:
+        """Marca como erro tarefas em andamento sem atualização recente. Retorna os ids"""
+
+    @abstractmethod
+    def try_enqueue(self, task_id: str, max_active: int, **fields) -> bool:
+        """Cria a tarefa PENDING somente se houver menos de max_active tarefas ativas (atômico)"""
+
+    @abstractmethod
+    def try_requeue(self, task_id: str, max_active: int, **fields) -> bool:
+        """Devolve à fila um job encerrado (RESUMABLE_STATES), respeitando o limite de admissão.
+        Os resultados por questão da execução anterior são descartados. Retorna False se a
+        tarefa não está em estado retomável ou a fila está cheia"""
+
+    @abstractmethod
+    def claim_next(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        """Reivindica o job pendente mais antigo (passa a PROCESSING). Retorna a tarefa ou None"""
+
+    @abstractmethod
+    def request_cancel(self, task_id: str) -> Optional[str]:
+        """Cancela a tarefa: pendente é cancelada na hora; em andamento recebe o pedido.
+        Retorna o estado resultante (None se a tarefa não existir)"""
+
+    def is_cancel_requested(self, task_id: str) -> bool:
+        task = self.get(task_id)
+        return bool(task and task.get('cancel_requested'))
+
+    @abstractmethod
+    def fail_worker_jobs(self, worker_id: str, error: str):
+        """Marca como erro os jobs em andamento de um worker que morreu"""
+
+    @abstractmethod
+    def events_since(self, task_id: str, after_seq: int = 0, limit: int = 500) -> List[Dict[str, Any]]:
+        """Eventos da tarefa com número maior que after_seq ({'seq', 'kind', 'data'}), em ordem"""
+
+    @abstractmethod
+    def last_event_seq(self, task_id: str) -> int:
+        """Número do último evento da tarefa (0 se não houver)"""
+
+    def changes_since(self, task_id: str, after_seq: int) -> Dict[str, Any]:
+        """Mudanças da tarefa após o evento after_seq (ver merge_events), com o novo 'seq'"""
+        events = self.events_since(task_id, after_seq, limit=-1)
+        changes = merge_events(events)
+        changes['seq'] = events[-1]['seq'] if events else after_seq
+        return changes
+
+    @abstractmethod
+    def purge_events(self, max_age_seconds: int = TASK_EVENTS_TTL_SECONDS) -> int:
+        """Remove eventos antigos. Retorna quantos foram removidos"""
+
+    @abstractmethod
+    def count_by_state(self) -> Dict[str, int]:
+        """Número de tarefas por estado (profundidade da fila = PENDING)"""
+
+
+def _build_task(row: Dict[str, Any], questions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Monta o dicionário da tarefa (mesmo formato do antigo dict em memória)"""
+    task = {key: value for key, value in row.items() if value is not None}
+    if isinstance(task.get('job_args'), str):
+        task['job_args'] = json.loads(task['job_args'])
+    questions = sorted(questions, key=lambda q: q['index'])
+    task['artifacts'] = [
+        {'index': q['index'], 'question': q['question'], 'files': q['files']}
+        for q in questions if q.get('files')
+    ]
+    summaries = [q['summary'] for q in questions if q.get('summary') is not None]
+    if summaries:
+        task['results_summary'] = summaries
+    return task
+
+
+class InMemoryTaskStore(TaskStore):
+    """Tarefas em um dicionário do processo (apenas para execução com um único worker)"""
+
+    def __init__(self):
+        self._tasks: Dict[str, Dict[str, Any]] = {}
+        self._questions: Dict[str, Dict[int, Dict[str, Any]]] = {}
+        self._events: List[Dict[str, Any]] = []
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def _record(self, task_id: str, kind: str, data: Dict[str, Any]):
+        # Chamado com self._lock adquirido
+        self._seq += 1
+        self._events.append({'seq': self._seq, 'task_id': task_id, 'kind': kind, 'data': data,
+                             'created_at': time.time()})
+        if self._seq % 1000 == 0:
+            cutoff = time.time() - TASK_EVENTS_TTL_SECONDS
+            self._events = [e for e in self._events if e['created_at'] >= cutoff]
+
+    def _record_fields(self, task_id: str, fields: Dict[str, Any]):
+        event = _event_for(fields)
+        if event is not None:
+            self._record(task_id, *event)
+
+    def create(self, task_id: str, **fields):
+        with self._lock:
+            fields.setdefault('created_at', time.time())
+            fields['updated_at'] = time.time()
+            self._tasks[task_id] = dict(fields)
+            self._questions[task_id] = {}
+            self._record_fields(task_id, fields)
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if task_id not in self._tasks:
+                return None
+            row = dict(self._tasks[task_id])
+            row.pop('updated_at', None)
+            questions = [dict(q) for q in self._questions[task_id].values()]
+        return _build_task(row, questions)
+
+    def update(self, task_id: str, **fields):
+        with self._lock:
+            if task_id in self._tasks:
+                self._tasks[task_id].update(fields)
+                self._tasks[task_id]['updated_at'] = time.time()
+                self._record_fields(task_id, fields)
+
+    def set_question_result(self, task_id: str, index: int, question: str, summary: Optional[str] = None,
+                            files: Optional[List[str]] = None):
+        with self._lock:
+            if task_id in self._questions:
+                entry = self._questions[task_id].setdefault(
+                    index, {'index': index, 'question': question, 'summary': None, 'files': []}
+                )
+                if summary is not None:
+                    entry['summary'] = summary
+                if files is not None:
+                    entry['files'] = list(files)
+                self._tasks[task_id]['updated_at'] = time.time()
+                self._record(task_id, 'question', _question_event(index, question, summary, files))
+
+    def recover_interrupted(self, stale_seconds: int = TASK_STALE_SECONDS) -> List[str]:
+        # Em memória nada sobrevive a um reinício
+        return []
+
+    def try_enqueue(self, task_id: str, max_active: int, **fields) -> bool:
+        with self._lock:
+            active = sum(1 for t in self._tasks.values() if t.get('state') in ACTIVE_STATES)
+            if max_active > 0 and active >= max_active:
+                return False
+            fields.setdefault('created_at', time.time())
+            fields.update(state='PENDING', updated_at=time.time())
+            self._tasks[task_id] = dict(fields)
+            self._questions[task_id] = {}
+            self._record_fields(task_id, fields)
+            return True
+
+    def try_requeue(self, task_id: str, max_active: int, **fields) -> bool:
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None or task.get('state') not in RESUMABLE_STATES or not task.get('job_kind'):
+                return False
+            active = sum(1 for t in self._tasks.values() if t.get('state') in ACTIVE_STATES)
+            if max_active > 0 and active >= max_active:
+                return False
+            changes = dict(_REQUEUE_RESET, **fields, state='PENDING')
+            task.update(changes, updated_at=time.time())
+            self._questions[task_id] = {}
+            self._record_fields(task_id, dict(changes, questions_reset=True))
+            return True
+
+    def claim_next(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            pending = [(t['created_at'], task_id) for task_id, t in self._tasks.items()
+                       if t.get('state') == 'PENDING' and t.get('job_kind')]
+            if not pending:
+                return None
+            task_id = min(pending)[1]
+            self._tasks[task_id].update(state='PROCESSING', worker_id=worker_id, updated_at=time.time())
+            self._record_fields(task_id, {'state': 'PROCESSING'})
+        task = self.get(task_id)
+        task['task_id'] = task_id
+        return task
+
+    def request_cancel(self, task_id: str) -> Optional[str]:
+        with self._lock:
+            task = self._tasks.get(task_id)
+            if task is None:
+                return None
+            if task.get('state') == 'PENDING':
+                changes = {'state': 'CANCELLED', 'status': 'Cancelada'}
+            elif task.get('state') == 'PROCESSING':
+                changes = {'cancel_requested': 1}
+            else:
+                changes = {}
+            task.update(changes, updated_at=time.time())
+            self._record_fields(task_id, changes)
+            return task['state']
+
+    def fail_worker_jobs(self, worker_id: str, error: str):
+        with self._lock:
+            for task_id, task in self._tasks.items():
+                if task.get('worker_id') == worker_id and task.get('state') == 'PROCESSING':
+                    task.update(state='ERROR', error=error, updated_at=time.time())
+                    self._record_fields(task_id, {'state': 'ERROR', 'error': error})
+
+    def events_since(self, task_id: str, after_seq: int = 0, limit: int = 500) -> List[Dict[str, Any]]:
+        with self._lock:
+            events = [{'seq': e['seq'], 'kind': e['kind'], 'data': dict(e['data'])}
+                      for e in self._events if e['task_id'] == task_id and e['seq'] > after_seq]
+        return events if limit < 0 else events[:limit]
+
+    def last_event_seq(self, task_id: str) -> int:
+        with self._lock:
+            return max((e['seq'] for e in self._events if e['task_id'] == task_id), default=0)
+
+    def purge_events(self, max_age_seconds: int = TASK_EVENTS_TTL_SECONDS) -> int:
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            before = len(self._events)
+            self._events = [e for e in self._events if e['created_at'] >= cutoff]
+            return before - len(self._events)
+
+    def count_by_state(self) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for task in self._tasks.values():
+                state = task.get('state') or 'UNKNOWN'
+                counts[state] = counts.get(state, 0) + 1
+            return counts
+
+
+class SQLiteTaskStore(TaskStore):
+    """Tarefas em SQLite (WAL): leitores não bloqueiam o escritor e vice-versa"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        # Uma conexão por thread (sqlite3 não compartilha conexões entre threads)
+        self._local = threading.local()
+        self._init_db()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: autocommit; escritas com evento usam _transaction()
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('PRAGMA busy_timeout=30000')
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        conn = self._conn()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS tasks (
+                task_id TEXT PRIMARY KEY,
+                state TEXT,
+                status TEXT,
+                progress REAL,
+                error TEXT,
+                result_file TEXT,
+                output_mode TEXT,
+                created_at REAL,
+                updated_at REAL,
+                extra TEXT NOT NULL DEFAULT '{}',
+                job_kind TEXT,
+                job_args TEXT,
+                worker_id TEXT,
+                cancel_requested INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        # Bancos criados antes da fila de jobs: acrescenta as colunas que faltam
+        existing = {row['name'] for row in conn.execute('PRAGMA table_info(tasks)')}
+        for name, ddl in (('job_kind', 'TEXT'), ('job_args', 'TEXT'), ('worker_id', 'TEXT'),
+                          ('cancel_requested', 'INTEGER NOT NULL DEFAULT 0')):
+            if name not in existing:
+                conn.execute(f'ALTER TABLE tasks ADD COLUMN {name} {ddl}')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS task_questions (
+                task_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                question TEXT,
+                summary TEXT,
+                files TEXT,
+                updated_at REAL,
+                PRIMARY KEY (task_id, idx)
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS task_events (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                data TEXT NOT NULL,
+                created_at REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks (state, updated_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_tasks_queue ON tasks (state, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_task_events ON task_events (task_id, seq)')
+
+    @contextmanager
+    def _transaction(self):
+        """Transação de escrita: a alteração e o seu evento ficam visíveis juntos (ou nenhum dos dois)"""
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _extra_assignment(extra: Dict[str, Any]) -> Tuple[str, List[Any]]:
+        """Substitui as chaves informadas no JSON 'extra' (sem mesclar o conteúdo aninhado, como o
+        InMemoryTaskStore; None grava null)"""
+        values: List[Any] = []
+        for key, value in extra.items():
+            values += [f'$."{key}"', json.dumps(value, default=str)]
+        return f"extra = json_set(extra, {', '.join('?, json(?)' for _ in extra)})", values
+
+    @staticmethod
+    def _record(conn: sqlite3.Connection, task_id: str, kind: str, data: Dict[str, Any]):
+        conn.execute(
+            'INSERT INTO task_events (task_id, kind, data, created_at) VALUES (?, ?, ?, ?)',
+            (task_id, kind, json.dumps(data, default=str), time.time())
+        )
+
+    def _record_fields(self, conn: sqlite3.Connection, task_id: str, fields: Dict[str, Any]):
+        event = _event_for(fields)
+        if event is not None:
+            self._record(conn, task_id, *event)
+
+    @staticmethod
+    def _split(fields: Dict[str, Any]):
+        if 'job_args' in fields and not isinstance(fields['job_args'], str):
+            fields = dict(fields, job_args=json.dumps(fields['job_args']))
+        columns = {k: v for k, v in fields.items() if k in TASK_COLUMNS}
+        extra = {k: v for k, v in fields.items() if k not in TASK_COLUMNS}
+        return columns, extra
+
+    def create(self, task_id: str, **fields):
+        fields.setdefault('created_at', time.time())
+        columns, extra = self._split(fields)
+        names = ['task_id', 'updated_at', 'extra'] + list(columns)
+        values = [task_id, time.time(), json.dumps(extra)] + list(columns.values())
+        placeholders = ', '.join('?' for _ in names)
+        with self._transaction() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO tasks ({', '.join(names)}) VALUES ({placeholders})", values)
+            self._record_fields(conn, task_id, fields)
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._conn()
+        row = conn.execute('SELECT * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        if row is None:
+            return None
+        data = dict(row)
+        extra = json.loads(data.pop('extra') or '{}')
+        data.pop('task_id')
+        data.pop('updated_at')
+        data.update(extra)
+        questions = [
+            {'index': q['idx'], 'question': q['question'], 'summary': q['summary'],
+             'files': json.loads(q['files']) if q['files'] else []}
+            for q in conn.execute(
+                'SELECT idx, question, summary, files FROM task_questions WHERE task_id = ?', (task_id,)
+            )
+        ]
+        return _build_task(data, questions)
+
+    def update(self, task_id: str, **fields):
+        columns, extra = self._split(fields)
+        assignments = [f"{name} = ?" for name in columns] + ['updated_at = ?']
+        values = list(columns.values()) + [time.time()]
+        if extra:
+            assignment, extra_values = self._extra_assignment(extra)
+            assignments.append(assignment)
+            values += extra_values
+        values.append(task_id)
+        with self._transaction() as conn:
+            cursor = conn.execute(f"UPDATE tasks SET {', '.join(assignments)} WHERE task_id = ?", values)
+            if cursor.rowcount:
+                self._record_fields(conn, task_id, fields)
+
+    def set_question_result(self, task_id: str, index: int, question: str, summary: Optional[str] = None,
+                            files: Optional[List[str]] = None):
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute('''
+                INSERT INTO task_questions (task_id, idx, question, summary, files, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (task_id, idx) DO UPDATE SET
+                    summary = COALESCE(excluded.summary, summary),
+                    files = COALESCE(excluded.files, files),
+                    updated_at = excluded.updated_at
+            ''', (task_id, index, question, summary, json.dumps(files) if files is not None else None, now))
+            conn.execute('UPDATE tasks SET updated_at = ? WHERE task_id = ?', (now, task_id))
+            self._record(conn, task_id, 'question', _question_event(index, question, summary, files))
+
+    def recover_interrupted(self, stale_seconds: int = TASK_STALE_SECONDS) -> List[str]:
+        conn = self._conn()
+        cutoff = time.time() - stale_seconds
+        # Jobs PENDING continuam na fila; só os que estavam em processamento são afetados
+        rows = conn.execute(
+            "SELECT task_id FROM tasks WHERE state = 'PROCESSING' AND updated_at < ?", (cutoff,)
+        ).fetchall()
+        task_ids = [row['task_id'] for row in rows]
+        error = 'Tarefa interrompida (servidor reiniciado)'
+        for task_id in task_ids:
+            with self._transaction() as conn:
+                cursor = conn.execute(
+                    "UPDATE tasks SET state = 'ERROR', error = ?, updated_at = ? WHERE task_id = ? AND state = 'PROCESSING'",
+                    (error, time.time(), task_id)
+                )
+                if cursor.rowcount:
+                    self._record_fields(conn, task_id, {'state': 'ERROR', 'error': error})
+        return task_ids
+
+    def try_enqueue(self, task_id: str, max_active: int, **fields) -> bool:
+        fields.setdefault('created_at', time.time())
+        fields['state'] = 'PENDING'
+        columns, extra = self._split(fields)
+        names = ['task_id', 'updated_at', 'extra'] + list(columns)
+        values = [task_id, time.time(), json.dumps(extra)] + list(columns.values())
+        # INSERT ... SELECT com a contagem no mesmo comando: admissão atômica entre processos
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO tasks ({', '.join(names)}) SELECT {', '.join('?' for _ in names)} "
+                f"WHERE ? <= 0 OR (SELECT COUNT(*) FROM tasks WHERE state IN ('PENDING', 'PROCESSING')) < ?",
+                values + [max_active, max_active]
+            )
+            admitted = cursor.rowcount == 1
+            if admitted:
+                self._record_fields(conn, task_id, fields)
+        return admitted
+
+    def try_requeue(self, task_id: str, max_active: int, **fields) -> bool:
+        changes = dict(_REQUEUE_RESET, **fields, state='PENDING')
+        columns, extra = self._split(changes)
+        assignments = [f"{name} = ?" for name in columns] + ['updated_at = ?']
+        values = list(columns.values()) + [time.time()]
+        if extra:
+            assignment, extra_values = self._extra_assignment(extra)
+            assignments.append(assignment)
+            values += extra_values
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                f"UPDATE tasks SET {', '.join(assignments)} "
+                f"WHERE task_id = ? AND job_kind IS NOT NULL AND state IN ({', '.join('?' for _ in RESUMABLE_STATES)}) "
+                f"AND (? <= 0 OR (SELECT COUNT(*) FROM tasks WHERE state IN ('PENDING', 'PROCESSING')) < ?)",
+                values + [task_id] + list(RESUMABLE_STATES) + [max_active, max_active]
+            )
+            requeued = cursor.rowcount == 1
+            if requeued:
+                conn.execute('DELETE FROM task_questions WHERE task_id = ?', (task_id,))
+                self._record_fields(conn, task_id, dict(changes, questions_reset=True))
+        return requeued
+
+    def claim_next(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT task_id FROM tasks WHERE state = 'PENDING' AND job_kind IS NOT NULL "
+                "ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE tasks SET state = 'PROCESSING', worker_id = ?, updated_at = ? WHERE task_id = ?",
+                    (worker_id, time.time(), row['task_id'])
+                )
+                self._record_fields(conn, row['task_id'], {'state': 'PROCESSING'})
+        if row is None:
+            return None
+        task = self.get(row['task_id'])
+        task['task_id'] = row['task_id']
+        return task
+
+    def request_cancel(self, task_id: str) -> Optional[str]:
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET state = 'CANCELLED', status = 'Cancelada', updated_at = ? "
+                "WHERE task_id = ? AND state = 'PENDING'", (now, task_id)
+            )
+            if cursor.rowcount:
+                self._record_fields(conn, task_id, {'state': 'CANCELLED', 'status': 'Cancelada'})
+            cursor = conn.execute(
+                "UPDATE tasks SET cancel_requested = 1, updated_at = ? WHERE task_id = ? AND state = 'PROCESSING'",
+                (now, task_id)
+            )
+            if cursor.rowcount:
+                self._record_fields(conn, task_id, {'cancel_requested': 1})
+            row = conn.execute('SELECT state FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return row['state'] if row else None
+
+    def fail_worker_jobs(self, worker_id: str, error: str):
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT task_id FROM tasks WHERE worker_id = ? AND state = 'PROCESSING'", (worker_id,)
+        ).fetchall()
+        for row in rows:
+            with self._transaction() as conn:
+                cursor = conn.execute(
+                    "UPDATE tasks SET state = 'ERROR', error = ?, updated_at = ? WHERE task_id = ? AND state = 'PROCESSING'",
+                    (error, time.time(), row['task_id'])
+                )
+                if cursor.rowcount:
+                    self._record_fields(conn, row['task_id'], {'state': 'ERROR', 'error': error})
+
+    def events_since(self, task_id: str, after_seq: int = 0, limit: int = 500) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            'SELECT seq, kind, data FROM task_events WHERE task_id = ? AND seq > ? ORDER BY seq LIMIT ?',
+            (task_id, after_seq, limit)
+        ).fetchall()
+        return [{'seq': row['seq'], 'kind': row['kind'], 'data': json.loads(row['data'])} for row in rows]
+
+    def last_event_seq(self, task_id: str) -> int:
+        row = self._conn().execute('SELECT MAX(seq) AS seq FROM task_events WHERE task_id = ?', (task_id,)).fetchone()
+        return row['seq'] or 0
+
+    def purge_events(self, max_age_seconds: int = TASK_EVENTS_TTL_SECONDS) -> int:
+        cursor = self._conn().execute('DELETE FROM task_events WHERE created_at < ?', (time.time() - max_age_seconds,))
+        return cursor.rowcount
+
+    def count_by_state(self) -> Dict[str, int]:
+        rows = self._conn().execute('SELECT state, COUNT(*) AS total FROM tasks GROUP BY state').fetchall()
+        return {(row['state'] or 'UNKNOWN'): row['total'] for row in rows}
+
+    def is_cancel_requested(self, task_id: str) -> bool:
+        row = self._conn().execute('SELECT cancel_requested FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return bool(row and row['cancel_requested'])
+
+
+def create_task_store(default_path: str) -> TaskStore:
+    """Store configurado por TASK_STORE ('sqlite' ou 'memory') e TASK_DB_PATH"""
+    backend = os.getenv('TASK_STORE', 'sqlite').lower()
+    if backend == 'memory':
+        return InMemoryTaskStore()
+    if backend != 'sqlite':
+        raise Exception(f"TASK_STORE desconhecido: {backend}. Use 'sqlite' ou 'memory'")
+    return SQLiteTaskStore(os.getenv('TASK_DB_PATH', default_path))
@@ -0,0 +1,41 @@
+"""Configuração comum dos testes: raiz do projeto no sys.path e caches em diretório temporário"""
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def coding_system(tmp_path, monkeypatch):
+    """Sistema de codificação com o cache de respostas fora da raiz do projeto"""
+    monkeypatch.setenv('CACHE_DB_PATH', str(tmp_path / 'cache.db'))
+    from improved_coding_system import ImprovedIPOCodingSystem
+    return ImprovedIPOCodingSystem()
+
+
+@pytest.fixture
+def web(tmp_path, monkeypatch):
+    """Módulo da interface web com pastas, tarefas (em memória) e checkpoints isolados no tmp_path"""
+    results = tmp_path / 'results'
+    uploads = tmp_path / 'uploads'
+    results.mkdir()
+    uploads.mkdir()
+    # Valem na primeira importação do módulo; depois os atributos são trocados abaixo
+    monkeypatch.setenv('RESULTS_FOLDER', str(results))
+    monkeypatch.setenv('UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setenv('TASK_STORE', 'memory')
+    monkeypatch.setenv('CACHE_DB_PATH', str(tmp_path / 'cache.db'))
+    import web_interface_ipo
+    from checkpoint_store import CheckpointStore
+    from task_store import InMemoryTaskStore
+    monkeypatch.setattr(web_interface_ipo, 'RESULTS_FOLDER', str(results))
+    monkeypatch.setattr(web_interface_ipo, 'UPLOAD_FOLDER', str(uploads))
+    monkeypatch.setattr(web_interface_ipo, 'task_store', InMemoryTaskStore())
+    monkeypatch.setattr(web_interface_ipo, 'checkpoints', CheckpointStore(
+        str(tmp_path / 'checkpoints'), version=web_interface_ipo.agent.result_version()))
+    return web_interface_ipo
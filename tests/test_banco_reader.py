@@ -0,0 +1,80 @@
+"""BancoReader produz as mesmas colunas que o pandas"""
+
+import math
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.styles import Font
+
+from banco_reader import BancoReader
+
+
+def same_values(left, right):
+    assert len(left) == len(right)
+    for a, b in zip(left, right):
+        if isinstance(a, float) and math.isnan(a):
+            assert isinstance(b, float) and math.isnan(b)
+        else:
+            assert a == b
+
+
+def read_columns(path, tmp_path):
+    reader = BancoReader(str(path), spool_dir=str(tmp_path / 'spool'))
+    try:
+        return {spool.name: spool.values() for spool in reader.iter_columns()}
+    finally:
+        reader.cleanup()
+
+
+def test_xlsx_trailing_formatted_rows_are_dropped(tmp_path):
+    path = tmp_path / 'banco.xlsx'
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['P1'])
+    ws.append(['saude'])
+    ws.append([None])
+    ws.append(['educacao'])
+    # linhas só com formatação depois dos dados
+    for row in range(5, 9):
+        ws.cell(row=row, column=1).font = Font(bold=True)
+    wb.save(path)
+
+    columns = read_columns(path, tmp_path)
+    same_values(columns['P1'], pd.read_excel(path)['P1'].tolist())
+    same_values(columns['P1'], ['saude', float('nan'), 'educacao'])
+
+
+ROWS = [
+    ['saude', 1, 'sim', 3.5, None],
+    [None, 2, 'nao', None, 'x'],
+    ['educacao e saude', None, '', 7, None],
+    ['  transporte ', 98, 'não sei', 0.25, 'y'],
+]
+HEADER = ['P1', 'P2', 'P3', 'P2', None]
+
+
+def assert_same_as_pandas(columns, frame):
+    assert list(columns) == [str(c) for c in frame.columns]
+    for name in columns:
+        same_values(columns[name], frame[name].tolist())
+
+
+def test_xlsx_matches_pandas(tmp_path):
+    path = tmp_path / 'banco.xlsx'
+    wb = Workbook()
+    ws = wb.active
+    ws.append(HEADER)
+    for row in ROWS:
+        ws.append(row)
+    wb.save(path)
+
+    columns = read_columns(path, tmp_path)
+    assert list(columns) == ['P1', 'P2', 'P3', 'P2.1', 'Unnamed: 4']
+    assert_same_as_pandas(columns, pd.read_excel(path))
+
+
+def test_csv_matches_pandas(tmp_path):
+    path = tmp_path / 'banco.csv'
+    pd.DataFrame(ROWS, columns=['P1', 'P2', 'P3', 'P4', 'P5']).to_csv(path, index=False)
+
+    assert_same_as_pandas(read_columns(path, tmp_path), pd.read_csv(path))
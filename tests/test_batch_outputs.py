@@ -0,0 +1,90 @@
+"""Saída consolidada do lote (ConsolidatedBatchWriter)"""
+
+import os
+
+from openpyxl import load_workbook
+
+from batch_outputs import ConsolidatedBatchWriter, render_spooled_question, sheet_title
+
+
+def question_result(codes, responses, report):
+    return {'code_column': codes, 'response_column': responses, 'detailed_report': report}
+
+
+def test_sheet_titles_are_valid_and_unique():
+    used = set()
+    assert sheet_title('P1: Saúde/Educação?', used) == 'P1_ Saúde_Educação_'
+    long_name = 'Questão com um nome muito longo para uma aba'
+    first = sheet_title(long_name, used)
+    second = sheet_title(long_name, used)
+    assert len(first) == len(second) == 31
+    assert first != second and second.endswith('~2')
+
+
+def test_consolidated_files_follow_column_order(tmp_path):
+    writer = ConsolidatedBatchWriter(str(tmp_path), ['P1', 'P2', 'P3'], base_name='lote')
+    # questões terminam fora de ordem (pool de colunas); P3 falhou
+    writer.add_question(1, question_result([2, 1], ['ruim', 'bom'], 'relatório P2'),
+                        [{'Código': 1, 'Descrição': 'Bom'}, {'Código': 2, 'Descrição': 'Ruim'}], 'resumo P2')
+    writer.add_question(0, question_result([1, float('nan'), 1], ['saude', None, 'saúde'], 'relatório P1'),
+                        [{'Código': 1, 'Descrição': 'Saúde'}], 'resumo P1')
+    writer.skip_question(2)
+
+    # enquanto o lote roda, a questão concluída é gerada a partir do spool
+    partial = dict(render_spooled_question(str(tmp_path), 0, 'P1'))
+    assert sorted(partial) == sorted(writer.question_filenames(0))
+    assert render_spooled_question(str(tmp_path), 2, 'P3') is None
+
+    files = writer.close()
+    assert not os.path.exists(ConsolidatedBatchWriter.spool_dir_for(str(tmp_path)))
+
+    banco = load_workbook(files['banco'], read_only=True)
+    rows = [list(row) for row in banco.active.iter_rows(values_only=True)]
+    assert rows[0] == ['P1 - Código', 'P1 - Resposta', 'P2 - Código', 'P2 - Resposta']
+    assert rows[1:] == [[1, 'saude', 2, 'ruim'], [None, None, 1, 'bom'], [1, 'saúde']]  # células vazias do fim da linha não são gravadas
+
+    f17 = load_workbook(files['f17'], read_only=True)
+    assert f17.sheetnames == ['P1', 'P2', 'P3']
+    assert [list(r) for r in f17['P2'].iter_rows(values_only=True)] == [['Código', 'Descrição'], [1, 'Bom'], [2, 'Ruim']]
+
+    with open(files['relatorio'], encoding='utf-8') as f:
+        assert f.read() == 'relatório P1\n\nrelatório P2\n\n'
+    with open(files['resumo'], encoding='utf-8') as f:
+        assert f.read() == 'resumo P1\n\nresumo P2\n\n'
+    # fechar de novo não regrava nada
+    assert writer.close() == files
+
+
+def test_streaming_zip_with_partial_copies(tmp_path):
+    import io
+    import zipfile
+
+    from batch_outputs import StreamingZipArchive, iter_zip_stream, read_partial_entries, read_zip_entries
+
+    partial_dir = StreamingZipArchive.partial_dir_for(str(tmp_path / 'tarefa'))
+    archive = StreamingZipArchive(str(tmp_path / 'lote.zip'), partial_dir=partial_dir)
+    archive.add_bytes('000_P1_relatorio.txt', b'relatorio ' * 100)
+    archive.add_bytes('000_P1_banco.xlsx', b'PK-planilha')
+    source = tmp_path / 'resumo.txt'
+    source.write_bytes(b'resumo')
+    archive.add_file(str(source), 'resumo.txt')
+    assert not source.exists()
+
+    # durante o lote: cópias parciais legíveis por outro processo
+    assert read_partial_entries(partial_dir, ['000_P1_relatorio.txt']) == [('000_P1_relatorio.txt', b'relatorio ' * 100)]
+    assert read_partial_entries(partial_dir, ['000_P2_relatorio.txt']) is None
+
+    archive.close()
+    archive.close()
+    assert not os.path.exists(partial_dir)
+    with zipfile.ZipFile(tmp_path / 'lote.zip') as zf:
+        infos = {info.filename: info for info in zf.infolist()}
+        assert list(infos) == ['000_P1_relatorio.txt', '000_P1_banco.xlsx', 'resumo.txt']
+        # xlsx já é comprimido: armazenado sem recomprimir
+        assert infos['000_P1_banco.xlsx'].compress_type == zipfile.ZIP_STORED
+        assert infos['000_P1_relatorio.txt'].compress_type == zipfile.ZIP_DEFLATED
+    assert read_zip_entries(str(tmp_path / 'lote.zip'), ['resumo.txt']) == [('resumo.txt', b'resumo')]
+
+    streamed = b''.join(iter_zip_stream([('a.txt', b'a' * 1000), ('b.xlsx', b'b')]))
+    with zipfile.ZipFile(io.BytesIO(streamed)) as zf:
+        assert zf.read('a.txt') == b'a' * 1000 and zf.read('b.xlsx') == b'b'
@@ -0,0 +1,185 @@
+"""Modo diferido: sessão de batch, ondas de coleta e serviço local"""
+
+import json
+import threading
+
+import pytest
+
+import batch_submission
+import model_routing
+import token_accounting
+from batch_submission import BatchSession, DeferredCall, LocalBatchService, custom_id, request_body, run_waves
+
+
+def chat_body(content, prompt_tokens=10, completion_tokens=2):
+    return {
+        'id': 'chatcmpl-teste', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o',
+        'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens},
+    }
+
+
+def output_line(key, content=None, error=None):
+    response = {'status_code': 200, 'body': chat_body(content)} if content is not None else None
+    return json.dumps({'id': 'req', 'custom_id': key, 'response': response, 'error': error})
+
+
+class FakeService:
+    """Serviço de batch que responde cada requisição com o texto da última mensagem em maiúsculas"""
+
+    def __init__(self, polls_until_done=1):
+        self.submitted = []
+        self.cancelled = []
+        self.polls_until_done = polls_until_done
+        self._polls = {}
+
+    def submit(self, path):
+        self.submitted.append(path)
+        batch_id = f"batch_{len(self.submitted)}"
+        self._polls[batch_id] = (path, 0)
+        return batch_id
+
+    def status(self, batch_id):
+        path, polls = self._polls[batch_id]
+        if polls < self.polls_until_done:
+            self._polls[batch_id] = (path, polls + 1)
+            return 'in_progress', None
+        with open(path, encoding='utf-8') as f:
+            requests = [json.loads(line) for line in f]
+        return 'completed', "\n".join(output_line(r['custom_id'], r['body']['messages'][-1]['content'].upper())
+                                      for r in requests) + "\n"
+
+    def cancel(self, batch_id):
+        self.cancelled.append(batch_id)
+
+
+@pytest.fixture(autouse=True)
+def no_polling_delay(monkeypatch):
+    monkeypatch.setattr(batch_submission, 'BATCH_POLL_SECONDS', 0)
+
+
+def body(text):
+    return request_body('gpt-4o', [{'role': 'user', 'content': text}])
+
+
+def test_custom_id_matches_identical_requests():
+    assert body('a')['temperature'] == 0
+    assert custom_id(body('a')) == custom_id(dict(reversed(list(body('a').items()))))
+    assert custom_id(body('a')) != custom_id(body('b'))
+    assert custom_id(body('a')) != custom_id(request_body('gpt-4o-mini', [{'role': 'user', 'content': 'a'}]))
+
+
+def test_collecting_session_defers_and_writes_the_batch_file(tmp_path):
+    session = BatchSession('t1', folder=str(tmp_path))
+    assert session.lookup(body('a')) is None  # fora da coleta: chamada interativa
+
+    with session.active(collecting=True):
+        assert batch_submission.current_session() is session
+        for text in ('a', 'b', 'a'):
+            with pytest.raises(DeferredCall):
+                session.lookup(body(text))
+    assert batch_submission.current_session() is None
+    assert session.pending_count == 2
+
+    path = session.write_batch_file(1)
+    with open(path, encoding='utf-8') as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['body'] for line in lines] == [body('a'), body('b')]
+    assert all(line['url'] == '/v1/chat/completions' and line['method'] == 'POST' for line in lines)
+    assert [line['custom_id'] for line in lines] == [custom_id(body('a')), custom_id(body('b'))]
+    assert session.pending_count == 0
+
+
+def test_output_lines_with_errors_stay_unanswered(tmp_path):
+    session = BatchSession('t1', folder=str(tmp_path))
+    output = "\n".join([output_line(custom_id(body('a')), 'A'),
+                        output_line(custom_id(body('b')), error={'message': 'falhou'}), ''])
+    assert session.load_output(output) == 1
+    assert session.lookup(body('a')).choices[0].message.content == 'A'
+    assert session.lookup(body('b')) is None
+
+
+def test_waves_follow_dependent_calls_until_nothing_is_new(tmp_path):
+    session = BatchSession('t1', folder=str(tmp_path))
+    service = FakeService()
+    statuses = []
+
+    def collect():
+        # a segunda chamada depende da resposta da primeira (ex.: padronização após o agrupamento)
+        try:
+            grouped = session.lookup(body('agrupar'))
+            session.lookup(body(f"padronizar {grouped.choices[0].message.content}"))
+        except DeferredCall:
+            pass
+
+    assert run_waves(session, collect, service, on_status=statuses.append) == 2
+    assert len(service.submitted) == 2 and session.result_count == 2
+    assert session.lookup(body('padronizar AGRUPAR')).choices[0].message.content == 'PADRONIZAR AGRUPAR'
+    assert statuses[0] == 'Onda 1: 1 chamadas enviadas ao batch'
+    assert any(status.startswith('Aguardando batch') for status in statuses)
+
+    # retomada: respostas vêm do disco e o batch já enviado não é reenviado
+    resumed = BatchSession('t1', folder=str(tmp_path))
+    assert resumed.result_count == 2
+    assert run_waves(resumed, collect, service) == 0
+    assert len(service.submitted) == 2
+
+
+def test_cancel_stops_waiting_and_cancels_the_batch(tmp_path):
+    session = BatchSession('t1', folder=str(tmp_path))
+    service = FakeService(polls_until_done=10)
+    cancel_event = threading.Event()
+    cancel_event.set()
+
+    def collect():
+        with pytest.raises(DeferredCall):
+            session.lookup(body('a'))
+
+    # cancelado antes do envio: nada vai ao batch
+    assert run_waves(session, collect, service, cancel_event) == 0
+    assert service.submitted == []
+
+    path = session.write_batch_file(1)
+    assert session.submit_and_wait(service, path, cancel_event) is False
+    assert service.cancelled == ['batch_1']
+
+
+def test_local_service_replays_against_a_compatible_endpoint(tmp_path):
+    from openai.types.chat import ChatCompletion
+
+    class Completions:
+        def create(self, **request):
+            text = request['messages'][-1]['content']
+            if text == 'falha':
+                raise Exception('erro do servidor')
+            return ChatCompletion.model_validate(chat_body(text.upper()))
+
+    class Client:
+        chat = type('Chat', (), {'completions': Completions()})()
+
+    session = BatchSession('t1', folder=str(tmp_path))
+    with session.active(collecting=True):
+        for text in ('a', 'falha'):
+            with pytest.raises(DeferredCall):
+                session.lookup(body(text))
+    assert session.submit_and_wait(LocalBatchService(Client()), session.write_batch_file(1)) is True
+    assert session.lookup(body('a')).choices[0].message.content == 'A'
+    assert session.lookup(body('falha')) is None
+    # batch local perdido com outro processo termina sem resultado
+    assert LocalBatchService(Client()).status('batch_local_x') == ('expired', None)
+
+
+def test_chat_completion_uses_the_batch_answer_at_batch_price(coding_system, tmp_path):
+    messages = [{'role': 'user', 'content': 'teste'}]
+    route = model_routing.Route('grouping', 'gpt-4o')
+    session = BatchSession('t1', folder=str(tmp_path))
+
+    with session.active(collecting=True), pytest.raises(DeferredCall):
+        coding_system._chat_completion('grouping', messages, route=route)
+    session.load_output(output_line(custom_id(request_body('gpt-4o', messages)), 'resposta'))
+
+    with token_accounting.metering() as meter, session.active():
+        response = coding_system._chat_completion('grouping', messages, route=route)
+    assert response.choices[0].message.content == 'resposta'
+    assert meter.summary()['batch_calls'] == 1
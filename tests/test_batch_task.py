@@ -0,0 +1,60 @@
+"""process_batch_task: estado final e limpeza do diretório de trabalho"""
+
+import os
+
+import pytest
+from openpyxl import Workbook
+
+
+def write_xlsx(path, rows):
+    wb = Workbook()
+    ws = wb.active
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+    return str(path)
+
+
+@pytest.fixture
+def upload(tmp_path):
+    """Banco só com questões fechadas (sem chamadas ao LLM) e um F17 vazio"""
+    banco = write_xlsx(tmp_path / 'banco.xlsx', [['P1', 'P2'], [1, 2], [2, 1], [1, 99]])
+    f17 = write_xlsx(tmp_path / 'f17.xlsx', [['Código', 'Descrição']])
+    return banco, f17
+
+
+def leftovers(web, task_id):
+    return [name for name in os.listdir(web.RESULTS_FOLDER) if name.startswith(task_id) and not name.endswith('.zip')]
+
+
+def test_completed_batch_removes_its_working_set(web, upload):
+    web.task_store.create('t1', state='PENDING')
+    web.process_batch_task('t1', *upload, output_mode='per_question')
+
+    task = web.task_store.get('t1')
+    assert task['state'] == 'COMPLETED'
+    assert os.path.exists(os.path.join(web.RESULTS_FOLDER, task['result_file']))
+    assert leftovers(web, 't1') == []
+
+
+def test_failed_batch_removes_its_working_set(web, upload, monkeypatch):
+    def broken_plan(requests):
+        raise Exception('falha no planejamento')
+
+    monkeypatch.setattr(web, 'plan_packs', broken_plan)
+    web.task_store.create('t2', state='PENDING')
+    web.process_batch_task('t2', *upload, output_mode='consolidated')
+
+    task = web.task_store.get('t2')
+    assert task['state'] == 'ERROR' and 'falha no planejamento' in task['error']
+    assert leftovers(web, 't2') == []
+
+
+def test_unreadable_banco_leaves_no_spool(web, upload, tmp_path):
+    broken = tmp_path / 'banco.csv'
+    broken.write_bytes(b'\x00\xff\x00')
+    web.task_store.create('t3', state='PENDING')
+    web.process_batch_task('t3', str(broken), upload[1])
+
+    assert web.task_store.get('t3')['state'] == 'ERROR'
+    assert leftovers(web, 't3') == []
@@ -0,0 +1,90 @@
+"""Gerador de pesquisas sintéticas e suíte de benchmarks (benchmarks/)"""
+
+import json
+import os
+import subprocess
+import sys
+from collections import Counter
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def survey(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(ROOT, 'benchmarks'))
+    import synthetic_survey
+    return synthetic_survey
+
+
+def test_same_seed_same_survey(survey):
+    assert survey.generate_answers(500, seed=7) == survey.generate_answers(500, seed=7)
+    assert survey.generate_answers(500, seed=7) != survey.generate_answers(500, seed=8)
+    banco, f17 = survey.generate_survey(200, open_questions=2, closed_questions=1, semi_open_questions=1, seed=3)
+    again, f17_again = survey.generate_survey(200, open_questions=2, closed_questions=1, semi_open_questions=1, seed=3)
+    assert banco.equals(again) and all(f17[name].equals(f17_again[name]) for name in f17)
+
+
+def test_answers_are_zipf_shaped_with_noise(survey):
+    answers = survey.generate_answers(5000, seed=1)
+    counts = Counter(answers)
+    top = [count for _, count in counts.most_common()]
+    # poucas respostas concentram a coluna e há uma cauda longa de raras
+    assert sum(top[:10]) > len(answers) * 0.3
+    assert sum(1 for count in top if count == 1) > 100
+    assert any(answer in survey.NON_RESPONSES for answer in counts)
+    assert any(' e ' in answer for answer in counts)
+    # o ruído de digitação multiplica os valores únicos
+    assert len(set(survey.generate_answers(5000, seed=1, typo_rate=0))) < len(counts) * 0.75
+
+
+def test_survey_shape_and_codebooks(survey):
+    banco, f17 = survey.generate_survey(300, open_questions=2, closed_questions=1, semi_open_questions=1, seed=5)
+    assert list(banco.columns) == ['P1', 'P2', 'P3', 'P4'] and len(banco) == 300
+    assert list(f17) == ['P1', 'P2', 'P3', 'P4']
+    assert all(list(sheet.columns) == ['Código', 'Descrição'] for sheet in f17.values())
+
+    codebook = dict(zip(f17['P1']['Descrição'], f17['P1']['Código']))
+    assert codebook['Não sabe/Não respondeu'] == 99 and codebook['Nenhum'] == 88
+    assert all(isinstance(value, str) for value in banco['P1'])
+    # semiaberta: parte já vem com os códigos do F17
+    assert any(isinstance(value, int) and value in set(f17['P3']['Código']) for value in banco['P3'])
+    assert set(banco['P4']) <= {1, 2, 3, 4, 5}
+
+
+def test_survey_files_are_readable_uploads(survey):
+    import io
+
+    import pandas as pd
+
+    banco_bytes, f17_bytes = survey.survey_files(50, open_questions=1, seed=2)
+    banco = pd.read_excel(io.BytesIO(banco_bytes))
+    assert list(banco.columns) == ['P1', 'P2'] and len(banco) == 50
+    assert pd.ExcelFile(io.BytesIO(f17_bytes)).sheet_names == ['P1', 'P2']
+
+
+def run_benchmarks(tmp_path, baselines, *extra):
+    baselines_path = tmp_path / 'baselines.json'
+    baselines_path.write_text(json.dumps(baselines), encoding='utf-8')
+    report_path = tmp_path / 'relatorio.json'
+    completed = subprocess.run(
+        [sys.executable, os.path.join(ROOT, 'benchmarks', 'run_benchmarks.py'), '--sizes', '1k',
+         '--cases', 'canonicalize,pipeline', '--repeat', '1', '--baselines', str(baselines_path),
+         '--json', str(report_path), *extra],
+        capture_output=True, text=True, timeout=300)
+    with open(report_path, encoding='utf-8') as f:
+        return completed.returncode, json.load(f)['comparison']
+
+
+def test_benchmark_report_flags_regressions(tmp_path):
+    code, rows = run_benchmarks(tmp_path, {})
+    assert code == 0
+    assert [(row['case'], row['size'], row['status']) for row in rows] == [('canonicalize', '1k', 'novo'),
+                                                                           ('pipeline', '1k', 'novo')]
+
+    # baseline muito menor (acima do piso de ruído): regressão; muito maior: melhora
+    code, rows = run_benchmarks(tmp_path, {'results': {'pipeline': {'1k': 0.001}, 'canonicalize': {'1k': 100.0}}},
+                                '--fail-on-regression')
+    assert code == 1
+    assert {row['case']: row['status'] for row in rows} == {'canonicalize': 'melhora', 'pipeline': 'REGRESSÃO'}
@@ -0,0 +1,109 @@
+"""Checkpoints por questão e retomada de jobs interrompidos"""
+
+import glob
+import os
+import time
+
+import pytest
+from openpyxl import Workbook
+
+import job_queue
+from checkpoint_store import CheckpointStore
+from job_queue import QueueFullError
+from task_store import InMemoryTaskStore
+
+
+def write_xlsx(path, rows):
+    wb = Workbook()
+    ws = wb.active
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+    return str(path)
+
+
+def test_checkpoint_round_trip_and_unreadable_entry(tmp_path):
+    store = CheckpointStore(str(tmp_path), version='v1')
+    key = store.key_for('P1', ['saude', 'educacao'], {})
+    assert store.load(key) is None
+
+    result = {'question_type': 'open', 'code_column': [1, 2]}
+    store.save(key, result)
+    assert store.load(key) == result
+    assert not glob.glob(os.path.join(str(tmp_path), '*.part'))
+
+    # entrada corrompida (worker morto no meio de outra gravação) é reprocessada
+    with open(os.path.join(str(tmp_path), f"{key}.pkl.gz"), 'wb') as f:
+        f.write(b'lixo')
+    assert store.load(key) is None
+
+
+def test_prune_removes_only_stale_entries(tmp_path):
+    store = CheckpointStore(str(tmp_path))
+    store.save('antigo', {'x': 1})
+    store.save('recente', {'x': 2})
+    old = time.time() - 10 * 86400
+    os.utime(os.path.join(str(tmp_path), 'antigo.pkl.gz'), (old, old))
+
+    assert store.prune(max_age_seconds=86400) == 1
+    assert store.load('antigo') is None and store.load('recente') == {'x': 2}
+
+
+def test_resume_requeues_and_resets_the_previous_run():
+    store = InMemoryTaskStore()
+    job_queue.submit(store, 't1', 'batch', {'banco_path': 'b.xlsx'})
+    store.claim_next('w1')
+    store.set_question_result('t1', 0, 'P1', summary='resumo P1', files=['000_P1_banco.xlsx'])
+    store.update('t1', state='ERROR', error='Worker terminou inesperadamente', progress=40)
+
+    job_queue.resume(store, 't1', status='Na fila (retomada)...')
+
+    task = store.get('t1')
+    assert task['state'] == 'PENDING' and task['status'] == 'Na fila (retomada)...'
+    assert task['progress'] == 0 and task.get('error') is None and task.get('worker_id') is None
+    assert task['artifacts'] == []
+    assert task['job_args'] == {'banco_path': 'b.xlsx'}
+    assert store.changes_since('t1', 0)['questions_reset'] is True
+    assert store.claim_next('w2')['task_id'] == 't1'
+
+
+def test_resume_rejects_running_unknown_and_full_queue(monkeypatch):
+    store = InMemoryTaskStore()
+    job_queue.submit(store, 'rodando', 'batch', {})
+    with pytest.raises(Exception, match='não pode ser retomada'):
+        job_queue.resume(store, 'rodando')
+    with pytest.raises(Exception, match='não encontrada'):
+        job_queue.resume(store, 'desconhecida')
+
+    store.create('erro', state='ERROR', job_kind='batch', job_args={})
+    monkeypatch.setattr(job_queue, 'MAX_ACTIVE_JOBS', 1)
+    with pytest.raises(QueueFullError):
+        job_queue.resume(store, 'erro')
+    assert store.get('erro')['state'] == 'ERROR'
+
+
+def test_resumed_batch_reuses_question_checkpoints(web, tmp_path, monkeypatch):
+    banco = write_xlsx(tmp_path / 'banco.xlsx', [['P1', 'P2'], [1, 2], [2, 1], [1, 99]])
+    f17 = write_xlsx(tmp_path / 'f17.xlsx', [['Código', 'Descrição']])
+    web.task_store.create('t1', state='PENDING', job_kind='batch', job_args={})
+    web.process_batch_task('t1', banco, f17, output_mode='per_question')
+    assert web.task_store.get('t1')['state'] == 'COMPLETED'
+
+    # sem o pacote do envio idêntico, a retomada passa pelas questões
+    for path in glob.glob(os.path.join(web.checkpoints.root, 'upload_*')):
+        os.remove(path)
+
+    def no_processing(*args, **kwargs):
+        raise AssertionError('questão com checkpoint foi reprocessada')
+
+    monkeypatch.setattr(web.agent, 'process_single_question_with_chatgpt', no_processing)
+    web.task_store.update('t1', state='CANCELLED')
+    response = web.app.test_client().post('/resume_task/t1')
+    assert response.get_json()['success'] is True
+    assert web.task_store.get('t1')['state'] == 'PENDING'
+
+    web.process_batch_task('t1', banco, f17, output_mode='per_question')
+    task = web.task_store.get('t1')
+    assert task['state'] == 'COMPLETED'
+    assert [a['question'] for a in task['artifacts']] == ['P1', 'P2']
+    assert all(a['files'] for a in task['artifacts'])
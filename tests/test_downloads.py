@@ -0,0 +1,58 @@
+"""Downloads do lote: ZIP final com Range/ETag e downloads parciais"""
+
+import io
+import os
+import zipfile
+
+from batch_outputs import StreamingZipArchive
+
+
+def finished_batch(web, task_id):
+    zip_name = f"resultado_completo_{task_id}.zip"
+    archive = StreamingZipArchive(os.path.join(web.RESULTS_FOLDER, zip_name))
+    archive.add_bytes('000_P1_relatorio.txt', os.urandom(4096))
+    archive.close()
+    web.task_store.create(task_id, state='COMPLETED', result_file=zip_name, output_mode='per_question')
+    web.task_store.set_question_result(task_id, 0, 'P1', files=['000_P1_relatorio.txt'])
+    with open(os.path.join(web.RESULTS_FOLDER, zip_name), 'rb') as f:
+        return f.read()
+
+
+def test_final_zip_supports_range_and_etag(web):
+    content = finished_batch(web, 't1')
+    client = web.app.test_client()
+
+    full = client.get('/download_batch/t1')
+    assert full.status_code == 200 and full.data == content
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    etag = full.headers['ETag']
+
+    # download retomado a partir do byte 100
+    part = client.get('/download_batch/t1', headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert part.status_code == 206
+    assert part.data == content[100:]
+    assert part.headers['Content-Range'] == f"bytes 100-{len(content) - 1}/{len(content)}"
+
+    assert client.get('/download_batch/t1', headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_partial_download_of_a_running_batch(web):
+    task_dir = os.path.join(web.RESULTS_FOLDER, 't2')
+    archive = StreamingZipArchive(os.path.join(web.RESULTS_FOLDER, 'resultado_completo_t2.zip'),
+                                  partial_dir=StreamingZipArchive.partial_dir_for(task_dir))
+    archive.add_bytes('000_P1_relatorio.txt', b'relatorio P1')
+    web.task_store.create('t2', state='PROCESSING', result_file='resultado_completo_t2.zip',
+                          output_mode='per_question', work_dir=task_dir)
+    web.task_store.set_question_result('t2', 0, 'P1', files=['000_P1_relatorio.txt'])
+    client = web.app.test_client()
+
+    single = client.get('/download_partial/t2?question=0&file=000_P1_relatorio.txt')
+    assert single.status_code == 200 and single.data == b'relatorio P1'
+    bundle = client.get('/download_partial/t2')
+    with zipfile.ZipFile(io.BytesIO(bundle.data)) as zf:
+        assert zf.namelist() == ['000_P1_relatorio.txt']
+
+    # fechado o lote, a mesma questão vem do ZIP final
+    archive.close()
+    web.task_store.update('t2', state='COMPLETED')
+    assert client.get('/download_partial/t2?question=0&file=000_P1_relatorio.txt').data == b'relatorio P1'
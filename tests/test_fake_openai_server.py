@@ -0,0 +1,120 @@
+"""Servidor falso da OpenAI (loadtest/fake_openai_server.py): formato, determinismo e falhas injetadas"""
+
+import json
+import os
+import urllib.error
+import urllib.request
+
+import pytest
+
+import llm_gate
+import model_routing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GROUPING_MESSAGES = [
+    {'role': 'system', 'content': 'regras fixas'},
+    {'role': 'user', 'content': 'F17 (codebook):\n1 - Saúde\n2 - Educação'},
+    {'role': 'user', 'content': 'Total de respostas para processar: 4\nResponses to be coded (do not reorder rows, '
+                                'process ALL 4 responses):\n1. saúde ruim\n2. saude publica\n3. emprego\n4. escola longe'},
+]
+
+
+@pytest.fixture
+def fake_server(monkeypatch):
+    monkeypatch.syspath_prepend(os.path.join(ROOT, 'loadtest'))
+    import fake_openai_server
+
+    servers = []
+
+    def start(**options):
+        options.setdefault('latency_ms', 0)
+        options.setdefault('jitter_ms', 0)
+        fake = fake_openai_server.FakeOpenAI(**options)
+        server = fake_openai_server.serve(fake, port=0)
+        servers.append(server)
+        return fake, f"http://127.0.0.1:{server.server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(f"{url}/v1/chat/completions", data=json.dumps(body).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, dict(response.headers), json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), json.load(e)
+
+
+def tool_body(messages, name='return_groups'):
+    return {'model': 'gpt-4o-mini', 'messages': messages,
+            'tools': [{'type': 'function', 'function': {'name': name, 'parameters': {}}}]}
+
+
+def test_grouping_is_deterministic_and_reuses_f17_codes(fake_server):
+    _, url = fake_server()
+    status, _, first = post(url, tool_body(GROUPING_MESSAGES))
+    _, _, second = post(url, tool_body(GROUPING_MESSAGES))
+
+    assert status == 200 and first['choices'][0]['finish_reason'] == 'tool_calls'
+    arguments = json.loads(first['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
+    assert arguments == json.loads(second['choices'][0]['message']['tool_calls'][0]['function']['arguments'])
+    assert arguments['groups'] == [
+        {'codigo': 1, 'titulo': 'Saúde', 'respostas': ['saúde ruim', 'saude publica']},
+        {'codigo': 10, 'titulo': 'Emprego', 'respostas': ['emprego']},
+        {'codigo': 11, 'titulo': 'Escola', 'respostas': ['escola longe']},
+    ]
+    assert first['usage']['prompt_tokens'] > 0 and first['usage']['completion_tokens'] > 0
+
+
+def test_packed_grouping_and_standardization(fake_server):
+    _, url = fake_server()
+    packed = [{'role': 'user', 'content': 'Questions in this request: 2\n\n'
+                                          '### QUESTÃO: P1\nF17 (codebook):\n(vazio)\nResponses to be coded (1):\n1. transporte\n\n'
+                                          '### QUESTÃO: P2\nF17 (codebook):\n5 - Lazer\nResponses to be coded (1):\n1. lazer no bairro'}]
+    body = {'model': 'gpt-4o-mini', 'messages': packed,
+            'functions': [{'name': 'return_question_groups', 'parameters': {}}]}
+    _, _, response = post(url, body)
+    message = response['choices'][0]['message']
+    assert response['choices'][0]['finish_reason'] == 'function_call'
+    questions = json.loads(message['function_call']['arguments'])['questions']
+    assert [(q['questao'], [g['codigo'] for g in q['groups']]) for q in questions] == [('P1', [10]), ('P2', [5])]
+
+    _, _, response = post(url, {'model': 'gpt-4o-mini', 'messages': [{'role': 'user', 'content': 'POSTO de saúde'}]})
+    assert response['choices'][0]['message']['content'] == 'Posto de saúde'
+
+
+def test_injected_failures_and_stats(fake_server):
+    fake, url = fake_server(rate_limit_rate=1.0, retry_after=2.5)
+    status, headers, payload = post(url, tool_body(GROUPING_MESSAGES))
+    assert status == 429 and headers['Retry-After'] == '2.5'
+    assert payload['error']['code'] == 'rate_limit_exceeded'
+
+    fake.rate_limit_rate, fake.error_rate = 0.0, 1.0
+    status, _, _ = post(url, tool_body(GROUPING_MESSAGES))
+    assert status == 500
+
+    fake.error_rate = 0.0
+    post(url, tool_body(GROUPING_MESSAGES))
+    with urllib.request.urlopen(f"{url}/stats") as response:
+        stats = json.load(response)
+    assert (stats['requests'], stats['rate_limited'], stats['errors'], stats['completed']) == (3, 1, 1, 1)
+    assert stats['in_flight'] == 0 and stats['models'] == {'gpt-4o-mini': 1}
+
+
+def test_app_grouping_through_the_fake_endpoint(fake_server, coding_system, tmp_path, monkeypatch):
+    _, url = fake_server()
+    monkeypatch.setenv('OPENAI_API_KEY', 'fake')
+    monkeypatch.setenv('RESULTS_FOLDER', str(tmp_path))
+    monkeypatch.setattr(llm_gate, 'LLM_MAX_CONCURRENCY', 0)
+    monkeypatch.setattr(model_routing, '_router', model_routing.ModelRouter(str(tmp_path / 'routing.db')))
+
+    route = model_routing.Route('grouping', 'gpt-4o-mini', base_url=f"{url}/v1")
+    codes, groups = coding_system.group_with_chatgpt(['saúde ruim', 'saude publica', 'emprego'], ['1 - Saúde'], route=route)
+    assert sorted(r for respostas in groups.values() for r in respostas) == ['emprego', 'saude publica', 'saúde ruim']
+    assert sorted(codes.values()) == [1, 10]
@@ -0,0 +1,34 @@
+"""Kernel fuzzy: fallback sem rapidfuzz em processos (pool spawn reaproveitado)"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from fuzzywuzzy import fuzz
+
+import fuzzy_kernel
+
+QUERIES = ['atendimento ruim', 'saude publica', 'falta de medico', 'seguranca', 'escola', 'transporte publico']
+CHOICES = ['Atendimento', 'Saúde', 'Falta de médicos', 'Segurança pública', 'Educação']
+
+
+def test_matches_fuzzywuzzy():
+    scores = fuzzy_kernel.score_matrix(QUERIES, CHOICES, 'token_set_ratio', workers=1)
+    expected = [[fuzz.token_set_ratio(q, c) for c in CHOICES] for q in QUERIES]
+    assert scores.tolist() == expected
+    assert fuzzy_kernel.extract_best('atendimento ruim', CHOICES, 'token_set_ratio', score_cutoff=50)[0] == 0
+
+
+def test_process_fallback_reuses_one_spawn_pool_from_threads(monkeypatch):
+    monkeypatch.setattr(fuzzy_kernel, 'HAS_RAPIDFUZZ', False)
+    monkeypatch.setattr(fuzzy_kernel, 'PARALLEL_MIN_PAIRS', 1)
+    monkeypatch.setattr(fuzzy_kernel, '_pools', {})
+    serial = fuzzy_kernel._score_rows(QUERIES, CHOICES, 'ratio')
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        results = list(executor.map(lambda _: fuzzy_kernel.score_matrix(QUERIES, CHOICES, 'ratio', workers=2), range(3)))
+
+    assert all(np.array_equal(result, serial) for result in results)
+    assert list(fuzzy_kernel._pools) == [2]
+    pool = fuzzy_kernel._pools[2]
+    assert pool._mp_context.get_start_method() == 'spawn'
+    pool.shutdown()
@@ -0,0 +1,97 @@
+"""Fila de jobs: admissão, ordem de reivindicação, cancelamento e worker"""
+
+import threading
+
+import pytest
+
+import job_queue
+from job_queue import QueueFullError
+from task_store import InMemoryTaskStore, SQLiteTaskStore
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteTaskStore(str(tmp_path / 'tasks.db'))
+    return InMemoryTaskStore()
+
+
+def test_admission_stops_at_max_active_jobs(store, monkeypatch):
+    monkeypatch.setattr(job_queue, 'MAX_ACTIVE_JOBS', 2)
+    job_queue.submit(store, 't1', 'batch', {'n': 1})
+    job_queue.submit(store, 't2', 'batch', {'n': 2})
+    with pytest.raises(QueueFullError):
+        job_queue.submit(store, 't3', 'batch', {'n': 3})
+    assert store.get('t3') is None
+
+    # tarefa encerrada libera a vaga
+    store.update('t1', state='COMPLETED')
+    job_queue.submit(store, 't3', 'batch', {'n': 3})
+    assert store.get('t3')['state'] == 'PENDING'
+
+
+def test_unknown_job_kind_is_rejected(store):
+    with pytest.raises(Exception, match='desconhecido'):
+        job_queue.submit(store, 't1', 'inexistente', {})
+    assert store.get('t1') is None
+
+
+def test_claim_takes_the_oldest_pending_job(store):
+    job_queue.submit(store, 'novo', 'batch', {'n': 2}, created_at=200.0)
+    job_queue.submit(store, 'antigo', 'batch', {'n': 1}, created_at=100.0)
+    store.create('sem_job', state='PENDING', created_at=50.0)
+
+    first = store.claim_next('w1')
+    assert first['task_id'] == 'antigo' and first['job_args'] == {'n': 1}
+    assert store.get('antigo')['state'] == 'PROCESSING'
+    assert store.claim_next('w2')['task_id'] == 'novo'
+    # tarefa sem job_kind não é um job
+    assert store.claim_next('w3') is None
+
+
+def test_cancel_pending_now_and_processing_between_questions(store):
+    job_queue.submit(store, 'pendente', 'batch', {})
+    job_queue.submit(store, 'rodando', 'batch', {}, created_at=0.0)
+    assert store.claim_next('w1')['task_id'] == 'rodando'
+
+    assert store.request_cancel('pendente') == 'CANCELLED'
+    assert store.get('pendente')['status'] == 'Cancelada'
+    assert store.request_cancel('rodando') == 'PROCESSING'
+    assert store.is_cancel_requested('rodando')
+    assert not store.is_cancel_requested('pendente')
+    assert store.request_cancel('desconhecida') is None
+    # cancelada não volta a ser reivindicada
+    assert store.claim_next('w2') is None
+
+
+def test_dead_worker_jobs_become_errors(store):
+    job_queue.submit(store, 't1', 'batch', {})
+    store.claim_next('w1')
+    store.fail_worker_jobs('w2', 'outro worker')
+    assert store.get('t1')['state'] == 'PROCESSING'
+    store.fail_worker_jobs('w1', 'Worker terminou inesperadamente')
+    assert store.get('t1')['state'] == 'ERROR'
+    assert store.get('t1')['error'] == 'Worker terminou inesperadamente'
+
+
+def test_worker_runs_jobs_and_records_handler_errors(store, monkeypatch):
+    stop = threading.Event()
+    calls = []
+
+    def handler(task_id, n):
+        calls.append((task_id, n))
+        if n == 2:
+            stop.set()
+            raise RuntimeError('falhou no meio')
+        store.update(task_id, state='COMPLETED')
+
+    monkeypatch.setattr(job_queue, '_resolve_handler', lambda kind: handler)
+    monkeypatch.setattr(job_queue, 'JOB_POLL_SECONDS', 0.01)
+    job_queue.submit(store, 't1', 'batch', {'n': 1}, created_at=1.0)
+    job_queue.submit(store, 't2', 'batch', {'n': 2}, created_at=2.0)
+
+    job_queue.run_worker(store, 'w1', stop)
+
+    assert calls == [('t1', 1), ('t2', 2)]
+    assert store.get('t1')['state'] == 'COMPLETED'
+    assert store.get('t2')['state'] == 'ERROR' and store.get('t2')['error'] == 'falhou no meio'
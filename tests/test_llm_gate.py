@@ -0,0 +1,153 @@
+"""Limite adaptativo (AIMD) e vagas do LLMGate"""
+
+import time
+
+import pytest
+
+import llm_gate
+from llm_gate import LLMGate
+
+
+@pytest.fixture
+def gate(tmp_path, monkeypatch):
+    monkeypatch.setattr(llm_gate, 'LLM_INITIAL_CONCURRENCY', 4)
+    monkeypatch.setattr(llm_gate, 'LLM_MIN_CONCURRENCY', 1)
+    monkeypatch.setattr(llm_gate, 'AIMD_INCREASE', 1.0)
+    monkeypatch.setattr(llm_gate, 'AIMD_DECREASE', 0.5)
+    monkeypatch.setattr(llm_gate, 'DECREASE_COOLDOWN_SECONDS', 5)
+    return LLMGate(str(tmp_path / 'llm_gate.db'), capacity=8)
+
+
+def test_successes_add_one_slot_per_window(gate):
+    assert gate.limit() == 4
+    for _ in range(4):
+        gate.on_success(1.0)
+    assert gate.limit() == 4
+    gate.on_success(1.0)
+    assert gate.limit() == 5
+
+
+def test_limit_stops_at_capacity(gate):
+    for _ in range(200):
+        gate.on_success(1.0)
+    assert gate.limit() == 8
+    assert gate.snapshot()['ceiling'] == 8
+
+
+def test_slow_calls_hold_the_limit(gate):
+    gate.on_success(1.0)
+    before = gate.snapshot()['concurrency']
+    gate.on_success(10.0)
+    assert gate.snapshot()['concurrency'] == before
+
+
+def test_overload_halves_once_per_cooldown(gate, monkeypatch):
+    assert gate.limit() == 4
+    gate.on_overload('rate_limit')
+    assert gate.limit() == 2
+    # 429 das chamadas já em voo: não reduz de novo dentro do intervalo
+    gate.on_overload('rate_limit')
+    assert gate.limit() == 2
+    monkeypatch.setattr(llm_gate, 'DECREASE_COOLDOWN_SECONDS', 0)
+    gate.on_overload('timeout')
+    assert gate.limit() == 1
+    # piso: LLM_MIN_CONCURRENCY
+    gate.on_overload('timeout')
+    assert gate.limit() == 1
+
+
+def test_acquire_respects_the_current_limit(gate):
+    slots = [gate.acquire(llm_gate.BULK) for _ in range(gate.limit())]
+    assert gate.snapshot()['in_use'] == 4
+    assert not gate._looks_available(gate._conn(), llm_gate.BULK, time.time())
+    gate.release(slots.pop())
+    assert gate._looks_available(gate._conn(), llm_gate.BULK, time.time())
+    for slot_id in slots:
+        gate.release(slot_id)
+    assert gate.snapshot()['in_use'] == 0
+
+
+def test_priority_reaches_pool_threads_through_in_context():
+    from concurrent.futures import ThreadPoolExecutor
+
+    import token_accounting
+
+    with llm_gate.priority(llm_gate.INTERACTIVE):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            levels = list(executor.map(token_accounting.in_context(lambda _: llm_gate.current_priority()), range(4)))
+        assert llm_gate.current_priority() == llm_gate.INTERACTIVE
+    assert levels == [llm_gate.INTERACTIVE] * 4
+    assert llm_gate.current_priority() == llm_gate.BULK
+
+
+class RateLimitError(Exception):
+    def __init__(self, message='rate_limit_exceeded', headers=None):
+        super().__init__(message)
+        self.status_code = 429
+        self.response = type('Response', (), {'headers': headers or {}})()
+
+
+@pytest.fixture
+def retries(gate, monkeypatch):
+    """Gate do teste como gate global, sem esperas reais (as esperas pedidas ficam registradas)"""
+    slept = []
+    monkeypatch.setattr(llm_gate, '_gate', gate)
+    monkeypatch.setattr(llm_gate, 'LLM_MAX_RETRIES', 3)
+    monkeypatch.setattr(llm_gate.time, 'sleep', slept.append)
+    monkeypatch.setattr(llm_gate.random, 'uniform', lambda a, b: 1.0)
+    return slept
+
+
+def test_call_retries_overloads_with_backoff(gate, retries):
+    outcomes = [RateLimitError(), TimeoutError('timed out'), 'resposta']
+
+    def func():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        assert gate.snapshot()['in_use'] == 1
+        return outcome
+
+    assert llm_gate.call(func) == 'resposta'
+    assert retries == [1.0, 2.0]
+    # cada sobrecarga reduziu o limite; a espera acontece fora da vaga
+    assert gate.limit() == 2
+    assert gate.snapshot()['in_use'] == 0
+
+
+def test_call_gives_up_after_max_retries(gate, retries):
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        raise RateLimitError()
+
+    with pytest.raises(RateLimitError):
+        llm_gate.call(func)
+    assert len(attempts) == 4 and len(retries) == 3
+    assert gate.snapshot()['in_use'] == 0
+
+
+def test_call_raises_other_errors_immediately(gate, retries):
+    attempts = []
+
+    def func():
+        attempts.append(1)
+        raise RateLimitError('Error code: 429 - insufficient_quota')
+
+    with pytest.raises(RateLimitError):
+        llm_gate.call(func)
+    # cota esgotada não é sobrecarga: sem nova tentativa e sem reduzir o limite
+    assert attempts == [1] and retries == []
+    assert gate.limit() == 4
+
+    with pytest.raises(ValueError):
+        llm_gate.call(lambda: int('x'))
+    assert retries == [] and gate.limit() == 4
+
+
+def test_retry_after_header_wins_when_longer():
+    assert llm_gate.backoff_seconds(0, RateLimitError(headers={'retry-after-ms': '7500'})) == 7.5
+    assert llm_gate.backoff_seconds(0, RateLimitError(headers={'retry-after': '3'})) == 3.0
+    # exponencial com jitter, limitado a BACKOFF_MAX_SECONDS
+    assert llm_gate.BACKOFF_MAX_SECONDS / 2 <= llm_gate.backoff_seconds(10) <= llm_gate.BACKOFF_MAX_SECONDS
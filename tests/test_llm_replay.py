@@ -0,0 +1,49 @@
+"""Regressão offline do pipeline: questão codificada com as respostas gravadas em fixtures/
+
+A gravação foi feita com LLM_MODE=record contra loadtest/fake_openai_server.py (mesmas
+QUESTION e EXISTING_CODES). Mudança de prompt ou de lógica que altere as requisições ao LLM
+faz o replay falhar com 'Chamada não gravada': regrave a fixture e confira os códigos."""
+
+import os
+
+import pytest
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'replay_question.jsonl.gz')
+
+EXISTING_CODES = {'Saúde': 1, 'Educação': 2, 'Segurança': 3}
+
+QUESTION = [
+    'saude', 'Saúde publica', 'mais saude', 'educação', 'educacao das criancas', 'segurança',
+    'seguranca nas ruas', 'emprego', 'empregos para jovens', 'transporte', 'transporte publico',
+    'saude',
+]
+
+EXPECTED_CODES = [1, 1, 1, 2, 2, 3, 3, 10, 10, 11, 11, 1]
+
+
+@pytest.fixture
+def replay(tmp_path, monkeypatch):
+    """LLM_MODE=replay com a fixture e estado (roteamento, blocos, cache) em diretório temporário"""
+    import llm_replay
+    import model_routing
+    import shard_sizer
+    from improved_coding_system import OPENAI_MODEL
+
+    monkeypatch.setattr(llm_replay, 'LLM_MODE', llm_replay.REPLAY)
+    monkeypatch.setattr(llm_replay, 'LLM_REPLAY_PATH', FIXTURE)
+    monkeypatch.setattr(llm_replay, '_replay_client', None)
+    monkeypatch.setattr(llm_replay, '_replay_cache_path', str(tmp_path / 'replay_cache.db'))
+    monkeypatch.setattr(model_routing, '_router', model_routing.ModelRouter(
+        str(tmp_path / 'model_routing.db'), default_model=OPENAI_MODEL))
+    monkeypatch.setattr(shard_sizer, '_sizer', shard_sizer.ShardSizer(str(tmp_path / 'shard_stats.db')))
+
+
+def test_question_codes_match_recording(replay):
+    from final_ipo_agent_improved import FinalIPOAgentImproved
+
+    result = FinalIPOAgentImproved().process_single_question_with_chatgpt(QUESTION, EXISTING_CODES, 'P5')
+
+    assert result['processing_method'].startswith('chatgpt')
+    assert result['code_column'] == EXPECTED_CODES
+    assert result['new_codes'] == {'Emprego': 10, 'Transporte': 11}
+    assert result['usage']['calls'] > 0
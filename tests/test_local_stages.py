@@ -0,0 +1,40 @@
+"""Modo multiprocessos das etapas locais: resultado idêntico ao serial"""
+
+import local_stages
+
+TEXTS = ['bolsa familia', 'saude', 'polisia', 'egotos', 'pessoas', 'lixos', 'educacao',
+         'onibis', 'Bolso novo', 'seguransa', 'iluminasao', 'tubarao azul', 'tubaram']
+CODES = {'Bolso': 5, 'Saúde': 1}
+
+
+def run_both(monkeypatch, func):
+    monkeypatch.setattr(local_stages, 'POOL_WORKERS', 0)
+    serial = func()
+    monkeypatch.setattr(local_stages, 'POOL_WORKERS', 2)
+    monkeypatch.setattr(local_stages, 'POOL_MIN_ITEMS', 1)
+    monkeypatch.setattr(local_stages, 'POOL_CHUNK_SIZE', 3)
+    return serial, func()
+
+
+def test_canonicalize_pool_matches_serial(coding_system, monkeypatch):
+    # Vocabulário que só existe no índice do processo principal
+    coding_system.spell_index.add_word('tubarão', 5000)
+
+    def canonicalize():
+        with coding_system.codebook_vocabulary(CODES):
+            return local_stages.canonicalize_many(coding_system, TEXTS, CODES)
+
+    serial, pooled = run_both(monkeypatch, canonicalize)
+    assert pooled == serial
+    assert serial[TEXTS.index('tubaram')][0] == 'Tubarão'
+    assert serial[TEXTS.index('bolsa familia')][0] == 'Bolso família'
+
+
+def test_match_pool_matches_serial(coding_system, monkeypatch):
+    response_to_code = {'saude': (1, 'saude'), 'bolso': (5, 'bolso'), 'policia': (10, 'policia')}
+    values = [coding_system.correct_text(t) for t in TEXTS]
+
+    serial, pooled = run_both(
+        monkeypatch, lambda: local_stages.match_many(coding_system, values, response_to_code, CODES))
+    assert pooled == serial
+    assert serial['Saúde'] == 1
@@ -0,0 +1,107 @@
+"""Roteamento por tarefa/tamanho e circuit breaker do modelo"""
+
+import pytest
+
+import llm_gate
+import model_routing
+from model_routing import ModelRouter
+
+CONFIG = {
+    'routes': [
+        {'task': 'standardize', 'model': 'gpt-4o-mini'},
+        {'task': 'grouping', 'max_items': 15, 'model': 'gpt-4o-mini'},
+        {'task': 'grouping'},
+    ],
+    'circuit_breaker': {'failures': 3, 'reset_seconds': 60},
+}
+
+
+class StatusError(Exception):
+    def __init__(self, status_code, message='erro'):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class APIConnectionError(Exception):
+    pass
+
+
+@pytest.fixture
+def router(tmp_path, monkeypatch):
+    monkeypatch.setenv('LLM_JOB_BUDGET_USD', '0')
+    return ModelRouter(str(tmp_path / 'model_routing.db'), config=CONFIG, default_model='gpt-4o')
+
+
+def test_routes_by_task_and_size(router):
+    assert router.route('standardize').model == 'gpt-4o-mini'
+    assert router.route('grouping', 15).model == 'gpt-4o-mini'
+    assert router.route('grouping', 16).model == 'gpt-4o'
+    assert router.route('outra').label() == 'chatgpt:gpt-4o'
+
+
+def test_breaker_opens_after_consecutive_failures_and_resets(router):
+    for _ in range(2):
+        router.record_failure('gpt-4o')
+    assert not router.is_open('gpt-4o')
+    router.record_failure('gpt-4o')
+    assert router.is_open('gpt-4o')
+    route = router.route('grouping', 100)
+    assert route.is_local and route.label() == 'fallback_local:circuito_aberto'
+    # outros modelos seguem normais
+    assert router.route('grouping', 5).model == 'gpt-4o-mini'
+
+    # passado o tempo de espera, a próxima chamada é a de teste; sucesso fecha o circuito
+    router.reset_seconds = 0
+    assert not router.is_open('gpt-4o')
+    router.record_success('gpt-4o')
+    router.reset_seconds = 60
+    router.record_failure('gpt-4o')
+    assert not router.is_open('gpt-4o')
+
+
+@pytest.mark.parametrize('error, transient', [
+    (StatusError(500), True),
+    (StatusError(503), True),
+    (StatusError(429, 'rate_limit_exceeded'), True),
+    (TimeoutError('timed out'), True),
+    (APIConnectionError('conexão recusada'), True),
+    (StatusError(400, 'context_length_exceeded'), False),
+    (StatusError(401, 'invalid_api_key'), False),
+    (StatusError(404, 'model_not_found'), False),
+    (StatusError(429, 'insufficient_quota'), False),
+    (TypeError('parâmetro inesperado'), False),
+])
+def test_only_transient_failures_count(error, transient):
+    assert model_routing.is_transient_failure(error) is transient
+
+
+def test_chat_completion_trips_the_breaker_only_on_transient_errors(coding_system, router, monkeypatch):
+    import improved_coding_system
+
+    errors = []
+
+    class Completions:
+        def create(self, **body):
+            raise errors.pop(0)
+
+    class Client:
+        chat = type('Chat', (), {'completions': Completions()})()
+
+    monkeypatch.setattr(model_routing, '_router', router)
+    monkeypatch.setattr(llm_gate, 'LLM_MAX_CONCURRENCY', 0)
+    monkeypatch.setattr(llm_gate, 'LLM_MAX_RETRIES', 0)
+    monkeypatch.setattr(improved_coding_system, 'get_openai_client', lambda **kwargs: Client())
+    route = model_routing.Route('grouping', 'gpt-4o')
+    messages = [{'role': 'user', 'content': 'teste'}]
+
+    errors.extend([StatusError(401, 'invalid_api_key')] * 5)
+    for _ in range(5):
+        with pytest.raises(StatusError):
+            coding_system._chat_completion('grouping', messages, route=route)
+    assert not router.is_open('gpt-4o')
+
+    errors.extend([StatusError(502)] * 3)
+    for _ in range(3):
+        with pytest.raises(StatusError):
+            coding_system._chat_completion('grouping', messages, route=route)
+    assert router.is_open('gpt-4o')
@@ -0,0 +1,95 @@
+"""Empacotamento de questões pequenas: planejamento (plan_packs) e execução (run_pack)"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import request_packing
+from batch_submission import DeferredCall
+from request_packing import plan_packs, question_tokens, run_pack
+
+
+def question(name, n, f17=()):
+    return {'name': name, 'responses': [f"resposta {name} {i}" for i in range(n)], 'f17': list(f17)}
+
+
+def completion(payload):
+    message = SimpleNamespace(content=json.dumps(payload, ensure_ascii=False), tool_calls=None, function_call=None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_plan_packs_first_fit_within_budget(monkeypatch):
+    monkeypatch.setattr(request_packing, 'PACK_MAX_ITEMS', 5)
+    monkeypatch.setattr(request_packing, 'PACK_MAX_QUESTIONS', 2)
+    questions = [question('P1', 3), question('P2', 0), question('P3', 2), question('P4', 20),
+                 question('P5', 4), question('P6', 1), question('P7', 5)]
+
+    packs = plan_packs(questions)
+    # sem respostas ou acima de PACK_MAX_ITEMS: caminho individual; pacote de uma questão só também
+    assert [[q['name'] for q in pack] for pack in packs] == [['P1', 'P3'], ['P5', 'P6']]
+
+
+def test_plan_packs_respects_the_token_budget(monkeypatch):
+    questions = [question('P1', 4), question('P2', 4), question('P3', 4)]
+    monkeypatch.setattr(request_packing, 'PACK_TOKEN_BUDGET', 2 * question_tokens(questions[0]))
+    assert [[q['name'] for q in pack] for pack in plan_packs(questions)] == [['P1', 'P2']]
+    # questão que sozinha estoura o orçamento não entra em pacote
+    monkeypatch.setattr(request_packing, 'PACK_TOKEN_BUDGET', question_tokens(questions[0]) - 1)
+    assert plan_packs(questions) == []
+
+
+@pytest.fixture
+def packing_system(coding_system, tmp_path, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-teste')
+    monkeypatch.setenv('RESULTS_FOLDER', str(tmp_path))
+    return coding_system
+
+
+def test_pack_results_are_reused_by_the_single_question_call(packing_system, monkeypatch):
+    p1, p2 = question('P1', 2, ['1 - Saúde']), question('P2', 2)
+    calls = []
+
+    def chat_completion(kind, messages, route=None, **kwargs):
+        calls.append(kind)
+        return completion({'questions': [
+            {'questao': 'P1', 'groups': [{'codigo': 1, 'titulo': 'Saúde', 'respostas': p1['responses']}]},
+            {'questao': 'Desconhecida', 'groups': []},
+        ]})
+
+    monkeypatch.setattr(packing_system, '_chat_completion', chat_completion)
+    results = run_pack(packing_system, [p1, p2])
+
+    assert calls == ['grouping_pack']
+    # P2 não veio na resposta: segue pelo caminho individual
+    assert list(results) == ['P1']
+    codes, groups = results['P1']
+    assert groups['Saúde'] == p1['responses'] and codes['Saúde'] == 1
+    # a chamada individual da questão encontra o agrupamento no cache
+    assert packing_system.group_with_chatgpt(p1['responses'], p1['f17']) == results['P1']
+    assert calls == ['grouping_pack']
+
+
+def test_failed_or_deferred_pack_falls_back_to_single_questions(packing_system, monkeypatch):
+    pack = [question('P1', 2), question('P2', 2)]
+
+    def overloaded(kind, messages, route=None, **kwargs):
+        raise Exception('Error code: 500 - servidor indisponível')
+
+    monkeypatch.setattr(packing_system, '_chat_completion', overloaded)
+    assert run_pack(packing_system, pack) == {}
+
+    def deferred(kind, messages, route=None, **kwargs):
+        raise DeferredCall('adiada para o batch')
+
+    monkeypatch.setattr(packing_system, '_chat_completion', deferred)
+    assert run_pack(packing_system, pack) == {}
+
+    # resposta fora do formato também cai no caminho individual
+    monkeypatch.setattr(packing_system, '_chat_completion', lambda *args, **kwargs: completion({'grupos': []}))
+    assert run_pack(packing_system, pack) == {}
+
+
+def test_programming_errors_in_the_pack_are_not_hidden(packing_system):
+    with pytest.raises(KeyError):
+        run_pack(packing_system, [{'name': 'P1', 'responses': ['a']}, {'name': 'P2', 'responses': ['b']}])
@@ -0,0 +1,85 @@
+"""Chaves de cache por conteúdo (questão e envio) e reaproveitamento de envios idênticos"""
+
+import os
+
+import numpy as np
+from openpyxl import Workbook
+
+from checkpoint_store import CheckpointStore
+
+
+def write_xlsx(path, rows):
+    wb = Workbook()
+    ws = wb.active
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+    return str(path)
+
+
+def test_question_key_follows_the_content(tmp_path):
+    store = CheckpointStore(str(tmp_path), version='v1')
+    key = store.key_for('P1', ['saude', None, 3], {'Saúde': 1})
+
+    # ausentes e tipos numpy em forma canônica; ordem do codebook não importa
+    assert store.key_for('P1', ['saude', float('nan'), np.int64(3)], {'Saúde': 1}) == key
+    assert store.key_for('P1', ['saude', None, 3], {'Saúde': 1, 'Educação': 2}) == \
+        store.key_for('P1', ['saude', None, 3], {'Educação': 2, 'Saúde': 1})
+
+    assert store.key_for('P2', ['saude', None, 3], {'Saúde': 1}) != key
+    assert store.key_for('P1', ['saude', None, 4], {'Saúde': 1}) != key
+    assert store.key_for('P1', ['saude', None, 3], {'Saúde': 2}) != key
+    assert store.key_for('P1', ['saude', None, 3], {'Saúde': 1}, {'saude': 'saúde'}) != key
+    assert CheckpointStore(str(tmp_path), version='v2').key_for('P1', ['saude', None, 3], {'Saúde': 1}) != key
+
+
+def test_upload_key_and_saved_package(tmp_path):
+    store = CheckpointStore(str(tmp_path / 'checkpoints'), version='v1')
+    banco = tmp_path / 'banco.xlsx'
+    f17 = tmp_path / 'f17.xlsx'
+    banco.write_bytes(b'banco')
+    f17.write_bytes(b'f17')
+
+    key = store.upload_key(str(banco), str(f17), 'per_question')
+    assert store.upload_key(str(banco), str(f17), 'consolidated') != key
+    assert CheckpointStore(str(tmp_path / 'checkpoints'), version='v2').upload_key(str(banco), str(f17), 'per_question') != key
+    assert store.load_upload(key) is None
+
+    result_zip = tmp_path / 'resultado.zip'
+    result_zip.write_bytes(b'PK-zip')
+    manifest = {'questions': [{'index': 0, 'question': 'P1', 'summary': 'resumo', 'files': ['000_P1_banco.xlsx']}]}
+    store.save_upload(key, str(result_zip), manifest)
+    # o resultado da tarefa pode expirar sem levar o pacote guardado
+    os.remove(result_zip)
+
+    zip_path, loaded = store.load_upload(key)
+    assert loaded == manifest
+    with open(zip_path, 'rb') as f:
+        assert f.read() == b'PK-zip'
+
+    banco.write_bytes(b'banco alterado')
+    assert store.upload_key(str(banco), str(f17), 'per_question') != key
+
+
+def test_identical_upload_reuses_the_previous_package(web, tmp_path, monkeypatch):
+    banco = write_xlsx(tmp_path / 'banco.xlsx', [['P1', 'P2'], [1, 2], [2, 1], [1, 99]])
+    f17 = write_xlsx(tmp_path / 'f17.xlsx', [['Código', 'Descrição']])
+    web.task_store.create('t1', state='PENDING')
+    web.process_batch_task('t1', banco, f17, output_mode='per_question')
+    first = web.task_store.get('t1')
+
+    def no_reading(*args, **kwargs):
+        raise AssertionError('envio idêntico abriu as planilhas')
+
+    monkeypatch.setattr(web, 'plan_packs', no_reading)
+    monkeypatch.setattr(web.agent, 'process_single_question_with_chatgpt', no_reading)
+    web.task_store.create('t2', state='PENDING')
+    web.process_batch_task('t2', banco, f17, output_mode='per_question')
+
+    second = web.task_store.get('t2')
+    assert second['state'] == 'COMPLETED' and 'reaproveitado' in second['status']
+    assert second['artifacts'] == first['artifacts']
+    assert second['results_summary'] == first['results_summary']
+    with open(os.path.join(web.RESULTS_FOLDER, first['result_file']), 'rb') as a, \
+            open(os.path.join(web.RESULTS_FOLDER, second['result_file']), 'rb') as b:
+        assert a.read() == b.read()
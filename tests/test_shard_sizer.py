@@ -0,0 +1,66 @@
+"""Orçamento aprendido (observe) e divisão em blocos (plan) do ShardSizer"""
+
+import pytest
+
+import shard_sizer
+from shard_sizer import ShardSizer, output_tokens
+
+MODEL = 'gpt-4o-mini'
+
+
+@pytest.fixture
+def sizer(tmp_path, monkeypatch):
+    monkeypatch.setattr(shard_sizer, 'SHARD_OUTPUT_TOKEN_BUDGET', 2000)
+    monkeypatch.setattr(shard_sizer, 'SHARD_MIN_OUTPUT_TOKENS', 200)
+    monkeypatch.setattr(shard_sizer, 'SHARD_PROMPT_TOKEN_BUDGET', 60000)
+    monkeypatch.setattr(shard_sizer, 'SHARD_DROP_TOLERANCE', 0.01)
+    return ShardSizer(str(tmp_path / 'shard_stats.db'))
+
+
+def items(n):
+    return [f"resposta numero {i} sobre o atendimento no posto de saude" for i in range(n)]
+
+
+def test_small_list_is_a_single_shard(sizer):
+    assert sizer.plan(items(5), MODEL) == [items(5)]
+    assert sizer.plan([], MODEL) == []
+
+
+def test_long_list_is_split_in_order_within_budget(sizer):
+    responses = items(300)
+    shards = sizer.plan(responses, MODEL)
+    assert len(shards) > 1
+    assert [r for shard in shards for r in shard] == responses
+    assert all(output_tokens(shard) <= 2000 * 1.05 for shard in shards)
+
+
+def test_drops_shrink_the_budget_and_the_shards(sizer):
+    responses = items(300)
+    before = len(sizer.plan(responses, MODEL))
+    # o modelo devolveu só metade de um bloco de ~1800 tokens
+    sizer.observe(MODEL, sent=100, missing=50, estimated_output_tokens=1800)
+    stats = sizer.stats(MODEL)
+    assert stats['output_budget'] == pytest.approx(1800 * 0.5 * 0.9)
+    assert stats['drop_rate'] == 0.5 and stats['samples'] == 1
+    assert len(sizer.plan(responses, MODEL)) > before
+    # outros modelos não são afetados
+    assert sizer.stats('gpt-4o')['output_budget'] == 2000
+
+
+def test_budget_never_goes_below_the_floor(sizer):
+    sizer.observe(MODEL, sent=10, missing=9, estimated_output_tokens=300)
+    assert sizer.stats(MODEL)['output_budget'] == 200
+
+
+def test_full_shards_without_drops_grow_back_to_the_ceiling(sizer):
+    sizer.observe(MODEL, sent=100, missing=50, estimated_output_tokens=1800)
+    budget = sizer.stats(MODEL)['output_budget']
+    sizer.observe(MODEL, sent=50, missing=0, estimated_output_tokens=int(budget))
+    assert sizer.stats(MODEL)['output_budget'] == pytest.approx(budget * 1.1)
+    # bloco pequeno (abaixo de 80% do orçamento) não é evidência de folga
+    grown = sizer.stats(MODEL)['output_budget']
+    sizer.observe(MODEL, sent=5, missing=0, estimated_output_tokens=50)
+    assert sizer.stats(MODEL)['output_budget'] == grown
+    for _ in range(50):
+        sizer.observe(MODEL, sent=100, missing=0, estimated_output_tokens=2000)
+    assert sizer.stats(MODEL)['output_budget'] == 2000
@@ -0,0 +1,54 @@
+"""Agrupamento em blocos paralelos (_group_in_shards)"""
+
+import threading
+
+import pytest
+
+import llm_gate
+import model_routing
+
+
+class FixedSizer:
+    """Sizer que divide a lista em blocos de tamanho fixo (sem estatísticas em disco)"""
+
+    def __init__(self, size):
+        self.size = size
+        self.observed = []
+
+    def plan(self, items, model, f17=None, prefix_tokens=0):
+        return [items[i:i + self.size] for i in range(0, len(items), self.size)]
+
+    def observe(self, model, sent, missing, estimated_output_tokens):
+        self.observed.append((sent, missing))
+
+
+@pytest.fixture
+def agent(tmp_path, monkeypatch):
+    monkeypatch.setenv('CACHE_DB_PATH', str(tmp_path / 'cache.db'))
+    from final_ipo_agent_improved import FinalIPOAgentImproved
+    return FinalIPOAgentImproved()
+
+
+def test_shard_threads_keep_the_interactive_priority(agent, monkeypatch):
+    import shard_sizer
+
+    monkeypatch.setattr(shard_sizer, 'get_sizer', lambda: FixedSizer(2))
+    seen = []
+
+    def group_with_chatgpt(shard, f17=None, route=None):
+        seen.append((threading.get_ident(), llm_gate.current_priority()))
+        return {f"grupo {shard[0]}": 10}, {f"grupo {shard[0]}": list(shard)}
+
+    monkeypatch.setattr(agent.coding_system, 'group_with_chatgpt', group_with_chatgpt)
+    items = ['saude', 'educacao', 'seguranca', 'emprego', 'transporte', 'lazer']
+    route = model_routing.Route('grouping', 'gpt-4o-mini')
+
+    with llm_gate.priority(llm_gate.INTERACTIVE):
+        codes, groups = agent._group_in_shards(items, [], {}, route)
+
+    assert len(seen) == 3
+    assert threading.get_ident() not in {ident for ident, _ in seen}
+    assert {level for _, level in seen} == {llm_gate.INTERACTIVE}
+    assert sorted(r for respostas in groups.values() for r in respostas) == sorted(items)
+    # código novo repetido entre blocos é renumerado
+    assert sorted(codes.values()) == [10, 11, 12]
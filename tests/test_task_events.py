@@ -0,0 +1,77 @@
+"""Progresso da tarefa: stream SSE (/task_events) e /task_status?since=N"""
+
+import json
+
+
+def parse_sse(body):
+    """Lista de (id, tipo, dados) das mensagens do stream (ignora retry e keepalive)"""
+    messages = []
+    for block in body.strip().split('\n\n'):
+        fields = dict(line.split(': ', 1) for line in block.split('\n') if not line.startswith(('retry:', ':')))
+        if 'event' in fields:
+            messages.append((int(fields['id']) if 'id' in fields else None, fields['event'], json.loads(fields['data'])))
+    return messages
+
+
+def run_task(store):
+    store.create('t1', state='PROCESSING', status='Iniciando', progress=0, work_dir='/tmp/privado')
+    store.update('t1', progress=50, status='Processando P1')
+    store.set_question_result('t1', 0, 'P1', summary='resumo P1', files=['000_P1_banco.xlsx'])
+    store.update('t1', state='COMPLETED', progress=100, result_file='resultado.zip')
+
+
+def test_first_connection_gets_a_snapshot_and_ends_on_final_state(web):
+    run_task(web.task_store)
+    response = web.app.test_client().get('/task_events/t1')
+    assert response.mimetype == 'text/event-stream'
+    assert response.headers['Cache-Control'] == 'no-cache'
+
+    messages = parse_sse(response.get_data(as_text=True))
+    assert [kind for _, kind, _ in messages] == ['snapshot']
+    seq, _, snapshot = messages[0]
+    assert seq == web.task_store.last_event_seq('t1')
+    assert snapshot['state'] == 'COMPLETED' and snapshot['results_summary'] == ['resumo P1']
+    assert 'work_dir' not in snapshot
+
+
+def test_reconnection_replays_only_the_missed_events(web):
+    run_task(web.task_store)
+    first_seq = web.task_store.events_since('t1')[0]['seq']
+    response = web.app.test_client().get('/task_events/t1', headers={'Last-Event-ID': str(first_seq)})
+
+    messages = parse_sse(response.get_data(as_text=True))
+    assert [kind for _, kind, _ in messages] == ['progress', 'question', 'state']
+    assert [seq for seq, _, _ in messages] == sorted(seq for seq, _, _ in messages)
+    assert messages[1][2] == {'index': 0, 'question': 'P1', 'summary': 'resumo P1', 'files': ['000_P1_banco.xlsx']}
+    assert messages[-1][2]['state'] == 'COMPLETED'
+
+
+def test_running_task_stream_is_bounded(web, monkeypatch):
+    monkeypatch.setattr(web, 'SSE_POLL_SECONDS', 0.01)
+    monkeypatch.setattr(web, 'SSE_MAX_SECONDS', 0.05)
+    web.task_store.create('t1', state='PROCESSING', progress=0)
+    messages = parse_sse(web.app.test_client().get('/task_events/t1').get_data(as_text=True))
+    # sem novos eventos a conexão fecha e o navegador reconecta
+    assert [kind for _, kind, _ in messages] == ['snapshot']
+
+
+def test_unknown_task_stream_reports_an_error(web):
+    messages = parse_sse(web.app.test_client().get('/task_events/desconhecida').get_data(as_text=True))
+    assert messages == [(None, 'state', {'state': 'ERROR', 'error': 'Tarefa não encontrada'})]
+
+
+def test_task_status_since_returns_only_the_changes(web):
+    client = web.app.test_client()
+    web.task_store.create('t1', state='PROCESSING', status='Iniciando', progress=0, work_dir='/tmp/privado')
+    full = client.get('/task_status/t1').get_json()
+    assert full['state'] == 'PROCESSING' and 'work_dir' not in full
+
+    web.task_store.update('t1', progress=50)
+    web.task_store.set_question_result('t1', 0, 'P1', summary='resumo P1')
+    changes = client.get(f"/task_status/t1?since={full['seq']}").get_json()
+    assert changes['progress'] == 50 and 'status' not in changes
+    assert changes['questions'] == [{'index': 0, 'question': 'P1', 'summary': 'resumo P1'}]
+    assert changes['seq'] == web.task_store.last_event_seq('t1')
+
+    # nada mudou: só o seq atual
+    assert client.get(f"/task_status/t1?since={changes['seq']}").get_json() == {'seq': changes['seq']}
@@ -0,0 +1,69 @@
+"""SQLiteTaskStore e InMemoryTaskStore: mesmo comportamento visível pela API"""
+
+import pytest
+
+from task_store import InMemoryTaskStore, SQLiteTaskStore
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def store(request, tmp_path):
+    if request.param == 'sqlite':
+        return SQLiteTaskStore(str(tmp_path / 'tasks.db'))
+    return InMemoryTaskStore()
+
+
+def test_create_get_and_question_results(store):
+    store.create('t1', state='PROCESSING', status='Iniciando', progress=0, output_mode='per_question')
+    store.set_question_result('t1', 1, 'P2', summary='resumo P2')
+    store.set_question_result('t1', 0, 'P1', summary='resumo P1', files=['P1/banco.xlsx'])
+    store.set_question_result('t1', 1, 'P2', files=['P2/banco.xlsx'])
+
+    task = store.get('t1')
+    assert task['state'] == 'PROCESSING' and task['output_mode'] == 'per_question'
+    assert task['results_summary'] == ['resumo P1', 'resumo P2']
+    assert [a['files'] for a in task['artifacts']] == [['P1/banco.xlsx'], ['P2/banco.xlsx']]
+    assert store.get('desconhecida') is None
+
+
+def test_update_replaces_top_level_fields(store):
+    store.create('t1', state='PROCESSING', usage={'calls': {'x': 1, 'y': 2}}, note='a')
+    store.update('t1', usage={'calls': {'x': 3}})
+    store.update('t1', note=None, progress=50)
+
+    task = store.get('t1')
+    assert task['usage'] == {'calls': {'x': 3}}
+    assert 'note' not in task
+    assert task['progress'] == 50
+
+
+def test_each_update_publishes_its_event(store):
+    store.create('t1', state='PROCESSING', work_dir='/tmp/privado')
+    store.update('t1', progress=10, status='Processando P1')
+    store.update('t1', state='COMPLETED', progress=100)
+    store.heartbeat('t1')
+
+    events = store.events_since('t1')
+    assert [e['kind'] for e in events] == ['state', 'progress', 'state']
+    assert 'work_dir' not in events[0]['data']
+    assert events[1]['data'] == {'progress': 10, 'status': 'Processando P1'}
+    assert store.changes_since('t1', events[0]['seq']) == {
+        'progress': 100, 'status': 'Processando P1', 'state': 'COMPLETED', 'seq': events[-1]['seq']}
+    assert store.last_event_seq('t1') == events[-1]['seq']
+
+
+def test_sqlite_update_and_event_commit_together(tmp_path, monkeypatch):
+    store = SQLiteTaskStore(str(tmp_path / 'tasks.db'))
+    store.create('t1', state='PROCESSING', progress=0)
+    seq = store.last_event_seq('t1')
+
+    def broken_record(conn, task_id, kind, data):
+        raise RuntimeError('falha ao gravar o evento')
+
+    monkeypatch.setattr(SQLiteTaskStore, '_record', staticmethod(broken_record))
+    with pytest.raises(RuntimeError):
+        store.update('t1', progress=50)
+    monkeypatch.undo()
+
+    # sem evento, a atualização também não fica visível
+    assert store.get('t1')['progress'] == 0
+    assert store.last_event_seq('t1') == seq
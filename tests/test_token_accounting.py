@@ -0,0 +1,129 @@
+"""Prefixo estável das mensagens e contabilidade de tokens por chamada, questão e job"""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import llm_gate
+import model_routing
+import token_accounting
+from token_accounting import UsageMeter, estimate_messages_tokens, estimate_tokens, metering, usage_counts
+
+
+def response_with_usage(prompt, completion, cached=0, content='ok'):
+    usage = SimpleNamespace(prompt_tokens=prompt, completion_tokens=completion,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=cached))
+    message = SimpleNamespace(content=content, tool_calls=None, function_call=None)
+    return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+
+@pytest.fixture
+def router(tmp_path, monkeypatch):
+    router = model_routing.ModelRouter(str(tmp_path / 'model_routing.db'), default_model='gpt-4o')
+    monkeypatch.setattr(model_routing, '_router', router)
+    return router
+
+
+def test_grouping_messages_share_a_stable_prefix(coding_system):
+    first = coding_system._grouping_messages(['saude', 'educacao'], ['1 - Saúde'])
+    second = coding_system._grouping_messages(['transporte'], ['1 - Transporte', '2 - Emprego'])
+
+    assert [m['role'] for m in first] == ['system', 'user', 'user']
+    # prompt de sistema + regras fixas idênticos: o provedor reaproveita o prefixo em cache
+    assert first[0] == second[0]
+    assert 'Saúde' not in first[0]['content'] and 'saude' not in first[0]['content']
+    assert first[1]['content'] == 'F17 (codebook):\n1 - Saúde'
+    assert first[2]['content'].endswith('1. saude\n2. educacao')
+    # mesma questão, mesmas mensagens (também são a chave do cache local)
+    assert coding_system._grouping_messages(['saude', 'educacao'], ['1 - Saúde']) == first
+
+
+def test_standardization_phrase_goes_after_the_fixed_prompt(coding_system, router, monkeypatch):
+    monkeypatch.setenv('OPENAI_API_KEY', 'sk-teste')
+    sent = []
+
+    def chat_completion(kind, messages, route=None, **kwargs):
+        sent.append(messages)
+        return response_with_usage(10, 2, content=messages[-1]['content'].capitalize())
+
+    monkeypatch.setattr(coding_system, '_chat_completion', chat_completion)
+    assert coding_system.standardize_with_chatgpt('posto de saude') == 'Posto de saude'
+    coding_system.standardize_with_chatgpt('escola longe')
+
+    assert sent[0][0] == sent[1][0] and sent[0][0]['role'] == 'system'
+    assert [m['content'] for m in sent[0][1:]] == ['posto de saude']
+    # repetida: vem do cache local
+    coding_system.standardize_with_chatgpt('posto de saude')
+    assert len(sent) == 2
+
+
+def test_usage_counts_from_objects_and_dicts():
+    assert usage_counts(response_with_usage(100, 20, 64)) == {'prompt_tokens': 100, 'completion_tokens': 20, 'cached_tokens': 64}
+    as_dict = SimpleNamespace(usage={'prompt_tokens': 7, 'completion_tokens': 3})
+    assert usage_counts(as_dict) == {'prompt_tokens': 7, 'completion_tokens': 3, 'cached_tokens': 0}
+    assert usage_counts(SimpleNamespace()) == {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+
+
+def test_estimates_grow_with_the_content():
+    assert 0 < estimate_tokens('saude') < estimate_tokens('saude ' * 50)
+    short = [{'role': 'user', 'content': 'saude'}]
+    assert estimate_messages_tokens(short + short) > estimate_messages_tokens(short)
+
+
+def test_nested_meters_and_pool_threads(monkeypatch):
+    monkeypatch.setattr(token_accounting, '_model_prices', {})
+    messages = [{'role': 'user', 'content': 'teste'}]
+    with metering() as job:
+        with metering() as question:
+            token_accounting.record_call('grouping', 'gpt-4o', messages, response_with_usage(1000, 100, 400))
+            token_accounting.record_cache_hit()
+        # thread do pool de colunas: soma no job pelo contexto copiado
+        thread = threading.Thread(target=token_accounting.in_context(
+            lambda: token_accounting.record_call('standardize', 'gpt-4o', messages, response_with_usage(50, 5))))
+        thread.start()
+        thread.join()
+        assert token_accounting.job_cost_usd() == job.summary()['cost_usd']
+    # fora de medição: nada é somado
+    token_accounting.record_call('grouping', 'gpt-4o', messages, response_with_usage(1, 1))
+
+    assert question.summary()['calls'] == 1 and question.summary()['cache_hits'] == 1
+    summary = job.summary(responses=500)
+    assert summary['calls'] == 2 and summary['prompt_tokens'] == 1050 and summary['cached_tokens'] == 400
+    assert summary['by_kind']['grouping'] == {'calls': 1, 'prompt_tokens': 1000, 'completion_tokens': 100, 'cached_tokens': 400}
+    expected = (600 * 2.50 + 400 * 1.25 + 100 * 10.00 + 50 * 2.50 + 5 * 10.00) / 1_000_000
+    assert summary['cost_usd'] == pytest.approx(expected)
+    assert summary['cost_per_1000_responses'] == pytest.approx(expected * 2, abs=1e-6)
+
+
+def test_cost_uses_the_model_price_and_the_batch_discount(monkeypatch):
+    monkeypatch.setattr(token_accounting, '_model_prices', {})
+    token_accounting.set_model_price('gpt-4o-mini', {'input': 0.15, 'output': 0.60})
+    counts = {'prompt_tokens': 1_000_000, 'completion_tokens': 1_000_000, 'cached_tokens': 0}
+
+    meter = UsageMeter()
+    meter.add('grouping', counts, 0, model='gpt-4o-mini')
+    meter.add('grouping', counts, 0, batch=True, model='gpt-4o-mini')
+    meter.add('grouping', counts, 0, model='desconhecido')
+    assert meter.summary()['cost_usd'] == pytest.approx(0.75 + 0.375 + 12.50)
+    assert meter.summary()['batch_calls'] == 1
+
+
+def test_chat_completion_records_the_call_usage(coding_system, router, monkeypatch):
+    import improved_coding_system
+
+    class Completions:
+        def create(self, **body):
+            return response_with_usage(120, 30, 100)
+
+    class Client:
+        chat = type('Chat', (), {'completions': Completions()})()
+
+    monkeypatch.setattr(llm_gate, 'LLM_MAX_CONCURRENCY', 0)
+    monkeypatch.setattr(improved_coding_system, 'get_openai_client', lambda **kwargs: Client())
+    with metering() as meter:
+        coding_system._chat_completion('grouping', [{'role': 'user', 'content': 'teste'}],
+                                       route=model_routing.Route('grouping', 'gpt-4o'))
+    summary = meter.summary()
+    assert summary['calls'] == 1 and summary['prompt_tokens'] == 120 and summary['cached_tokens'] == 100
+    assert summary['estimated_prompt_tokens'] > 0
@@ -0,0 +1,202 @@
+"""
+Contabilidade de tokens das chamadas ao LLM
+- Estimativa offline de tokens (tiktoken quando instalado; senão ~4 caracteres por token)
+- Cada chamada registra tokens de prompt, de completion e de prompt em cache no provedor
+  (usage da API), além da estimativa feita antes do envio
+- Medidores aninhados: um por job (lote inteiro) e um por questão; a chamada é somada em
+  todos os medidores ativos no contexto
+- O contexto segue para as threads do pool de colunas via in_context()
+- Custo estimado pelos preços por 1M de tokens do modelo de cada chamada (bloco 'price' da rota em
+  config/model_routing.json; modelos sem preço usam LLM_PRICE_*), para acompanhar a meta de custo
+  por 1000 respostas (docs/logica_negocio.md)
+"""
+
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Preços em US$ por 1M de tokens dos modelos sem preço configurado (padrão: gpt-4o)
+PRICE_INPUT_PER_1M = float(os.getenv('LLM_PRICE_INPUT_PER_1M', 2.50))
+PRICE_CACHED_INPUT_PER_1M = float(os.getenv('LLM_PRICE_CACHED_INPUT_PER_1M', 1.25))
+PRICE_OUTPUT_PER_1M = float(os.getenv('LLM_PRICE_OUTPUT_PER_1M', 10.00))
+# Fração do preço cobrada nas respostas vindas da API de batch (batch_submission.py)
+BATCH_PRICE_FACTOR = float(os.getenv('LLM_BATCH_PRICE_FACTOR', 0.5))
+
+# Tokens fixos por mensagem no formato de chat (papel + delimitadores)
+_MESSAGE_OVERHEAD_TOKENS = 4
+
+_encodings: Dict[str, Any] = {}
+# Preços por modelo ({'input', 'cached_input', 'output'} por 1M de tokens), registrados pelo roteador
+_model_prices: Dict[str, Dict[str, float]] = {}
+_prices_lock = threading.Lock()
+_active_meters: contextvars.ContextVar = contextvars.ContextVar('token_meters', default=())
+
+
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            _encodings[model] = tiktoken.encoding_for_model(model)
+        except Exception:
+            _encodings[model] = tiktoken.get_encoding('o200k_base')
+    return _encodings[model]
+
+
+def estimate_tokens(text: str, model: str = 'gpt-4o') -> int:
+    """Tokens de um texto, sem chamar a API"""
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def estimate_messages_tokens(messages: List[Dict[str, Any]], model: str = 'gpt-4o') -> int:
+    """Tokens de prompt de uma lista de mensagens de chat"""
+    return sum(estimate_tokens(str(m.get('content') or ''), model) + _MESSAGE_OVERHEAD_TOKENS for m in messages) + 3
+
+
+def set_model_price(model: str, price: Dict[str, Any]):
+    """Preços por 1M de tokens de um modelo; campos ausentes usam LLM_PRICE_*"""
+    with _prices_lock:
+        _model_prices[model] = {
+            'input': float(price.get('input', PRICE_INPUT_PER_1M)),
+            'cached_input': float(price.get('cached_input', PRICE_CACHED_INPUT_PER_1M)),
+            'output': float(price.get('output', PRICE_OUTPUT_PER_1M)),
+        }
+
+
+def cost_usd(prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0, model: Optional[str] = None) -> float:
+    price = _model_prices.get(model) if model else None
+    if price is None:
+        price = {'input': PRICE_INPUT_PER_1M, 'cached_input': PRICE_CACHED_INPUT_PER_1M, 'output': PRICE_OUTPUT_PER_1M}
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (uncached * price['input'] + cached_tokens * price['cached_input']
+            + completion_tokens * price['output']) / 1_000_000
+
+
+def _usage_value(usage: Any, name: str) -> int:
+    value = usage.get(name) if isinstance(usage, dict) else getattr(usage, name, None)
+    return int(value or 0)
+
+
+def usage_counts(response: Any) -> Dict[str, int]:
+    """(prompt, completion, cached) informados pela API; zeros quando ausentes"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+    details = usage.get('prompt_tokens_details') if isinstance(usage, dict) else getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': _usage_value(usage, 'prompt_tokens'),
+        'completion_tokens': _usage_value(usage, 'completion_tokens'),
+        'cached_tokens': _usage_value(details, 'cached_tokens') if details is not None else 0,
+    }
+
+
+class UsageMeter:
+    """Totais de tokens de um job ou de uma questão (seguro entre threads)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.batch_calls = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.estimated_prompt_tokens = 0
+        # Custo somado chamada a chamada (preço do modelo; chamadas de batch com BATCH_PRICE_FACTOR)
+        self.cost_usd = 0.0
+        self.by_kind: Dict[str, Dict[str, int]] = {}
+
+    def add(self, kind: str, counts: Dict[str, int], estimated_prompt_tokens: int, batch: bool = False,
+            model: Optional[str] = None):
+        cost = cost_usd(counts['prompt_tokens'], counts['completion_tokens'], counts['cached_tokens'], model)
+        with self._lock:
+            self.calls += 1
+            if batch:
+                self.batch_calls += 1
+                cost *= BATCH_PRICE_FACTOR
+            self.cost_usd += cost
+            self.prompt_tokens += counts['prompt_tokens']
+            self.completion_tokens += counts['completion_tokens']
+            self.cached_tokens += counts['cached_tokens']
+            self.estimated_prompt_tokens += estimated_prompt_tokens
+            kind_totals = self.by_kind.setdefault(kind, {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0})
+            kind_totals['calls'] += 1
+            for name in ('prompt_tokens', 'completion_tokens', 'cached_tokens'):
+                kind_totals[name] += counts[name]
+
+    def add_cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def summary(self, responses: Optional[int] = None) -> Dict[str, Any]:
+        """Totais + custo estimado (e custo por 1000 respostas, quando informado o total)"""
+        with self._lock:
+            data = {
+                'calls': self.calls,
+                'batch_calls': self.batch_calls,
+                'cache_hits': self.cache_hits,
+                'prompt_tokens': self.prompt_tokens,
+                'completion_tokens': self.completion_tokens,
+                'cached_tokens': self.cached_tokens,
+                'estimated_prompt_tokens': self.estimated_prompt_tokens,
+                'by_kind': {kind: dict(totals) for kind, totals in self.by_kind.items()},
+                'cost_usd': round(self.cost_usd, 6),
+            }
+        if responses:
+            data['responses'] = responses
+            data['cost_per_1000_responses'] = round(data['cost_usd'] * 1000 / responses, 6)
+        return data
+
+
+@contextmanager
+def metering(meter: Optional[UsageMeter] = None):
+    """Ativa um medidor no contexto atual (somado aos já ativos)"""
+    meter = meter or UsageMeter()
+    token = _active_meters.set(_active_meters.get() + (meter,))
+    try:
+        yield meter
+    finally:
+        _active_meters.reset(token)
+
+
+def in_context(func: Callable) -> Callable:
+    """Envolve func para rodar (ex.: em outra thread) com os medidores ativos agora"""
+    context = contextvars.copy_context()
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def record_call(kind: str, model: str, messages: List[Dict[str, Any]], response: Any, batch: bool = False) -> Dict[str, int]:
+    """Registra uma chamada respondida pela API (ou pelo batch, com preço de batch) em todos os medidores ativos"""
+    counts = usage_counts(response)
+    estimated = estimate_messages_tokens(messages, model)
+    for meter in _active_meters.get():
+        meter.add(kind, counts, estimated, batch=batch, model=model)
+    print(f"[DEBUG] Tokens ({kind}, {model}{', batch' if batch else ''}): prompt={counts['prompt_tokens']} (cache {counts['cached_tokens']}, "
+          f"estimado {estimated}) completion={counts['completion_tokens']}", flush=True)
+    return counts
+
+
+def job_cost_usd() -> float:
+    """Custo estimado acumulado no medidor mais externo do contexto (o job; 0 fora de medição)"""
+    meters = _active_meters.get()
+    if not meters:
+        return 0.0
+    return meters[0].summary()['cost_usd']
+
+
+def record_cache_hit():
+    """Resposta servida pelo cache local (nenhum token gasto)"""
+    for meter in _active_meters.get():
+        meter.add_cache_hit()
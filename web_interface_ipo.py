@@ -4,9 +4,10 @@ Interface Web Intuitiva para Agente IPO
 - Questão específica (colar dados)
 """
 
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
-import pandas as pd
+from flask import Flask, Request, Response, render_template, request, jsonify, flash, redirect, send_file, url_for
 import os
+import mimetypes
+import json
 import tempfile
 from datetime import datetime
 from werkzeug.utils import secure_filename
@@ -15,18 +16,27 @@ import threading
 import uuid
 import time
 import shutil
-import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
 
 # Carrega variáveis de ambiente do .env
 load_dotenv()
 
 from final_ipo_agent_improved import FinalIPOAgentImproved
-
-app = Flask(__name__)
-
-# Configurações de segurança
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'ipo_agent_secret_key_2025_production')
-app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB
+from f17_loader import F17Workbook
+from banco_reader import BancoReader, SUPPORTED_EXTENSIONS
+from batch_dedup import GlobalResponseTable
+from request_packing import plan_packs, run_pack
+from batch_outputs import (ConsolidatedBatchWriter, StreamingZipArchive, iter_zip_stream, read_partial_entries,
+                           read_zip_entries, render_spooled_question, DEFAULT_OUTPUT_MODE, OUTPUT_MODES)
+from task_store import create_task_store, FINAL_STATES, PRIVATE_FIELDS
+from checkpoint_store import CheckpointStore
+from improved_coding_system import get_openai_client
+import batch_submission
+import job_queue
+import llm_gate
+import model_routing
+import token_accounting
 
 # Configurações de diretório (compatível Windows/Linux)
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER', os.path.join(tempfile.gettempdir(), 'ipo_uploads'))
@@ -34,118 +44,377 @@ RESULTS_FOLDER = os.getenv('RESULTS_FOLDER', os.path.join(tempfile.gettempdir(),
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
 
+class SpoolingRequest(Request):
+    """Grava os arquivos enviados direto no UPLOAD_FOLDER, sem buffer em memória"""
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, prefix='upload_', suffix='.part', delete=False)
+        self.__dict__.setdefault('_spooled_paths', []).append(stream.name)
+        return stream
+
+    def close(self):
+        # Remove arquivos temporários que não foram movidos por save_upload (ex.: upload rejeitado)
+        super().close()
+        for path in self.__dict__.get('_spooled_paths', []):
+            if os.path.exists(path):
+                os.remove(path)
+
+def save_upload(file_storage, dest_path):
+    """Move o arquivo já gravado em disco para o destino (sem copiar quando possível)"""
+    stream_name = getattr(file_storage.stream, 'name', None)
+    if isinstance(stream_name, str) and os.path.dirname(os.path.abspath(stream_name)) == os.path.abspath(UPLOAD_FOLDER):
+        file_storage.stream.flush()
+        file_storage.stream.close()
+        os.replace(stream_name, dest_path)
+    else:
+        file_storage.save(dest_path)
+
+app = Flask(__name__)
+app.request_class = SpoolingRequest
+
+# Configurações de segurança
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'ipo_agent_secret_key_2025_production')
+MAX_UPLOAD_MB = int(os.getenv('MAX_UPLOAD_MB', 500))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(RESULTS_FOLDER, exist_ok=True)
 
 agent = FinalIPOAgentImproved()
 
-# Armazenamento de tarefas em memória (em produção usar Redis/DB)
-tasks = {}
+# Armazenamento de tarefas compartilhado entre processos (SQLite por padrão)
+task_store = create_task_store(os.path.join(RESULTS_FOLDER, 'tasks.db'))
+interrupted = task_store.recover_interrupted()
+if interrupted:
+    print(f"[DEBUG] Tarefas interrompidas por reinício: {len(interrupted)}", flush=True)
+task_store.purge_events()
+
+# Resultados de cada questão concluída (retomada após queda sem reprocessar o que já terminou)
+# e cache de resultados por conteúdo; a versão do pipeline/prompts entra nas chaves
+checkpoints = CheckpointStore(os.getenv('CHECKPOINT_FOLDER', os.path.join(RESULTS_FOLDER, 'checkpoints')),
+                              version=agent.result_version())
+pruned = checkpoints.prune()
+if pruned:
+    print(f"[DEBUG] Checkpoints expirados removidos: {pruned}", flush=True)
+
+# Intervalo de sinalização de tarefa viva durante o processamento
+TASK_HEARTBEAT_SECONDS = int(os.getenv('TASK_HEARTBEAT_SECONDS', 60))
+
+# Número de colunas processadas simultaneamente em cada lote
+BATCH_COLUMN_WORKERS = max(1, int(os.getenv('BATCH_COLUMN_WORKERS', 4)))
+
+# Intervalo de verificação de pedidos de cancelamento durante o processamento
+TASK_CANCEL_POLL_SECONDS = float(os.getenv('TASK_CANCEL_POLL_SECONDS', 3))
+
+def column_representatives(response_table, spool):
+    """Representantes das variantes da coluna no lote (entram na chave do checkpoint)"""
+    return response_table.representatives(spool.value_counts) if response_table is not None else None
+
+def process_batch_column(col_idx, col_name, spool, f17_book, archive, writer=None, on_artifacts=None, cancel_event=None,
+                         response_table=None, pack_future=None):
+    """Processa uma coluna do banco (executada no pool de colunas). Retorna a linha do resumo.
+    on_artifacts(col_idx, col_safe, arquivos, degradado) é chamado assim que os arquivos da questão são
+    gravados; degradado = codificada pelo fallback local por orçamento/circuit breaker (model_routing.py).
+    Com cancel_event sinalizado a coluna não é processada. response_table: tabela global de
+    respostas do lote (ver batch_dedup.py); pack_future: chamada empacotada que já traz o
+    agrupamento desta questão (ver request_packing.py)"""
+    col_safe = str(col_name).strip()
+    if pack_future is not None:
+        # O agrupamento chega pelo cache assim que o pacote termina
+        pack_future.result()
+    if cancel_event is not None and cancel_event.is_set():
+        spool.cleanup()
+        return f"Questão '{col_safe}': Cancelada"
+    # Coluna relida do spool em disco; o arquivo é removido ao final
+    question_data = spool.values()
+    spool.cleanup()
+    print(f"[DEBUG] Coluna '{col_safe}': {spool.row_count} linhas, {spool.unique_count} valores únicos", flush=True)
+    # Codebook da aba correspondente (F17 já carregado e indexado uma única vez)
+    existing_codes = f17_book.codes_for(col_safe)
+    
+    # Processa a questão (falhas ficam isoladas nesta coluna); com checkpoint do mesmo
+    # conteúdo o resultado é reaproveitado sem nova chamada ao LLM
+    try:
+        checkpoint_key = checkpoints.key_for(col_safe, question_data, existing_codes,
+                                             column_representatives(response_table, spool))
+        result = checkpoints.load(checkpoint_key)
+        cached = result is not None
+        if cached:
+            print(f"[DEBUG] Coluna '{col_safe}': resultado recuperado do checkpoint", flush=True)
+        else:
+            result = agent.process_single_question_with_chatgpt(
+                question_data,
+                existing_codes,
+                col_safe,
+                response_table=response_table
+            )
+        # Resultado do fallback local por orçamento/circuit breaker não vira checkpoint:
+        # o próximo envio volta a tentar o modelo
+        degraded = model_routing.is_degraded(result.get('processing_method'))
+        if not cached and not degraded:
+            checkpoints.save(checkpoint_key, result)
+        
+        if writer is not None:
+            # Modo consolidado: resultado entra nos arquivos únicos do lote
+            writer.add_question(col_idx, result, agent.build_final_f17(result),
+                                agent.create_statistical_summary(result))
+            files = writer.question_filenames(col_idx)
+        else:
+            # Arquivos da questão vão direto para o ZIP do lote (prefixo = posição da coluna);
+            # resultado reaproveitado usa as planilhas já geradas, quando guardadas
+            outputs = checkpoints.load_outputs(checkpoint_key) if cached else None
+            if outputs is None:
+                outputs = agent.render_improved_outputs(result)
+                if not degraded:
+                    checkpoints.save_outputs(checkpoint_key, outputs)
+            files = []
+            for filename, content in outputs.values():
+                archive.add_bytes(f"{col_idx:03d}_{filename}", content)
+                files.append(f"{col_idx:03d}_{filename}")
+        if on_artifacts is not None:
+            on_artifacts(col_idx, col_safe, files, degraded)
+        return f"Questão '{col_safe}': Sucesso ({result['question_type']})"
+        
+    except Exception as e:
+        print(f"Erro ao processar questão {col_safe}: {e}")
+        if writer is not None:
+            writer.skip_question(col_idx)
+        return f"Questão '{col_safe}': Erro - {str(e)}"
+
+def complete_from_upload_cache(task_id, output_mode, cached_zip, manifest):
+    """Conclui a tarefa com o pacote de um envio idêntico já processado"""
+    zip_filename = f"resultado_completo_{task_id}.zip"
+    zip_path = os.path.join(RESULTS_FOLDER, zip_filename)
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+    try:
+        os.link(cached_zip, zip_path)
+    except OSError:
+        shutil.copyfile(cached_zip, zip_path)
+    for question in manifest['questions']:
+        task_store.set_question_result(task_id, question['index'], question['question'],
+                                       summary=question.get('summary'), files=question.get('files'))
+    task_store.update(task_id, output_mode=output_mode, result_file=zip_filename, progress=100, state='COMPLETED',
+                      status='Concluído com sucesso! (resultado de envio idêntico reaproveitado)')
+
+def collect_batch_requests(spools, f17_book, response_table, packs, session):
+    """Passada de coleta do modo diferido (ver batch_submission.py): roda os pacotes e as questões
+    sem checkpoint; as chamadas ao LLM sem resposta ficam registradas para o próximo batch"""
+    waiting_pack = set()
+    for pack in packs:
+        before = session.pending_count
+        run_pack(agent.coding_system, pack)
+        if session.pending_count > before:
+            # Questões do pacote esperam a resposta do pacote, não vão ao batch individualmente
+            waiting_pack.update(question['index'] for question in pack)
+    for spool in spools:
+        if spool.index in waiting_pack:
+            continue
+        col_safe = str(spool.name).strip()
+        question_data = spool.values()
+        existing_codes = f17_book.codes_for(col_safe)
+        checkpoint_key = checkpoints.key_for(col_safe, question_data, existing_codes,
+                                             column_representatives(response_table, spool))
+        if checkpoints.load(checkpoint_key) is not None:
+            continue
+        try:
+            agent.process_single_question_with_chatgpt(question_data, existing_codes, col_safe,
+                                                       response_table=response_table)
+        except Exception as e:
+            # Chamada adiada (DeferredCall) ou erro: a questão é reprocessada na passada final
+            if not isinstance(e, batch_submission.DeferredCall):
+                print(f"[DEBUG] Coleta do batch: questão {col_safe} com erro ({e})", flush=True)
 
-def process_batch_task(task_id, banco_path, f17_path):
-    """Função executada em thread separada"""
+def process_batch_task(task_id, banco_path, f17_path, output_mode=DEFAULT_OUTPUT_MODE,
+                       execution_mode=batch_submission.DEFAULT_EXECUTION_MODE):
+    """Job 'batch' executado por um worker da fila (job_queue). execution_mode='deferred': as
+    chamadas ao LLM vão pela API de batch do provedor (batch_submission.py)"""
+    archive = None
+    writer = None
+    # Diretório de trabalho da tarefa (cópias parciais e spool do modo consolidado) e spool do
+    # banco: removidos ao final, inclusive em erro (a retomada recomeça do checkpoint)
+    task_dir = os.path.join(RESULTS_FOLDER, task_id)
+    spool_dir = os.path.join(RESULTS_FOLDER, f"{task_id}_spool")
     try:
-        tasks[task_id]['state'] = 'PROCESSING'
-        tasks[task_id]['status'] = 'Lendo arquivos...'
-        tasks[task_id]['progress'] = 5
+        task_store.update(task_id, state='PROCESSING', status='Lendo arquivos...', progress=5)
+        
+        # Envio idêntico a um lote já concluído (hash dos arquivos): pacote reaproveitado sem
+        # abrir as planilhas
+        upload_key = checkpoints.upload_key(banco_path, f17_path, output_mode)
+        cached_upload = checkpoints.load_upload(upload_key)
+        if cached_upload is not None:
+            print(f"[DEBUG] Tarefa {task_id}: envio idêntico já processado, reaproveitando o pacote", flush=True)
+            complete_from_upload_cache(task_id, output_mode, *cached_upload)
+            return
         
-        # Carrega arquivos
+        # Carrega o F17 e abre o banco em streaming (colunas gravadas em spool no disco)
         try:
-            banco_df = pd.read_excel(banco_path)
-            f17_xl = pd.ExcelFile(f17_path)
+            f17_book = F17Workbook.load(f17_path)
+            banco_reader = BancoReader(banco_path, spool_dir=spool_dir)
+            columns = banco_reader.columns
         except Exception as e:
-            raise Exception(f"Erro ao ler arquivos Excel: {str(e)}")
+            raise Exception(f"Erro ao ler arquivos: {str(e)}")
             
-        tasks[task_id]['progress'] = 10
-        total_cols = len(banco_df.columns)
+        task_store.update(task_id, progress=10)
+        total_cols = len(columns)
         processed_count = 0
+        progress_lock = threading.Lock()
         
-        # Diretório para resultados desta tarefa
-        task_dir = os.path.join(RESULTS_FOLDER, task_id)
+        # Sobras de uma execução interrompida são descartadas ao retomar
+        shutil.rmtree(task_dir, ignore_errors=True)
         os.makedirs(task_dir, exist_ok=True)
         
-        results_summary = []
+        # ZIP final montado à medida que as questões terminam (cópias parciais no diretório da
+        # tarefa para os downloads parciais)
+        zip_filename = f"resultado_completo_{task_id}.zip"
+        archive = StreamingZipArchive(os.path.join(RESULTS_FOLDER, zip_filename),
+                                      partial_dir=StreamingZipArchive.partial_dir_for(task_dir))
+        
+        # Modo consolidado: um banco, um F17 e dois relatórios para o lote inteiro
+        writer = None
+        if output_mode == 'consolidated':
+            writer = ConsolidatedBatchWriter(task_dir, columns, base_name=f"lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
         
-        # Itera sobre colunas
-        for col_idx, col_name in enumerate(banco_df.columns):
-            col_safe = str(col_name).strip()
-            tasks[task_id]['status'] = f'Processando questão: {col_safe}'
-            
-            # Tenta encontrar aba correspondente no F17
-            # Procura por match exato ou parcial no nome da aba
-            f17_sheet_name = None
-            for sheet in f17_xl.sheet_names:
-                if str(sheet).strip() == col_safe:
-                    f17_sheet_name = sheet
-                    break
-            
-            # Se não achou exato, tenta conter
-            if not f17_sheet_name:
-                for sheet in f17_xl.sheet_names:
-                    if col_safe in str(sheet) or str(sheet) in col_safe:
-                        f17_sheet_name = sheet
-                        break
+        # Questões concluídas ficam disponíveis para download parcial imediatamente
+        # (em qualquer worker: ZIP e spool ficam em disco, registrados no task_store)
+        task_store.update(task_id, output_mode=output_mode, result_file=zip_filename, work_dir=task_dir)
+        
+        # Resultado por questão, guardado junto do pacote final para reenvios idênticos
+        question_results = {}
+        degraded_questions = set()
+        def register_artifacts(col_idx, col_safe, files, degraded=False):
+            question_results.setdefault(col_idx, {'index': col_idx, 'question': col_safe})['files'] = files
+            if degraded:
+                degraded_questions.add(col_idx)
+            task_store.set_question_result(task_id, col_idx, col_safe, files=files)
+        
+        # Uso do LLM no lote (tokens e custo estimado), publicado no task_status
+        usage = token_accounting.UsageMeter()
+        
+        # Sinaliza periodicamente que a tarefa está viva (questões longas não atualizam o progresso)
+        # e acompanha pedidos de cancelamento feitos pelo /cancel_task
+        heartbeat_stop = threading.Event()
+        cancel_event = threading.Event()
+        def heartbeat():
+            last_beat = time.time()
+            while not heartbeat_stop.wait(TASK_CANCEL_POLL_SECONDS):
+                if not cancel_event.is_set() and task_store.is_cancel_requested(task_id):
+                    print(f"[DEBUG] Cancelamento solicitado para a tarefa {task_id}", flush=True)
+                    cancel_event.set()
+                if time.time() - last_beat >= TASK_HEARTBEAT_SECONDS:
+                    task_store.heartbeat(task_id)
+                    last_beat = time.time()
+        threading.Thread(target=heartbeat, daemon=True).start()
+        
+        try:
+            # Pré-passada: tabela global de respostas únicas de todas as colunas (contagens do
+            # spool, sem reler os valores); textos repetidos entre colunas são normalizados e
+            # triados uma única vez
+            spools = []
+            response_table = GlobalResponseTable(agent.coding_system.normalize_text)
+            for spool in banco_reader.iter_columns():
+                spools.append(spool)
+                response_table.add_column(spool.index, spool.value_counts)
+            print(f"[DEBUG] Tarefa {task_id}: tabela global de respostas {response_table.stats()}", flush=True)
             
-            question_data = banco_df[col_name].tolist()
-            existing_codes = {}
+            # Questões pequenas são agrupadas juntas em chamadas empacotadas (orçamento de tokens)
+            packs = plan_packs([dict(agent.grouping_request(str(spool.name).strip(), spool.value_counts,
+                                                            f17_book.codes_for(str(spool.name).strip()), response_table),
+                                     index=spool.index)
+                                for spool in spools])
             
-            if f17_sheet_name:
-                try:
-                    df_f17 = pd.read_excel(f17_path, sheet_name=f17_sheet_name)
-                    # Assume colunas 0 (código) e 1 (descrição)
-                    if len(df_f17.columns) >= 2:
-                        for _, row in df_f17.iterrows():
-                            try:
-                                code = int(row.iloc[0])
-                                desc = str(row.iloc[1])
-                                existing_codes[desc] = code
-                            except:
-                                continue
-                except Exception as e:
-                    print(f"Erro ao ler aba {f17_sheet_name}: {e}")
+            # Modo diferido: ondas de coleta + batch; a passada final reproduz as respostas do batch
+            batch_session = None
+            if execution_mode == 'deferred':
+                batch_session = batch_submission.BatchSession(task_id)
+                service = batch_submission.get_service(lambda: get_openai_client(api_key=os.getenv("OPENAI_API_KEY")))
+                with token_accounting.metering(usage):
+                    waves = batch_submission.run_waves(
+                        batch_session,
+                        lambda: collect_batch_requests(spools, f17_book, response_table, packs, batch_session),
+                        service, cancel_event, lambda status: task_store.update(task_id, status=status))
+                print(f"[DEBUG] Tarefa {task_id}: {waves} ondas de batch, {batch_session.result_count} respostas", flush=True)
+                task_store.update(task_id, status='Respostas do batch recebidas, gerando resultados...',
+                                  usage=usage.summary(responses=response_table.total_responses))
             
-            # Processa a questão
-            try:
-                result = agent.process_single_question_with_chatgpt(
-                    question_data,
-                    existing_codes,
-                    col_safe
-                )
-                
-                # Salva resultados parciais
-                agent.save_improved_outputs(result, task_dir)
-                results_summary.append(f"Questão '{col_safe}': Sucesso ({result['question_type']})")
-                
-            except Exception as e:
-                print(f"Erro ao processar questão {col_safe}: {e}")
-                results_summary.append(f"Questão '{col_safe}': Erro - {str(e)}")
-            
-            processed_count += 1
-            progress = 10 + (processed_count / total_cols * 80)
-            tasks[task_id]['progress'] = progress
+            # Tokens de todas as chamadas ao LLM do lote (inclusive nas threads do pool)
+            with token_accounting.metering(usage), (batch_session.active() if batch_session else nullcontext()):
+                # Processa colunas em paralelo (são independentes entre si); os pacotes entram primeiro
+                # no pool e cada questão empacotada espera o seu
+                with ThreadPoolExecutor(max_workers=BATCH_COLUMN_WORKERS) as executor:
+                    pack_futures = {}
+                    for pack in packs:
+                        pack_future = executor.submit(token_accounting.in_context(run_pack), agent.coding_system, pack)
+                        for question in pack:
+                            pack_futures[question['index']] = pack_future
+                    futures = {}
+                    for spool in spools:
+                        if cancel_event.is_set():
+                            break
+                        futures[executor.submit(token_accounting.in_context(process_batch_column), spool.index, spool.name,
+                                                spool, f17_book, archive, writer, register_artifacts, cancel_event,
+                                                response_table, pack_futures.get(spool.index))] = spool.index
+                    for future in as_completed(futures):
+                        col_idx = futures[future]
+                        col_safe = str(columns[col_idx]).strip()
+                        try:
+                            summary = future.result()
+                        except Exception as e:
+                            summary = f"Questão '{col_safe}': Erro - {str(e)}"
+                        # Resumo gravado por posição da coluna (ordem determinística no task_status)
+                        task_store.set_question_result(task_id, col_idx, col_safe, summary=summary)
+                        question_results.setdefault(col_idx, {'index': col_idx, 'question': col_safe})['summary'] = summary
+                    
+                        with progress_lock:
+                            processed_count += 1
+                            task_store.update(task_id,
+                                              status=f'Concluída questão: {col_safe} ({processed_count}/{total_cols})',
+                                              progress=10 + (processed_count / total_cols * 80),
+                                              usage=usage.summary(responses=response_table.total_responses))
+        finally:
+            heartbeat_stop.set()
+            banco_reader.cleanup()
             
-        # Finalização: Cria ZIP com tudo
-        tasks[task_id]['status'] = 'Gerando pacote final...'
-        zip_filename = f"resultado_completo_{task_id}.zip"
-        zip_path = os.path.join(RESULTS_FOLDER, zip_filename)
+        # Finalização: arquivos consolidados entram no ZIP
+        task_store.update(task_id, status='Gerando pacote final...')
+        if writer is not None:
+            # Após o fechamento só o ZIP completo está disponível
+            writer.close(archive)
+        archive.close()
         
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            for root, dirs, files in os.walk(task_dir):
-                for file in files:
-                    zipf.write(os.path.join(root, file), file)
-                    
-        # Limpa diretório temporário da tarefa
-        shutil.rmtree(task_dir)
+        if cancel_event.is_set():
+            # Cancelada: o pacote traz só as questões concluídas antes do cancelamento
+            print(f"[DEBUG] Tarefa {task_id} cancelada", flush=True)
+            task_store.update(task_id, result_file=zip_filename, state='CANCELLED',
+                              status='Cancelada', usage=usage.summary(responses=response_table.total_responses))
+            return
+        
+        # Só lotes sem nenhuma questão com erro (nem em fallback local por orçamento/circuit breaker)
+        # entram no cache de envios
+        if (all(q.get('files') for q in question_results.values()) and len(question_results) == total_cols
+                and not degraded_questions):
+            checkpoints.save_upload(upload_key, os.path.join(RESULTS_FOLDER, zip_filename),
+                                    {'output_mode': output_mode,
+                                     'questions': [question_results[idx] for idx in sorted(question_results)]})
         
-        tasks[task_id]['result_file'] = zip_filename
-        tasks[task_id]['progress'] = 100
-        tasks[task_id]['state'] = 'COMPLETED'
-        tasks[task_id]['status'] = 'Concluído com sucesso!'
+        job_usage = usage.summary(responses=response_table.total_responses)
+        print(f"[DEBUG] Tarefa {task_id}: uso do LLM {job_usage}", flush=True)
+        task_store.update(task_id, result_file=zip_filename, progress=100, state='COMPLETED',
+                          status='Concluído com sucesso!', usage=job_usage)
         
     except Exception as e:
         print(f"Erro fatal na tarefa {task_id}: {e}")
-        tasks[task_id]['state'] = 'ERROR'
-        tasks[task_id]['error'] = str(e)
+        if writer is not None:
+            writer.discard()
+        if archive is not None:
+            archive.close()
+        task_store.update(task_id, state='ERROR', error=str(e))
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+        shutil.rmtree(task_dir, ignore_errors=True)
+
+def stream_file(path, download_name):
+    """Envia o arquivo do disco com suporte a Range (downloads retomáveis) e validação por ETag"""
+    return send_file(path, as_attachment=True, download_name=download_name, conditional=True, etag=True, max_age=0)
 
 @app.route('/')
 def index():
@@ -156,7 +425,8 @@ def index():
 def upload_files():
     """Upload de arquivos completos"""
     if request.method == 'GET':
-        return render_template('upload.html')
+        return render_template('upload.html', max_upload_mb=MAX_UPLOAD_MB, output_mode=DEFAULT_OUTPUT_MODE,
+                               execution_mode=batch_submission.DEFAULT_EXECUTION_MODE)
     
     try:
         # Verifica se arquivos foram enviados
@@ -169,32 +439,44 @@ def upload_files():
         if banco_file.filename == '' or f17_file.filename == '':
             return jsonify({'success': False, 'error': 'Selecione os arquivos'})
         
-        # Salva arquivos
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        banco_path = os.path.join(UPLOAD_FOLDER, f"banco_{timestamp}_{secure_filename(banco_file.filename)}")
-        f17_path = os.path.join(UPLOAD_FOLDER, f"f17_{timestamp}_{secure_filename(f17_file.filename)}")
+        if os.path.splitext(banco_file.filename)[1].lower() not in SUPPORTED_EXTENSIONS:
+            return jsonify({'success': False, 'error': f"Formato de banco não suportado. Use {', '.join(SUPPORTED_EXTENSIONS)}"})
         
-        banco_file.save(banco_path)
-        f17_file.save(f17_path)
+        output_mode = request.form.get('output_mode', DEFAULT_OUTPUT_MODE)
+        if output_mode not in OUTPUT_MODES:
+            return jsonify({'success': False, 'error': f"Formato de saída inválido. Use {', '.join(OUTPUT_MODES)}"})
+        execution_mode = request.form.get('execution_mode', batch_submission.DEFAULT_EXECUTION_MODE)
+        if execution_mode not in batch_submission.EXECUTION_MODES:
+            return jsonify({'success': False,
+                            'error': f"Modo de execução inválido. Use {', '.join(batch_submission.EXECUTION_MODES)}"})
         
-        # Cria tarefa
+        # Salva arquivos (id da tarefa no nome: envios simultâneos não colidem)
         task_id = str(uuid.uuid4())
-        tasks[task_id] = {
-            'state': 'PENDING',
-            'status': 'Iniciando...',
-            'progress': 0,
-            'created_at': time.time()
-        }
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        banco_path = os.path.join(UPLOAD_FOLDER, f"banco_{timestamp}_{task_id[:8]}_{secure_filename(banco_file.filename)}")
+        f17_path = os.path.join(UPLOAD_FOLDER, f"f17_{timestamp}_{task_id[:8]}_{secure_filename(f17_file.filename)}")
         
-        # Inicia thread
-        thread = threading.Thread(target=process_batch_task, args=(task_id, banco_path, f17_path))
-        thread.daemon = True
-        thread.start()
+        save_upload(banco_file, banco_path)
+        save_upload(f17_file, f17_path)
+        
+        # Enfileira o job (executado pelo pool de workers do job_queue)
+        try:
+            job_queue.submit(task_store, task_id, 'batch',
+                             {'banco_path': banco_path, 'f17_path': f17_path, 'output_mode': output_mode,
+                              'execution_mode': execution_mode},
+                             status='Na fila...', progress=0, created_at=time.time())
+        except job_queue.QueueFullError as e:
+            os.remove(banco_path)
+            os.remove(f17_path)
+            response = jsonify({'success': False, 'error': str(e)})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(job_queue.QUEUE_RETRY_AFTER)
+            return response
         
         return jsonify({
             'success': True,
             'task_id': task_id,
-            'message': 'Processamento iniciado'
+            'message': 'Processamento na fila'
         })
         
     except Exception as e:
@@ -202,22 +484,164 @@ def upload_files():
 
 @app.route('/task_status/<task_id>')
 def task_status(task_id):
-    """Retorna status da tarefa"""
-    task = tasks.get(task_id)
+    """Retorna status da tarefa. Com ?since=N (número do último evento recebido) retorna só os
+    campos e questões que mudaram depois dele, com o novo 'seq' (fallback barato do /task_events)"""
+    since = request.args.get('since', type=int)
+    if since:
+        return jsonify(task_store.changes_since(task_id, since))
+    seq = task_store.last_event_seq(task_id)
+    task = task_store.get(task_id)
     if not task:
         return jsonify({'state': 'ERROR', 'error': 'Tarefa não encontrada'})
-    return jsonify(task)
+    return jsonify(dict(public_task(task), seq=seq))
+
+def public_task(task):
+    """Tarefa sem os campos internos (caminhos no servidor, argumentos do job)"""
+    return {key: value for key, value in task.items() if key not in PRIVATE_FIELDS}
+
+# Stream de eventos (SSE): intervalo de leitura dos eventos e duração máxima de cada conexão
+# (o navegador reconecta sozinho, continuando do último evento pelo Last-Event-ID)
+SSE_POLL_SECONDS = float(os.getenv('SSE_POLL_SECONDS', 1))
+SSE_MAX_SECONDS = int(os.getenv('SSE_MAX_SECONDS', 300))
+SSE_KEEPALIVE_SECONDS = 15
+
+def sse_message(kind, data, seq=None):
+    lines = [f"id: {seq}"] if seq is not None else []
+    lines += [f"event: {kind}", f"data: {json.dumps(data, default=str)}"]
+    return '\n'.join(lines) + '\n\n'
+
+@app.route('/task_events/<task_id>')
+def task_events(task_id):
+    """Progresso da tarefa em Server-Sent Events: 'snapshot' (tarefa completa, na primeira
+    conexão), 'progress', 'question' (questão concluída) e 'state' (mudança de estado/erro)"""
+    last_seq = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+    
+    def generate():
+        seq = last_seq
+        yield f"retry: {int(SSE_POLL_SECONDS * 2000)}\n\n"
+        task = task_store.get(task_id)
+        if task is None:
+            yield sse_message('state', {'state': 'ERROR', 'error': 'Tarefa não encontrada'})
+            return
+        if not seq:
+            # Primeira conexão: estado atual completo; os eventos seguintes são incrementais
+            seq = task_store.last_event_seq(task_id)
+            task = task_store.get(task_id)
+            yield sse_message('snapshot', public_task(task), seq)
+        if task['state'] in FINAL_STATES and not task_store.events_since(task_id, seq, limit=1):
+            return
+        
+        started = last_sent = time.time()
+        while time.time() - started < SSE_MAX_SECONDS:
+            for event in task_store.events_since(task_id, seq):
+                seq = event['seq']
+                last_sent = time.time()
+                yield sse_message(event['kind'], event['data'], seq)
+                if event['kind'] == 'state' and event['data'].get('state') in FINAL_STATES:
+                    return
+            if time.time() - last_sent >= SSE_KEEPALIVE_SECONDS:
+                last_sent = time.time()
+                yield ": keepalive\n\n"
+            time.sleep(SSE_POLL_SECONDS)
+    
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Desliga o buffer de proxies (nginx) para os eventos chegarem na hora
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/cancel_task/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    """Cancela a tarefa: pendente sai da fila; em andamento para após as questões em curso"""
+    state = task_store.request_cancel(task_id)
+    if state is None:
+        return jsonify({'success': False, 'error': 'Tarefa não encontrada'}), 404
+    return jsonify({'success': True, 'state': state})
+
+@app.route('/resume_task/<task_id>', methods=['POST'])
+def resume_task(task_id):
+    """Retoma tarefa interrompida ou cancelada: questões com checkpoint não são reprocessadas"""
+    try:
+        job_queue.resume(task_store, task_id, status='Na fila (retomada)...')
+    except job_queue.QueueFullError as e:
+        response = jsonify({'success': False, 'error': str(e)})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(job_queue.QUEUE_RETRY_AFTER)
+        return response
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+    return jsonify({'success': True, 'task_id': task_id, 'message': 'Processamento retomado'})
 
 @app.route('/download_batch/<task_id>')
 def download_batch(task_id):
-    """Download do resultado final"""
-    task = tasks.get(task_id)
-    if not task or task['state'] != 'COMPLETED':
+    """Download do resultado final (de tarefa cancelada: só as questões concluídas)"""
+    task = task_store.get(task_id)
+    if not task or task['state'] not in ('COMPLETED', 'CANCELLED') or not task.get('result_file'):
         flash('Arquivo não disponível', 'error')
         return redirect(url_for('index'))
         
     filename = task.get('result_file')
-    return send_file(os.path.join(RESULTS_FOLDER, filename), as_attachment=True)
+    return stream_file(os.path.join(RESULTS_FOLDER, filename), filename)
+
+def partial_question_files(task_id, idx):
+    """(nome, conteúdo) dos arquivos de uma questão concluída do lote, ou None se indisponível"""
+    task = task_store.get(task_id) or {}
+    artifact = next((a for a in task.get('artifacts', []) if a['index'] == idx), None)
+    if artifact is None:
+        return None
+    if task.get('output_mode') == 'per_question':
+        # Durante o lote: cópias parciais no diretório da tarefa; depois: o ZIP já fechado
+        if task.get('work_dir') and task.get('state') not in FINAL_STATES:
+            files = read_partial_entries(StreamingZipArchive.partial_dir_for(task['work_dir']), artifact['files'])
+            if files is not None:
+                return files
+        return read_zip_entries(os.path.join(RESULTS_FOLDER, task['result_file']), artifact['files'])
+    if task.get('state') in FINAL_STATES or not task.get('work_dir'):
+        return None
+    return render_spooled_question(task['work_dir'], idx, artifact['question'])
+
+@app.route('/download_partial/<task_id>')
+def download_partial(task_id):
+    """Download de resultados parciais de um lote em andamento
+    - sem parâmetros: ZIP com todas as questões concluídas até agora
+    - ?question=<índice>: ZIP de uma questão (com &file=<nome>, apenas aquele arquivo)"""
+    task = task_store.get(task_id)
+    if not task or not task.get('artifacts'):
+        flash('Arquivo não disponível', 'error')
+        return redirect(url_for('index'))
+    
+    question = request.args.get('question', type=int)
+    if question is None:
+        if task['state'] == 'COMPLETED':
+            return redirect(url_for('download_batch', task_id=task_id))
+        indices = [a['index'] for a in task.get('artifacts', [])]
+        
+        def entries():
+            for idx in indices:
+                yield from partial_question_files(task_id, idx) or []
+        
+        response = Response(iter_zip_stream(entries()), mimetype='application/zip')
+        response.headers.set('Content-Disposition', 'attachment', filename=f"resultado_parcial_{task_id}.zip")
+        return response
+    
+    files = partial_question_files(task_id, question)
+    if files is None:
+        flash('Questão ainda não concluída ou indisponível', 'error')
+        return redirect(url_for('index'))
+    
+    filename = request.args.get('file')
+    if filename:
+        content = dict(files).get(filename)
+        if content is None:
+            flash('Arquivo não encontrado', 'error')
+            return redirect(url_for('index'))
+        response = Response(content, mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers.set('Content-Disposition', 'attachment', filename=filename)
+        return response
+    
+    response = Response(iter_zip_stream(files), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f"resultado_questao_{question:03d}_{task_id}.zip")
+    return response
 
 @app.route('/questao_especifica', methods=['GET', 'POST'])
 def questao_especifica():
@@ -277,11 +701,13 @@ def questao_especifica():
             })
         print("[DEBUG] Chamando process_single_question_with_chatgpt", flush=True)
         try:
-            result = agent.process_single_question_with_chatgpt(
-                question_data, 
-                existing_codes,
-                question_name
-            )
+            # Requisição interativa: passa à frente das chamadas ao LLM dos lotes
+            with llm_gate.priority(llm_gate.INTERACTIVE):
+                result = agent.process_single_question_with_chatgpt(
+                    question_data, 
+                    existing_codes,
+                    question_name
+                )
             print("[DEBUG] Retornou do process_single_question_with_chatgpt", flush=True)
         except Exception as e_chatgpt:
             error_str = str(e_chatgpt)
@@ -332,7 +758,7 @@ def download_file(filename):
     try:
         file_path = os.path.join(RESULTS_FOLDER, filename)
         if os.path.exists(file_path):
-            return send_file(file_path, as_attachment=True)
+            return stream_file(file_path, filename)
         else:
             flash('Arquivo não encontrado', 'error')
             return redirect(url_for('index'))
@@ -345,6 +771,45 @@ def exemplo():
     """Página com exemplo de uso"""
     return render_template('exemplo.html')
 
+STARTED_AT = time.time()
+
+def process_memory_mb(pid='self'):
+    """Memória residente (RSS) de um processo em MB, via /proc (None fora do Linux ou se o processo sumiu)"""
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except (OSError, ValueError):
+        pass
+    return None
+
+@app.route('/metrics')
+def metrics():
+    """Métricas de operação em JSON: fila de jobs, vagas do llm_gate e memória dos processos
+    (usado pelo teste de carga em loadtest/load_generator.py)"""
+    counts = task_store.count_by_state()
+    gate = llm_gate.get_gate()
+    return jsonify({
+        'uptime_seconds': round(time.time() - STARTED_AT, 1),
+        'tasks': counts,
+        'queue_depth': counts.get('PENDING', 0),
+        'active_jobs': counts.get('PROCESSING', 0),
+        'max_active_jobs': job_queue.MAX_ACTIVE_JOBS,
+        'job_workers': job_queue.JOB_WORKERS,
+        'llm_gate': gate.snapshot() if gate is not None else None,
+        'memory_mb': {
+            'web': process_memory_mb(),
+            'workers': {str(pid): process_memory_mb(pid) for pid in job_queue.worker_pids()},
+        },
+        'threads': threading.active_count(),
+    })
+
+# Workers da fila de jobs embutidos no servidor (um pool por máquina); com
+# JOB_EMBEDDED_WORKERS=0 o pool roda à parte com 'python job_queue.py'
+if job_queue.JOB_EMBEDDED_WORKERS and not job_queue.in_worker():
+    job_queue.start_pool(task_store)
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     debug = os.environ.get('FLASK_ENV') != 'production'